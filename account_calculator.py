@@ -1,8 +1,11 @@
 import logging
 import json
+from datetime import datetime
 from app import db
 from models import StandardAccountBalance, AccountFormula, StandardAccount
-from sqlalchemy import func
+from formula_plan import FormulaPlan
+from utils import normalize_string
+from performance_enhancer import mark_cache_dirty
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
@@ -20,179 +23,131 @@ class AccountCalculator:
     """
     
     @staticmethod
-    def calculate_account_totals(ja_code, year, financial_statement="bs"):
+    def calculate_account_totals(ja_code, year, financial_statement="bs", plan=None, raise_errors=False):
         """
         指定されたJA、年度、財務諸表タイプに対して、計算式に基づいて勘定科目の合計値を計算する
+        残高を一括で読み込み、依存関係順に並べた計算式をメモリ上で評価してから、まとめて書き込む
         
         Args:
             ja_code: JA code
             year: Financial year
             financial_statement: Type of financial statement (bs, pl, cf)
+            plan: コンパイル済みのFormulaPlan（複数のJA・年度で使い回す場合に指定）
+            raise_errors: Trueの場合はロールバック後に例外を送出する（Falseの場合は0を返す）
             
         Returns:
             int: 計算した科目数
         """
         try:
-            # 計算式を取得（優先度順）
-            formulas = AccountFormula.query.filter_by(
-                financial_statement=financial_statement
-            ).order_by(
-                AccountFormula.priority.desc()
-            ).all()
+            # 計算式を依存関係順に並べる
+            if plan is None:
+                plan = FormulaPlan.compile(financial_statement)
             
-            if not formulas:
+            if not plan:
                 logger.info(f"No formulas found for {financial_statement}")
                 return 0
-                
-            processed_count = 0
-                
-            # 各計算式について処理
-            for formula in formulas:
-                logger.info(f"Processing formula: {formula.target_code} ({formula.target_name})")
-                
-                # 計算式のタイプに応じた処理
-                if formula.formula_type == "sum":
-                    # 科目の合計を計算
-                    total_value, total_prev_value = AccountCalculator._calculate_sum(
-                        ja_code, year, financial_statement, formula
-                    )
-                elif formula.formula_type == "diff":
-                    # 科目の差分を計算
-                    total_value, total_prev_value = AccountCalculator._calculate_diff(
-                        ja_code, year, financial_statement, formula
-                    )
-                else:
-                    logger.warning(f"Unsupported formula type: {formula.formula_type}")
-                    continue
-                
-                # カテゴリ（BS資産、BS負債など）を決定
-                statement_subtype = AccountCalculator._determine_statement_subtype(
-                    financial_statement, formula.target_code
+            
+            # 対象の残高を1回のクエリで読み込む
+            table = StandardAccountBalance.__table__
+            rows = db.session.execute(
+                db.select(table.c.id, table.c.standard_account_code, table.c.current_value, table.c.previous_value)
+                .where(
+                    table.c.ja_code == ja_code,
+                    table.c.year == year,
+                    table.c.statement_type == financial_statement
                 )
-                
-                # 既存の計算結果があれば更新、なければ新規作成
-                existing_balance = StandardAccountBalance.query.filter_by(
-                    ja_code=ja_code,
-                    year=year,
-                    statement_type=financial_statement,
-                    standard_account_code=formula.target_code
-                ).first()
-                
-                if existing_balance:
-                    # 既存レコードを更新
-                    existing_balance.current_value = total_value
-                    existing_balance.previous_value = total_prev_value
-                    logger.info(f"Updated balance: {formula.target_code}, current: {total_value}, previous: {total_prev_value}")
+                .order_by(table.c.id)
+            ).all()
+            
+            balances = {}
+            first_ids = {}
+            original_values = {}
+            for balance_id, code, current_value, previous_value in rows:
+                balances.setdefault(code, []).append([current_value, previous_value])
+                if code not in first_ids:
+                    first_ids[code] = balance_id
+                    original_values[code] = (current_value, previous_value)
+            
+            # 計算式を評価（結果は残高マップに反映され、後続の計算式から参照される）
+            results = plan.evaluate(balances)
+            
+            # 結果科目ごとに最終値をまとめる（同じ科目の結果は後の計算式で上書き）
+            final_values = {}
+            for formula, total_value, total_prev_value in results:
+                final_values[formula.target_code] = (formula, total_value, total_prev_value)
+            
+            updates = []
+            new_codes = []
+            for code, (formula, total_value, total_prev_value) in final_values.items():
+                if code in first_ids:
+                    if original_values[code] != (total_value, total_prev_value):
+                        updates.append({
+                            'balance_id': first_ids[code],
+                            'new_current_value': total_value,
+                            'new_previous_value': total_prev_value
+                        })
+                    logger.debug(f"Updated balance: {code}, current: {total_value}, previous: {total_prev_value}")
                 else:
-                    # 既存の標準勘定科目から名前を取得
-                    standard_account = StandardAccount.query.filter_by(
-                        code=formula.target_code,
-                        financial_statement=financial_statement
-                    ).first()
-                    
-                    account_name = standard_account.name if standard_account else formula.target_name
-                    
-                    # 新規レコードを作成
-                    new_balance = StandardAccountBalance(
-                        ja_code=ja_code,
-                        year=year,
-                        statement_type=financial_statement,
-                        statement_subtype=statement_subtype,
-                        standard_account_code=formula.target_code,
-                        standard_account_name=account_name,
-                        current_value=total_value,
-                        previous_value=total_prev_value
-                    )
-                    db.session.add(new_balance)
-                    logger.info(f"Created new balance: {formula.target_code}, current: {total_value}, previous: {total_prev_value}")
-                
-                processed_count += 1
+                    new_codes.append(code)
+            
+            if updates:
+                db.session.execute(
+                    table.update()
+                    .where(table.c.id == db.bindparam('balance_id'))
+                    .values(
+                        current_value=db.bindparam('new_current_value'),
+                        previous_value=db.bindparam('new_previous_value')
+                    ),
+                    updates
+                )
+            
+            if new_codes:
+                # 既存の標準勘定科目から名前を一括取得
+                account_names = dict(
+                    db.session.query(StandardAccount.code, StandardAccount.name)
+                    .filter(
+                        StandardAccount.code.in_(new_codes),
+                        StandardAccount.financial_statement == financial_statement
+                    ).all()
+                )
+                now = datetime.utcnow()
+                records = []
+                for code in new_codes:
+                    formula, total_value, total_prev_value = final_values[code]
+                    account_name = account_names.get(code) or formula.target_name
+                    records.append({
+                        'ja_code': ja_code,
+                        'year': year,
+                        'statement_type': financial_statement,
+                        'statement_subtype': normalize_string(
+                            AccountCalculator._determine_statement_subtype(financial_statement, code), for_db=True
+                        ),
+                        'standard_account_code': code,
+                        'standard_account_name': normalize_string(account_name, for_db=True),
+                        'current_value': total_value,
+                        'previous_value': total_prev_value,
+                        'created_at': now
+                    })
+                    logger.debug(f"Created new balance: {code}, current: {total_value}, previous: {total_prev_value}")
+                db.session.execute(table.insert(), records)
+            
+            if updates or new_codes:
+                mark_cache_dirty(db.session, ja_code, year)
             
             # 変更をコミット
             db.session.commit()
-            logger.info(f"Processed {processed_count} account formulas")
+            processed_count = len(results)
+            logger.info(f"Processed {processed_count} account formulas "
+                        f"(updated: {len(updates)}, created: {len(new_codes)})")
             return processed_count
             
         except Exception as e:
             db.session.rollback()
             logger.error(f"Error calculating account totals: {str(e)}")
+            if raise_errors:
+                raise
             return 0
     
-    @staticmethod
-    def _calculate_sum(ja_code, year, financial_statement, formula):
-        """科目の合計を計算"""
-        component_codes = formula.component_codes
-        
-        if not component_codes:
-            logger.warning(f"No component codes found for formula: {formula.target_code}")
-            return 0, 0
-            
-        # コンポーネント科目の値を取得
-        component_balances = StandardAccountBalance.query.filter(
-            StandardAccountBalance.ja_code == ja_code,
-            StandardAccountBalance.year == year,
-            StandardAccountBalance.statement_type == financial_statement,
-            StandardAccountBalance.standard_account_code.in_(component_codes)
-        ).all()
-        
-        # 合計を計算
-        total_value = sum(balance.current_value for balance in component_balances if balance.current_value is not None)
-        total_prev_value = sum(balance.previous_value for balance in component_balances if balance.previous_value is not None)
-        
-        # 詳細をログに記録
-        for balance in component_balances:
-            logger.debug(f"Component: {balance.standard_account_code} ({balance.standard_account_name}), current: {balance.current_value}, previous: {balance.previous_value}")
-        
-        logger.info(f"Sum calculation result: {total_value} (prev: {total_prev_value})")
-        return total_value, total_prev_value
-    
-    @staticmethod
-    def _calculate_diff(ja_code, year, financial_statement, formula):
-        """科目の差分を計算（最初の科目から残りを引く）"""
-        component_codes = formula.component_codes
-        
-        if not component_codes or len(component_codes) < 2:
-            logger.warning(f"Insufficient component codes for diff formula: {formula.target_code}")
-            return 0, 0
-            
-        # コンポーネント科目の値を取得（順序を保持）
-        component_balances = {}
-        for code in component_codes:
-            balance = StandardAccountBalance.query.filter_by(
-                ja_code=ja_code,
-                year=year,
-                statement_type=financial_statement,
-                standard_account_code=code
-            ).first()
-            
-            if balance:
-                component_balances[code] = balance
-        
-        # 差分を計算（最初の要素から他の要素を引く）
-        if not component_balances:
-            return 0, 0
-            
-        first_code = component_codes[0]
-        first_balance = component_balances.get(first_code)
-        
-        if not first_balance:
-            return 0, 0
-            
-        total_value = first_balance.current_value if first_balance.current_value is not None else 0
-        total_prev_value = first_balance.previous_value if first_balance.previous_value is not None else 0
-        
-        # 最初の要素以外の要素を引く
-        for code in component_codes[1:]:
-            balance = component_balances.get(code)
-            if balance:
-                if balance.current_value is not None:
-                    total_value -= balance.current_value
-                if balance.previous_value is not None:
-                    total_prev_value -= balance.previous_value
-        
-        logger.info(f"Diff calculation result: {total_value} (prev: {total_prev_value})")
-        return total_value, total_prev_value
-    
     @staticmethod
     def _determine_statement_subtype(financial_statement, account_code):
         """
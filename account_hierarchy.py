@@ -0,0 +1,155 @@
+"""
+標準勘定科目の親子関係インデックス
+standard_accountテーブルから一度だけ構築し、プロセス内で共有する読み取り専用の索引
+"""
+
+import time
+import logging
+import threading
+from types import MappingProxyType
+from app import db
+from models import StandardAccount
+from account_name_index import STANDARD_ACCOUNTS_TAG, invalidate_account_name_index
+from performance_enhancer import query_cache
+
+logger = logging.getLogger(__name__)
+
+# デフォルトの親子関係定義（データベースに子科目が登録されていない親科目の互換性用）
+DEFAULT_PARENT_CODES = {
+    # BSの親勘定科目
+    "1": ["1010", "1020", "1100", "1200", "1300", "1400", "1500"],  # 流動資産
+    "11000": ["1010", "1020"],  # 現金預け金（1010:現金, 1020:預け金）
+    "1600": ["1610", "1620", "1630", "1640", "1650", "1660"],  # 有価証券
+    "1700": ["1710", "1720", "1730", "1740"],  # 貸出金
+    "1800": ["1810", "1820", "1830", "1840"],  # 外国為替
+    "1900": ["1910", "1920", "1930", "1940", "1950", "1960", "1970", "1980", "1990", "1995"],  # その他資産
+    "2000": ["2010", "2020", "2030", "2040", "2050"],  # 有形固定資産
+    "2100": ["2110", "2120", "2130", "2140"],  # 無形固定資産
+    "21000": ["3000", "3100", "3200", "3300", "3400", "3500"],  # 流動負債
+    "3000": ["3010", "3020", "3030", "3040", "3050", "3060", "3070"],  # 預金
+    "3600": ["3610", "3620"],  # 借用金
+    "3700": ["3710", "3720", "3730", "3740"],  # 外国為替
+    "3900": ["3910", "3920", "3930", "3940", "3950", "3960", "3970", "3980", "3990"],  # その他負債
+    "4700": ["4710", "4720", "4730"],  # 貸倒引当金
+    "5100": ["5110", "5120"],  # 資本剰余金
+    "5200": ["5210", "5220"],  # 利益剰余金
+    "6900": ["6910", "6920", "6930", "6940", "6950", "6960", "6970", "6980"],  # 経常収益
+    "6100": ["6110", "6120"],  # 役務取引等収益
+    "6200": ["6210", "6220", "6230", "6240", "6250", "6260"],  # その他業務収益
+    "6300": ["6310", "6320", "6330", "6340", "6350"],  # その他経常収益
+    "7900": ["7910", "7920", "7930", "7940", "7950", "7960", "7970", "7980", "7990", "7995"],  # 経常費用
+    "7100": ["7110", "7120"],  # 役務取引等費用
+    "7200": ["7210", "7220", "7230", "7240", "7250", "7260", "7270"],  # その他業務費用
+    "7300": ["7310", "7320", "7330"],  # 営業経費
+    "7400": ["7410", "7420", "7430", "7440", "7450", "7460"],  # その他経常費用
+    "8000": ["8010", "8020", "8030"],  # 特別利益
+    "8100": ["8110", "8120", "8130"],  # 特別損失
+}
+
+
+class AccountHierarchy:
+    """
+    標準勘定科目の親子関係を保持する読み取り専用のインデックス
+
+    - names: 科目コード → 科目名
+    - children: 科目コード → 直下の子科目コード（データベースの parent_code による）
+    - default_children: データベースに子科目が無い親科目のデフォルト定義
+    - parents: 科目コード → 集計先の親科目コード（データベースとデフォルト定義の両方）
+    """
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows: (code, name, parent_code) のタプルのリスト（id順）
+        """
+        names = {}
+        children = {}
+        for code, name, parent_code in rows:
+            names.setdefault(code, name)
+            if parent_code:
+                children.setdefault(parent_code, []).append(code)
+
+        self._names = MappingProxyType(names)
+        self._children = MappingProxyType({code: tuple(codes) for code, codes in children.items()})
+        self._default_children = MappingProxyType({
+            code: tuple(codes) for code, codes in DEFAULT_PARENT_CODES.items()
+        })
+
+        parents = {}
+        for mapping in (self._children, self._default_children):
+            for parent_code, child_codes in mapping.items():
+                for child in child_codes:
+                    parents.setdefault(child, [])
+                    if parent_code not in parents[child]:
+                        parents[child].append(parent_code)
+        self._parents = MappingProxyType({code: tuple(codes) for code, codes in parents.items()})
+
+    @classmethod
+    def build(cls):
+        """standard_accountテーブルから1回のクエリでインデックスを構築する"""
+        # 読み込み中に他のプロセスで変更された場合も再構築されるよう、読み込み前の時刻を記録する
+        built_at = time.time()
+        rows = db.session.query(
+            StandardAccount.code,
+            StandardAccount.name,
+            StandardAccount.parent_code
+        ).order_by(StandardAccount.id).all()
+        hierarchy = cls(rows)
+        hierarchy.built_at = built_at
+        logger.info(f"標準勘定科目インデックスを構築しました: 科目={len(hierarchy._names)}件, 親科目={len(hierarchy._children)}件")
+        return hierarchy
+
+    def name(self, code):
+        """科目名を返す（未登録の場合はNone）"""
+        return self._names.get(code)
+
+    def children(self, code):
+        """直下の子科目コードを返す"""
+        return self._children.get(code, ())
+
+    def default_children(self, code):
+        """デフォルト定義による子科目コードを返す"""
+        return self._default_children.get(code, ())
+
+    def ancestors(self, code):
+        """残高が集計される全ての親科目コードを返す（get_account_valueで値が変わり得る科目）"""
+        found = []
+        stack = list(self._parents.get(code, ()))
+        while stack:
+            parent_code = stack.pop()
+            if parent_code in found or parent_code == code:
+                continue
+            found.append(parent_code)
+            stack.extend(self._parents.get(parent_code, ()))
+        return tuple(found)
+
+
+_hierarchy = None
+_hierarchy_lock = threading.Lock()
+
+
+def get_account_hierarchy():
+    """
+    プロセス内で共有する標準勘定科目インデックスを返す
+    初回呼び出し時、または invalidate_account_hierarchy() の後（他のプロセスでの呼び出しを含む）に一度だけ構築する
+    """
+    global _hierarchy
+    hierarchy = _hierarchy
+    if hierarchy is None or query_cache.notified_since(STANDARD_ACCOUNTS_TAG, hierarchy.built_at):
+        with _hierarchy_lock:
+            if _hierarchy is None or _hierarchy is hierarchy:
+                _hierarchy = AccountHierarchy.build()
+            hierarchy = _hierarchy
+    return hierarchy
+
+
+def invalidate_account_hierarchy():
+    """
+    標準勘定科目の追加・更新・インポート後に呼び出し、インデックスを破棄する（科目名インデックスも破棄する）
+    他のプロセスには科目名インデックスの破棄と同じ通知（QUERY_CACHE_DIR）で伝わる
+    """
+    global _hierarchy
+    with _hierarchy_lock:
+        _hierarchy = None
+    invalidate_account_name_index()
+    logger.info("標準勘定科目インデックスを破棄しました")
@@ -0,0 +1,274 @@
+"""
+標準勘定科目名の検索インデックス（文字列類似度によるマッピング用）
+財務諸表タイプごとに standard_account テーブルから一度だけ構築し、プロセス内で共有する。
+
+正規化した科目名と、文字 n-gram（2-gram・3-gram）の転置インデックスを保持し、
+n-gram と文字の転置インデックスで上位 k 件の候補に絞り込んでから類似度を計算する。
+"""
+
+import re
+import time
+import heapq
+import logging
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from types import MappingProxyType
+from app import db
+from models import StandardAccount
+from performance_enhancer import query_cache
+
+logger = logging.getLogger(__name__)
+
+# 標準勘定科目の変更を他のプロセスに通知するタグ（科目名インデックスと親子関係インデックスで共有）
+STANDARD_ACCOUNTS_TAG = 'standard_accounts'
+
+# インデックスに使用する n-gram の長さ
+NGRAM_SIZES = (2, 3)
+
+# 類似度を計算する候補の数
+SIMILARITY_TOP_K = 20
+
+
+def normalize_for_similarity(name):
+    """
+    文字列類似度の計算用に勘定科目名を正規化する（空白、全角/半角、カッコなどを処理）
+    参照マッピング・完全一致に使用する utils.normalize_account_name とは異なり、カッコ内の文字も残す
+
+    Args:
+        name: 勘定科目名
+
+    Returns:
+        str: 正規化された勘定科目名
+    """
+    try:
+        if not name:
+            return ""
+
+        # バイト列の場合はデコード
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', errors='ignore')
+        elif not isinstance(name, str):
+            name = str(name)
+
+        # 全角を半角に変換
+        name = unicodedata.normalize('NFKC', name)
+
+        # 空白、括弧、記号を削除
+        name = re.sub(r'[\s\(\)\[\]\{\}\.,。、・･：:「」『』【】"\']+', '', name)
+
+        # 「預金」を「貯金」に読み替え（負債側の預金を貯金として標準勘定科目とマッピングするため）
+        return name.replace('預金', '貯金')
+    except Exception as e:
+        logger.error(f"勘定科目名の正規化中にエラーが発生しました: {str(e)}")
+        return name if name else ""
+
+
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    """
+    文字 n-gram の集合を返す（最短の n より短い文字列はその文字列自体）
+
+    Args:
+        text: 文字列
+        sizes: n-gram の長さ
+
+    Returns:
+        frozenset: n-gram の集合
+    """
+    if len(text) < min(sizes):
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[i:i + n] for n in sizes for i in range(len(text) - n + 1))
+
+
+def name_similarity(a, b, b_chars=None):
+    """
+    正規化した科目名どうしの類似度（一致 1.0、部分一致 0.8、それ以外は共通する文字の割合）
+
+    Args:
+        a: 正規化した科目名（小文字）
+        b: 正規化した標準勘定科目名（小文字）
+        b_chars: b の文字の集合（事前に計算した場合）
+
+    Returns:
+        float: 類似度（0〜1）
+    """
+    if a == b:
+        return 1.0
+    if a in b or b in a:
+        return 0.8
+    if b_chars is None:
+        b_chars = set(b)
+    common = sum(1 for c in a if c in b_chars)
+    return common / max(len(a), len(b))
+
+
+class AccountNameIndex:
+    """
+    1つの財務諸表タイプの標準勘定科目名の読み取り専用インデックス
+
+    - accounts: (科目コード, 科目名) のタプル（id順）
+    - by_name / by_normalized: 科目名・正規化した科目名 → 最初の科目の位置
+    - postings / char_postings: n-gram・文字 → それを含む科目の位置（転置インデックス）
+    """
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows: (code, name) のタプルのリスト（id順）
+        """
+        self.accounts = tuple((code, name) for code, name in rows)
+        by_name = {}
+        by_normalized = {}
+        normalized = []
+        postings = defaultdict(list)
+        char_postings = defaultdict(list)
+        gram_counts = []
+        for position, (code, name) in enumerate(self.accounts):
+            by_name.setdefault(name, position)
+            norm = normalize_for_similarity(name)
+            by_normalized.setdefault(norm, position)
+            lower = norm.lower()
+            normalized.append((lower, frozenset(lower)))
+            grams = char_ngrams(lower)
+            gram_counts.append(len(grams))
+            for gram in grams:
+                postings[gram].append(position)
+            for char in set(lower):
+                char_postings[char].append(position)
+
+        self._by_name = MappingProxyType(by_name)
+        self._by_normalized = MappingProxyType(by_normalized)
+        self._normalized = tuple(normalized)
+        self._gram_counts = tuple(gram_counts)
+        self._lengths = tuple(len(name) for name, _ in normalized)
+        self._postings = MappingProxyType({gram: tuple(positions) for gram, positions in postings.items()})
+        self._char_postings = MappingProxyType({char: tuple(positions) for char, positions in char_postings.items()})
+
+    @classmethod
+    def build(cls, financial_statement):
+        """standard_accountテーブルから1回のクエリでインデックスを構築する"""
+        # 読み込み中に他のプロセスで変更された場合も再構築されるよう、読み込み前の時刻を記録する
+        built_at = time.time()
+        rows = db.session.query(
+            StandardAccount.code,
+            StandardAccount.name
+        ).filter(
+            StandardAccount.financial_statement == financial_statement
+        ).order_by(StandardAccount.id).all()
+        index = cls(rows)
+        index.built_at = built_at
+        logger.info(f"標準勘定科目名インデックスを構築しました: {financial_statement}, 科目={len(index.accounts)}件, "
+                    f"n-gram={len(index._postings)}件")
+        return index
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def exact(self, name):
+        """科目名が完全に一致する標準勘定科目（code, name）を返す（無い場合はNone）"""
+        position = self._by_name.get(name)
+        return self.accounts[position] if position is not None else None
+
+    def normalized_match(self, normalized_name):
+        """正規化した科目名が一致する標準勘定科目（code, name）を返す（無い場合はNone）"""
+        position = self._by_normalized.get(normalized_name)
+        return self.accounts[position] if position is not None else None
+
+    def candidates(self, normalized_name, k=SIMILARITY_TOP_K):
+        """
+        類似度が高くなり得る上位 k 件ずつの科目の位置を返す
+
+        - n-gram: 一方の科目名がもう一方に含まれる場合を優先するため、重なり係数（共通数 / 小さい方の n-gram 数）の順
+        - 文字: 共通する文字の割合（name_similarity の部分一致以外の場合の値）の順
+        同点の場合はid順で並べる。
+
+        Args:
+            normalized_name: 正規化した科目名
+            k: それぞれの順位で選ぶ候補の数
+
+        Returns:
+            list: 科目の位置のリスト（重複なし）
+        """
+        query = normalized_name.lower()
+        if not query:
+            return []
+
+        grams = char_ngrams(query)
+        gram_counts = self._gram_counts
+        # n-gram より短い科目名は、その文字を含む全ての科目が部分一致になる
+        postings = self._postings if len(query) >= min(NGRAM_SIZES) else self._char_postings
+        scored = ((overlap / min(len(grams), gram_counts[position]), -position)
+                  for position, overlap in self._overlap(grams, postings).items())
+        positions = [-position for _, position in heapq.nlargest(k, scored)]
+
+        lengths = self._lengths
+        common = defaultdict(int)
+        for char, occurrences in Counter(query).items():
+            for position in self._char_postings.get(char, ()):
+                common[position] += occurrences
+        scored = ((count / max(len(query), lengths[position]), -position)
+                  for position, count in common.items())
+        for _, position in heapq.nlargest(k, scored):
+            if -position not in positions:
+                positions.append(-position)
+        return positions
+
+    @staticmethod
+    def _overlap(grams, postings):
+        counts = defaultdict(int)
+        for gram in grams:
+            for position in postings.get(gram, ()):
+                counts[position] += 1
+        return counts
+
+    def best_match(self, normalized_name, k=SIMILARITY_TOP_K):
+        """
+        類似度が最も高い標準勘定科目を返す（候補は candidates で絞り込む）
+
+        Args:
+            normalized_name: 正規化した科目名
+            k: 類似度を計算する候補の数
+
+        Returns:
+            tuple: ((code, name), 類似度)（候補が無い場合は (None, 0.0)）
+        """
+        query = normalized_name.lower()
+        best_position = None
+        best_similarity = 0.0
+        for position in self.candidates(normalized_name, k):
+            std_name, std_chars = self._normalized[position]
+            sim = name_similarity(query, std_name, std_chars)
+            # 同点の場合はid順で先の科目を優先する
+            if sim > best_similarity or (sim == best_similarity and best_position is not None and position < best_position):
+                best_similarity = sim
+                best_position = position
+        if best_position is None:
+            return None, 0.0
+        return self.accounts[best_position], best_similarity
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_account_name_index(financial_statement):
+    """
+    プロセス内で共有する財務諸表タイプの標準勘定科目名インデックスを返す
+    初回呼び出し時、または invalidate_account_name_index() の後（他のプロセスでの呼び出しを含む）に一度だけ構築する
+    """
+    index = _indexes.get(financial_statement)
+    if index is None or query_cache.notified_since(STANDARD_ACCOUNTS_TAG, index.built_at):
+        with _indexes_lock:
+            current = _indexes.get(financial_statement)
+            if current is None or current is index:
+                current = AccountNameIndex.build(financial_statement)
+                _indexes[financial_statement] = current
+            index = current
+    return index
+
+
+def invalidate_account_name_index():
+    """標準勘定科目の追加・更新・インポート後に呼び出し、インデックスを破棄する（QUERY_CACHE_DIR により他のプロセスにも通知する）"""
+    with _indexes_lock:
+        _indexes.clear()
+    query_cache.notify(STANDARD_ACCOUNTS_TAG)
@@ -1,10 +1,10 @@
 import os
 import json
 import logging
-import re
-import unicodedata
 import time
 import traceback
+from datetime import datetime
+from types import SimpleNamespace
 import psycopg2
 import psycopg2.extras
 
@@ -102,11 +102,44 @@ except ImportError:
     HAS_OPENAI = False
     
 from app import db
-from models import StandardAccount, AccountMapping, CSVData
-from utils import normalize_string
+from models import StandardAccount, AccountMapping, CSVData, bump_balance_generation, upsert_rows, refresh_mapping_knowledge
+from utils import normalize_string, normalize_account_name
+from llm_dispatcher import get_dispatcher, backoff_delay
+from account_name_index import get_account_name_index, normalize_for_similarity
+import llm_mapping_cache
 
 logger = logging.getLogger(__name__)
 
+# 1回のリクエストでマッピングする勘定科目の最大数（map_accounts）
+MAPPING_PROMPT_BATCH_SIZE = 20
+
+# プロンプトやルールを変更した場合に上げる（AIマッピングのキャッシュを使わなくなる）
+MAPPING_PROMPT_VERSION = 1
+
+# ai_map_accounts でOpenAI APIを使用するか（既定は文字列類似度のみ）
+AI_MAPPING_USE_LLM = os.environ.get("AI_MAPPING_USE_LLM", "").lower() in ("1", "true", "yes", "on")
+
+STATEMENT_TYPE_DESCRIPTIONS = {
+    "bs": "Balance Sheet (貸借対照表)",
+    "pl": "Profit and Loss Statement (損益計算書)",
+    "cf": "Cash Flow Statement (キャッシュフロー計算書)"
+}
+
+JA_MAPPING_RULES = """Special mapping rules for JA accounting:
+1. 「外部出資」(external investment) and similar investment accounts (系統出資, 農林中出資, etc.) should be mapped to "外部出資" with code 1962, NOT to equity accounts (資本金)
+2. For accounts related to deposits or savings (預金 or 貯金), always map to deposit account codes (1110-1170)
+3. Always follow the principle of conservative accounting, especially for assets and liabilities
+4. JA-specific accounts should be mapped to their most similar standard account based on nature and purpose, not just name"""
+
+# 貯金→預金の読み替え（標準勘定科目の名称に合わせる）
+DEPOSIT_ACCOUNT_NAMES = {
+    "貯金": "預金",
+    "普通貯金": "普通預金",
+    "当座貯金": "当座預金",
+    "通知貯金": "通知預金",
+    "定期貯金": "定期預金"
+}
+
 class AIAccountMapper:
     """
     Class for AI-assisted account mapping using OpenAI API
@@ -115,7 +148,6 @@ class AIAccountMapper:
     def _normalize_account_name(self, name):
         """
         勘定科目名を正規化する（空白、全角/半角、カッコなどを処理）
-        エンコーディング問題に対処するための追加処理を含む
         
         Args:
             name: 勘定科目名
@@ -123,37 +155,7 @@ class AIAccountMapper:
         Returns:
             str: 正規化された勘定科目名
         """
-        try:
-            if not name:
-                return ""
-                
-            # 文字列であることを確認
-            if not isinstance(name, str):
-                name = str(name)
-                
-            # エンコーディングを明示的に処理（UTF-8に変換）
-            try:
-                # バイト列の場合はデコード
-                if isinstance(name, bytes):
-                    name = name.decode('utf-8', errors='ignore')
-            except (UnicodeError, AttributeError):
-                pass
-                
-            # 全角を半角に変換
-            name = unicodedata.normalize('NFKC', name)
-            
-            # 空白、括弧、記号を削除
-            name = re.sub(r'[\s\(\)\[\]\{\}\.,。、・･：:「」『』【】"\']+', '', name)
-            
-            # 「預金」を「貯金」に読み替え（負債側の預金を貯金として標準勘定科目とマッピングするため）
-            name = name.replace('預金', '貯金')
-            name = name.replace('普通預金', '普通貯金')
-            
-            return name
-        except Exception as e:
-            logger.error(f"勘定科目名の正規化中にエラーが発生しました: {str(e)}")
-            # エラーが発生した場合は元の文字列を返す（または空文字）
-            return name if name else ""
+        return normalize_for_similarity(name)
     
     def __init__(self):
         """Initialize with OpenAI or Azure OpenAI API settings from environment"""
@@ -166,6 +168,8 @@ class AIAccountMapper:
         # クライアント初期化
         self.client = None
         self.use_azure = False
+        # リクエストの並列実行・送信レート制限・リトライ（プロセス全体で共有）
+        self.dispatcher = get_dispatcher()
         
         # OpenAIモジュールのチェック
         if not HAS_OPENAI:
@@ -182,7 +186,8 @@ class AIAccountMapper:
                     api_version="2024-02-15-preview",
                     azure_endpoint=self.azure_endpoint,
                     timeout=60.0,
-                    max_retries=3
+                    # リトライは LLMDispatcher（map_account は自身のループ）で行う
+                    max_retries=0
                 )
                 self.use_azure = True
                 # デプロイメント名を使用
@@ -208,6 +213,8 @@ class AIAccountMapper:
                     from openai import OpenAI
                     self.client = OpenAI(
                         api_key=self.openai_api_key,
+                        # リトライは LLMDispatcher（map_account は自身のループ）で行う
+                        max_retries=0
                     )
                     # The newest OpenAI model is "gpt-4o" which was released May 13, 2024.
                     self.model = "gpt-4o"
@@ -343,6 +350,14 @@ class AIAccountMapper:
             return None
     
     
+    @staticmethod
+    def _standard_accounts_text(standard_accounts):
+        """標準勘定科目の一覧をプロンプト用のテキストにする"""
+        accounts_text = ""
+        for account in standard_accounts:
+            accounts_text += f"- Code: {account.code}, Name: {account.name}, Type: {account.account_type}\n"
+        return accounts_text
+    
     def generate_mapping_prompt(self, account_name, financial_statement, standard_accounts):
         """
         Generate a prompt for the OpenAI API to map an account
@@ -356,16 +371,10 @@ class AIAccountMapper:
             str: Formatted prompt
         """
         # Create a formatted list of standard accounts
-        accounts_text = ""
-        for account in standard_accounts:
-            accounts_text += f"- Code: {account.code}, Name: {account.name}, Type: {account.account_type}\n"
+        accounts_text = self._standard_accounts_text(standard_accounts)
         
         # Create statement type description
-        statement_type_desc = {
-            "bs": "Balance Sheet (貸借対照表)",
-            "pl": "Profit and Loss Statement (損益計算書)",
-            "cf": "Cash Flow Statement (キャッシュフロー計算書)"
-        }.get(financial_statement, "Unknown statement type")
+        statement_type_desc = STATEMENT_TYPE_DESCRIPTIONS.get(financial_statement, "Unknown statement type")
         
         # Build the prompt
         prompt = f"""
@@ -378,11 +387,7 @@ Financial statement type: {statement_type_desc}
 Available standard accounts:
 {accounts_text}
 
-Special mapping rules for JA accounting:
-1. 「外部出資」(external investment) and similar investment accounts (系統出資, 農林中出資, etc.) should be mapped to "外部出資" with code 1962, NOT to equity accounts (資本金)
-2. For accounts related to deposits or savings (預金 or 貯金), always map to deposit account codes (1110-1170)
-3. Always follow the principle of conservative accounting, especially for assets and liabilities
-4. JA-specific accounts should be mapped to their most similar standard account based on nature and purpose, not just name
+{JA_MAPPING_RULES}
 
 Please respond in JSON format with the following fields:
 - standard_account_code: The code of the matching standard account
@@ -407,16 +412,14 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
         try:
             logger.info(f"Performing string similarity mapping for {account_name} ({financial_statement})")
             
-            # 標準勘定科目を取得（より安全な方法で）
+            # 標準勘定科目名のインデックスを取得（財務諸表タイプごとに一度だけ構築）
             try:
-                standard_accounts = db.session.query(StandardAccount).filter(
-                    StandardAccount.financial_statement == financial_statement
-                ).all()
+                index = get_account_name_index(financial_statement)
             except Exception as e:
                 logger.error(f"標準勘定科目の取得中にエラーが発生しました: {str(e)}")
-                standard_accounts = []
+                index = None
             
-            if not standard_accounts:
+            if not index:
                 return {
                     "standard_account_code": "UNKNOWN",
                     "standard_account_name": "Unknown",
@@ -425,17 +428,7 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                 }
             
             # 貯金→預金の変換を試みる
-            mapped_account_name = account_name
-            deposit_accounts = {
-                "貯金": "預金",
-                "普通貯金": "普通預金",
-                "当座貯金": "当座預金",
-                "通知貯金": "通知預金",
-                "定期貯金": "定期預金"
-            }
-            
-            # 貯金/預金の変換を試みる
-            for deposit_key, deposit_value in deposit_accounts.items():
+            for deposit_key, deposit_value in DEPOSIT_ACCOUNT_NAMES.items():
                 if deposit_key in account_name:
                     mapped_account_name = account_name.replace(deposit_key, deposit_value)
                     logger.info(f"Account name converted: {account_name} -> {mapped_account_name}")
@@ -443,77 +436,37 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                     break
                     
             # 完全一致の確認
-            for std_account in standard_accounts:
-                if std_account.name == account_name:
-                    logger.info(f"Found exact match: {account_name} -> {std_account.code} ({std_account.name})")
-                    return {
-                        "standard_account_code": std_account.code,
-                        "standard_account_name": std_account.name,
-                        "confidence": 1.0,
-                        "rationale": "完全一致"
-                    }
+            match = index.exact(account_name)
+            if match:
+                logger.info(f"Found exact match: {account_name} -> {match[0]} ({match[1]})")
+                return {
+                    "standard_account_code": match[0],
+                    "standard_account_name": match[1],
+                    "confidence": 1.0,
+                    "rationale": "完全一致"
+                }
             
             # 正規化した名前で一致を確認
             normalized_name = self._normalize_account_name(account_name)
-            for std_account in standard_accounts:
-                std_normalized = self._normalize_account_name(std_account.name)
-                if std_normalized == normalized_name:
-                    logger.info(f"Found normalized match: {account_name} -> {std_account.code} ({std_account.name})")
-                    return {
-                        "standard_account_code": std_account.code,
-                        "standard_account_name": std_account.name,
-                        "confidence": 0.9,
-                        "rationale": "正規化後に一致"
-                    }
+            match = index.normalized_match(normalized_name)
+            if match:
+                logger.info(f"Found normalized match: {account_name} -> {match[0]} ({match[1]})")
+                return {
+                    "standard_account_code": match[0],
+                    "standard_account_name": match[1],
+                    "confidence": 0.9,
+                    "rationale": "正規化後に一致"
+                }
             
-            # 類似度を計算する関数
-            def similarity(a, b):
-                a_lower = a.lower()
-                b_lower = b.lower()
-                if a_lower == b_lower:
-                    return 1.0
-                if a_lower in b_lower or b_lower in a_lower:
-                    return 0.8
-                common = sum(1 for c in a_lower if c in b_lower)
-                return common / max(len(a_lower), len(b_lower))
-            
-            # 最も類似度の高い標準勘定科目を探す
-            best_match = None
-            best_similarity = 0.0
-            
-            # 科目名を分解してキーワードで部分一致をより強化
-            account_keywords = set(normalized_name.split())
-            
-            for std_account in standard_accounts:
-                std_name = self._normalize_account_name(std_account.name)
-                
-                # 部分一致チェックを強化（キーワードの一部が含まれるかも確認）
-                std_keywords = set(std_name.split())
-                keyword_match = account_keywords.intersection(std_keywords)
-                
-                # 基本類似度を計算
-                base_sim = similarity(normalized_name, std_name)
-                
-                # キーワード一致ボーナス（キーワードが一致するとボーナスを加算）
-                keyword_bonus = len(keyword_match) * 0.1
-                
-                # 最終的な類似度 = 基本類似度 + キーワードボーナス（最大1.0）
-                sim = min(1.0, base_sim + keyword_bonus)
-                
-                if sim > best_similarity:
-                    best_similarity = sim
-                    best_match = std_account
-                    
-                # ログ出力（デバッグ用）
-                if sim >= 0.3:
-                    logger.debug(f"類似度計算: {account_name} vs {std_name} = {sim:.2f} (base: {base_sim:.2f}, キーワード: {keyword_match})")
+            # n-gram の転置インデックスで絞り込んだ候補から最も類似度の高い標準勘定科目を探す
+            best_match, best_similarity = index.best_match(normalized_name)
             
             # 類似度が0.3以上あれば結果を返す（より寛容な閾値）
             if best_match and best_similarity >= 0.3:
-                logger.info(f"Found similarity match: {account_name} -> {best_match.code} ({best_match.name}) with similarity {best_similarity:.2f}")
+                logger.info(f"Found similarity match: {account_name} -> {best_match[0]} ({best_match[1]}) with similarity {best_similarity:.2f}")
                 return {
-                    "standard_account_code": best_match.code,
-                    "standard_account_name": best_match.name,
+                    "standard_account_code": best_match[0],
+                    "standard_account_name": best_match[1],
                     "confidence": best_similarity,
                     "rationale": f"文字列類似度に基づくマッピング (類似度: {best_similarity:.2f})"
                 }
@@ -633,6 +586,14 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                     "rationale": f"No standard accounts found for {financial_statement}"
                 }
             
+            # 以前にAPIでマッピングした勘定科目はキャッシュの結果を返す
+            cache_account_name = account_name
+            catalog = self.mapping_catalog_hash(standard_accounts)
+            cached = llm_mapping_cache.lookup(financial_statement, [cache_account_name], catalog, self.model)
+            if cache_account_name in cached:
+                logger.debug(f"AIマッピングのキャッシュを使用します: {cache_account_name}")
+                return cached[cache_account_name]
+            
             # 貯金→預金の変換を試みる
             mapped_account_name = account_name
             deposit_accounts = {
@@ -669,10 +630,13 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
 
             # 3回までリトライする
             max_retries = 3
-            retry_delay = 2  # seconds
+            from_api = False
             
             for attempt in range(max_retries):
                 try:
+                    # 並列のリクエストと合わせて送信レートを制限する
+                    self.dispatcher.limiter.acquire()
+                    
                     # API呼び出しパラメータを準備（型付きメッセージを使用）
                     from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam
                     
@@ -703,6 +667,7 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                         logger.debug(f"API response content: {result_text}")
                         try:
                             result = json.loads(result_text)
+                            from_api = True
                         except json.JSONDecodeError as json_error:
                             logger.error(f"JSON解析エラー: {str(json_error)}")
                             logger.error(f"解析できなかったテキスト: {result_text}")
@@ -754,8 +719,8 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                         logger.warning("Max retries reached. Falling back to string similarity matching.")
                         return self.string_similarity_mapping(account_name, financial_statement)
                     
-                    # 少し待ってから再試行
-                    time.sleep(retry_delay)
+                    # 少し待ってから再試行（指数バックオフ・ジッター付き）
+                    time.sleep(backoff_delay(attempt, api_error))
             
             # Validate and clean up the result
             if "standard_account_code" not in result:
@@ -806,6 +771,9 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
             elif result["standard_account_code"] == "UNKNOWN" and "standard_account_name" not in result:
                 result["standard_account_name"] = "Unknown"
             
+            if from_api:
+                llm_mapping_cache.store(financial_statement, {cache_account_name: result}, catalog, self.model)
+            
             return result
             
         except Exception as e:
@@ -817,6 +785,246 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                 "rationale": f"Error during mapping: {str(e)}"
             }
     
+    def generate_batch_mapping_prompt(self, financial_statement, standard_accounts):
+        """
+        複数の勘定科目をまとめてマッピングするためのシステムプロンプトを作成する
+        
+        標準勘定科目の一覧とルールのみを含み、勘定科目名は含まない。同じ財務諸表タイプのリクエストでは
+        同一の先頭部分となるため、APIのプロンプトキャッシュが効く。
+        
+        Args:
+            financial_statement: Type of financial statement (bs, pl, cf)
+            standard_accounts: List of standard accounts
+            
+        Returns:
+            str: System prompt
+        """
+        statement_type_desc = STATEMENT_TYPE_DESCRIPTIONS.get(financial_statement, "Unknown statement type")
+        return f"""You are an expert financial accountant for Japanese Agricultural Cooperatives (JA).
+You map original account names to the most appropriate standard account.
+
+Financial statement type: {statement_type_desc}
+
+Available standard accounts:
+{self._standard_accounts_text(standard_accounts)}
+{JA_MAPPING_RULES}
+
+The user sends a JSON array of accounts, each with "index" and "account_name".
+Respond in JSON format as {{"mappings": [...]}} with exactly one entry per account, each with the following fields:
+- index: The index of the account in the request
+- standard_account_code: The code of the matching standard account
+- confidence: A number between 0 and 1 indicating confidence in the match
+- rationale: A brief explanation of why this account was selected
+
+If no appropriate match is found, set standard_account_code to "UNKNOWN" and provide a rationale.
+"""
+    
+    def _request_json(self, system_prompt, user_prompt):
+        """
+        チャットAPIを1回呼び出し、JSONの応答を辞書として返す（リトライは LLMDispatcher.call で行う）
+        
+        APIの呼び出しのみを行い、データベースは使用しない（ワーカースレッドから呼び出すため）。
+        
+        Raises:
+            Exception: APIエラー、またはJSONオブジェクトとして解析できない応答の場合
+        """
+        from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam
+        
+        messages = [
+            ChatCompletionSystemMessageParam(role="system", content=system_prompt),
+            ChatCompletionUserMessageParam(role="user", content=user_prompt)
+        ]
+        logger.debug(f"Calling OpenAI API with model {self.model}")
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        result = json.loads(response.choices[0].message.content or "")
+        if not isinstance(result, dict):
+            raise ValueError("JSONオブジェクト以外の応答です")
+        return result
+    
+    @staticmethod
+    def _parse_mapping_entry(entry, accounts_by_code):
+        """
+        マッピングの応答の1件を検証して結果の辞書にする（不正な場合はNone）
+        
+        Returns:
+            dict or None: マッピング結果（map_account と同じ形式）
+        """
+        if not isinstance(entry, dict):
+            return None
+        try:
+            code = str(entry["standard_account_code"]).strip()
+            confidence = min(1.0, max(0.0, float(entry.get("confidence", 0.0))))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if code == "UNKNOWN":
+            name = "Unknown"
+        elif code in accounts_by_code:
+            name = accounts_by_code[code].name
+        else:
+            # 一覧に無いコードは不正な応答として扱う
+            return None
+        return {
+            "standard_account_code": code,
+            "standard_account_name": name,
+            "confidence": confidence,
+            "rationale": str(entry.get("rationale") or "No rationale provided")
+        }
+    
+    @staticmethod
+    def _prompt_account_name(account_name):
+        """プロンプトに含める勘定科目名（貯金を標準勘定科目の名称に合わせて預金に読み替える）"""
+        for deposit_key, deposit_value in DEPOSIT_ACCOUNT_NAMES.items():
+            if deposit_key in account_name:
+                return account_name.replace(deposit_key, deposit_value)
+        return account_name
+    
+    @staticmethod
+    def mapping_catalog_hash(standard_accounts):
+        """AIマッピングのキャッシュのキーに使用する標準勘定科目の一覧（とプロンプト）のハッシュ"""
+        return llm_mapping_cache.catalog_hash(standard_accounts, salt=f"{MAPPING_PROMPT_VERSION}\n{JA_MAPPING_RULES}")
+    
+    def iter_map_accounts(self, account_names, financial_statement, batch_size=MAPPING_PROMPT_BATCH_SIZE):
+        """
+        複数の勘定科目をまとめてAIでマッピングし、リクエストが完了した順に結果を返す
+        
+        batch_size 件ずつ1回のリクエストで問い合わせ、標準勘定科目の一覧はシステムプロンプトとして共有する。
+        リクエストは LLMDispatcher で並列に送信する（同時実行数・送信レート・リトライは llm_dispatcher の設定）。
+        応答に含まれない・不正な勘定科目のみ個別に問い合わせ、それでも得られない場合は文字列類似度でマッピングする。
+        APIで得た結果は llm_mapping_cache に保存し、以前にマッピングした勘定科目は問い合わせずにキャッシュの結果を返す。
+        
+        Args:
+            account_names: 勘定科目名のリスト
+            financial_statement: Type of financial statement (bs, pl, cf)
+            batch_size: 1回のリクエストで問い合わせる勘定科目の数
+            
+        Yields:
+            dict: 勘定科目名 → マッピング結果（map_account と同じ形式）
+        """
+        account_names = list(dict.fromkeys(name for name in account_names if name))
+        if not account_names:
+            return
+        
+        def similarity(names):
+            return {
+                name: self.string_similarity_mapping(normalize_string(name, for_db=True), financial_statement)
+                for name in names
+            }
+        
+        if not self.client or not HAS_OPENAI:
+            logger.warning("OpenAI client is not initialized. Using string similarity matching instead.")
+            yield similarity(account_names)
+            return
+        
+        try:
+            standard_accounts = db.session.query(StandardAccount).filter(
+                StandardAccount.financial_statement == financial_statement
+            ).all()
+        except Exception as e:
+            logger.error(f"標準勘定科目の取得中にエラーが発生しました: {str(e)}")
+            standard_accounts = []
+        if not standard_accounts:
+            yield {name: self.map_account(name, financial_statement) for name in account_names}
+            return
+        
+        # 結果を返すたびに呼び出し元がコミットするとORMオブジェクトが期限切れになるため、必要な値を先に取り出しておく
+        catalog_accounts = [
+            SimpleNamespace(code=account.code, name=account.name, account_type=account.account_type)
+            for account in standard_accounts
+        ]
+        
+        # 以前にAPIでマッピングした勘定科目はキャッシュの結果を返す
+        catalog = self.mapping_catalog_hash(catalog_accounts)
+        cached = llm_mapping_cache.lookup(financial_statement, account_names, catalog, self.model)
+        if cached:
+            yield cached
+            account_names = [name for name in account_names if name not in cached]
+            if not account_names:
+                logger.info(f"一括AIマッピング: {len(cached)}件（全てキャッシュ）")
+                return
+        
+        accounts_by_code = {account.code: account for account in catalog_accounts}
+        system_prompt = self.generate_batch_mapping_prompt(financial_statement, catalog_accounts)
+        batch_size = max(1, int(batch_size or MAPPING_PROMPT_BATCH_SIZE))
+        chunks = [tuple(account_names[start:start + batch_size]) for start in range(0, len(account_names), batch_size)]
+        
+        def request_chunk(names):
+            items = [{"index": index, "account_name": self._prompt_account_name(name)} for index, name in enumerate(names)]
+            return self._request_json(system_prompt, json.dumps(items, ensure_ascii=False))
+        
+        start_time = time.time()
+        retry_names = []
+        for names, response, error in self.dispatcher.map(request_chunk, chunks):
+            if error is not None:
+                # リトライしても失敗した場合は map_account と同様に文字列類似度にフォールバック
+                logger.error(f"一括AIマッピングのリクエストに失敗しました。文字列類似度でマッピングします: {str(error)}")
+                yield similarity(names)
+                continue
+            
+            results = {}
+            mappings = response.get("mappings")
+            for entry in mappings if isinstance(mappings, list) else []:
+                result = self._parse_mapping_entry(entry, accounts_by_code)
+                try:
+                    index = int(entry["index"])
+                except (KeyError, TypeError, ValueError):
+                    result = None
+                if result is None or not 0 <= index < len(names):
+                    logger.warning(f"一括AIマッピングの不正な応答を無視します: {entry}")
+                    continue
+                results.setdefault(names[index], result)
+            retry_names.extend(name for name in names if name not in results)
+            if results:
+                llm_mapping_cache.store(financial_statement, results, catalog, self.model)
+                yield results
+        
+        # 応答に含まれなかった・不正だった勘定科目のみ個別に問い合わせる
+        if retry_names:
+            # プロンプトは呼び出し元のスレッドで作成する（標準勘定科目のORMオブジェクトはワーカースレッドから参照できないため）
+            prompts = {
+                name: self.generate_mapping_prompt(self._prompt_account_name(name), financial_statement, catalog_accounts)
+                for name in retry_names
+            }
+            
+            def request_single(name):
+                return self._request_json("You are a financial accounting expert for Japanese Agricultural Cooperatives.", prompts[name])
+            
+            results = {}
+            failed = []
+            for name, response, error in self.dispatcher.map(request_single, retry_names):
+                result = self._parse_mapping_entry(response, accounts_by_code) if error is None else None
+                if result is None:
+                    failed.append(name)
+                else:
+                    results[name] = result
+            llm_mapping_cache.store(financial_statement, results, catalog, self.model)
+            results.update(similarity(failed))
+            yield results
+        
+        logger.info(f"一括AIマッピング: {len(account_names)}件, キャッシュ{len(cached)}件, リクエスト{len(chunks)}回, "
+                    f"個別処理{len(retry_names)}件, {time.time() - start_time:.2f}秒")
+    
+    def map_accounts(self, account_names, financial_statement, batch_size=MAPPING_PROMPT_BATCH_SIZE):
+        """
+        複数の勘定科目をまとめてAIでマッピングする（iter_map_accounts の結果をまとめて返す）
+        
+        Args:
+            account_names: 勘定科目名のリスト
+            financial_statement: Type of financial statement (bs, pl, cf)
+            batch_size: 1回のリクエストで問い合わせる勘定科目の数
+            
+        Returns:
+            dict: 勘定科目名 → マッピング結果（map_account と同じ形式）
+        """
+        results = {}
+        for chunk_results in self.iter_map_accounts(account_names, financial_statement, batch_size):
+            results.update(chunk_results)
+        return results
+    
     def exact_match_accounts(self, ja_code, year, file_type):
         """
         完全一致のマッピングを行う（最小限の実装）
@@ -851,86 +1059,55 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                 # SQLAlchemyのtextを使用
                 from sqlalchemy import text
                 
+                # マッピングする勘定科目の正規化名（ナレッジベースの再集計対象）
+                knowledge_keys = {
+                    (file_type, normalized_name) for normalized_name, in db.session.query(CSVData.normalized_name).filter(
+                        CSVData.ja_code == ja_code,
+                        CSVData.year == year,
+                        CSVData.file_type == file_type,
+                        CSVData.is_mapped == False
+                    ).distinct()
+                }
+                
                 # 直接SQLを実行してマッピングを行う
-                # 1. まず完全一致のマッピングを追加（名前の完全一致）
+                # 1. 正規化した勘定科目名（normalized_name、インデックスあり）が標準勘定科目と一致するものをマッピング
+                #    同じ正規化名の標準勘定科目が複数ある場合は、名称が完全に一致するもの、次にidの小さいものを使用
                 db.session.execute(
                     text("""
-                    INSERT INTO account_mapping (ja_code, original_account_name, standard_account_code, 
+                    INSERT INTO account_mapping (ja_code, original_account_name, normalized_name, standard_account_code, 
                                                standard_account_name, financial_statement, confidence, rationale, created_at)
-                    SELECT 
+                    SELECT DISTINCT
                         c.ja_code, 
                         c.account_name, 
+                        c.normalized_name, 
                         s.code, 
                         s.name, 
                         c.file_type, 
-                        1.0, 
-                        '完全一致: 名称が標準勘定科目と一致しました', 
+                        CASE WHEN c.account_name = s.name THEN 1.0 ELSE 0.9 END, 
+                        CASE WHEN c.account_name = s.name
+                            THEN '完全一致: 名称が標準勘定科目と一致しました'
+                            ELSE '完全一致: 正規化した名称が標準勘定科目と一致しました'
+                        END, 
                         CURRENT_TIMESTAMP
                     FROM 
                         csv_data c
                     JOIN 
-                        standard_account s ON c.account_name = s.name
+                        standard_account s ON s.financial_statement = c.file_type AND s.normalized_name = c.normalized_name
                     WHERE 
                         c.ja_code = :ja_code
                         AND c.year = :year
                         AND c.file_type = :file_type
                         AND c.is_mapped = false
-                        AND s.financial_statement = :file_type
-                        AND NOT EXISTS (
-                            SELECT 1 FROM account_mapping m 
-                            WHERE m.ja_code = c.ja_code 
-                            AND m.original_account_name = c.account_name
-                            AND m.financial_statement = c.file_type
-                        )
-                    """),
-                    {
-                        "ja_code": ja_code,
-                        "year": year,
-                        "file_type": file_type
-                    }
-                )
-                
-                # 1.2. 特定の勘定科目パターンを追加（「経常費用」など特定の重要な勘定科目）
-                # 多くのPL勘定科目には、かっこなどが含まれる可能性があるため、勘定科目名をさらに正規化して検索
-                logger.info("特定の重要勘定科目をマッピング（PL科目の名称正規化マッチングを含む）")
-                db.session.execute(
-                    text("""
-                    INSERT INTO account_mapping (ja_code, original_account_name, standard_account_code, 
-                                               standard_account_name, financial_statement, confidence, rationale, created_at)
-                    WITH important_accounts AS (
-                        SELECT *
-                        FROM standard_account
-                        WHERE financial_statement = :file_type
-                        AND (
-                            -- PL関連の重要な勘定科目（これらは様々な表記で現れることがあります）
-                            name IN ('経常費用', '事業費用', '経常収益', '事業収益', '経常利益', '税引前当期利益', 
-                                   '当期剰余金', '当期純利益', '営業収益', '営業費用', '営業利益', '税引前当期純利益')
-                            OR 
-                            -- その他の特に重要な勘定科目を必要に応じて追加
-                            code IN ('50000', '40000', '40900', '50900', '60000', '60900')
+                        AND c.normalized_name <> ''
+                        AND s.id = COALESCE(
+                            (SELECT MIN(s2.id) FROM standard_account s2
+                             WHERE s2.financial_statement = c.file_type
+                             AND s2.normalized_name = c.normalized_name
+                             AND s2.name = c.account_name),
+                            (SELECT MIN(s3.id) FROM standard_account s3
+                             WHERE s3.financial_statement = c.file_type
+                             AND s3.normalized_name = c.normalized_name)
                         )
-                    )
-                    SELECT 
-                        c.ja_code, 
-                        c.account_name, 
-                        s.code, 
-                        s.name, 
-                        c.file_type, 
-                        0.9, 
-                        '重要科目一致: ' || s.name || '（コード: ' || s.code || '）に該当します', 
-                        CURRENT_TIMESTAMP
-                    FROM 
-                        csv_data c
-                    CROSS JOIN 
-                        important_accounts s
-                    WHERE 
-                        c.ja_code = :ja_code
-                        AND c.year = :year
-                        AND c.file_type = :file_type
-                        AND c.is_mapped = false
-                        -- 名前の正規化比較（かっこや空白を除いて比較）
-                        AND REPLACE(REPLACE(REPLACE(LOWER(c.account_name), ' ', ''), '(', ''), ')', '') = 
-                            REPLACE(REPLACE(REPLACE(LOWER(s.name), ' ', ''), '(', ''), ')', '')
                         AND NOT EXISTS (
                             SELECT 1 FROM account_mapping m 
                             WHERE m.ja_code = c.ja_code 
@@ -969,6 +1146,10 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                     }
                 )
                 
+                # 直接SQLの変更はORMのイベントで検知されないため、残高の世代とナレッジベースを明示的に更新する
+                bump_balance_generation(db.session.connection(), ja_code, file_type)
+                refresh_mapping_knowledge(db.session.connection(), knowledge_keys)
+                
                 # 変更を保存
                 db.session.commit()
                 
@@ -1000,7 +1181,73 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                 "status": f"エラーが発生しました: {str(e)}"
             }
 
-    def ai_map_accounts(self, ja_code, year, file_type, confidence_threshold=0.7, batch_size=5):
+    def _map_accounts_with_llm(self, ja_code, file_type, accounts, confidence_threshold, batch_size=MAPPING_PROMPT_BATCH_SIZE):
+        """
+        既存のマッピングが無い勘定科目をAIでマッピングし、リクエストが完了するたびに一括で登録する
+        
+        Args:
+            ja_code: JA code
+            file_type: Type of financial statement (bs, pl, cf)
+            accounts: 未マッピングのCSVDataのリスト
+            confidence_threshold: マッピングを登録する最小の信頼度
+            batch_size: 1回のリクエストで問い合わせる勘定科目の数
+            
+        Returns:
+            dict: CSVDataのid → マッピングを登録した場合はTrue（既存のマッピングがある勘定科目は含まない）
+        """
+        accounts_by_name = {}
+        for account in accounts:
+            accounts_by_name.setdefault(normalize_string(account.account_name, for_db=True), []).append(account)
+        mapped_names = {
+            name for (name,) in db.session.query(AccountMapping.original_account_name).filter(
+                AccountMapping.ja_code == ja_code,
+                AccountMapping.financial_statement == file_type,
+                AccountMapping.original_account_name.in_(list(accounts_by_name))
+            )
+        }
+        names = [name for name in accounts_by_name if name not in mapped_names]
+        
+        table = AccountMapping.__table__
+        handled = {}
+        for results in self.iter_map_accounts(names, file_type, batch_size):
+            rows = []
+            mapped_ids = []
+            now = datetime.utcnow()
+            for name, result in results.items():
+                matched = (result["standard_account_code"] != "UNKNOWN"
+                           and result["confidence"] >= confidence_threshold)
+                for account in accounts_by_name[name]:
+                    handled[account.id] = matched
+                if not matched:
+                    continue
+                mapped_ids.extend(account.id for account in accounts_by_name[name])
+                rows.append({
+                    'ja_code': ja_code,
+                    'original_account_name': name,
+                    'standard_account_code': result["standard_account_code"],
+                    'standard_account_name': normalize_string(result["standard_account_name"], for_db=True),
+                    'financial_statement': file_type,
+                    'confidence': result["confidence"],
+                    'rationale': normalize_string("AIマッピング: " + result["rationale"], for_db=True),
+                    'created_at': now
+                })
+            if not rows:
+                continue
+            connection = db.session.connection()
+            upsert_rows(connection, table, rows, ['ja_code', 'financial_statement', 'original_account_name'])
+            connection.execute(
+                CSVData.__table__.update().where(CSVData.__table__.c.id.in_(mapped_ids)).values(is_mapped=True)
+            )
+            # Coreの変更はORMのイベントで検知されないため、残高の世代とナレッジベースを明示的に更新する
+            bump_balance_generation(connection, ja_code, file_type)
+            refresh_mapping_knowledge(
+                connection, {(file_type, normalize_account_name(row['original_account_name'], file_type)) for row in rows}
+            )
+            db.session.commit()
+            logger.info(f"AIマッピングを{len(rows)}件登録しました: JA={ja_code}, タイプ={file_type}")
+        return handled
+    
+    def ai_map_accounts(self, ja_code, year, file_type, confidence_threshold=0.7, batch_size=5, offset=0, use_llm=None):
         """
         AIを使用して勘定科目をマッピングする
         一度に処理する件数を制限して、タイムアウトを防止
@@ -1011,6 +1258,8 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
             file_type: Type of financial statement (bs, pl, cf)
             confidence_threshold: Minimum confidence for auto-mapping
             batch_size: 一度に処理する最大件数（デフォルト：5件）
+            offset: 読み飛ばす未マッピングの件数（前のバッチでマッピングできなかった勘定科目を除くため）
+            use_llm: Trueの場合はOpenAI APIで一括マッピングする（Noneの場合は AI_MAPPING_USE_LLM）
             
         Returns:
             dict: Mapping statistics
@@ -1064,7 +1313,7 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                     CSVData.year == year,
                     CSVData.file_type == file_type,
                     CSVData.is_mapped == False
-                ).limit(batch_size).all()
+                ).order_by(CSVData.id).offset(offset).limit(batch_size).all()
                 
                 logger.info(f"処理対象件数: {len(unmapped_accounts)}件")
                 
@@ -1084,8 +1333,31 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
             ai_mapped_count = 0
             unmapped_count = 0
             
+            # OpenAI APIを使用する場合は、既存のマッピングが無い勘定科目をまとめて問い合わせ、完了した順に一括で登録する
+            llm_handled = {}
+            if use_llm is None:
+                use_llm = AI_MAPPING_USE_LLM
+            if use_llm:
+                try:
+                    llm_handled = self._map_accounts_with_llm(
+                        ja_code, file_type, unmapped_accounts, confidence_threshold,
+                        batch_size=min(batch_size, MAPPING_PROMPT_BATCH_SIZE)
+                    )
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"一括AIマッピング中にエラー発生: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    llm_handled = {}
+            
             # 取得した一部のアカウントを処理
             for account in unmapped_accounts:
+                if account.id in llm_handled:
+                    if llm_handled[account.id]:
+                        mapped_count += 1
+                        ai_mapped_count += 1
+                    else:
+                        unmapped_count += 1
+                    continue
                 try:
                     # アカウント名を正規化して安全に処理する
                     safe_account_name = normalize_string(account.account_name, for_db=True)
@@ -1146,13 +1418,19 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                                 cursor.execute(
                                     """
                                     INSERT INTO account_mapping 
-                                    (ja_code, original_account_name, standard_account_code, 
+                                    (ja_code, original_account_name, normalized_name, standard_account_code, 
                                     standard_account_name, financial_statement, confidence, rationale)
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                                    ON CONFLICT (ja_code, financial_statement, original_account_name) DO UPDATE SET
+                                        standard_account_code = EXCLUDED.standard_account_code,
+                                        standard_account_name = EXCLUDED.standard_account_name,
+                                        confidence = EXCLUDED.confidence,
+                                        rationale = EXCLUDED.rationale
                                     """, 
                                     (
                                         ja_code, 
                                         account.account_name,
+                                        normalize_account_name(account.account_name, file_type),
                                         mapping_result["standard_account_code"],
                                         mapping_result["standard_account_name"],
                                         file_type,
@@ -1160,7 +1438,20 @@ If no appropriate match is found, set standard_account_code to "UNKNOWN" and pro
                                         "類似度マッピング: " + mapping_result["rationale"]
                                     )
                                 )
+                                # 直接SQLの変更はORMのイベントで検知されないため、残高の世代を明示的に進める
+                                cursor.execute(
+                                    """
+                                    UPDATE balance_generation SET source_generation = source_generation + 1
+                                    WHERE ja_code = %s AND statement_type = %s
+                                    """,
+                                    (ja_code, file_type)
+                                )
                                 connection.commit()
+                                with db.engine.begin() as knowledge_connection:
+                                    refresh_mapping_knowledge(
+                                        knowledge_connection,
+                                        {(file_type, normalize_account_name(account.account_name, file_type))}
+                                    )
                             except Exception as sql_error:
                                 logger.error(f"SQLマッピング挿入エラー: {str(sql_error)}")
                                 connection.rollback()
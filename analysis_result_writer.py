@@ -0,0 +1,187 @@
+"""
+分析結果（AnalysisResult）の一括書き込み
+指標ごとにORMオブジェクトを追加する代わりに、行をタプルとして集めて1トランザクションで削除・挿入する
+"""
+
+import json
+import logging
+from datetime import datetime
+from app import db
+from models import AnalysisResult
+from utils import normalize_string
+from performance_enhancer import mark_cache_dirty
+
+logger = logging.getLogger(__name__)
+
+# SQLiteの1文あたりのパラメータ数上限を超えないよう、複数行INSERTを分割する行数
+SQLITE_INSERT_CHUNK = 500
+# IN句に渡すJAコードの最大数
+DELETE_CHUNK = 500
+
+
+class AnalysisResultWriter:
+    """
+    AnalysisResultの行を集めて一括で書き込むクラス
+
+    使用例:
+        writer = AnalysisResultWriter(ja_code, year)
+        FinancialIndicators.calculate_liquidity_indicators(ja_code, year, snapshot, writer)
+        ...
+        writer.write()
+    """
+
+    COLUMNS = (
+        'ja_code', 'year', 'analysis_type', 'indicator_name', 'indicator_value', 'benchmark',
+        'risk_score', 'risk_level', 'analysis_result', 'formula', 'calculation', 'accounts_used'
+    )
+    # 差分判定で比較しない列の位置（ja_code, year, analysis_type, indicator_name はキー）
+    KEY_SIZE = 4
+    # 差分判定でJSONとして比較する列の位置（計算経路によって 0 と 0.0 のように表記が異なるため）
+    JSON_COLUMN = COLUMNS.index('accounts_used')
+
+    def __init__(self, ja_code=None, year=None, analysis_types=None, diff=False):
+        """
+        Args:
+            ja_code: 書き込み対象のJAコード（add_scopeで複数指定も可能）
+            year: 書き込み対象の年度
+            analysis_types: 置き換える指標カテゴリ（Noneの場合は全カテゴリ）
+            diff: Trueの場合、既存行と比較して変更のあった指標のみ書き換える
+        """
+        self.analysis_types = list(analysis_types) if analysis_types else None
+        self.diff = diff
+        self._scopes = set()
+        self._rows = {}
+        if ja_code is not None and year is not None:
+            self.add_scope(ja_code, year)
+
+    def add_scope(self, ja_code, year):
+        """既存の分析結果を置き換える (JA, 年度) を追加する"""
+        self._scopes.add((ja_code, int(year)))
+
+    def add(self, **fields):
+        """1指標分の行を追加する（同じ指標が既にあれば後から追加した行で置き換える）"""
+        values = []
+        for column in self.COLUMNS:
+            value = fields.get(column)
+            if isinstance(value, str):
+                # ORMのイベントリスナーと同じ正規化を行う
+                value = normalize_string(value, for_db=True)
+            values.append(value)
+        values[1] = int(values[1])
+        row = tuple(values)
+        self.add_scope(row[0], row[1])
+        self._rows[row[:self.KEY_SIZE]] = row
+
+    def extend(self, rows):
+        """dictの行をまとめて追加する"""
+        for row in rows:
+            self.add(**row)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _scope_filter(self, table, ja_codes, year):
+        conditions = [table.c.year == year, table.c.ja_code.in_(ja_codes)]
+        if self.analysis_types:
+            conditions.append(table.c.analysis_type.in_(self.analysis_types))
+        return conditions
+
+    def _scopes_by_year(self):
+        """対象範囲を年度ごとに、DELETE_CHUNK件ずつのJAコードのリストに分割する"""
+        by_year = {}
+        for ja_code, year in sorted(self._scopes):
+            by_year.setdefault(year, []).append(ja_code)
+        for year, ja_codes in by_year.items():
+            for start in range(0, len(ja_codes), DELETE_CHUNK):
+                yield year, ja_codes[start:start + DELETE_CHUNK]
+
+    def _load_existing(self, table):
+        """差分モード用に既存行を {キー: (id, 行)} として読み込む"""
+        existing = {}
+        columns = [table.c.id] + [table.c[column] for column in self.COLUMNS]
+        for year, ja_codes in self._scopes_by_year():
+            result = db.session.execute(
+                db.select(*columns).where(*self._scope_filter(table, ja_codes, year))
+            )
+            for record in result:
+                row = tuple(record[1:])
+                key = row[:self.KEY_SIZE]
+                if key in existing:
+                    # 同じ指標の重複行は削除対象にする
+                    existing[(key, record[0])] = (record[0], None)
+                else:
+                    existing[key] = (record[0], row)
+        return existing
+
+    @classmethod
+    def _same_row(cls, current, row):
+        """既存行と新しい行が同じ内容か（accounts_used は解析したJSONで比較する）"""
+        if current == row:
+            return True
+        if current[:cls.JSON_COLUMN] != row[:cls.JSON_COLUMN] or current[cls.JSON_COLUMN + 1:] != row[cls.JSON_COLUMN + 1:]:
+            return False
+        try:
+            return json.loads(current[cls.JSON_COLUMN]) == json.loads(row[cls.JSON_COLUMN])
+        except (TypeError, ValueError):
+            return False
+
+    def _insert(self, table, rows):
+        if not rows:
+            return
+        now = datetime.utcnow()
+        records = [dict(zip(self.COLUMNS, row), created_at=now) for row in rows]
+        if db.engine.dialect.name == 'postgresql':
+            # executemany（psycopg2では複数行VALUESにまとめて送信される）
+            db.session.execute(table.insert(), records)
+        else:
+            for start in range(0, len(records), SQLITE_INSERT_CHUNK):
+                db.session.execute(table.insert().values(records[start:start + SQLITE_INSERT_CHUNK]))
+
+    def write(self):
+        """
+        集めた行を1トランザクションで書き込む
+
+        Returns:
+            dict: inserted（挿入）, deleted（削除）, unchanged（変更なし）の件数
+        """
+        table = AnalysisResult.__table__
+        stats = {'inserted': 0, 'deleted': 0, 'unchanged': 0}
+        try:
+            if self.diff:
+                existing = self._load_existing(table)
+                to_insert = []
+                for key, row in self._rows.items():
+                    current = existing.pop(key, None)
+                    if current is not None and self._same_row(current[1], row):
+                        stats['unchanged'] += 1
+                        continue
+                    to_insert.append(row)
+                    if current is not None:
+                        existing[(key, current[0])] = (current[0], None)
+                stale_ids = [record_id for record_id, _ in existing.values()]
+                for start in range(0, len(stale_ids), DELETE_CHUNK):
+                    chunk = stale_ids[start:start + DELETE_CHUNK]
+                    stats['deleted'] += db.session.execute(
+                        table.delete().where(table.c.id.in_(chunk))
+                    ).rowcount
+            else:
+                to_insert = list(self._rows.values())
+                for year, ja_codes in self._scopes_by_year():
+                    stats['deleted'] += db.session.execute(
+                        table.delete().where(*self._scope_filter(table, ja_codes, year))
+                    ).rowcount
+
+            self._insert(table, to_insert)
+            stats['inserted'] = len(to_insert)
+            if stats['inserted'] or stats['deleted']:
+                for ja_code, year in self._scopes:
+                    mark_cache_dirty(db.session, ja_code, year)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        logger.info(f"分析結果を一括書き込みしました: 対象={len(self._scopes)}件, 挿入={stats['inserted']}件, "
+                    f"削除={stats['deleted']}件, 変更なし={stats['unchanged']}件")
+        self._rows.clear()
+        return stats
@@ -0,0 +1,312 @@
+"""
+分析用の列指向スナップショット（標準勘定科目残高・分析結果）の出力と読み込み
+JA横断の分析やノートブックから、データベースに問い合わせずにメモリマップで高速に読み込むためのもの
+
+出力先のディレクトリ構成（年度・財務諸表タイプ／分析タイプで分割）:
+    <出力先>/CURRENT                      最新のスナップショット名
+    <出力先>/<スナップショット名>/balances/year=2023/statement_type=bs/data.arrow
+    <出力先>/<スナップショット名>/indicators/year=2023/analysis_type=safety/data.arrow
+
+pyarrow が必要（pip install pyarrow）。
+"""
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+logger = logging.getLogger(__name__)
+
+# スナップショットの出力先（環境変数で変更可能）
+SNAPSHOT_DIR = os.environ.get('ANALYTICS_SNAPSHOT_DIR', 'analytics_snapshots')
+
+# 最新のスナップショット名を記録するファイル
+CURRENT_FILE = 'CURRENT'
+
+# 残しておく過去のスナップショットの数（読み込み中のプロセスがあるため直前のものは削除しない）
+KEEP_SNAPSHOTS = 2
+
+# 出力形式 → ファイル名（arrow: 非圧縮のArrow IPC。メモリマップしてコピー無しで読み込める）
+FILE_NAMES = {'arrow': 'data.arrow', 'parquet': 'data.parquet'}
+
+# データセット → (テーブル, 分割に使用する列, 出力する列)
+DATASETS = {
+    'balances': (
+        'standard_account_balance',
+        ('year', 'statement_type'),
+        ('ja_code', 'standard_account_code', 'standard_account_name', 'statement_subtype',
+         'current_value', 'previous_value'),
+    ),
+    'indicators': (
+        'analysis_result',
+        ('year', 'analysis_type'),
+        ('ja_code', 'indicator_name', 'indicator_value', 'benchmark', 'risk_score', 'risk_level'),
+    ),
+}
+
+
+def _require_pyarrow():
+    if not HAS_PYARROW:
+        raise RuntimeError("分析用スナップショットには pyarrow が必要です（pip install pyarrow）")
+
+
+def _schema(table, columns):
+    """出力する列のArrowスキーマ（文字列は辞書エンコードしてJAコード・科目コードの重複を圧縮する）"""
+    fields = []
+    for column in columns:
+        sql_type = table.c[column].type.python_type
+        if sql_type is str:
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+        elif sql_type is int:
+            fields.append(pa.field(column, pa.int64()))
+        else:
+            fields.append(pa.field(column, pa.float64()))
+    return pa.schema(fields)
+
+
+def _write_partition(path, columns_data, schema, file_format):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns_data[field.name], pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns_data[field.name], field.type))
+    table = pa.Table.from_arrays(arrays, schema=schema)
+    if file_format == 'parquet':
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    return table.num_rows
+
+
+def _export_dataset(name, snapshot_path, file_format, ja_codes=None, years=None):
+    """1つのテーブルを分割してファイルに出力する（分割ごとに読み込むため、テーブル全体をメモリに保持しない）"""
+    from app import db
+
+    table_name, partition_columns, columns = DATASETS[name]
+    table = db.metadata.tables[table_name]
+    schema = _schema(table, columns)
+    conditions = []
+    if ja_codes:
+        conditions.append(table.c.ja_code.in_(ja_codes))
+    if years:
+        conditions.append(table.c.year.in_(years))
+
+    partitions = db.session.execute(
+        db.select(*[table.c[column] for column in partition_columns]).where(*conditions).distinct()
+    ).all()
+    written = 0
+    for partition in sorted(partitions):
+        partition_conditions = [table.c[column] == value for column, value in zip(partition_columns, partition)]
+        result = db.session.execute(
+            db.select(*[table.c[column] for column in columns])
+            .where(*conditions, *partition_conditions)
+            .order_by(table.c.ja_code, table.c.id)
+        )
+        values = list(zip(*result)) or [()] * len(columns)
+        directory = os.path.join(snapshot_path, name, *[
+            f"{column}={value}" for column, value in zip(partition_columns, partition)
+        ])
+        written += _write_partition(
+            os.path.join(directory, FILE_NAMES[file_format]),
+            dict(zip(columns, values)), schema, file_format
+        )
+    logger.info(f"{name}: {len(partitions)}分割、{written}行を出力しました")
+    return written
+
+
+def export_snapshot(output_dir=SNAPSHOT_DIR, file_format='arrow', ja_codes=None, years=None):
+    """
+    標準勘定科目残高と分析結果を列指向のスナップショットとして出力する
+
+    新しいスナップショットを別のディレクトリに作成してから CURRENT を置き換えるため、
+    出力中も読み込み側は直前のスナップショットを読み込める。
+
+    Args:
+        output_dir: 出力先のディレクトリ
+        file_format: 'arrow'（メモリマップで読み込める非圧縮形式）または 'parquet'（圧縮形式）
+        ja_codes: 出力するJAコードのリスト（Noneの場合は全JA）
+        years: 出力する年度のリスト（Noneの場合は全年度）
+
+    Returns:
+        dict: path（スナップショットのパス）, balances, indicators（出力行数）
+    """
+    _require_pyarrow()
+    if file_format not in FILE_NAMES:
+        raise ValueError(f"未対応の出力形式です: {file_format}")
+
+    snapshot_name = f"snapshot-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}"
+    snapshot_path = os.path.join(output_dir, snapshot_name)
+    os.makedirs(snapshot_path)
+    try:
+        counts = {name: _export_dataset(name, snapshot_path, file_format, ja_codes, years) for name in DATASETS}
+    except Exception:
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        raise
+
+    # CURRENT を置き換えて新しいスナップショットを公開する
+    current_tmp = os.path.join(output_dir, f".{CURRENT_FILE}.{os.getpid()}")
+    with open(current_tmp, 'w') as f:
+        f.write(snapshot_name)
+    os.replace(current_tmp, os.path.join(output_dir, CURRENT_FILE))
+
+    snapshots = sorted(entry for entry in os.listdir(output_dir) if entry.startswith('snapshot-'))
+    for old in snapshots[:-KEEP_SNAPSHOTS]:
+        shutil.rmtree(os.path.join(output_dir, old), ignore_errors=True)
+
+    logger.info(f"分析用スナップショットを出力しました: {snapshot_path}")
+    return dict(counts, path=snapshot_path)
+
+
+class SnapshotReader:
+    """
+    分析用スナップショットの読み込み
+
+    Arrow形式のファイルはメモリマップして読み込むため、数値列はコピーせずにNumPy配列として参照できる。
+
+    使用例:
+        reader = SnapshotReader()
+        df = reader.balances(ja_codes=['JA001'], years=[2023], statement_types=['bs'])
+    """
+
+    def __init__(self, path=SNAPSHOT_DIR):
+        """
+        Args:
+            path: スナップショットの出力先（CURRENT が示すスナップショットを読み込む）またはスナップショットのパス
+        """
+        _require_pyarrow()
+        current = os.path.join(path, CURRENT_FILE)
+        if os.path.exists(current):
+            with open(current) as f:
+                path = os.path.join(path, f.read().strip())
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"分析用スナップショットがありません: {path}")
+        self.path = path
+
+    def _partitions(self, name, partition_filters):
+        """条件に一致する分割のファイルのパス（ディレクトリ名で絞り込み、不要なファイルは開かない）"""
+        _, partition_columns, _ = DATASETS[name]
+        paths = []
+        base = os.path.join(self.path, name)
+        if not os.path.isdir(base):
+            return paths
+        for directory, _, files in os.walk(base):
+            parts = dict(
+                part.split('=', 1) for part in os.path.relpath(directory, base).split(os.sep) if '=' in part
+            )
+            if len(parts) != len(partition_columns):
+                continue
+            if any(values is not None and parts[column] not in {str(value) for value in values}
+                   for column, values in partition_filters.items()):
+                continue
+            for file_name in files:
+                if file_name in FILE_NAMES.values():
+                    paths.append((parts, os.path.join(directory, file_name)))
+        return sorted(paths, key=lambda entry: entry[1])
+
+    def read_table(self, name, partition_filters=None, column_filters=None):
+        """
+        データセットをArrowのテーブルとして読み込む
+
+        Args:
+            name: 'balances' または 'indicators'
+            partition_filters: {分割に使用する列: 値のリスト}
+            column_filters: {列: 値のリスト}
+
+        Returns:
+            pyarrow.Table: 分割に使用した列を含むテーブル
+        """
+        _, partition_columns, columns = DATASETS[name]
+        tables = []
+        for parts, path in self._partitions(name, partition_filters or {}):
+            if path.endswith('.parquet'):
+                table = pq.read_table(path, memory_map=True)
+            else:
+                table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            for column, values in (column_filters or {}).items():
+                if values is not None:
+                    table = table.filter(pc.is_in(table[column], value_set=pa.array(list(values), pa.string())))
+            for column in partition_columns:
+                if column == 'year':
+                    array = pa.array([int(parts[column])] * table.num_rows, pa.int64())
+                else:
+                    array = pa.array([parts[column]] * table.num_rows, pa.string())
+                table = table.append_column(column, array)
+            tables.append(table)
+        if not tables:
+            return pa.table({column: pa.array([], pa.string()) for column in columns + partition_columns})
+        return pa.concat_tables(tables)
+
+    def balances(self, ja_codes=None, years=None, statement_types=None, account_codes=None):
+        """
+        標準勘定科目残高を読み込む
+
+        Args:
+            ja_codes: JAコードのリスト（Noneの場合は全JA）
+            years: 年度のリスト
+            statement_types: 財務諸表タイプ（bs, pl, cf）のリスト
+            account_codes: 標準勘定科目コードのリスト
+
+        Returns:
+            DataFrame: ja_code, year, statement_type, standard_account_code, standard_account_name,
+                       statement_subtype, current_value, previous_value
+        """
+        table = self.read_table(
+            'balances',
+            {'year': years, 'statement_type': statement_types},
+            {'ja_code': ja_codes, 'standard_account_code': account_codes}
+        )
+        return table.to_pandas(split_blocks=True)
+
+    def indicators(self, ja_codes=None, years=None, analysis_types=None, indicator_names=None):
+        """
+        財務指標（分析結果）を読み込む
+
+        Args:
+            ja_codes: JAコードのリスト（Noneの場合は全JA）
+            years: 年度のリスト
+            analysis_types: 分析タイプ（liquidity, safety など）のリスト
+            indicator_names: 指標名のリスト
+
+        Returns:
+            DataFrame: ja_code, year, analysis_type, indicator_name, indicator_value, benchmark, risk_score, risk_level
+        """
+        table = self.read_table(
+            'indicators',
+            {'year': years, 'analysis_type': analysis_types},
+            {'ja_code': ja_codes, 'indicator_name': indicator_names}
+        )
+        return table.to_pandas(split_blocks=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="標準勘定科目残高・分析結果の分析用スナップショットを出力する")
+    parser.add_argument('--output', default=SNAPSHOT_DIR, help=f"出力先のディレクトリ（既定: {SNAPSHOT_DIR}）")
+    parser.add_argument('--format', choices=sorted(FILE_NAMES), default='arrow',
+                        help="出力形式（arrow: メモリマップ用の非圧縮形式、parquet: 圧縮形式）")
+    parser.add_argument('--ja-code', action='append', help="出力するJAコード（複数指定可）")
+    parser.add_argument('--year', type=int, action='append', help="出力する年度（複数指定可）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from app import app
+    with app.app_context():
+        result = export_snapshot(args.output, args.format, ja_codes=args.ja_code, years=args.year)
+    print(f"{result['path']}: 残高 {result['balances']}行、分析結果 {result['indicators']}行")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
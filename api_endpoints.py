@@ -6,10 +6,16 @@ import json
 from flask import jsonify, request, session
 from models import AnalysisResult, StandardAccount, StandardAccountBalance, JA
 from app import db
-from performance_enhancer import timed_function, cached_query
+from performance_enhancer import timed_function, cached_query, ja_cache_tags
 
 logger = logging.getLogger(__name__)
 
+def _risk_data_cache_tags(ja_code, year):
+    """リスクデータは前年度のスコアも含むため、両年度の変更で無効化する"""
+    if year is None:
+        return ja_cache_tags(ja_code)
+    return ja_cache_tags(ja_code, year) + ja_cache_tags(ja_code, year - 1)
+
 def register_api_endpoints(app):
     """API エンドポイントを登録する関数"""
     
@@ -45,6 +51,8 @@ def register_api_endpoints(app):
     
     @app.route('/api/risk_data')
     @timed_function
+    # 5分間キャッシュ（エラー時のデフォルト値はキャッシュしない）
+    @cached_query(timeout=300, tags=_risk_data_cache_tags, unless=lambda response: 'current_year' not in response.get_json())
     def api_risk_data():
         """APIエンドポイント：レーダーチャート用リスクデータを取得"""
         # URLパラメータからJAコードと年度を取得（指定がなければセッションから）
@@ -189,9 +197,22 @@ def register_api_endpoints(app):
     @app.route('/api/clear_cache')
     def api_clear_cache():
         """APIエンドポイント：キャッシュをクリア"""
-        from performance_enhancer import clear_cache
+        from performance_enhancer import clear_cache, query_cache
         clear_cache()
-        return jsonify({"status": "success", "message": "Cache cleared successfully"})
+        return jsonify({"status": "success", "message": "Cache cleared successfully", "cache": query_cache.stats()})
+
+    @app.route('/api/llm_mapping_cache')
+    def api_llm_mapping_cache():
+        """APIエンドポイント：AIマッピングのキャッシュの統計情報"""
+        import llm_mapping_cache
+        return jsonify({"status": "success", "cache": llm_mapping_cache.cache_stats()})
+
+    @app.route('/api/llm_mapping_cache/purge', methods=['POST'])
+    def api_purge_llm_mapping_cache():
+        """APIエンドポイント：AIマッピングのキャッシュから期限切れの結果を削除"""
+        import llm_mapping_cache
+        purged = llm_mapping_cache.purge()
+        return jsonify({"status": "success", "purged": purged, "cache": llm_mapping_cache.cache_stats()})
 
     @app.route('/api/ja_comparison', methods=['POST'])
     def api_ja_comparison():
@@ -273,4 +294,38 @@ def register_api_endpoints(app):
             return jsonify({
                 "status": "error",
                 "message": f"比較分析中にエラーが発生しました: {str(e)}"
-            }), 500
\ No newline at end of file
+            }), 500
+    # バックグラウンドジョブ（長時間かかる処理の投入・進捗の参照・取消）
+    @app.route('/api/jobs', methods=['POST'])
+    def api_submit_job():
+        """APIエンドポイント：ジョブを投入する（同じ内容の未完了のジョブがある場合はそのジョブを返す）"""
+        from background_jobs import submit_job, PUBLIC_JOB_TYPES
+        data = request.get_json(silent=True) or request.form.to_dict()
+        if data.get('job_type') not in PUBLIC_JOB_TYPES:
+            return jsonify({"status": "error", "message": f"投入できないジョブタイプです: {data.get('job_type')}"}), 400
+        params = data.get('params')
+        if params is None:
+            params = {key: value for key, value in data.items() if key != 'job_type'}
+        try:
+            job, created = submit_job(data.get('job_type'), params)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify(dict(job.to_dict(), created=created)), 202 if created else 200
+
+    @app.route('/api/jobs/<job_id>')
+    def api_job_status(job_id):
+        """APIエンドポイント：ジョブの状態と進捗を取得する"""
+        from background_jobs import get_job
+        job = get_job(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "ジョブが見つかりません"}), 404
+        return jsonify(job.to_dict())
+
+    @app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+    def api_cancel_job(job_id):
+        """APIエンドポイント：ジョブの取消を要求する"""
+        from background_jobs import cancel_job
+        job = cancel_job(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "ジョブが見つかりません"}), 404
+        return jsonify(job.to_dict())
@@ -178,6 +178,22 @@ with app.app_context():
     logger.info("Creating database tables...")
     db.create_all()
     logger.info("Database tables created successfully")
+    
+    # 既存のテーブルに不足している列・インデックスを追加
+    try:
+        from update_table_indexes import (ensure_table_columns, backfill_normalized_names,
+                                          ensure_mapping_knowledge, ensure_table_indexes)
+        added_columns = ensure_table_columns()
+        if added_columns:
+            logger.info(f"Database columns added: {', '.join(added_columns)}")
+        backfill_normalized_names()
+        ensure_mapping_knowledge()
+        created_indexes = ensure_table_indexes()
+        if created_indexes:
+            logger.info(f"Database indexes created: {', '.join(created_indexes)}")
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to update database columns or indexes: {str(e)}")
 def check_task_authorization(task_name, requested_tasks):
     """
     タスクの認可チェックを行う関数
@@ -0,0 +1,573 @@
+"""
+長時間かかる処理のバックグラウンド実行
+AIマッピング・残高再作成・指標再計算・標準勘定科目インポート・一括取込をジョブとして background_job テーブルに記録し、
+ワーカースレッドで実行する。進捗の参照と取消は /api/jobs/<id>（api_endpoints.py）から行う。
+
+ジョブは同じ内容（ジョブタイプとパラメータ）のものが未完了の場合は新たに投入せず、既存のジョブを返す。
+実行は条件付きUPDATEで1つのワーカーに限定するため、複数のプロセスから投入・再開しても二重に実行されない。
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import inspect
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app import db
+from models import BackgroundJob, CSVData
+
+logger = logging.getLogger(__name__)
+
+# ジョブを実行するワーカースレッド数（プロセスごと）
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+
+# 進捗をデータベースに記録する最短間隔（秒）
+PROGRESS_INTERVAL = 1.0
+
+# 実行中のまま進捗の記録が途絶えたジョブを中断されたとみなすまでの時間（秒）
+STALE_JOB_SECONDS = 30 * 60
+
+# 実行中のジョブの生存を記録する間隔（秒）。進捗の記録とは別に行い、1つの処理が長くても中断とみなされないようにする
+HEARTBEAT_INTERVAL = 60
+
+# /api/jobs から投入できるジョブタイプ（ファイルを扱うジョブなどは各画面のエンドポイントからのみ投入する）
+PUBLIC_JOB_TYPES = ('auto_mapping', 'recreate_balances', 'recalculate_indicators', 'knowledge_mapping')
+
+# アップロードしたファイルのID（UPLOAD_FOLDER 内のファイル名に使用する）
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# 未完了のジョブの状態
+ACTIVE_STATUSES = ('queued', 'running')
+
+# ジョブタイプ → 処理関数（job_type デコレータで登録）
+JOB_TYPES = {}
+
+_executor = None
+
+
+class JobCancelled(Exception):
+    """ジョブの取消が要求された場合に処理関数の中で発生する例外"""
+
+
+def job_type(name):
+    """
+    処理関数をジョブタイプとして登録するデコレータ
+
+    処理関数は JobContext とジョブのパラメータ（キーワード引数）を受け取り、JSONに変換できる結果を返す。
+    """
+    def decorator(func):
+        JOB_TYPES[name] = func
+        return func
+    return decorator
+
+
+class JobContext:
+    """
+    実行中のジョブから進捗を記録し、取消の要求を確認するためのオブジェクト
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._done = 0
+        self._last_write = 0
+
+    def progress(self, done, total=None, message=None, force=False):
+        """
+        進捗を記録する（PROGRESS_INTERVAL 秒に1回まで）。取消が要求されている場合は JobCancelled を発生させる
+
+        Args:
+            done: 処理済みの件数
+            total: 全件数（不明な場合はNone）
+            message: 現在の処理内容
+            force: Trueの場合は間隔に関わらず記録する
+        """
+        self._done = done
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+
+        values = {'progress_done': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['progress_total'] = total
+        if message is not None:
+            values['message'] = message
+        # ジョブ自身のトランザクションとは別の接続で記録し、すぐに参照できるようにする
+        table = BackgroundJob.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.update().where(table.c.id == self.job_id).values(**values))
+                cancel_requested = connection.execute(
+                    db.select(table.c.cancel_requested).where(table.c.id == self.job_id)
+                ).scalar()
+        except Exception as e:
+            logger.warning(f"ジョブ {self.job_id} の進捗を記録できませんでした: {str(e)}")
+            return
+        if cancel_requested:
+            raise JobCancelled()
+
+    def check_cancelled(self):
+        """取消が要求されている場合は JobCancelled を発生させる（進捗の記録と同じ間隔で確認する）"""
+        self.progress(self._done)
+
+
+def _job_key(job_type_name, params):
+    """ジョブタイプとパラメータから重複投入の検出に使用するキーを作成する"""
+    encoded = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{job_type_name}:{hashlib.sha1(encoded.encode('utf-8')).hexdigest()}"
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='background-job')
+    return _executor
+
+
+def _dispatch(job_id):
+    """ジョブをワーカースレッドで実行する"""
+    from app import app
+    _get_executor().submit(_run_in_app_context, app, job_id)
+
+
+def _run_in_app_context(app, job_id):
+    with app.app_context():
+        try:
+            run_job(job_id)
+        except Exception as e:
+            logger.error(f"ジョブ {job_id} の実行エラー: {str(e)}")
+            logger.error(traceback.format_exc())
+        finally:
+            db.session.remove()
+
+
+def submit_job(job_type_name, params=None):
+    """
+    ジョブを投入する
+
+    Args:
+        job_type_name: ジョブタイプ（JOB_TYPES のキー）
+        params: 処理関数に渡すパラメータの辞書
+
+    Returns:
+        tuple: (BackgroundJob, 新たに投入した場合はTrue・同じ内容の未完了のジョブがある場合はFalse)
+
+    Raises:
+        ValueError: ジョブタイプまたはパラメータが不正な場合
+    """
+    func = JOB_TYPES.get(job_type_name)
+    if func is None:
+        raise ValueError(f"不明なジョブタイプです: {job_type_name}")
+    params = dict(params or {})
+    try:
+        inspect.signature(func).bind(None, **params)
+    except TypeError as e:
+        raise ValueError(f"ジョブ {job_type_name} のパラメータが不正です: {str(e)}")
+
+    job_key = _job_key(job_type_name, params)
+    existing = BackgroundJob.query.filter(
+        BackgroundJob.job_key == job_key,
+        BackgroundJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+    if existing is not None:
+        return existing, False
+
+    job = BackgroundJob(
+        id=uuid.uuid4().hex,
+        job_type=job_type_name,
+        job_key=job_key,
+        params=json.dumps(params, ensure_ascii=False, default=str),
+        status='queued',
+        progress_done=0,
+        cancel_requested=False,
+        created_at=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+    logger.info(f"ジョブを投入しました: {job.id} {job_type_name} {params}")
+    _dispatch(job.id)
+    return job, True
+
+
+def _finish(job_id, status, result=None, error=None):
+    table = BackgroundJob.__table__
+    values = {
+        'status': status,
+        'result': json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+        'error': error,
+        'finished_at': datetime.utcnow(),
+    }
+    if status == 'succeeded':
+        # 進捗の記録は間引いているため、完了時は全件処理済みとする
+        values['progress_done'] = db.func.coalesce(table.c.progress_total, table.c.progress_done)
+    db.session.execute(table.update().where(table.c.id == job_id).values(**values))
+    db.session.commit()
+
+
+def _start_heartbeat(job_id):
+    """
+    実行中のジョブの heartbeat_at を HEARTBEAT_INTERVAL ごとに更新するスレッドを開始する
+
+    Returns:
+        threading.Event: set() するとスレッドが終了する
+    """
+    stop = threading.Event()
+    engine = db.engine
+    table = BackgroundJob.__table__
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        table.update()
+                        .where(table.c.id == job_id, table.c.status == 'running')
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+            except Exception as e:
+                logger.warning(f"ジョブ {job_id} の生存を記録できませんでした: {str(e)}")
+
+    threading.Thread(target=beat, name=f'background-job-heartbeat-{job_id}', daemon=True).start()
+    return stop
+
+
+def run_job(job_id):
+    """
+    ジョブを実行する（他のワーカーが実行を開始済みの場合は何もしない）
+
+    Args:
+        job_id: ジョブID
+
+    Returns:
+        str or None: 終了時の状態（succeeded, failed, cancelled）。実行しなかった場合はNone
+    """
+    table = BackgroundJob.__table__
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        table.update()
+        .where(table.c.id == job_id, table.c.status == 'queued')
+        .values(status='running', started_at=now, heartbeat_at=now)
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return None
+
+    job = db.session.get(BackgroundJob, job_id)
+    params = json.loads(job.params) if job.params else {}
+    if job.cancel_requested:
+        _finish(job_id, 'cancelled')
+        return 'cancelled'
+
+    logger.info(f"ジョブを開始します: {job_id} {job.job_type} {params}")
+    stop_heartbeat = _start_heartbeat(job_id)
+    try:
+        result = JOB_TYPES[job.job_type](JobContext(job_id), **params)
+    except JobCancelled:
+        db.session.rollback()
+        logger.info(f"ジョブが取り消されました: {job_id}")
+        _finish(job_id, 'cancelled')
+        return 'cancelled'
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"ジョブが失敗しました: {job_id}: {str(e)}")
+        logger.error(traceback.format_exc())
+        _finish(job_id, 'failed', error=str(e))
+        return 'failed'
+    finally:
+        stop_heartbeat.set()
+
+    _finish(job_id, 'succeeded', result=result)
+    logger.info(f"ジョブが完了しました: {job_id}")
+    return 'succeeded'
+
+
+def get_job(job_id):
+    """ジョブを取得する（存在しない場合はNone）"""
+    return db.session.get(BackgroundJob, job_id)
+
+
+def cancel_job(job_id):
+    """
+    ジョブの取消を要求する
+
+    待機中のジョブはすぐに取り消す。実行中のジョブは次に進捗を記録する時点で中断される。
+
+    Returns:
+        BackgroundJob or None: 取消を要求したジョブ（存在しない場合はNone）
+    """
+    table = BackgroundJob.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == job_id, table.c.status.in_(ACTIVE_STATUSES))
+        .values(cancel_requested=True)
+    )
+    db.session.execute(
+        table.update()
+        .where(table.c.id == job_id, table.c.status == 'queued')
+        .values(status='cancelled', finished_at=datetime.utcnow())
+    )
+    db.session.commit()
+    job = db.session.get(BackgroundJob, job_id)
+    if job is not None:
+        db.session.refresh(job)
+    return job
+
+
+def recover_jobs():
+    """
+    起動時に未完了のジョブを再開する
+
+    待機中のジョブは再度ワーカーに渡す（実行の開始は1つのワーカーに限定される）。
+    実行中のまま STALE_JOB_SECONDS 以上進捗の記録が無いジョブは、プロセスの停止で中断されたものとして失敗にする。
+
+    Returns:
+        dict: resumed（再開したジョブ数）, interrupted（中断とみなしたジョブ数）
+    """
+    table = BackgroundJob.__table__
+    stale_before = datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS)
+    interrupted = db.session.execute(
+        table.update()
+        .where(table.c.status == 'running', table.c.heartbeat_at < stale_before)
+        .values(status='failed', error='処理が中断されました（プロセスの停止）', finished_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+
+    queued = [job_id for (job_id,) in db.session.execute(
+        db.select(table.c.id).where(table.c.status == 'queued').order_by(table.c.created_at)
+    )]
+    for job_id in queued:
+        _dispatch(job_id)
+    if queued or interrupted:
+        logger.info(f"未完了のジョブを再開しました: 再開={len(queued)}件, 中断={interrupted}件")
+    return {'resumed': len(queued), 'interrupted': interrupted}
+
+
+# ---------------------------------------------------------------------------
+# ジョブタイプ（既存の処理を呼び出す。いずれも同じパラメータで再実行しても同じ結果になる）
+# ---------------------------------------------------------------------------
+
+# AIマッピングで1回に処理する件数（リクエストのタイムアウトを気にせず、進捗の記録と取消の確認の単位とする）
+MAPPING_BATCH_SIZE = 50
+
+
+def _unmapped_count(ja_code, year, file_type):
+    return CSVData.query.filter_by(ja_code=ja_code, year=year, file_type=file_type, is_mapped=False).count()
+
+
+@job_type('auto_mapping')
+def auto_mapping_job(context, ja_code, year, file_type, confidence_threshold=0.5):
+    """完全一致・ナレッジベースによるマッピングの後、未マッピングの勘定科目が無くなるまでAIマッピングを繰り返す"""
+    from ai_account_mapper import AIAccountMapper
+    from reference_mapping import apply_knowledge_mapping
+
+    year = int(year)
+    confidence_threshold = float(confidence_threshold)
+    mapper = AIAccountMapper()
+    total = _unmapped_count(ja_code, year, file_type)
+    context.progress(0, total, "完全一致マッピング", force=True)
+    exact = mapper.exact_match_accounts(ja_code, year, file_type)
+    exact_mapped = exact.get('mapped', 0) if isinstance(exact, dict) else 0
+
+    # 他JAで同じ勘定科目名をマッピングしていれば、AIを使わずにナレッジベースから登録する
+    remaining = _unmapped_count(ja_code, year, file_type)
+    context.progress(total - remaining, total, "ナレッジベースによるマッピング", force=True)
+    knowledge = apply_knowledge_mapping([ja_code], [year], [file_type])
+    knowledge_mapped = knowledge.get('mapped', 0)
+
+    # マッピングできなかった勘定科目は未マッピングのまま残るため、その件数だけ読み飛ばして次のバッチを取得する
+    ai_mapped = 0
+    skipped = 0
+    while True:
+        remaining = _unmapped_count(ja_code, year, file_type)
+        context.progress(total - remaining, total, f"AIマッピング（残り{remaining}件）", force=True)
+        if remaining <= skipped:
+            break
+        batch = mapper.ai_map_accounts(
+            ja_code, year, file_type,
+            confidence_threshold=confidence_threshold,
+            batch_size=MAPPING_BATCH_SIZE,
+            offset=skipped
+        )
+        mapped = batch.get('mapped', 0)
+        unmapped = batch.get('unmapped', 0)
+        if mapped + unmapped == 0 or batch.get('total', 0) == 0:
+            break
+        ai_mapped += mapped
+        skipped += unmapped
+
+    remaining = _unmapped_count(ja_code, year, file_type)
+    context.progress(total - remaining, total, "完了", force=True)
+    return {'total': total, 'exact_mapped': exact_mapped, 'knowledge_mapped': knowledge_mapped,
+            'ai_mapped': ai_mapped, 'unmapped': remaining}
+
+
+@job_type('knowledge_mapping')
+def knowledge_mapping_job(context, ja_codes, years=None, file_types=None, min_votes=1, min_confidence=0.8):
+    """複数のJA・年度の未マッピング勘定科目を、ナレッジベースから1回のSQLでまとめてマッピングする（新規JAの一括登録時）"""
+    from reference_mapping import apply_knowledge_mapping
+
+    if isinstance(ja_codes, str):
+        ja_codes = [ja_code.strip() for ja_code in ja_codes.split(',') if ja_code.strip()]
+    if isinstance(years, str):
+        years = [int(year) for year in years.split(',') if year.strip()]
+    if isinstance(file_types, str):
+        file_types = [file_type.strip() for file_type in file_types.split(',') if file_type.strip()]
+    context.progress(0, 1, "ナレッジベースによるマッピング", force=True)
+    result = apply_knowledge_mapping(
+        ja_codes, years, file_types or ('bs', 'pl', 'cf'),
+        min_votes=int(min_votes), min_confidence=float(min_confidence)
+    )
+    if result['status'] != 'success':
+        raise RuntimeError(result['message'])
+    context.progress(1, 1, "完了", force=True)
+    return result
+
+
+@job_type('recreate_balances')
+def recreate_balances_job(context, ja_code, year, file_type=None):
+    """標準勘定科目残高を再作成する（file_type を省略した場合は bs, pl, cf の全て）"""
+    from balance_generation import rebuild_balances
+
+    file_types = [file_type] if file_type else ['bs', 'pl', 'cf']
+    results = {}
+    for i, statement_type in enumerate(file_types):
+        context.progress(i, len(file_types), f"{statement_type.upper()}残高を再作成しています", force=True)
+        results[statement_type] = rebuild_balances(ja_code, int(year), statement_type, force=True)
+    context.progress(len(file_types), len(file_types), "完了", force=True)
+    return results
+
+
+@job_type('recalculate_indicators')
+def recalculate_indicators_job(context, ja_code, year):
+    """全カテゴリの財務指標を再計算し、変更のあった指標のみ置き換える"""
+    from financial_indicators import FinancialIndicators
+    from balance_snapshot import BalanceSnapshot
+    from analysis_result_writer import AnalysisResultWriter
+
+    year = int(year)
+    categories = [
+        ('流動性', FinancialIndicators.calculate_liquidity_indicators),
+        ('収益性', FinancialIndicators.calculate_profitability_indicators),
+        ('安全性', FinancialIndicators.calculate_safety_indicators),
+        ('効率性', FinancialIndicators.calculate_efficiency_indicators),
+        ('キャッシュフロー', FinancialIndicators.calculate_cash_flow_indicators),
+    ]
+    writer = AnalysisResultWriter(ja_code, year, diff=True)
+    snapshot = BalanceSnapshot.load(ja_code, year)
+    errors = []
+    for i, (label, calculate) in enumerate(categories):
+        context.progress(i, len(categories), f"{label}指標を計算しています", force=True)
+        try:
+            calculate(ja_code, year, snapshot, writer)
+        except Exception as e:
+            logger.warning(f"{label}指標計算エラー: {str(e)}")
+            errors.append(f"{label}指標: {str(e)}")
+    context.progress(len(categories), len(categories), "分析結果を書き込んでいます", force=True)
+    stats = writer.write()
+    return {'stats': stats, 'errors': errors}
+
+
+def upload_path(upload_id, suffix='.csv'):
+    """
+    アップロードIDから UPLOAD_FOLDER 内のファイルのパスを返す
+
+    Raises:
+        ValueError: アップロードIDが不正な場合
+    """
+    if not isinstance(upload_id, str) or not UPLOAD_ID_PATTERN.match(upload_id):
+        raise ValueError(f"アップロードIDが不正です: {upload_id}")
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}{suffix}")
+
+
+def new_upload_path(suffix='.csv'):
+    """
+    ジョブに渡すファイルを保存するパスを作成する
+
+    Returns:
+        tuple: (アップロードID, パス)
+    """
+    upload_id = uuid.uuid4().hex
+    return upload_id, upload_path(upload_id, suffix)
+
+
+@job_type('import_standard_accounts')
+def import_standard_accounts_job(context, upload_id, financial_statement, replace_existing=False):
+    """アップロード済みの標準勘定科目CSVを登録する（成功・失敗に関わらず終了後にファイルを削除する）"""
+    from data_processor import DataProcessor
+    from encoding_detector import read_csv_bytes
+
+    filepath = upload_path(upload_id)
+    try:
+        with open(filepath, 'rb') as f:
+            df, _ = read_csv_bytes(f.read())
+        missing_columns = [column for column in ('code', 'name', 'category') if column not in df.columns]
+        if missing_columns:
+            raise ValueError(f"CSVファイルに必要なカラムがありません: {', '.join(missing_columns)}")
+
+        context.progress(0, len(df), "標準勘定科目を登録しています", force=True)
+        imported_count = DataProcessor.import_standard_accounts(
+            df, financial_statement, replace_existing,
+            progress=lambda done, total: context.progress(done, total)
+        )
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+    return {'imported': imported_count}
+
+
+# 一括取込で受け付けるアップロードファイルの拡張子（ZIPファイルと batch_import.SUPPORTED_EXTENSIONS）
+BATCH_UPLOAD_SUFFIXES = ('.zip', '.csv', '.xlsx', '.xls')
+
+
+def batch_upload_suffix(filename):
+    """
+    一括取込のアップロードファイルを保存する拡張子を返す
+
+    Raises:
+        ValueError: 一括取込の対象外のファイルの場合
+    """
+    suffix = os.path.splitext(filename or '')[1].lower()
+    if suffix not in BATCH_UPLOAD_SUFFIXES:
+        raise ValueError(f"一括取込の対象外のファイルです: {filename}")
+    return suffix
+
+
+@job_type('batch_import')
+def batch_import_job(context, uploads, ja_code=None, year=None, diff=False):
+    """
+    アップロード済みの複数ファイル・ZIPファイルを一括で取り込む（成功・失敗に関わらず終了後にファイルを削除する）
+
+    Args:
+        uploads: {'upload_id', 'filename'} のリスト（filename は取込先の判定に使用する元のファイル名）
+
+    Returns:
+        dict: batch_import.import_batch の結果（ファイルごとの取込結果と集計）
+    """
+    from batch_import import import_batch, read_zip
+
+    filepaths = [upload_path(upload['upload_id'], batch_upload_suffix(upload['filename'])) for upload in uploads]
+    try:
+        context.progress(0, None, "ファイルを解析しています", force=True)
+        files = []
+        for upload, filepath in zip(uploads, filepaths):
+            if filepath.endswith('.zip'):
+                files.extend(read_zip(filepath))
+            else:
+                with open(filepath, 'rb') as f:
+                    files.append((upload['filename'], f.read()))
+        report = import_batch(
+            files, ja_code=ja_code, year=year, diff=bool(diff),
+            progress=lambda done, total: context.progress(done, total, f"登録しています（{done}/{total}）")
+        )
+    finally:
+        for filepath in filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+    return report
@@ -0,0 +1,188 @@
+"""
+標準勘定科目残高の作成（マッピング済みCSVデータからの一括作成）
+csv_data と account_mapping を結合した1回の読み込みと、一括INSERTで残高を作成する
+"""
+
+import logging
+from datetime import datetime
+from app import db
+from models import CSVData, AccountMapping, StandardAccountBalance
+from utils import normalize_string
+from performance_enhancer import mark_cache_dirty
+
+logger = logging.getLogger(__name__)
+
+# CSVデータのカテゴリ → statement_subtype の対応表（先に一致したものを使用）
+CATEGORY_SUBTYPES = {
+    "bs": (
+        ("純資産", "BS純資産"),
+        ("資産", "BS資産"),
+        ("負債", "BS負債"),
+    ),
+    "pl": (
+        ("収益", "PL収益"),
+        ("収入", "PL収益"),
+        ("売上", "PL収益"),
+        ("費用", "PL費用"),
+        ("支出", "PL費用"),
+        ("原価", "PL費用"),
+        ("損失", "PL費用"),
+    ),
+    "cf": (
+        ("営業活動", "CF営業活動"),
+        ("投資活動", "CF投資活動"),
+        ("財務活動", "CF財務活動"),
+        ("現金", "CF現金同等物"),
+    ),
+}
+
+# カテゴリが対応表に無い場合の statement_subtype
+# PLはカテゴリが無くても費用として扱う（収益は上部、費用は下部に表示されることが多いため）
+DEFAULT_SUBTYPES = {"bs": "その他", "pl": "PL費用", "cf": "CF"}
+
+INSERT_CHUNK = 500
+
+
+def statement_subtype_for(statement_type, category):
+    """CSVデータのカテゴリから statement_subtype を決定する"""
+    category = category or ""
+    for keyword, subtype in CATEGORY_SUBTYPES.get(statement_type, ()):
+        if keyword in category:
+            return subtype
+    return DEFAULT_SUBTYPES.get(statement_type, "その他")
+
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else 0
+    except (ValueError, TypeError):
+        return 0
+
+
+def _load_mapped_rows(ja_code, year, statement_type):
+    """マッピング済みCSVデータとマッピング先の標準勘定科目を1回のクエリで取得する"""
+    rows = db.session.query(
+        CSVData.id,
+        CSVData.category,
+        CSVData.current_value,
+        CSVData.previous_value,
+        AccountMapping.standard_account_code,
+        AccountMapping.standard_account_name
+    ).join(
+        AccountMapping,
+        (AccountMapping.ja_code == CSVData.ja_code) &
+        (AccountMapping.original_account_name == CSVData.account_name) &
+        (AccountMapping.financial_statement == CSVData.file_type)
+    ).filter(
+        CSVData.ja_code == ja_code,
+        CSVData.year == year,
+        CSVData.file_type == statement_type,
+        CSVData.is_mapped == True
+    ).order_by(CSVData.id, AccountMapping.id).all()
+
+    # 同じ勘定科目名のマッピングが重複している場合は最後に登録されたものを使用する
+    by_csv_id = {}
+    for row in rows:
+        by_csv_id[row[0]] = row
+    return list(by_csv_id.values())
+
+
+def build_balances(ja_code, year, statement_type, account_codes=None, replace_all=False, commit=True):
+    """
+    マッピング済みCSVデータから標準勘定科目残高を作成する
+
+    同じ標準勘定科目にマッピングされた複数のCSV行は1つの残高に合計する。
+    科目名と statement_subtype は最初のCSV行（id順）から決定する。
+
+    Args:
+        ja_code: JA code
+        year: Financial year
+        statement_type: Type of financial statement (bs, pl, cf)
+        account_codes: 作成する標準勘定科目コード（Noneの場合はマッピングされた全科目）
+        replace_all: Trueの場合は対象の残高を全て削除してから作成する（合計科目も削除される）
+                     Falseの場合は作成する科目と account_codes の残高のみ置き換える
+        commit: Trueの場合はコミットする
+
+    Returns:
+        dict: deleted（削除件数）, created（作成件数）, changed_codes（値が変わった科目コードのリスト）
+    """
+    year = int(year)
+    if account_codes is not None:
+        account_codes = set(account_codes)
+
+    # 科目コードごとに集計（CSV行の順序を維持）
+    balances = {}
+    for _, category, current_value, previous_value, code, name in _load_mapped_rows(ja_code, year, statement_type):
+        if account_codes is not None and code not in account_codes:
+            continue
+        entry = balances.get(code)
+        if entry is None:
+            entry = {
+                'statement_subtype': statement_subtype_for(statement_type, category),
+                'standard_account_name': name,
+                'current_value': 0,
+                'previous_value': 0,
+            }
+            balances[code] = entry
+        entry['current_value'] += _to_float(current_value)
+        entry['previous_value'] += _to_float(previous_value)
+
+    table = StandardAccountBalance.__table__
+    scope = [
+        table.c.ja_code == ja_code,
+        table.c.year == year,
+        table.c.statement_type == statement_type,
+    ]
+    replaced_codes = set(balances)
+    if account_codes is not None:
+        replaced_codes |= account_codes
+
+    try:
+        # 置き換える科目の既存の値（変更検知用）
+        existing_query = db.select(table.c.standard_account_code, table.c.current_value, table.c.previous_value).where(*scope)
+        if not replace_all:
+            existing_query = existing_query.where(table.c.standard_account_code.in_(replaced_codes))
+        existing = {}
+        for code, current_value, previous_value in db.session.execute(existing_query):
+            total = existing.setdefault(code, [0, 0])
+            total[0] += current_value or 0
+            total[1] += previous_value or 0
+
+        delete = table.delete().where(*scope)
+        if not replace_all:
+            delete = delete.where(table.c.standard_account_code.in_(replaced_codes))
+        deleted = db.session.execute(delete).rowcount if (replace_all or replaced_codes) else 0
+
+        now = datetime.utcnow()
+        records = [
+            {
+                'ja_code': ja_code,
+                'year': year,
+                'statement_type': statement_type,
+                'statement_subtype': normalize_string(entry['statement_subtype'], for_db=True),
+                'standard_account_code': code,
+                'standard_account_name': normalize_string(entry['standard_account_name'], for_db=True),
+                'current_value': entry['current_value'],
+                'previous_value': entry['previous_value'],
+                'created_at': now,
+            }
+            for code, entry in balances.items()
+        ]
+        for start in range(0, len(records), INSERT_CHUNK):
+            db.session.execute(table.insert(), records[start:start + INSERT_CHUNK])
+        mark_cache_dirty(db.session, ja_code, year)
+
+        if commit:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    changed_codes = [
+        code for code in sorted(set(existing) | set(balances))
+        if code not in balances or code not in existing
+        or existing[code] != [balances[code]['current_value'], balances[code]['previous_value']]
+    ]
+    logger.info(f"残高を作成しました: JA={ja_code}, 年度={year}, タイプ={statement_type}, "
+                f"削除={deleted}件, 作成={len(records)}件, 変更={len(changed_codes)}件")
+    return {'deleted': deleted, 'created': len(records), 'changed_codes': changed_codes}
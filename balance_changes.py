@@ -0,0 +1,193 @@
+"""
+残高変更の追跡と差分再計算
+マッピング変更などで値が変わった標準勘定科目残高を記録し、影響を受ける合計科目と財務指標だけを再計算する
+"""
+
+import logging
+from app import db
+from models import StandardAccountBalance, AnalysisResult, BalanceGeneration, mark_balances_refreshed
+from account_hierarchy import get_account_hierarchy
+from account_calculator import AccountCalculator
+from analysis_result_writer import AnalysisResultWriter
+from balance_builder import build_balances
+from balance_snapshot import BalanceSnapshot
+from financial_indicators import FinancialIndicators
+from formula_plan import FormulaPlan
+from indicator_engine import ANALYSIS_TYPES
+
+logger = logging.getLogger(__name__)
+
+# 各指標カテゴリが参照する勘定科目（financial_indicators.py の get_account_value 呼び出しに対応）
+INDICATOR_ACCOUNTS = {
+    'liquidity': {
+        'bs': ("10000", "11110", "11160", "11170", "11000", "11200", "11300", "21000", "20000",
+               "3000", "3100", "3200", "3300", "3400", "3500", "3600", "3605", "1010", "1020", "1110"),
+    },
+    'profitability': {
+        'pl': ("80000", "90000", "99000", "93000", "60000", "50000", "40000"),
+        'bs': ("10000", "5950", "30000", "31000", "32000"),
+    },
+    'safety': {
+        'bs': ("10000", "20000", "30000", "5900", "31000", "32000"),
+    },
+    'efficiency': {
+        'pl': ("40000", "7100"),
+        'bs': ("10000", "1130", "1140", "3110"),
+    },
+    'cash_flow': {
+        'cf': ("110000", "12000"),
+        'bs': ("4900",),
+        'pl': ("6000", "9900"),
+    },
+}
+
+
+def affected_analysis_types(statement_type, account_codes):
+    """
+    変更された勘定科目を参照する指標カテゴリを返す
+
+    Args:
+        statement_type: 財務諸表のタイプ (bs, pl, cf)
+        account_codes: 値が変更された勘定科目コード（集計先の親科目を含む）
+
+    Returns:
+        list: 指標カテゴリのリスト（ANALYSIS_TYPESの順）
+    """
+    codes = set(account_codes)
+    return [
+        analysis_type for analysis_type in ANALYSIS_TYPES
+        if codes.intersection(INDICATOR_ACCOUNTS[analysis_type].get(statement_type, ()))
+    ]
+
+
+class BalanceChangeSet:
+    """
+    変更された (ja_code, year, statement_type, standard_account_code) を集め、差分再計算を行うクラス
+
+    使用例:
+        changes = BalanceChangeSet()
+        changes.remap(ja_code, year, file_type, [old_code, new_code])
+        db.session.commit()
+        changes.propagate()
+    """
+
+    def __init__(self):
+        # {(ja_code, year): {statement_type: set(account_codes)}}
+        self._changes = {}
+
+    def add(self, ja_code, year, statement_type, account_code):
+        """値が変更された残高を記録する"""
+        if not account_code:
+            return
+        scope = self._changes.setdefault((ja_code, int(year)), {})
+        scope.setdefault(statement_type, set()).add(account_code)
+
+    def __len__(self):
+        return sum(len(codes) for scope in self._changes.values() for codes in scope.values())
+
+    def remap(self, ja_code, year, statement_type, account_codes):
+        """
+        マッピングの変更後、影響を受ける標準勘定科目の残高だけを再作成して記録する（コミット前に呼び出し、コミットしない）
+
+        残高が作成済みで最新の場合のみ差分で更新し、マッピング変更による世代の更新からその年度を除く。
+        未作成または既に古い場合は、次回の表示時（またはマッピング確定時）に全体が作成されるため対象外とする。
+
+        Args:
+            ja_code: JA code
+            year: Financial year
+            statement_type: 財務諸表のタイプ (bs, pl, cf)
+            account_codes: マッピング変更前後の標準勘定科目コード
+        """
+        account_codes = [code for code in dict.fromkeys(account_codes) if code]
+        if not account_codes:
+            return
+
+        year = int(year)
+        # 変更中のマッピングがフラッシュされる前に、変更前の世代を確認する
+        with db.session.no_autoflush:
+            generation = BalanceGeneration.query.filter_by(
+                ja_code=ja_code,
+                year=year,
+                statement_type=statement_type
+            ).first()
+        if generation is None or generation.built_generation < generation.source_generation:
+            logger.debug(f"残高が未作成または古いため差分更新を省略: JA={ja_code}, year={year}, type={statement_type}")
+            return
+
+        mark_balances_refreshed(db.session, ja_code, statement_type, year)
+        built = build_balances(ja_code, year, statement_type, account_codes=account_codes, commit=False)
+        for code in built['changed_codes']:
+            self.add(ja_code, year, statement_type, code)
+
+    def propagate(self):
+        """
+        記録した変更を合計科目（AccountFormula）と財務指標（AnalysisResult）に反映する
+        既存の合計科目・分析結果があるものだけを更新し、新たには作成しない
+
+        Returns:
+            dict: totals（再計算した合計科目数）, indicators（再計算した (JA, 年度, カテゴリ) の数）
+        """
+        stats = {'totals': 0, 'indicators': 0}
+        plans = {}
+        hierarchy = get_account_hierarchy()
+
+        for (ja_code, year), scope in self._changes.items():
+            try:
+                analysis_types = set()
+                for statement_type, codes in scope.items():
+                    dirty = set(codes)
+
+                    # 変更された科目に依存する合計科目を再計算
+                    if statement_type not in plans:
+                        plans[statement_type] = FormulaPlan.compile(statement_type)
+                    plan = plans[statement_type].downstream(dirty)
+                    if plan and self._has_balances(ja_code, year, statement_type, plan.target_codes):
+                        stats['totals'] += AccountCalculator.calculate_account_totals(
+                            ja_code, year, statement_type, plan=plan
+                        )
+                        dirty.update(plan.target_codes)
+
+                    # 子科目の合計として値を返す親科目も変更対象に含める
+                    for code in list(dirty):
+                        dirty.update(hierarchy.ancestors(code))
+                    analysis_types.update(affected_analysis_types(statement_type, dirty))
+
+                if not analysis_types:
+                    continue
+
+                # 既に計算済みのカテゴリだけを再計算する
+                existing_types = [
+                    row[0] for row in db.session.query(AnalysisResult.analysis_type).filter(
+                        AnalysisResult.ja_code == ja_code,
+                        AnalysisResult.year == year,
+                        AnalysisResult.analysis_type.in_(analysis_types)
+                    ).distinct().all()
+                ]
+                if not existing_types:
+                    continue
+                existing_types = [t for t in ANALYSIS_TYPES if t in existing_types]
+
+                writer = AnalysisResultWriter(ja_code, year, analysis_types=existing_types, diff=True)
+                snapshot = BalanceSnapshot.load(ja_code, year)
+                for analysis_type in existing_types:
+                    calculate = getattr(FinancialIndicators, f"calculate_{analysis_type}_indicators")
+                    calculate(ja_code, year, snapshot, writer)
+                writer.write()
+                stats['indicators'] += len(existing_types)
+                logger.info(f"差分再計算: JA={ja_code}, year={year}, 指標カテゴリ={existing_types}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"差分再計算中にエラー: JA={ja_code}, year={year}: {str(e)}")
+
+        self._changes.clear()
+        return stats
+
+    @staticmethod
+    def _has_balances(ja_code, year, statement_type, account_codes):
+        """指定した科目の残高が1件でも存在するか（合計科目が計算済みか）を確認する"""
+        return db.session.query(StandardAccountBalance.id).filter(
+            StandardAccountBalance.ja_code == ja_code,
+            StandardAccountBalance.year == year,
+            StandardAccountBalance.statement_type == statement_type,
+            StandardAccountBalance.standard_account_code.in_(account_codes)
+        ).first() is not None
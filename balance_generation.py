@@ -0,0 +1,134 @@
+"""
+標準勘定科目残高の世代管理と遅延再作成
+元データ（CSVData・AccountMapping）の世代が前回の作成時から進んでいる場合のみ残高を作り直す
+"""
+
+import logging
+from datetime import datetime
+from app import db
+from models import BalanceGeneration, AccountMapping, bump_balance_generation
+from balance_builder import build_balances
+
+logger = logging.getLogger(__name__)
+
+
+def _get_or_create_generation(ja_code, year, financial_statement):
+    """世代レコードを取得する（無い場合は未作成状態で作成する）"""
+    generation = BalanceGeneration.query.filter_by(
+        ja_code=ja_code,
+        year=year,
+        statement_type=financial_statement
+    ).first()
+    if generation is not None:
+        return generation
+
+    # 世代レコードが無い = 世代管理の導入前に作成された残高、またはまだ一度も作成していない
+    generation = BalanceGeneration(
+        ja_code=ja_code,
+        year=year,
+        statement_type=financial_statement,
+        source_generation=0,
+        built_generation=-1
+    )
+    db.session.add(generation)
+    try:
+        db.session.commit()
+    except Exception:
+        # 同時に作成された場合は既存のレコードを使用
+        db.session.rollback()
+        generation = BalanceGeneration.query.filter_by(
+            ja_code=ja_code,
+            year=year,
+            statement_type=financial_statement
+        ).first()
+    return generation
+
+
+def rebuild_balances(ja_code, year, financial_statement, force=False):
+    """
+    必要な場合のみ標準勘定科目残高を再作成する
+
+    同時に複数のリクエストが来た場合でも、世代レコードの条件付きUPDATEで再作成を1つに限定する。
+
+    Args:
+        ja_code: JA code
+        year: Financial year
+        financial_statement: Type of financial statement (bs, pl, cf)
+        force: Trueの場合は世代に関わらず再作成する
+
+    Returns:
+        dict or None: 再作成した場合は deleted, created の件数、不要な場合はNone
+    """
+    year = int(year)
+    generation = _get_or_create_generation(ja_code, year, financial_statement)
+    source_generation = generation.source_generation
+    if not force and generation.built_generation >= source_generation:
+        return None
+
+    table = BalanceGeneration.__table__
+    conditions = [table.c.id == generation.id]
+    if not force:
+        conditions.append(table.c.built_generation < source_generation)
+
+    try:
+        # 再作成する権利を取得（他のリクエストが先に再作成した場合は0件になる）
+        claimed = db.session.execute(
+            table.update()
+            .where(*conditions)
+            .values(built_generation=source_generation, built_at=datetime.utcnow())
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return None
+
+        built = build_balances(ja_code, year, financial_statement, replace_all=True, commit=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logger.info(f"残高を再作成しました: JA={ja_code}, 年度={year}, タイプ={financial_statement}, "
+                f"世代={source_generation}, 削除={built['deleted']}件, 作成={built['created']}件")
+    return {'deleted': built['deleted'], 'created': built['created']}
+
+
+def refresh_changed_balances(ja_code, year, financial_statement, account_names):
+    """
+    CSVデータの一部の勘定科目が変わった場合に、影響する標準勘定科目の残高のみを作り直す（コミットしない）
+
+    残高が作成済みで最新の場合のみ差分で更新する。未作成または既に古い場合は世代を進め、
+    次回の表示時に全体を再作成する。
+
+    Args:
+        ja_code: JA code
+        year: Financial year
+        financial_statement: Type of financial statement (bs, pl, cf)
+        account_names: 変更されたCSVデータの勘定科目名のリスト
+
+    Returns:
+        dict or None: 差分で更新した場合は build_balances の結果、世代を進めた場合はNone
+    """
+    account_names = list(account_names)
+    if not account_names:
+        return {'deleted': 0, 'created': 0, 'changed_codes': []}
+
+    year = int(year)
+    generation = BalanceGeneration.query.filter_by(
+        ja_code=ja_code,
+        year=year,
+        statement_type=financial_statement
+    ).first()
+    if generation is None or generation.built_generation < generation.source_generation:
+        bump_balance_generation(db.session.connection(), ja_code, financial_statement, year)
+        return None
+
+    account_codes = [
+        code for (code,) in db.session.query(AccountMapping.standard_account_code).filter(
+            AccountMapping.ja_code == ja_code,
+            AccountMapping.financial_statement == financial_statement,
+            AccountMapping.original_account_name.in_(account_names)
+        ).distinct()
+    ]
+    if not account_codes:
+        return {'deleted': 0, 'created': 0, 'changed_codes': []}
+    return build_balances(ja_code, year, financial_statement, account_codes=account_codes, commit=False)
@@ -0,0 +1,146 @@
+"""
+JA・年度単位の標準勘定科目残高スナップショット
+財務指標計算で勘定科目ごとに発行していたクエリを、残高の一括読み込みとメモリ上の参照に置き換える
+"""
+
+import logging
+from app import db
+from models import StandardAccountBalance
+from account_hierarchy import get_account_hierarchy
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceSnapshot:
+    """
+    1つのJA・年度のbs/pl/cf残高をまとめて保持するクラス
+
+    使用例:
+        snapshot = BalanceSnapshot.load(ja_code, year)
+        value, name = snapshot.get_account_value("bs", "10000")
+    """
+
+    def __init__(self, ja_code, year, balances, hierarchy):
+        """
+        Args:
+            ja_code: JA code
+            year: Financial year
+            balances: {(statement_type, code): {'value', 'name', 'count'}} の辞書
+            hierarchy: 標準勘定科目の親子関係インデックス（AccountHierarchy）
+        """
+        self.ja_code = ja_code
+        self.year = year
+        self._balances = balances
+        self._hierarchy = hierarchy
+
+    @classmethod
+    def load(cls, ja_code, year):
+        """
+        JA・年度の全残高を一括で読み込む（親子関係は共有インデックスを使用）
+
+        Args:
+            ja_code: JA code
+            year: Financial year
+
+        Returns:
+            BalanceSnapshot: 読み込んだスナップショット
+        """
+        rows = db.session.query(
+            StandardAccountBalance.statement_type,
+            StandardAccountBalance.standard_account_code,
+            StandardAccountBalance.standard_account_name,
+            StandardAccountBalance.current_value
+        ).filter(
+            StandardAccountBalance.ja_code == ja_code,
+            StandardAccountBalance.year == year
+        ).order_by(StandardAccountBalance.id).all()
+
+        # 同じコードを持つ複数のレコードは合計し、名前は最初のレコードから取得する
+        balances = {}
+        for statement_type, code, name, current_value in rows:
+            entry = balances.get((statement_type, code))
+            if entry is None:
+                entry = {'value': 0, 'name': name, 'count': 0, 'first_value': current_value}
+                balances[(statement_type, code)] = entry
+            if current_value is not None:
+                entry['value'] += current_value
+            entry['count'] += 1
+
+        logger.debug(f"残高スナップショット読み込み: JA={ja_code}, year={year}, 残高={len(rows)}件")
+        return cls(ja_code, year, balances, get_account_hierarchy())
+
+    def _sum_codes(self, statement_type, codes):
+        """指定コード群の残高合計と、見つかったレコード数を返す"""
+        total_value = 0
+        record_count = 0
+        for code in codes:
+            entry = self._balances.get((statement_type, code))
+            if entry:
+                total_value += entry['value']
+                record_count += entry['count']
+        return total_value, record_count
+
+    def get_account_value(self, statement_type, account_code):
+        """
+        勘定科目の現在値を取得する
+        親勘定科目（例：流動資産）の残高が無い場合、子勘定科目（例：現金・預金）の合計を計算
+
+        Args:
+            statement_type: Type of financial statement (bs, pl, cf)
+            account_code: Standard account code
+
+        Returns:
+            tuple: (float: Account value or 0 if not found, str: Account name or '不明な科目')
+        """
+        # NoneやNaNをチェック
+        if account_code is None:
+            logger.warning("get_account_value: account_codeがNoneです")
+            return 0, "不明な科目"
+
+        # 文字列型に変換（数字で受け取った場合も対応）
+        if not isinstance(account_code, str):
+            account_code = str(account_code)
+
+        # 特定のコードのハードコードされた処理（問題のある科目コード対応）
+        if account_code == "3200":  # 債券
+            return 0, "債券"
+
+        # 直接の勘定科目
+        entry = self._balances.get((statement_type, account_code))
+        if entry:
+            account_name = entry['name'] or f"科目{account_code}"
+            logger.debug(f"勘定科目 {account_code} ({account_name}) の値: {entry['value']} (レコード数: {entry['count']})")
+            return entry['value'], account_name
+
+        parent_name = self._hierarchy.name(account_code) or f"{account_code}の科目"
+
+        # 親科目の場合は子科目の合計を計算
+        child_codes = self._hierarchy.children(account_code)
+        if child_codes:
+            total_value, record_count = self._sum_codes(statement_type, child_codes)
+            if record_count:
+                logger.debug(f"子勘定科目合計: {total_value} ({record_count} 勘定科目)")
+                return total_value, parent_name
+
+        # デフォルトの親子関係定義を使用（互換性のため）
+        default_child_codes = self._hierarchy.default_children(account_code)
+        if default_child_codes:
+            total_value, record_count = self._sum_codes(statement_type, default_child_codes)
+            logger.debug(f"デフォルト親子定義による合計: {total_value} ({record_count} 勘定科目)")
+            return total_value, parent_name
+
+        # 該当する科目が見つからない場合
+        logger.debug(f"勘定科目 {account_code} が見つかりません")
+        return 0, f"{account_code}の科目"
+
+    def get_first_record(self, statement_type, account_code):
+        """
+        勘定科目の最初のレコードの値と名前を取得する（子科目の集計は行わない）
+
+        Returns:
+            tuple: (float or None, str or None) レコードが無い場合は (None, None)
+        """
+        entry = self._balances.get((statement_type, account_code))
+        if not entry:
+            return None, None
+        return entry['first_value'], entry['name']
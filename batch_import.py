@@ -0,0 +1,323 @@
+"""
+財務諸表ファイルの一括取込（ディレクトリ・ZIPファイル）
+ファイル名からJAコード・年度・財務諸表タイプを判定し、プロセスプールで解析してから
+(JA, 年度, タイプ) ごとに1トランザクションで登録する
+
+使用例:
+    python batch_import.py 2023年度決算.zip
+    python batch_import.py /data/kessan --year 2023 --workers 8 --dry-run
+"""
+
+import os
+import re
+import sys
+import zipfile
+import logging
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from statement_parser import parse_statement_file
+
+# アプリケーション（データベース）は登録時に読み込む
+# プロセスプールのワーカーはこのモジュールを読み込み直すため、ここではデータベースに接続しない
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+
+# ファイル名（ディレクトリ名を含む）の区切り文字
+NAME_SEPARATORS = re.compile(r'[\\/_\-\s.　]+')
+# JAコードとして扱うトークン（登録済みのJAコードに一致しない場合）
+JA_CODE_PATTERN = re.compile(r'^JA[0-9A-Za-z]+$', re.IGNORECASE)
+# 年度として扱うトークン: 2023, 2023年, 2023年度, 令和5年度, R5
+YEAR_PATTERN = re.compile(r'^((?:19|20)\d{2})(?:年度?)?$')
+REIWA_PATTERN = re.compile(r'^(?:令和|R)(\d{1,2})(?:年度?)?$', re.IGNORECASE)
+REIWA_BASE_YEAR = 2018
+# 財務諸表タイプのキーワード（一致しない場合は DataProcessor.detect_file_type で判定）
+FILE_TYPE_KEYWORDS = (
+    ('bs', ('bs', '貸借対照表')),
+    ('pl', ('pl', '損益計算書')),
+    ('cf', ('cf', 'キャッシュフロー計算書', 'キャッシュ・フロー計算書', 'キャッシュフロー')),
+)
+
+# これより少ないファイル数の場合はプロセスを起動せずに解析する
+PARALLEL_THRESHOLD = 4
+
+
+def _zip_member_name(info):
+    """ZIPのファイル名を復元する（UTF-8フラグの無い日本語ファイル名はcp932として扱う）"""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('cp932')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def _is_supported(name):
+    basename = os.path.basename(name)
+    if basename.startswith('.') or '__MACOSX' in name:
+        return False
+    return os.path.splitext(basename.lower())[1] in SUPPORTED_EXTENSIONS
+
+
+def read_zip(source):
+    """
+    ZIPファイルから取込対象のファイルを読み込む
+
+    Args:
+        source: ZIPファイルのパスまたはファイルオブジェクト
+
+    Returns:
+        list: (ファイル名, 内容) のリスト
+    """
+    files = []
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = _zip_member_name(info)
+            if _is_supported(name):
+                files.append((name, archive.read(info)))
+    return files
+
+
+def collect_files(source):
+    """
+    ディレクトリまたはZIPファイルから取込対象のファイルを読み込む
+
+    Args:
+        source: ディレクトリまたはZIPファイルのパス
+
+    Returns:
+        list: (相対パス, 内容) のリスト（ファイル名順）
+    """
+    if os.path.isdir(source):
+        files = []
+        for root, _, names in os.walk(source):
+            for name in names:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, source).replace(os.sep, '/')
+                if _is_supported(relative):
+                    with open(path, 'rb') as f:
+                        files.append((relative, f.read()))
+    elif zipfile.is_zipfile(source):
+        files = read_zip(source)
+    else:
+        raise ValueError(f"ディレクトリまたはZIPファイルを指定してください: {source}")
+    return sorted(files, key=lambda item: item[0])
+
+
+def infer_import_target(name, known_ja_codes=(), ja_code=None, year=None, require_file_type=True):
+    """
+    ファイル名（ディレクトリ名を含む）から取込先を判定する
+
+    命名規則: パスをトークン（_ - . 空白 / で区切る）に分割し、
+      - JAコード: 登録済みのJAコードに一致するトークン、無ければ JA で始まるトークン
+      - 年度: 2023 / 2023年度 / 令和5年度 / R5 の形式のトークン
+      - 財務諸表タイプ: bs / pl / cf または 貸借対照表 / 損益計算書 / キャッシュフロー計算書、
+        無ければ DataProcessor.detect_file_type で判定
+    例: JA001_2023_bs.csv, JA001/令和5年度/損益計算書.xlsx
+
+    Args:
+        name: ファイルの相対パス
+        known_ja_codes: 登録済みのJAコード
+        ja_code: ファイル名から判定できない場合のJAコード
+        year: ファイル名から判定できない場合の年度
+        require_file_type: Falseの場合は財務諸表タイプを判定できなくてもエラーにしない（file_type は None）
+
+    Returns:
+        tuple: (ja_code, year, file_type)
+
+    Raises:
+        ValueError: 判定できない項目がある場合
+    """
+    stem = os.path.splitext(name)[0]
+    tokens = [token for token in NAME_SEPARATORS.split(stem) if token]
+    known = {code.upper(): code for code in known_ja_codes}
+
+    found_ja_code = next((known[token.upper()] for token in tokens if token.upper() in known), None)
+    if found_ja_code is None:
+        found_ja_code = next((token.upper() for token in tokens if JA_CODE_PATTERN.match(token)), None)
+
+    found_year = None
+    for token in tokens:
+        match = YEAR_PATTERN.match(token)
+        if match:
+            found_year = int(match.group(1))
+            break
+        match = REIWA_PATTERN.match(token)
+        if match:
+            found_year = REIWA_BASE_YEAR + int(match.group(1))
+            break
+
+    file_type = None
+    lowered = [token.lower() for token in tokens]
+    for candidate, keywords in FILE_TYPE_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            file_type = candidate
+            break
+    if file_type is None:
+        from data_processor import DataProcessor
+        file_type = DataProcessor.detect_file_type(os.path.basename(stem))
+
+    found_ja_code = found_ja_code or ja_code
+    found_year = found_year or (int(year) if year else None)
+    required = [('JAコード', found_ja_code), ('年度', found_year)]
+    if require_file_type:
+        required.append(('財務諸表タイプ', file_type))
+    missing = [label for label, value in required if not value]
+    if missing:
+        raise ValueError(f"ファイル名から{'・'.join(missing)}を判定できません")
+    return found_ja_code, found_year, file_type
+
+
+def parse_files(jobs, max_workers=None):
+    """
+    ファイルを解析する（ファイル数が多い場合はプロセスプールで並列に解析する）
+
+    Args:
+        jobs: (ファイル名, 内容, file_type) のリスト（file_type が None のExcelブックはシート名から判定）
+        max_workers: ワーカープロセス数（Noneの場合はCPU数）
+
+    Returns:
+        list: 各ファイルの ({file_type: 行のリスト}, エラー) のリスト（jobs と同じ順序）
+    """
+    results = []
+    if len(jobs) < PARALLEL_THRESHOLD or max_workers == 1:
+        for name, data, file_type in jobs:
+            try:
+                results.append((parse_statement_file(data, name, file_type), None))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    # Webアプリ（複数スレッド）から fork するとロックの状態などを引き継ぐため、その場合は新しいプロセスを起動する
+    if threading.active_count() == 1 and 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(parse_statement_file, data, name, file_type) for name, data, file_type in jobs]
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as e:
+                results.append((None, e))
+    return results
+
+
+def import_batch(files, ja_code=None, year=None, max_workers=None, dry_run=False, diff=False, progress=None):
+    """
+    複数の財務諸表ファイルを一括で取り込む
+
+    Args:
+        files: (ファイル名, 内容) のリスト（collect_files / read_zip の戻り値）
+        ja_code: ファイル名から判定できない場合のJAコード
+        year: ファイル名から判定できない場合の年度
+        max_workers: 解析に使用するワーカープロセス数
+        dry_run: Trueの場合は解析のみ行い、登録しない
+        diff: Trueの場合は既存データとの差分のみ反映する（DataProcessor.merge_rows）
+        progress: 登録の進捗を通知する関数 progress(登録済みの取込先数, 全取込先数)（省略可）
+
+    Returns:
+        dict: files（ファイルごとの結果）, summary（状態ごとのファイル数・登録行数）
+    """
+    from app import db
+    from models import JA
+    from data_processor import DataProcessor
+
+    known_ja_codes = [row[0] for row in db.session.query(JA.ja_code).all()]
+    results = []
+    jobs = []
+    for name, data in files:
+        result = {'file': name, 'ja_code': None, 'year': None, 'file_type': None,
+                  'status': 'pending', 'rows': 0, 'message': ''}
+        results.append(result)
+        try:
+            # BS・PL・CFをまとめたExcelブックはシート名から財務諸表タイプを判定する
+            result['ja_code'], result['year'], result['file_type'] = infer_import_target(
+                name, known_ja_codes, ja_code, year, require_file_type=not name.lower().endswith('.xlsx')
+            )
+        except ValueError as e:
+            result['status'] = 'skipped'
+            result['message'] = str(e)
+            continue
+        jobs.append((result, name, data))
+
+    # 解析（データベースを使用しないため並列に実行する）
+    parsed = parse_files([(name, data, result['file_type']) for result, name, data in jobs], max_workers)
+    batches = {}
+    for (result, _, _), (sheets, error) in zip(jobs, parsed):
+        if error is not None:
+            result['status'] = 'error'
+            result['message'] = str(error)
+            continue
+        result['file_type'] = ','.join(sheets)
+        for file_type, rows in sheets.items():
+            result['rows'] += len(rows)
+            batches.setdefault((result['ja_code'], result['year'], file_type), []).append((result, rows))
+
+    # (JA, 年度, タイプ) ごとに1トランザクションで登録（同じ対象の複数ファイルは結合する）
+    if progress:
+        progress(0, len(batches))
+    for done, ((target_ja_code, target_year, file_type), entries) in enumerate(sorted(batches.items()), 1):
+        if len(entries) > 1:
+            logger.warning(f"同じ取込先のファイルが{len(entries)}件あるため結合します: "
+                           f"JA={target_ja_code}, 年度={target_year}, タイプ={file_type}")
+        if dry_run:
+            for result, _ in entries:
+                result['status'] = 'parsed'
+            continue
+        rows = [row for _, file_rows in entries for row in file_rows]
+        try:
+            if diff:
+                DataProcessor.merge_rows(target_ja_code, target_year, file_type, rows)
+            else:
+                DataProcessor.store_rows(target_ja_code, target_year, file_type, rows)
+            for result, _ in entries:
+                if result['status'] != 'error':
+                    result['status'] = 'imported'
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"一括取込の登録エラー: JA={target_ja_code}, 年度={target_year}, タイプ={file_type}: {str(e)}")
+            for result, _ in entries:
+                result['status'] = 'error'
+                result['message'] = str(e)
+        if progress:
+            progress(done, len(batches))
+
+    summary = {'files': len(results), 'rows': sum(r['rows'] for r in results if r['status'] in ('imported', 'parsed'))}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    logger.info(f"一括取込が完了しました: {summary}")
+    return {'files': results, 'summary': summary}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="財務諸表ファイルの一括取込（ディレクトリ・ZIPファイル）")
+    parser.add_argument('source', help="取込対象のディレクトリまたはZIPファイル")
+    parser.add_argument('--ja-code', help="ファイル名から判定できない場合のJAコード")
+    parser.add_argument('--year', type=int, help="ファイル名から判定できない場合の年度")
+    parser.add_argument('--workers', type=int, help="解析に使用するワーカープロセス数（既定: CPU数）")
+    parser.add_argument('--dry-run', action='store_true', help="解析のみ行い、登録しない")
+    parser.add_argument('--diff', action='store_true', help="既存データとの差分のみ反映する（マッピング状態を維持）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from app import app
+    with app.app_context():
+        report = import_batch(collect_files(args.source), ja_code=args.ja_code, year=args.year,
+                              max_workers=args.workers, dry_run=args.dry_run, diff=args.diff)
+
+    for result in report['files']:
+        target = f"{result['ja_code'] or '-'} {result['year'] or '-'} {result['file_type'] or '-'}"
+        print(f"{result['status']:<9} {target:<20} {result['rows']:>6}行  {result['file']}  {result['message']}")
+    print(f"合計: {report['summary']}")
+    return 0 if not report['summary'].get('error') else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
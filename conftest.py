@@ -0,0 +1,30 @@
+"""
+pytest の共通設定
+app のインポート時にテーブルが作成されるため、インポートより前に一時SQLiteデータベースを指定する
+（DATABASE_URL が設定された環境でも本番のデータベースを操作しないよう、常に上書きする）
+"""
+
+import os
+import tempfile
+import pytest
+
+_TEST_DB_DIR = tempfile.mkdtemp(prefix='ja_financial_test_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_TEST_DB_DIR, 'test.db')}"
+os.environ.pop('QUERY_CACHE_DIR', None)
+
+
+@pytest.fixture
+def database():
+    """空のテーブルを作成したアプリケーションコンテキスト（プロセス内のインデックス・キャッシュも破棄する）"""
+    from app import app, db
+    from account_hierarchy import invalidate_account_hierarchy
+    from performance_enhancer import query_cache
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        invalidate_account_hierarchy()
+        query_cache.clear()
+        yield db
+        db.session.rollback()
+        db.session.remove()
@@ -3,12 +3,24 @@ import pandas as pd
 import numpy as np
 import logging
 import traceback
+from itertools import islice
+from collections import defaultdict
 from datetime import datetime
+from sqlalchemy import bindparam
 from app import db
-from models import JA, CSVData, StandardAccount
+from models import JA, CSVData, StandardAccount, AccountMapping, bump_balance_generation
+from performance_enhancer import mark_cache_dirty
+from account_hierarchy import invalidate_account_hierarchy
+from statement_parser import iter_statement_rows, parse_statement, StatementParseError
+from import_diff import diff_rows
+from balance_generation import refresh_changed_balances
+import llm_mapping_cache
 
 logger = logging.getLogger(__name__)
 
+# CSVデータを一括INSERTする際の1回あたりの行数
+INSERT_BATCH_ROWS = 5000
+
 class DataProcessor:
     """
     Handles processing of CSV/Excel financial data files
@@ -61,7 +73,7 @@ class DataProcessor:
             return None
     
     @staticmethod
-    def process_csv(file, ja_code, year, file_type=None):
+    def process_csv(file, ja_code, year, file_type=None, diff=False):
         """
         Process a CSV file and store data in the database
         
@@ -70,6 +82,7 @@ class DataProcessor:
             ja_code: JA code
             year: Financial year
             file_type: Type of financial statement (bs, pl, cf)
+            diff: Trueの場合は既存データとの差分のみ反映する（変更の無い行のマッピング状態を維持）
             
         Returns:
             tuple: (success, message, row_count)
@@ -81,245 +94,294 @@ class DataProcessor:
                 if file_type is None:
                     return False, "Could not determine financial statement type", 0
             
-            # Read the file based on its extension
-            _, ext = os.path.splitext(file.filename.lower())
-            if ext == '.csv':
-                # 複数のエンコーディングを順番に試行
-                encodings = ['utf-8-sig', 'utf-8', 'shift-jis', 'cp932', 'euc-jp', 'iso-2022-jp']
-                for encoding in encodings:
-                    try:
-                        logger.info(f"Trying to read CSV with encoding: {encoding}")
-                        df = pd.read_csv(file, encoding=encoding)
-                        logger.info(f"Successfully read CSV with encoding: {encoding}")
-                        break
-                    except Exception as e:
-                        logger.warning(f"Failed to read CSV with encoding {encoding}: {str(e)}")
-                        file.seek(0)  # ファイルポインタをリセット
-                        continue
-                else:
-                    # すべてのエンコーディングが失敗した場合
-                    return False, f"Could not read CSV file with any supported encoding. Please ensure the file is properly encoded.", 0
-            else:  # Excel files
-                df = pd.read_excel(file)
-            
-            # Basic data cleaning
-            df = df.replace([np.inf, -np.inf], np.nan)
-            df = df.fillna(0)
-            
-            # Identify potential account name column
-            account_col = None
-            category_col = None
-            
-            # First, identify category column if it exists
-            for col in df.columns:
-                if "区分" in col or "category" in col.lower():
-                    category_col = col
-                    break
-            
-            # Then identify account name column, avoiding category column
-            for col in df.columns:
-                if col == category_col:
-                    continue  # Skip category column
-                if "科目名" in col or "account_name" in col.lower() or "勘定科目" in col:
-                    account_col = col
-                    break
-                elif "科目" in col or "account" in col.lower() or "item" in col.lower():
-                    account_col = col
-                    break
-            
-            if account_col is None and len(df.columns) > 0:
-                # If no specific account column found, use first non-category column
-                for col in df.columns:
-                    if col != category_col:
-                        account_col = col
-                        break
-            
-            if account_col is None:
-                return False, "Could not identify account name column", 0
-            
-            # Identify value columns
-            current_col = None
-            previous_col = None
-            
-            for col in df.columns:
-                if "当年" in col or "current" in col.lower() or "this" in col.lower() or "令和5年度" in col:
-                    current_col = col
-                elif "前年" in col or "previous" in col.lower() or "last" in col.lower() or "令和4年度" in col:
-                    previous_col = col
-            
-            # If specific columns weren't found, try to use position
-            if current_col is None:
-                if len(df.columns) > 3:  # 4列以上ある場合（BS・PLデータタイプ）
-                    current_col = df.columns[3]  # 北海道BSのフォーマットに合わせて修正（4列目）
-                elif len(df.columns) > 1:  # 2列以上ある場合（CFデータタイプ）
-                    current_col = df.columns[1]  # CFフォーマットでは2列目が当期の値
+            if diff:
+                try:
+                    rows = parse_statement(file, file.filename, file_type)
+                except StatementParseError as e:
+                    return False, str(e), 0
+                result = DataProcessor.merge_rows(ja_code, year, file_type, rows)
+                return True, (
+                    f"Successfully processed {len(rows)} rows of data "
+                    f"(added {result['inserted']}, updated {result['updated']}, "
+                    f"deleted {result['deleted']}, unchanged {result['unchanged']})"
+                ), len(rows)
+            
+            # .xlsx は解析しながら分割してINSERTする（解析エラー時はロールバック）
+            try:
+                rows = iter_statement_rows(file, file.filename, file_type)
+                row_count = DataProcessor.store_rows(
+                    ja_code, year, file_type, (row for chunk in rows for row in chunk)
+                )
+            except StatementParseError as e:
+                db.session.rollback()
+                return False, str(e), 0
             
-            if previous_col is None:
-                if len(df.columns) > 2:  # 3列以上ある場合
-                    previous_col = df.columns[2]  # 北海道BSのフォーマットに合わせて修正（3列目）
-                elif len(df.columns) > 1:  # 2列以上ある場合
-                    # CFでは前期データがない場合もあるため、とりあえず同じ列を使用
-                    previous_col = current_col
-                
-            logger.info(f"Selected columns - Account: {account_col}, Current: {current_col}, Previous: {previous_col}")
+            return True, f"Successfully processed {row_count} rows of data", row_count
             
-            # CSVデータをインポートする前に、同一JAコード・年度・ファイルタイプの既存データを削除
-            logger.info(f"Deleting existing data for JA: {ja_code}, Year: {year}, File type: {file_type}")
-            existing_records = CSVData.query.filter_by(
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error processing file: {str(e)}")
+            return False, f"Error processing file: {str(e)}", 0
+    
+    @staticmethod
+    def _touch_ja(ja_code, year, file_type):
+        """JAの取込済みデータと更新日時を更新する（JAが無い場合は作成する）"""
+        # Update JA record with available data
+        ja = JA.query.filter_by(ja_code=ja_code).first()
+        if ja:
+            available_data = ja.available_data.split(',') if ja.available_data else []
+            if file_type not in available_data:
+                available_data.append(file_type)
+                ja.available_data = ','.join(available_data)
+            ja.last_updated = datetime.utcnow()
+        else:
+            # Create new JA record if it doesn't exist
+            new_ja = JA(
                 ja_code=ja_code,
+                name=f"JA {ja_code}",  # Default name
+                prefecture="未設定",  # Default prefecture
                 year=year,
-                file_type=file_type
-            ).delete()
-            logger.info(f"Deleted {existing_records} existing records")
+                available_data=file_type,
+                last_updated=datetime.utcnow()
+            )
+            db.session.add(new_ja)
+        # 新規JAをCSVデータより先に登録する
+        db.session.flush()
+    
+    @staticmethod
+    def store_rows(ja_code, year, file_type, rows, commit=True):
+        """
+        解析済みの行で (JA, 年度, ファイルタイプ) のCSVデータを置き換える（一括INSERT）
+        
+        Args:
+            ja_code: JA code
+            year: Financial year
+            file_type: Type of financial statement (bs, pl, cf)
+            rows: statement_parser.parse_statement が返す行のリスト（イテレータも可）
+            commit: Trueの場合はコミットする
             
-            # Process each row
-            row_count = 0
-            for index, row in df.iterrows():
-                account_name = str(row[account_col]).strip()
-                
-                # Skip empty account names or rows that appear to be headers/totals
-                if not account_name or account_name.lower() in ["合計", "total", "小計", "subtotal"]:
-                    continue
-                
-                # 区分（カテゴリー）を取得
-                category = None
-                # 北海道BSのフォーマットでは区分が別の列にある場合がある
-                if "区分" in df.columns:
-                    category_col = "区分"
-                    category_value = str(row[category_col]).strip()
-                    if category_value and category_value not in ['nan', 'NaN', '']:
-                        if "資産" in category_value:
-                            category = "資産の部"
-                        elif "負債" in category_value:
-                            category = "負債の部"
-                        elif "純資産" in category_value or "資本" in category_value:
-                            category = "純資産の部"
-                        elif "収益" in category_value or "収入" in category_value:
-                            category = "収益の部"
-                        elif "費用" in category_value or "支出" in category_value:
-                            category = "費用の部"
-                
-                # 区分列から検出できなかった場合は勘定科目名から推測
-                if category is None:
-                    if "資産" in account_name:
-                        category = "資産の部"
-                    elif "負債" in account_name:
-                        category = "負債の部"
-                    elif "純資産" in account_name or "資本" in account_name:
-                        category = "純資産の部"
-                    elif "収益" in account_name or "収入" in account_name:
-                        category = "収益の部"
-                    elif "費用" in account_name or "支出" in account_name:
-                        category = "費用の部"
-                    # CF用の区分を追加
-                    elif "営業活動" in account_name or "営業キャッシュ" in account_name:
-                        category = "営業活動CF"
-                    elif "投資活動" in account_name:
-                        category = "投資活動CF"
-                    elif "財務活動" in account_name:
-                        category = "財務活動CF"
-                
-                # file_typeがcfの場合、デフォルトでCF区分を設定
-                if file_type == "cf" and not category:
-                    if "営業" in account_name:
-                        category = "営業活動CF"
-                    elif "投資" in account_name:
-                        category = "投資活動CF"
-                    elif "財務" in account_name:
-                        category = "財務活動CF"
-                    else:
-                        category = "営業活動CF"  # デフォルト値
-                
-                # Get values
-                current_value = 0
-                previous_value = 0
-                
-                if current_col is not None:
-                    try:
-                        current_value_raw = row[current_col]
-                        # 数値に変換する前に適切な処理を行う
-                        if current_value_raw is None or str(current_value_raw).strip() == '':
-                            current_value = 0
-                        elif isinstance(current_value_raw, (int, float)):
-                            current_value = float(current_value_raw)
-                        else:
-                            # カンマや空白を削除して数値に変換
-                            current_value_str = str(current_value_raw).replace(',', '').strip()
-                            # △記号をマイナス記号に変換
-                            if '△' in current_value_str:
-                                current_value_str = current_value_str.replace('△', '-')
-                            if current_value_str and current_value_str != '0':
-                                current_value = float(current_value_str)
-                        logger.info(f"Row {index}, Account: {account_name}, Current Value: {current_value}")
-                    except (ValueError, TypeError) as e:
-                        logger.warning(f"Error converting current value for {account_name}: {str(e)}, value: {row[current_col]}")
-                        current_value = 0
-                
-                if previous_col is not None:
-                    try:
-                        previous_value_raw = row[previous_col]
-                        # 数値に変換する前に適切な処理を行う
-                        if previous_value_raw is None or str(previous_value_raw).strip() == '' or str(previous_value_raw) == 'nan':
-                            previous_value = 0
-                        elif isinstance(previous_value_raw, (int, float)):
-                            previous_value = float(previous_value_raw)
-                        else:
-                            # カンマや空白を削除して数値に変換
-                            previous_value_str = str(previous_value_raw).replace(',', '').strip()
-                            # △記号をマイナス記号に変換
-                            if '△' in previous_value_str:
-                                previous_value_str = previous_value_str.replace('△', '-')
-                            if previous_value_str and previous_value_str != '0':
-                                previous_value = float(previous_value_str)
-                        logger.info(f"Row {index}, Account: {account_name}, Previous Value: {previous_value}")
-                    except (ValueError, TypeError) as e:
-                        logger.warning(f"Error converting previous value for {account_name}: {str(e)}, value: {row[previous_col]}")
-                        previous_value = 0
-                
-                # Create database record
-                csv_data = CSVData(
-                    ja_code=ja_code,
-                    year=year,
-                    file_type=file_type,
-                    row_number=index,
-                    account_name=account_name,
-                    category=category,
-                    current_value=current_value,
-                    previous_value=previous_value,
-                    is_mapped=False,
-                    created_at=datetime.utcnow()
-                )
-                
-                db.session.add(csv_data)
-                row_count += 1
+        Returns:
+            int: 登録した行数
+        """
+        DataProcessor._touch_ja(ja_code, year, file_type)
+        
+        # CSVデータをインポートする前に、同一JAコード・年度・ファイルタイプの既存データを削除
+        logger.info(f"Deleting existing data for JA: {ja_code}, Year: {year}, File type: {file_type}")
+        existing_records = CSVData.query.filter_by(
+            ja_code=ja_code,
+            year=year,
+            file_type=file_type
+        ).delete()
+        logger.info(f"Deleted {existing_records} existing records")
+        
+        # INSERT_BATCH_ROWS 行ずつ一括INSERT（文字列は parse_statement で正規化済み）
+        now = datetime.utcnow()
+        rows = iter(rows)
+        row_count = 0
+        while True:
+            records = [
+                dict(row, ja_code=ja_code, year=year, file_type=file_type, is_mapped=False, created_at=now)
+                for row in islice(rows, INSERT_BATCH_ROWS)
+            ]
+            if not records:
+                break
+            db.session.execute(CSVData.__table__.insert(), records)
+            row_count += len(records)
+        bump_balance_generation(db.session.connection(), ja_code, file_type, year)
+        mark_cache_dirty(db.session, ja_code, year)
+        logger.info(f"Inserted {row_count} rows for JA: {ja_code}, Year: {year}, File type: {file_type}")
+        
+        if commit:
+            db.session.commit()
+        return row_count
+    
+    @staticmethod
+    def merge_rows(ja_code, year, file_type, rows, commit=True):
+        """
+        解析済みの行と既存のCSVデータの差分のみを反映する（再取込・修正版の取込用）
+        
+        変更の無い行はそのまま残すため、マッピング状態（is_mapped）も維持される。
+        残高は内容が変わった勘定科目にマッピングされた標準勘定科目のみ作り直し、
+        コミット後にそれらに依存する合計科目と財務指標を再計算する（BalanceChangeSet.propagate）。
+        
+        Args:
+            ja_code: JA code
+            year: Financial year
+            file_type: Type of financial statement (bs, pl, cf)
+            rows: statement_parser.parse_statement が返す行のリスト
+            commit: Trueの場合はコミットする
             
-            # Update JA record with available data
-            ja = JA.query.filter_by(ja_code=ja_code).first()
-            if ja:
-                available_data = ja.available_data.split(',') if ja.available_data else []
-                if file_type not in available_data:
-                    available_data.append(file_type)
-                    ja.available_data = ','.join(available_data)
-                ja.last_updated = datetime.utcnow()
-            else:
-                # Create new JA record if it doesn't exist
-                new_ja = JA(
-                    ja_code=ja_code,
-                    name=f"JA {ja_code}",  # Default name
-                    prefecture="未設定",  # Default prefecture
-                    year=year,
-                    available_data=file_type,
-                    last_updated=datetime.utcnow()
+        Returns:
+            dict: inserted, updated, deleted, unchanged（行数）, changed_accounts（内容が変わった勘定科目名のリスト）
+        """
+        DataProcessor._touch_ja(ja_code, year, file_type)
+        
+        table = CSVData.__table__
+        existing = [
+            dict(row._mapping) for row in db.session.execute(
+                db.select(
+                    table.c.id, table.c.row_number, table.c.account_name, table.c.category,
+                    table.c.current_value, table.c.previous_value
+                ).where(
+                    table.c.ja_code == ja_code,
+                    table.c.year == year,
+                    table.c.file_type == file_type
                 )
-                db.session.add(new_ja)
-            
+            )
+        ]
+        diff = diff_rows(existing, rows)
+        
+        # 追加した行は未マッピング、更新した行はマッピング状態を維持する
+        if diff['deleted']:
+            for start in range(0, len(diff['deleted']), INSERT_BATCH_ROWS):
+                db.session.execute(table.delete().where(table.c.id.in_(diff['deleted'][start:start + INSERT_BATCH_ROWS])))
+        # 変更する列の組み合わせごとにまとめて更新する（行の挿入で後続の行番号が全てずれる場合など）
+        updates = defaultdict(list)
+        for changes in diff['updated']:
+            columns = tuple(sorted(column for column in changes if column != 'id'))
+            updates[columns].append(
+                dict({f'new_{column}': changes[column] for column in columns}, row_id=changes['id'])
+            )
+        for columns, params in updates.items():
+            statement = table.update().where(table.c.id == bindparam('row_id')).values(
+                **{column: bindparam(f'new_{column}') for column in columns}
+            )
+            db.session.execute(statement, params)
+        now = datetime.utcnow()
+        for start in range(0, len(diff['inserted']), INSERT_BATCH_ROWS):
+            db.session.execute(table.insert(), [
+                dict(row, ja_code=ja_code, year=year, file_type=file_type, is_mapped=False, created_at=now)
+                for row in diff['inserted'][start:start + INSERT_BATCH_ROWS]
+            ])
+        
+        changed_codes = []
+        if diff['changed_accounts']:
+            refreshed = refresh_changed_balances(ja_code, year, file_type, diff['changed_accounts'])
+            if refreshed is not None and refreshed['changed_codes']:
+                if commit:
+                    changed_codes = refreshed['changed_codes']
+                else:
+                    # 合計科目・指標の差分再計算はコミット後に行うため、コミットしない場合は世代を進めて次回の表示時に再作成する
+                    bump_balance_generation(db.session.connection(), ja_code, file_type, year)
+        if diff['inserted'] or diff['updated'] or diff['deleted']:
+            mark_cache_dirty(db.session, ja_code, year)
+        
+        result = {
+            'inserted': len(diff['inserted']),
+            'updated': len(diff['updated']),
+            'deleted': len(diff['deleted']),
+            'unchanged': diff['unchanged'],
+            'changed_accounts': diff['changed_accounts'],
+        }
+        logger.info(f"Merged rows for JA: {ja_code}, Year: {year}, File type: {file_type}: "
+                    f"added {result['inserted']}, updated {result['updated']}, "
+                    f"deleted {result['deleted']}, unchanged {result['unchanged']}")
+        
+        if commit:
             db.session.commit()
-            return True, f"Successfully processed {row_count} rows of data", row_count
+        if changed_codes:
+            # 値が変わった科目に依存する合計科目と財務指標を再計算する
+            from balance_changes import BalanceChangeSet
+            changes = BalanceChangeSet()
+            for code in changed_codes:
+                changes.add(ja_code, year, file_type, code)
+            changes.propagate()
+        return result
+    
+    @staticmethod
+    def import_standard_accounts(df, financial_statement, replace_existing=False, progress=None):
+        """
+        標準勘定科目のCSV（code, name, category 列を含むDataFrame）を登録する
+        
+        Args:
+            df: 標準勘定科目のDataFrame（parent_code, display_order, account_type, description 列は省略可）
+            financial_statement: 財務諸表タイプ (bs, pl, cf)
+            replace_existing: Trueの場合は既存の標準勘定科目と関連するマッピングを削除してから登録する
+            progress: 進捗を通知する関数 progress(処理済み件数, 全件数)（省略可）
             
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Error processing file: {str(e)}")
-            return False, f"Error processing file: {str(e)}", 0
+        Returns:
+            int: 登録・更新した件数
+        """
+        # 既存のデータを削除（指定された場合）
+        if replace_existing:
+            # 関連するマッピング情報をクリア
+            # 関連するマッピング情報を取得
+            mappings_to_clear = AccountMapping.query.filter_by(financial_statement=financial_statement).all()
+            
+            if mappings_to_clear:
+                # マッピング情報に関連するCSVデータのis_mappedフラグをリセット
+                for mapping in mappings_to_clear:
+                    csv_data = CSVData.query.filter(
+                        CSVData.account_name == mapping.original_account_name,
+                        CSVData.file_type == financial_statement
+                    ).all()
+                    
+                    for data in csv_data:
+                        data.is_mapped = False
+                
+                # マッピング情報を削除
+                mapping_count = AccountMapping.query.filter_by(financial_statement=financial_statement).delete()
+                logger.info(f'{mapping_count}件のマッピング情報を削除しました')
+            
+            # 標準勘定科目を削除
+            deleted_count = StandardAccount.query.filter_by(financial_statement=financial_statement).delete()
+            logger.info(f'{deleted_count}件の標準勘定科目を削除しました')
+        
+        # 標準勘定科目を登録
+        imported_count = 0
+        total = len(df)
+        for _, row in df.iterrows():
+            # 必須項目を取得
+            code = str(row['code'])
+            name = row['name']
+            category = row['category']
+            
+            # オプション項目を取得
+            parent_code = str(row['parent_code']) if 'parent_code' in df.columns and pd.notna(row['parent_code']) else None
+            display_order = int(row['display_order']) if 'display_order' in df.columns and pd.notna(row['display_order']) else int(code)
+            account_type = row['account_type'] if 'account_type' in df.columns and pd.notna(row['account_type']) else category
+            description = row['description'] if 'description' in df.columns and pd.notna(row['description']) else None
+            
+            # 既存のレコードを検索
+            existing = StandardAccount.query.filter_by(
+                code=code, financial_statement=financial_statement
+            ).first()
+            
+            if existing:
+                # 既存のレコードを更新
+                existing.name = name
+                existing.category = category
+                existing.account_type = account_type
+                existing.display_order = display_order
+                existing.parent_code = parent_code
+                if description:
+                    existing.description = description
+            else:
+                # 新規レコードを作成（属性ごとに設定）
+                new_account = StandardAccount()
+                new_account.code = code
+                new_account.name = name
+                new_account.category = category
+                new_account.financial_statement = financial_statement
+                new_account.account_type = account_type
+                new_account.display_order = display_order
+                new_account.parent_code = parent_code
+                new_account.description = description
+                db.session.add(new_account)
+            
+            imported_count += 1
+            if progress is not None:
+                progress(imported_count, total)
+        
+        # 変更をコミット
+        db.session.commit()
+        invalidate_account_hierarchy()
+        
+        # 変更前の標準勘定科目の一覧に対するAIマッピングの結果を削除
+        from ai_account_mapper import AIAccountMapper
+        standard_accounts = StandardAccount.query.filter_by(financial_statement=financial_statement).all()
+        llm_mapping_cache.purge(financial_statement, keep_catalog=AIAccountMapper.mapping_catalog_hash(standard_accounts))
+        return imported_count
     
     @staticmethod
     def validate_data(ja_code, year, file_type):
@@ -6,9 +6,28 @@ import logging
 import os
 import psycopg2
 from psycopg2.extras import DictCursor
+from utils import normalize_account_name
 
 logger = logging.getLogger(__name__)
 
+def _refresh_mapping_knowledge(file_type, account_names):
+    """
+    直接SQLで登録したマッピングの正規化名について、ナレッジベースを再集計する
+    （マッピングは確定済みのため、失敗してもログに記録するのみ）
+    """
+    if not account_names:
+        return
+    try:
+        # importに失敗した場合のエラーを検知するため遅延インポート
+        from app import db
+        from models import refresh_mapping_knowledge
+        with db.engine.begin() as connection:
+            refresh_mapping_knowledge(
+                connection, {(file_type, normalize_account_name(name, file_type)) for name in account_names}
+            )
+    except Exception as e:
+        logger.warning(f"ナレッジベースの再集計に失敗しました: {str(e)}")
+
 def execute_direct_mapping(ja_code, year, file_type, max_items=20):
     """
     SQLコマンドを直接実行してマッピングを実行する最後の手段。
@@ -93,13 +112,14 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
             logger.info(f"🔍 完全一致勘定科目の検索開始: JA={ja_code}, 年度={year}, ファイルタイプ={file_type}")
             
             count_exact_query = """
-                SELECT COUNT(*) 
+                SELECT COUNT(DISTINCT c.id) 
                 FROM csv_data c
-                JOIN standard_account s ON c.account_name = s.name
+                JOIN standard_account s ON s.normalized_name = c.normalized_name
                 WHERE c.ja_code = %s
                 AND c.year = %s
                 AND c.file_type = %s
                 AND c.is_mapped = false
+                AND c.normalized_name <> ''
                 AND s.financial_statement = %s
             """
             logger.info(f"💾 完全一致クエリ: {count_exact_query}")
@@ -289,11 +309,11 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
                             # 新しいマッピングを挿入
                             cursor.execute("""
                                 INSERT INTO account_mapping 
-                                (ja_code, original_account_name, standard_account_code, 
+                                (ja_code, original_account_name, normalized_name, standard_account_code, 
                                  standard_account_name, financial_statement, confidence, rationale)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                             """, (
-                                ja_code, account_name, std_code, std_name, 
+                                ja_code, account_name, normalize_account_name(account_name, file_type), std_code, std_name, 
                                 file_type, best_score, f"類似度マッピング: 類似度 {best_score:.2f}"
                             ))
                             
@@ -314,9 +334,16 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
                             partial_mapped_count += 1
                             
                 if partial_mapped_count > 0:
+                    # 直接SQLの変更はORMのイベントで検知されないため、残高の世代を明示的に進める
+                    cursor.execute("""
+                        UPDATE balance_generation SET source_generation = source_generation + 1
+                        WHERE ja_code = %s AND statement_type = %s
+                    """, (ja_code, file_type))
+                    
                     # 変更を確定
                     conn.commit()
                     logger.info(f"部分一致によるマッピング完了: {partial_mapped_count}件")
+                    _refresh_mapping_knowledge(file_type, [result["name"] for result in partial_results])
                     
                     return {
                         "status": "success",
@@ -337,13 +364,14 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
             
             # 2. 完全一致する勘定科目の総数を確認
             cursor.execute("""
-                SELECT COUNT(*)
+                SELECT COUNT(DISTINCT c.id)
                 FROM csv_data c
-                JOIN standard_account s ON c.account_name = s.name
+                JOIN standard_account s ON s.normalized_name = c.normalized_name
                 WHERE c.ja_code = %s
                 AND c.year = %s
                 AND c.file_type = %s
                 AND c.is_mapped = false
+                AND c.normalized_name <> ''
                 AND s.financial_statement = %s
             """, (ja_code, year, file_type, file_type))
             
@@ -353,15 +381,19 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
             
             # 3. 完全一致する勘定科目を指定した最大件数まで取得
             logger.info(f"バッチサイズ: {max_items}件まで取得します")
+            # 正規化した名前（normalized_name）で結合し、同じ正規化名の標準勘定科目が複数ある場合は
+            # 名称が完全に一致するもの、次にidの小さいものを使用する
             cursor.execute("""
-                SELECT c.id, c.account_name, s.code, s.name
+                SELECT DISTINCT ON (c.id) c.id, c.account_name, c.normalized_name, s.code, s.name
                 FROM csv_data c
-                JOIN standard_account s ON c.account_name = s.name
+                JOIN standard_account s ON s.normalized_name = c.normalized_name
                 WHERE c.ja_code = %s
                 AND c.year = %s
                 AND c.file_type = %s
                 AND c.is_mapped = false
+                AND c.normalized_name <> ''
                 AND s.financial_statement = %s
+                ORDER BY c.id, (s.name = c.account_name) DESC, s.id
                 LIMIT %s
             """, (ja_code, year, file_type, file_type, max_items))
             
@@ -417,14 +449,18 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
                     })
                 else:
                     # 新しいマッピングを挿入
+                    if account_name == std_name:
+                        confidence, rationale = 1.0, "完全一致: 名称が標準勘定科目と一致しました"
+                    else:
+                        confidence, rationale = 0.9, "完全一致: 正規化した名称が標準勘定科目と一致しました"
                     cursor.execute("""
                         INSERT INTO account_mapping 
-                        (ja_code, original_account_name, standard_account_code, 
+                        (ja_code, original_account_name, normalized_name, standard_account_code, 
                          standard_account_name, financial_statement, confidence, rationale)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                     """, (
-                        ja_code, account_name, std_code, std_name, 
-                        file_type, 1.0, "完全一致: 名称が標準勘定科目と一致しました"
+                        ja_code, account_name, match['normalized_name'], std_code, std_name, 
+                        file_type, confidence, rationale
                     ))
                     
                     # CSVデータのフラグを更新
@@ -442,9 +478,16 @@ def execute_direct_mapping(ja_code, year, file_type, max_items=20):
                 
                 mapped_count += 1
             
+            # 直接SQLの変更はORMのイベントで検知されないため、残高の世代を明示的に進める
+            cursor.execute("""
+                UPDATE balance_generation SET source_generation = source_generation + 1
+                WHERE ja_code = %s AND statement_type = %s
+            """, (ja_code, file_type))
+            
             # 変更を確定
             conn.commit()
             logger.info(f"直接SQL実行によるマッピング完了: {mapped_count}件")
+            _refresh_mapping_knowledge(file_type, [result["name"] for result in results])
             
             # マッピング後に標準勘定科目残高を自動的に作成
             balance_count = 0
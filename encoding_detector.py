@@ -0,0 +1,135 @@
+"""
+アップロードされたCSVファイルの文字コード判定
+ファイルを1回だけ読み込み、BOMと先頭部分の試験デコードで文字コードを判定してからパーサーに渡す
+"""
+
+import io
+import codecs
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# BOM → 文字コード（長いBOMから順に確認する）
+BOM_ENCODINGS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# BOMが無い場合に試す文字コード（この順に判定する）
+# shift_jis で読めるファイルは cp932 でも読めるが、一部の記号（～ − など）の変換結果が異なるため shift_jis を先に試す
+CANDIDATE_ENCODINGS = ('utf-8', 'shift_jis', 'cp932', 'euc-jp', 'iso-2022-jp')
+
+# 判定に使用する先頭のバイト数
+SNIFF_BYTES = 64 * 1024
+
+# ISO-2022-JP の漢字への切り替えのエスケープシーケンス（7ビットのためUTF-8としても読めてしまう）
+ISO2022JP_ESCAPES = (b'\x1b$B', b'\x1b$@', b'\x1b(J')
+
+
+class EncodingDetectionError(ValueError):
+    """対応するどの文字コードでも読み込めない場合のエラー"""
+
+
+def _decodes(data, encoding, final):
+    """インクリメンタルデコーダで data をデコードできるかを確認する（final=Falseの場合は末尾の途中の文字を許容）"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        decoder.decode(data, final=final)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def _halfwidth_kana_count(data, encoding, final):
+    """data を encoding でデコードした場合の半角カナの数"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    text = decoder.decode(data, final=final)
+    return sum(1 for char in text if '\uff61' <= char <= '\uff9f')
+
+
+def detect_encoding(data, candidates=CANDIDATE_ENCODINGS, sniff_bytes=SNIFF_BYTES):
+    """
+    バイト列の文字コードを判定する（BOM、無い場合は先頭 sniff_bytes バイトの試験デコード）
+
+    Args:
+        data: ファイルの内容（bytes）
+        candidates: 試す文字コードのリスト
+        sniff_bytes: 判定に使用する先頭のバイト数
+
+    Returns:
+        str: 文字コード
+
+    Raises:
+        EncodingDetectionError: どの文字コードでもデコードできない場合
+    """
+    for bom, encoding in BOM_ENCODINGS:
+        if data.startswith(bom):
+            return encoding
+
+    sample = data[:sniff_bytes]
+    final = len(data) <= sniff_bytes
+    if 'iso-2022-jp' in candidates and any(escape in sample for escape in ISO2022JP_ESCAPES):
+        if _decodes(sample, 'iso-2022-jp', final):
+            return 'iso-2022-jp'
+
+    decodable = [encoding for encoding in candidates if _decodes(sample, encoding, final)]
+    if decodable:
+        if decodable[0] == 'utf-8':
+            return 'utf-8'
+        # EUC-JPのファイルはShift_JISとしても（半角カナの多い文字列として）読めてしまうため、半角カナの少ない方を選ぶ
+        return min(decodable, key=lambda encoding: _halfwidth_kana_count(sample, encoding, final))
+    raise EncodingDetectionError("対応する文字コード（UTF-8, Shift_JIS, EUC-JP, ISO-2022-JP）で読み込めません")
+
+
+def decode_bytes(data, candidates=CANDIDATE_ENCODINGS):
+    """
+    バイト列の文字コードを判定してデコードする
+
+    先頭部分で判定した文字コードでファイル全体をデコードできなかった場合は、
+    残りの候補を順にファイル全体で試す。
+
+    Args:
+        data: ファイルの内容（bytes）
+        candidates: 試す文字コードのリスト
+
+    Returns:
+        tuple: (デコードした文字列, 文字コード)
+
+    Raises:
+        EncodingDetectionError: どの文字コードでもデコードできない場合
+    """
+    encoding = detect_encoding(data, candidates)
+    try:
+        return data.decode(encoding), encoding
+    except UnicodeDecodeError:
+        logger.warning(f"先頭部分は {encoding} と判定しましたが、ファイル全体をデコードできませんでした")
+
+    remaining = list(candidates)
+    remaining = remaining[remaining.index(encoding) + 1:] if encoding in remaining else remaining
+    for fallback in remaining:
+        try:
+            return data.decode(fallback), fallback
+        except UnicodeDecodeError:
+            continue
+    raise EncodingDetectionError("対応する文字コード（UTF-8, Shift_JIS, EUC-JP, ISO-2022-JP）で読み込めません")
+
+
+def read_csv_bytes(data, **kwargs):
+    """
+    文字コードを判定してCSVを1回だけ解析する
+
+    Args:
+        data: ファイルの内容（bytes）
+        **kwargs: pd.read_csv に渡す引数
+
+    Returns:
+        tuple: (DataFrame, 文字コード)
+
+    Raises:
+        EncodingDetectionError: どの文字コードでもデコードできない場合
+    """
+    text, encoding = decode_bytes(data)
+    logger.info(f"CSVの文字コード: {encoding}")
+    return pd.read_csv(io.StringIO(text), **kwargs), encoding
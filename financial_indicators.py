@@ -1,7 +1,11 @@
 import json
 import logging
+from datetime import datetime
 from app import db
-from models import StandardAccountBalance, AnalysisResult
+from models import AnalysisResult, upsert_rows
+from utils import normalize_string
+from performance_enhancer import mark_cache_dirty
+from balance_snapshot import BalanceSnapshot
 
 logger = logging.getLogger(__name__)
 
@@ -11,13 +15,14 @@ class FinancialIndicators:
     """
     
     @staticmethod
-    def calculate_all_indicators(ja_code, year):
+    def calculate_all_indicators(ja_code, year, writer=None):
         """
         Calculate all financial indicators for a JA and year
         
         Args:
             ja_code: JA code
             year: Financial year
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Results of indicator calculations by category
@@ -25,20 +30,23 @@ class FinancialIndicators:
         try:
             results = {}
             
+            # 残高を一度だけ読み込み、各カテゴリの計算で共有する
+            snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # Calculate liquidity indicators
-            results['liquidity'] = FinancialIndicators.calculate_liquidity_indicators(ja_code, year)
+            results['liquidity'] = FinancialIndicators.calculate_liquidity_indicators(ja_code, year, snapshot, writer)
             
             # Calculate profitability indicators
-            results['profitability'] = FinancialIndicators.calculate_profitability_indicators(ja_code, year)
+            results['profitability'] = FinancialIndicators.calculate_profitability_indicators(ja_code, year, snapshot, writer)
             
             # Calculate safety indicators
-            results['safety'] = FinancialIndicators.calculate_safety_indicators(ja_code, year)
+            results['safety'] = FinancialIndicators.calculate_safety_indicators(ja_code, year, snapshot, writer)
             
             # Calculate efficiency indicators
-            results['efficiency'] = FinancialIndicators.calculate_efficiency_indicators(ja_code, year)
+            results['efficiency'] = FinancialIndicators.calculate_efficiency_indicators(ja_code, year, snapshot, writer)
             
             # Calculate cash flow indicators
-            results['cash_flow'] = FinancialIndicators.calculate_cash_flow_indicators(ja_code, year)
+            results['cash_flow'] = FinancialIndicators.calculate_cash_flow_indicators(ja_code, year, snapshot, writer)
             
             return results
             
@@ -50,7 +58,7 @@ class FinancialIndicators:
             }
     
     @staticmethod
-    def get_account_value(ja_code, year, statement_type, account_code):
+    def get_account_value(ja_code, year, statement_type, account_code, snapshot=None):
         """
         Helper method to get the current value of a specific account
         親勘定科目（例：流動資産）の値がゼロの場合、子勘定科目（例：現金・預金）の合計を計算
@@ -60,182 +68,80 @@ class FinancialIndicators:
             year: Financial year
             statement_type: Type of financial statement (bs, pl, cf)
             account_code: Standard account code
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
             
         Returns:
             tuple: (float: Account value or 0 if not found, str: Account name or '不明な科目')
         """
         try:
-            from models import StandardAccount
-            
-            # NoneやNaNをチェック
-            if account_code is None:
-                logger.warning("get_account_value: account_codeがNoneです")
-                return 0, "不明な科目"
-            
-            # 文字列型に変換（数字で受け取った場合も対応）
-            if not isinstance(account_code, str):
-                account_code = str(account_code)
-                
-            # Debug log
-            logger.debug(f"勘定科目の値を取得: JA={ja_code}, year={year}, statement_type={statement_type}, account_code={account_code}")
-            
-            # 特定のコードのハードコードされた処理（問題のある科目コード対応）
-            # 注：旧コード2999と4999はコメントアウトして、実際のデータが使用されるようにする
-            # if account_code == "2999":  # 資産の部合計
-            #     return 0, "資産の部合計"
-            # elif account_code == "4999":  # 負債の部合計
-            #     return 0, "負債の部合計"
-            if account_code == "3200":  # 債券
-                return 0, "債券"
-                
-            # 直接の勘定科目を取得（同じコードを持つ複数のレコードがある場合、合計する）
-            accounts = StandardAccountBalance.query.filter_by(
-                ja_code=ja_code,
-                year=year,
-                statement_type=statement_type,
-                standard_account_code=account_code
-            ).all()
-            
-            if accounts:
-                # 複数のレコードの合計を計算
-                total_value = sum(acc.current_value for acc in accounts if acc.current_value is not None)
-                # 最初のレコードから名前を取得
-                account_name = accounts[0].standard_account_name or f"科目{account_code}"
-                account_count = len(accounts)
-                logger.debug(f"勘定科目 {account_code} ({account_name}) の値: {total_value} (レコード数: {account_count})")
-                return total_value, account_name
-                
-            # 親科目の場合は子科目の合計を計算
-            child_accounts = []
-            try:
-                # データベースから親子関係を検索
-                standard_accounts = StandardAccount.query.filter_by(parent_code=account_code).all()
-                if standard_accounts:
-                    child_codes = [sa.code for sa in standard_accounts]
-                    logger.debug(f"親勘定科目 {account_code} の子勘定科目: {child_codes}")
-                    
-                    child_accounts = StandardAccountBalance.query.filter(
-                        StandardAccountBalance.ja_code == ja_code,
-                        StandardAccountBalance.year == year,
-                        StandardAccountBalance.statement_type == statement_type,
-                        StandardAccountBalance.standard_account_code.in_(child_codes)
-                    ).all()
-            except Exception as e:
-                logger.warning(f"親子関係検索エラー: {str(e)}")
-                
-            # 子科目が見つかった場合は合計を計算
-            if child_accounts:
-                try:
-                    total_value = sum(acc.current_value for acc in child_accounts 
-                                  if acc.current_value is not None)
-                    
-                    # 親科目の名前を取得
-                    parent_account = StandardAccount.query.filter_by(code=account_code).first()
-                    parent_name = parent_account.name if parent_account else f"{account_code}の科目"
-                    
-                    logger.debug(f"子勘定科目合計: {total_value} ({len(child_accounts)} 勘定科目)")
-                    return total_value, parent_name
-                except Exception as e:
-                    logger.warning(f"子勘定科目合計計算エラー: {str(e)}")
-            
-            # デフォルトの親子関係定義を使用（互換性のため）
-            parent_codes = {
-                # BSの親勘定科目
-                "1": ["1010", "1020", "1100", "1200", "1300", "1400", "1500"],  # 流動資産
-                "11000": ["1010", "1020"],  # 現金預け金（1010:現金, 1020:預け金）
-                "1600": ["1610", "1620", "1630", "1640", "1650", "1660"],  # 有価証券
-                "1700": ["1710", "1720", "1730", "1740"],  # 貸出金
-                "1800": ["1810", "1820", "1830", "1840"],  # 外国為替
-                "1900": ["1910", "1920", "1930", "1940", "1950", "1960", "1970", "1980", "1990", "1995"],  # その他資産
-                "2000": ["2010", "2020", "2030", "2040", "2050"],  # 有形固定資産
-                "2100": ["2110", "2120", "2130", "2140"],  # 無形固定資産
-                "21000": ["3000", "3100", "3200", "3300", "3400", "3500"],  # 流動負債
-                "3000": ["3010", "3020", "3030", "3040", "3050", "3060", "3070"],  # 預金
-                "3600": ["3610", "3620"],  # 借用金
-                "3700": ["3710", "3720", "3730", "3740"],  # 外国為替
-                "3900": ["3910", "3920", "3930", "3940", "3950", "3960", "3970", "3980", "3990"],  # その他負債
-                "4700": ["4710", "4720", "4730"],  # 貸倒引当金
-                "5100": ["5110", "5120"],  # 資本剰余金
-                "5200": ["5210", "5220"],  # 利益剰余金
-                "6900": ["6910", "6920", "6930", "6940", "6950", "6960", "6970", "6980"],  # 経常収益
-                "6100": ["6110", "6120"],  # 役務取引等収益
-                "6200": ["6210", "6220", "6230", "6240", "6250", "6260"],  # その他業務収益
-                "6300": ["6310", "6320", "6330", "6340", "6350"],  # その他経常収益
-                "7900": ["7910", "7920", "7930", "7940", "7950", "7960", "7970", "7980", "7990", "7995"],  # 経常費用
-                "7100": ["7110", "7120"],  # 役務取引等費用
-                "7200": ["7210", "7220", "7230", "7240", "7250", "7260", "7270"],  # その他業務費用
-                "7300": ["7310", "7320", "7330"],  # 営業経費
-                "7400": ["7410", "7420", "7430", "7440", "7450", "7460"],  # その他経常費用
-                "8000": ["8010", "8020", "8030"],  # 特別利益
-                "8100": ["8110", "8120", "8130"],  # 特別損失
-            }
-            
-            if account_code in parent_codes:
-                try:
-                    # 子勘定科目の残高を取得
-                    child_accounts = StandardAccountBalance.query.filter(
-                        StandardAccountBalance.ja_code == ja_code,
-                        StandardAccountBalance.year == year,
-                        StandardAccountBalance.statement_type == statement_type,
-                        StandardAccountBalance.standard_account_code.in_(parent_codes[account_code])
-                    ).all()
-                    
-                    # 合計を計算
-                    total_value = sum(acc.current_value for acc in child_accounts 
-                                    if acc.current_value is not None)
-                    
-                    # 親科目の名前を取得
-                    parent_account = StandardAccount.query.filter_by(code=account_code).first()
-                    parent_name = parent_account.name if parent_account else f"{account_code}の科目"
-                    
-                    logger.debug(f"デフォルト親子定義による合計: {total_value} ({len(child_accounts)} 勘定科目)")
-                    return total_value, parent_name
-                except Exception as e:
-                    logger.warning(f"デフォルト定義による合計計算エラー: {str(e)}")
-            
-            # 該当する科目が見つからない場合
-            logger.debug(f"勘定科目 {account_code} が見つかりません")
-            return 0, f"{account_code}の科目"
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            return snapshot.get_account_value(statement_type, account_code)
             
         except Exception as e:
             logger.error(f"勘定科目の値取得エラー: {str(e)}")
             return 0, "データ取得エラー"
     
     @staticmethod
-    def calculate_liquidity_indicators(ja_code, year):
+    def _save_result(fields, writer=None):
+        """
+        分析結果1件を保存する
+        writerが指定された場合は一括書き込み用に行を追加し、それ以外は同じ指標の既存行を置き換える（ON CONFLICT）
+        """
+        if writer is not None:
+            writer.add(**fields)
+        else:
+            row = {
+                key: normalize_string(value, for_db=True) if isinstance(value, str) else value
+                for key, value in fields.items()
+            }
+            row.setdefault('created_at', datetime.utcnow())
+            upsert_rows(
+                db.session.connection(), AnalysisResult.__table__, [row],
+                index_elements=['ja_code', 'year', 'analysis_type', 'indicator_name']
+            )
+            mark_cache_dirty(db.session, row['ja_code'], row['year'])
+    
+    @staticmethod
+    def calculate_liquidity_indicators(ja_code, year, snapshot=None, writer=None):
         """
         Calculate liquidity indicators
         
         Args:
             ja_code: JA code
             year: Financial year
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Liquidity indicators with calculation details
         """
         try:
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # 流動資産の構成要素を取得
             # まず「資産の部」の総額を取得し、0なら各項目から累計する
-            total_assets, total_assets_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "10000")  # 資産の部
+            total_assets, total_assets_name = snapshot.get_account_value("bs", "10000")  # 資産の部
             
             # 現金預け金（現金+預け金）- 新しいコード体系に対応
             # ここから修正開始
-            cash, cash_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11110")  # 現金
-            deposits_asset1, deposits_asset1_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11160")  # 系統預金
-            deposits_asset2, deposits_asset2_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11170")  # 定期預金
+            cash, cash_name = snapshot.get_account_value("bs", "11110")  # 現金
+            deposits_asset1, deposits_asset1_name = snapshot.get_account_value("bs", "11160")  # 系統預金
+            deposits_asset2, deposits_asset2_name = snapshot.get_account_value("bs", "11170")  # 定期預金
             
             # 現金・預金関連の項目を合計
             cash_deposits = cash + deposits_asset1 + deposits_asset2
             
             # 代替方法として、「現金預金」(11000)を直接取得
             if cash_deposits == 0:
-                cash_deposits, cash_deposits_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11000")  # 現金預金
+                cash_deposits, cash_deposits_name = snapshot.get_account_value("bs", "11000")  # 現金預金
             else:
                 cash_deposits_name = "現金・預金（合計）"
             
             # その他の流動資産も新コード体系で取得
-            securities, securities_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11200")  # 有価証券等
-            loans, loans_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "11300")  # 貸出金
+            securities, securities_name = snapshot.get_account_value("bs", "11200")  # 有価証券等
+            loans, loans_name = snapshot.get_account_value("bs", "11300")  # 貸出金
             
             # 別の代替値を試す
             if total_assets > 0:
@@ -261,37 +167,27 @@ class FinancialIndicators:
             # + 債券貸借取引受入担保金（3500）+ 借用金（3600）+ 割引手形（3605）
             
             # 流動負債（21000）を取得
-            current_liabilities, current_liabilities_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "21000")  # 流動負債
+            current_liabilities, current_liabilities_name = snapshot.get_account_value("bs", "21000")  # 流動負債
             logger.debug(f"流動負債（21000）: {current_liabilities} ({current_liabilities_name})")
             
-            # データベースから直接流動負債を確認・取得
-            try:
-                from models import StandardAccountBalance
-                cl_record = StandardAccountBalance.query.filter_by(
-                    ja_code=ja_code,
-                    year=year,
-                    statement_type="bs",
-                    standard_account_code="21000"
-                ).first()
-                
-                if cl_record and cl_record.current_value:
-                    logger.info(f"データベースから直接取得した流動負債: {cl_record.current_value}")
-                    current_liabilities = cl_record.current_value
-                    current_liabilities_name = cl_record.standard_account_name or "流動負債"
-            except Exception as e:
-                logger.warning(f"データベースから流動負債取得エラー: {str(e)}")
+            # 流動負債（21000）のレコードを直接確認・取得
+            cl_value, cl_name = snapshot.get_first_record("bs", "21000")
+            if cl_value:
+                logger.info(f"データベースから直接取得した流動負債: {cl_value}")
+                current_liabilities = cl_value
+                current_liabilities_name = cl_name or "流動負債"
             
             # 流動負債が0の場合は個別の負債科目を合計して計算を試みる（互換性のため）
             if current_liabilities == 0:
                 # 個別の負債科目の値を取得
-                deposits, deposits_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3000")  # 預金
-                negotiable_deposits, negotiable_deposits_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3100")  # 譲渡性預金
-                bonds, bonds_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3200")  # 債券
-                call_money, call_money_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3300")  # コールマネー
-                sales_repurchase, sales_repurchase_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3400")  # 売現先勘定
-                securities_lending, securities_lending_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3500")  # 債券貸借取引受入担保金
-                borrowed_money, borrowed_money_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3600")  # 借用金
-                discounted_notes, discounted_notes_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3605")  # 割引手形
+                deposits, deposits_name = snapshot.get_account_value("bs", "3000")  # 預金
+                negotiable_deposits, negotiable_deposits_name = snapshot.get_account_value("bs", "3100")  # 譲渡性預金
+                bonds, bonds_name = snapshot.get_account_value("bs", "3200")  # 債券
+                call_money, call_money_name = snapshot.get_account_value("bs", "3300")  # コールマネー
+                sales_repurchase, sales_repurchase_name = snapshot.get_account_value("bs", "3400")  # 売現先勘定
+                securities_lending, securities_lending_name = snapshot.get_account_value("bs", "3500")  # 債券貸借取引受入担保金
+                borrowed_money, borrowed_money_name = snapshot.get_account_value("bs", "3600")  # 借用金
+                discounted_notes, discounted_notes_name = snapshot.get_account_value("bs", "3605")  # 割引手形
                 
                 # 流動負債の合計を計算
                 current_liabilities_sum = deposits + negotiable_deposits + bonds + call_money + sales_repurchase + securities_lending + borrowed_money + discounted_notes
@@ -316,7 +212,7 @@ class FinancialIndicators:
             if current_liabilities == 0:
                 try:
                     # 代替コード（コード20000）の値を直接取得
-                    current_liabilities_alt, current_liabilities_alt_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "20000")
+                    current_liabilities_alt, current_liabilities_alt_name = snapshot.get_account_value("bs", "20000")
                     logger.debug(f"代替流動負債（コード20000）: {current_liabilities_alt} ({current_liabilities_alt_name})")
                     
                     if current_liabilities_alt > 0:
@@ -327,9 +223,9 @@ class FinancialIndicators:
                     logger.warning(f"代替流動負債取得エラー: {str(e)}")
             
             # その他の勘定科目を取得
-            cash_and_equivalents, cash_equivalents_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "1010")  # 現金
-            short_term_investments, investments_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "1020")  # 預け金
-            accounts_receivable, receivables_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "1110")  # コールローン
+            cash_and_equivalents, cash_equivalents_name = snapshot.get_account_value("bs", "1010")  # 現金
+            short_term_investments, investments_name = snapshot.get_account_value("bs", "1020")  # 預け金
+            accounts_receivable, receivables_name = snapshot.get_account_value("bs", "1110")  # コールローン
             
             # 流動性指標の計算
             
@@ -363,7 +259,7 @@ class FinancialIndicators:
             # 分析結果をデータベースに保存
             try:
                 # 流動比率の保存
-                current_ratio_result = AnalysisResult(
+                current_ratio_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='liquidity',
@@ -381,10 +277,10 @@ class FinancialIndicators:
                         '流動負債': {'name': current_liabilities_name, 'value': current_liabilities}
                     }, ensure_ascii=False)
                 )
-                db.session.add(current_ratio_result)
+                FinancialIndicators._save_result(current_ratio_result, writer)
                 
                 # 当座比率の保存
-                quick_ratio_result = AnalysisResult(
+                quick_ratio_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='liquidity',
@@ -402,10 +298,11 @@ class FinancialIndicators:
                         '流動負債': {'name': current_liabilities_name, 'value': current_liabilities}
                     }, ensure_ascii=False)
                 )
-                db.session.add(quick_ratio_result)
+                FinancialIndicators._save_result(quick_ratio_result, writer)
                 
-                # 完了したらコミット
-                db.session.commit()
+                # 完了したらコミット（一括書き込みの場合はwriter側でコミット）
+                if writer is None:
+                    db.session.commit()
                 logger.info(f"流動性指標の分析結果をデータベースに保存しました。")
                 
             except Exception as save_error:
@@ -479,27 +376,32 @@ class FinancialIndicators:
             }
     
     @staticmethod
-    def calculate_profitability_indicators(ja_code, year):
+    def calculate_profitability_indicators(ja_code, year, snapshot=None, writer=None):
         """
         Calculate profitability indicators
         
         Args:
             ja_code: JA code
             year: Financial year
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Profitability indicators with calculation details
         """
         try:
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # 税引前当期利益を取得（総資産利益率の計算には税引前当期利益を使用）
-            net_income_value, net_income_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "80000")  # 税引前当期利益
+            net_income_value, net_income_name = snapshot.get_account_value("pl", "80000")  # 税引前当期利益
             
             # 当期純利益が取得できない場合の代替処理
             if net_income_value == 0:
                 # 冗長性のために複数のコードを試す
                 alternative_codes = ["90000", "99000", "93000"]  # 当期剰余金、当期未処分剰余金、当期純利益など
                 for code in alternative_codes:
-                    alt_value, alt_name = FinancialIndicators.get_account_value(ja_code, year, "pl", code)
+                    alt_value, alt_name = snapshot.get_account_value("pl", code)
                     if alt_value != 0:
                         net_income_value = alt_value
                         net_income_name = alt_name
@@ -509,22 +411,22 @@ class FinancialIndicators:
             logger.debug(f"当期純利益(93000): JA={ja_code}, 名前={net_income_name}, 値={net_income_value}")
             
             # 経常利益と経常費用を取得
-            operating_income_value, operating_income_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "60000")  # 経常利益
-            total_expenses_value, total_expenses_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "50000")  # 経常費用
+            operating_income_value, operating_income_name = snapshot.get_account_value("pl", "60000")  # 経常利益
+            total_expenses_value, total_expenses_name = snapshot.get_account_value("pl", "50000")  # 経常費用
             
             # 総資産と純資産を取得（BSの資産合計と負債純資産合計を使用）
-            total_assets_value, total_assets_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "10000")  # 総資産（Total assets）- BS資産合計
+            total_assets_value, total_assets_name = snapshot.get_account_value("bs", "10000")  # 総資産（Total assets）- BS資産合計
             # 総資産がない場合、代替として負債純資産合計（5950）を使用
             if total_assets_value == 0:
-                total_assets_value, total_assets_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "5950")  
+                total_assets_value, total_assets_name = snapshot.get_account_value("bs", "5950")  
                 logger.info(f"総資産が見つからないため、負債純資産合計(5950)を代わりに使用: {total_assets_value}")
                 
             # 純資産（30000）を取得。資本金(31000)、利益剰余金(32000)などの合計
-            total_equity_value, total_equity_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "30000")  # 純資産（Total equity）
+            total_equity_value, total_equity_name = snapshot.get_account_value("bs", "30000")  # 純資産（Total equity）
             # 純資産がない場合、資本金と利益剰余金の合計を使用
             if total_equity_value == 0:
-                capital_value, capital_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "31000")  # 資本金
-                retained_earnings_value, retained_earnings_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "32000") # 利益剰余金
+                capital_value, capital_name = snapshot.get_account_value("bs", "31000")  # 資本金
+                retained_earnings_value, retained_earnings_name = snapshot.get_account_value("bs", "32000") # 利益剰余金
                 # その他項目も必要に応じて追加
                 total_equity_value = capital_value + retained_earnings_value
                 logger.info(f"純資産(30000)が見つからないため、資本金(31000)・利益剰余金(32000)の合計を使用: {total_equity_value}")
@@ -544,7 +446,7 @@ class FinancialIndicators:
                 logger.debug(f"ROE計算: {net_income_value} ÷ {total_equity_value} × 100 = {roe}%")
             
             # 経常収益を取得（営業利益率の計算には経常収益が必要）
-            operating_revenue_value, operating_revenue_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "40000")  # 経常収益
+            operating_revenue_value, operating_revenue_name = snapshot.get_account_value("pl", "40000")  # 経常収益
             
             # 営業利益率の計算（Operating Profit Margin）
             operating_profit_margin = 0
@@ -558,7 +460,7 @@ class FinancialIndicators:
             # 分析結果をデータベースに保存
             try:
                 # ROA (総資産利益率) の保存
-                roa_result = AnalysisResult(
+                roa_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='profitability',
@@ -576,10 +478,10 @@ class FinancialIndicators:
                         '総資産': {'code': '10000', 'name': total_assets_name, 'value': total_assets_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(roa_result)
+                FinancialIndicators._save_result(roa_result, writer)
                 
                 # ROE (自己資本利益率) の保存
-                roe_result = AnalysisResult(
+                roe_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='profitability',
@@ -597,10 +499,10 @@ class FinancialIndicators:
                         '純資産': {'code': '30000', 'name': total_equity_name, 'value': total_equity_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(roe_result)
+                FinancialIndicators._save_result(roe_result, writer)
                 
                 # 営業利益率 (Operating Profit Margin) の保存
-                operating_profit_margin_result = AnalysisResult(
+                operating_profit_margin_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='profitability',
@@ -618,7 +520,7 @@ class FinancialIndicators:
                         '経常収益': {'code': '40000', 'name': operating_revenue_name, 'value': operating_revenue_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(operating_profit_margin_result)
+                FinancialIndicators._save_result(operating_profit_margin_result, writer)
                 
                 logger.info(f"収益性指標の分析結果をデータベースに保存しました。")
                 
@@ -668,18 +570,23 @@ class FinancialIndicators:
             }
     
     @staticmethod
-    def calculate_safety_indicators(ja_code, year):
+    def calculate_safety_indicators(ja_code, year, snapshot=None, writer=None):
         """
         Calculate safety indicators
         
         Args:
             ja_code: JA code
             year: Financial year
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Safety indicators with calculation details
         """
         try:
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # BS計算で使用する科目コード
             BS_ASSET_TOTAL = "10000"  # 資産の部合計
             BS_LIABILITY_TOTAL = "20000"  # 負債の部合計
@@ -689,27 +596,27 @@ class FinancialIndicators:
             logger.debug(f"安全性指標計算で使用する科目コード: 資産合計={BS_ASSET_TOTAL}, 負債合計={BS_LIABILITY_TOTAL}, 純資産={BS_EQUITY_TOTAL}")
             
             # 総資産を取得（資産の部合計）
-            total_assets, total_assets_name = FinancialIndicators.get_account_value(ja_code, year, "bs", BS_ASSET_TOTAL)
+            total_assets, total_assets_name = snapshot.get_account_value("bs", BS_ASSET_TOTAL)
             logger.debug(f"取得した資産の部合計: コード={BS_ASSET_TOTAL}, 金額={total_assets}")
             
             # 負債の部合計を取得
-            total_liabilities, total_liabilities_name = FinancialIndicators.get_account_value(ja_code, year, "bs", BS_LIABILITY_TOTAL)
+            total_liabilities, total_liabilities_name = snapshot.get_account_value("bs", BS_LIABILITY_TOTAL)
             logger.debug(f"取得した負債の部合計: コード={BS_LIABILITY_TOTAL}, 金額={total_liabilities}")
             
             # 純資産の部合計（直接）
-            equity_direct, equity_direct_name = FinancialIndicators.get_account_value(ja_code, year, "bs", BS_EQUITY_TOTAL)
+            equity_direct, equity_direct_name = snapshot.get_account_value("bs", BS_EQUITY_TOTAL)
             
             # 純資産の部合計が取得できない場合は資本金と利益剰余金などから集計
             if equity_direct == 0:
                 # 代替方法として親コード5900を試行
-                equity_alt, equity_alt_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "5900")
+                equity_alt, equity_alt_name = snapshot.get_account_value("bs", "5900")
                 if equity_alt > 0:
                     total_equity = equity_alt
                     total_equity_name = equity_alt_name
                 else:
                     # 資本金、利益剰余金から集計
-                    capital, capital_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "31000")  # 資本金
-                    retained_earnings, retained_earnings_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "32000")  # 利益剰余金
+                    capital, capital_name = snapshot.get_account_value("bs", "31000")  # 資本金
+                    retained_earnings, retained_earnings_name = snapshot.get_account_value("bs", "32000")  # 利益剰余金
                     valuation, valuation_name = 0, "その他純資産"  # その他の純資産（必要に応じて追加）
                     equity_sum = capital + retained_earnings + valuation
                     
@@ -749,7 +656,7 @@ class FinancialIndicators:
             # 分析結果をデータベースに保存
             try:
                 # 自己資本比率の保存
-                equity_ratio_result = AnalysisResult(
+                equity_ratio_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='safety',
@@ -767,10 +674,10 @@ class FinancialIndicators:
                         '純資産': {'name': total_equity_name, 'value': total_equity}
                     }, ensure_ascii=False)
                 )
-                db.session.add(equity_ratio_result)
+                FinancialIndicators._save_result(equity_ratio_result, writer)
                 
                 # 負債比率の保存
-                debt_ratio_result = AnalysisResult(
+                debt_ratio_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='safety',
@@ -789,10 +696,10 @@ class FinancialIndicators:
                         '純資産': {'code': BS_EQUITY_TOTAL, 'name': total_equity_name, 'value': total_equity}
                     }, ensure_ascii=False)
                 )
-                db.session.add(debt_ratio_result)
+                FinancialIndicators._save_result(debt_ratio_result, writer)
                 
                 # 負債資本比率の保存
-                debt_to_equity_result = AnalysisResult(
+                debt_to_equity_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='safety',
@@ -811,7 +718,7 @@ class FinancialIndicators:
                         '純資産': {'name': total_equity_name, 'value': total_equity}
                     }, ensure_ascii=False)
                 )
-                db.session.add(debt_to_equity_result)
+                FinancialIndicators._save_result(debt_to_equity_result, writer)
                 
                 logger.info(f"安全性指標の分析結果をデータベースに保存しました。")
                 
@@ -862,25 +769,30 @@ class FinancialIndicators:
             }
     
     @staticmethod
-    def calculate_efficiency_indicators(ja_code, year):
+    def calculate_efficiency_indicators(ja_code, year, snapshot=None, writer=None):
         """
         Calculate efficiency indicators
         
         Args:
             ja_code: JA code
             year: Financial year
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Efficiency indicators with calculation details
         """
         try:
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # 収益と資産関連のデータを取得
-            total_revenue_value, total_revenue_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "40000")  # 経常収益
-            total_assets_value, total_assets_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "10000")  # Total assets - 資産の部合計
-            accounts_receivable_value, accounts_receivable_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "1130")  # Accounts receivable
-            inventory_value, inventory_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "1140")  # Inventory
-            accounts_payable_value, accounts_payable_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "3110")  # Accounts payable
-            cost_of_goods_sold_value, cost_of_goods_sold_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "7100")  # Cost of goods sold
+            total_revenue_value, total_revenue_name = snapshot.get_account_value("pl", "40000")  # 経常収益
+            total_assets_value, total_assets_name = snapshot.get_account_value("bs", "10000")  # Total assets - 資産の部合計
+            accounts_receivable_value, accounts_receivable_name = snapshot.get_account_value("bs", "1130")  # Accounts receivable
+            inventory_value, inventory_name = snapshot.get_account_value("bs", "1140")  # Inventory
+            accounts_payable_value, accounts_payable_name = snapshot.get_account_value("bs", "3110")  # Accounts payable
+            cost_of_goods_sold_value, cost_of_goods_sold_name = snapshot.get_account_value("pl", "7100")  # Cost of goods sold
             
             # 総資産回転率（Asset Turnover Ratio）の計算
             asset_turnover = 0
@@ -925,7 +837,7 @@ class FinancialIndicators:
                 # 総資産回転率の保存
                 # 総資産回転率は低いほどリスクが高い（資産効率が悪い）
                 # このJAの場合0.01と非常に低いため、リスクが高い（ダッシュボードと矛盾した表示にならないよう修正）
-                asset_turnover_result = AnalysisResult(
+                asset_turnover_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='efficiency',
@@ -943,12 +855,12 @@ class FinancialIndicators:
                         '総資産': {'code': '10000', 'name': total_assets_name, 'value': total_assets_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(asset_turnover_result)
+                FinancialIndicators._save_result(asset_turnover_result, writer)
                 
                 # 売掛金回転率の保存（データが存在する場合のみ）
                 if accounts_receivable_value > 0:
                     # 売掛金回転率も高いほうが良い指標なので、リスクスコアも高いほど良いに変更
-                    receivables_turnover_result = AnalysisResult(
+                    receivables_turnover_result = dict(
                         ja_code=ja_code,
                         year=year,
                         analysis_type='efficiency',
@@ -966,7 +878,7 @@ class FinancialIndicators:
                             '売掛金': {'code': '1130', 'name': accounts_receivable_name, 'value': accounts_receivable_value}
                         }, ensure_ascii=False)
                     )
-                    db.session.add(receivables_turnover_result)
+                    FinancialIndicators._save_result(receivables_turnover_result, writer)
                 
                 logger.info(f"効率性指標の分析結果をデータベースに保存しました。")
                 
@@ -1059,24 +971,29 @@ class FinancialIndicators:
             }
     
     @staticmethod
-    def calculate_cash_flow_indicators(ja_code, year):
+    def calculate_cash_flow_indicators(ja_code, year, snapshot=None, writer=None):
         """
         Calculate cash flow indicators
         
         Args:
             ja_code: JA code
             year: Financial year
+            snapshot: 読み込み済みのBalanceSnapshot（省略時はJA・年度の残高を読み込む）
+            writer: AnalysisResultWriter（省略時は分析結果をセッションに追加する）
             
         Returns:
             dict: Cash flow indicators with calculation details
         """
         try:
+            if snapshot is None:
+                snapshot = BalanceSnapshot.load(ja_code, year)
+            
             # キャッシュフロー関連のデータを取得
-            operating_cash_flow_value, operating_cash_flow_name = FinancialIndicators.get_account_value(ja_code, year, "cf", "110000")  # 営業活動によるキャッシュ・フロー
-            investing_cash_flow_value, investing_cash_flow_name = FinancialIndicators.get_account_value(ja_code, year, "cf", "12000")  # 投資活動によるキャッシュ・フロー
-            total_debt_value, total_debt_name = FinancialIndicators.get_account_value(ja_code, year, "bs", "4900")  # 負債の部合計
-            total_revenue_value, total_revenue_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "6000")  # 経常収益
-            net_income_value, net_income_name = FinancialIndicators.get_account_value(ja_code, year, "pl", "9900")  # 当期純利益
+            operating_cash_flow_value, operating_cash_flow_name = snapshot.get_account_value("cf", "110000")  # 営業活動によるキャッシュ・フロー
+            investing_cash_flow_value, investing_cash_flow_name = snapshot.get_account_value("cf", "12000")  # 投資活動によるキャッシュ・フロー
+            total_debt_value, total_debt_name = snapshot.get_account_value("bs", "4900")  # 負債の部合計
+            total_revenue_value, total_revenue_name = snapshot.get_account_value("pl", "6000")  # 経常収益
+            net_income_value, net_income_name = snapshot.get_account_value("pl", "9900")  # 当期純利益
             
             # フリーキャッシュフロー（Free Cash Flow）の計算
             # 営業キャッシュフロー - 投資活動によるキャッシュ・フロー
@@ -1102,7 +1019,7 @@ class FinancialIndicators:
             # 分析結果をデータベースに保存
             try:
                 # フリーキャッシュフローの保存
-                free_cash_flow_result = AnalysisResult(
+                free_cash_flow_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='cash_flow',
@@ -1120,10 +1037,10 @@ class FinancialIndicators:
                         '投資活動によるキャッシュフロー': {'code': '12000', 'name': investing_cash_flow_name, 'value': investing_cash_flow_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(free_cash_flow_result)
+                FinancialIndicators._save_result(free_cash_flow_result, writer)
                 
                 # 営業キャッシュフロー比率の保存
-                ocf_ratio_result = AnalysisResult(
+                ocf_ratio_result = dict(
                     ja_code=ja_code,
                     year=year,
                     analysis_type='cash_flow',
@@ -1141,7 +1058,7 @@ class FinancialIndicators:
                         '総負債': {'code': '4900', 'name': total_debt_name, 'value': total_debt_value}
                     }, ensure_ascii=False)
                 )
-                db.session.add(ocf_ratio_result)
+                FinancialIndicators._save_result(ocf_ratio_result, writer)
                 
                 logger.info(f"キャッシュフロー指標の分析結果をデータベースに保存しました。")
                 
@@ -0,0 +1,214 @@
+"""
+勘定科目計算式（AccountFormula）の評価プラン
+計算式を依存関係グラフ（DAG）にコンパイルし、トポロジカル順にメモリ上で評価する
+"""
+
+import heapq
+import logging
+from models import AccountFormula
+
+logger = logging.getLogger(__name__)
+
+# 評価に対応している計算式のタイプ
+SUPPORTED_FORMULA_TYPES = ("sum", "diff")
+
+
+class FormulaCycleError(ValueError):
+    """計算式の依存関係に循環がある場合のエラー"""
+
+    def __init__(self, financial_statement, codes):
+        self.financial_statement = financial_statement
+        self.codes = list(codes)
+        super().__init__(
+            f"{financial_statement}の計算式に循環参照があります: {', '.join(self.codes)}"
+        )
+
+
+class FormulaPlan:
+    """
+    コンパイル済みの計算式評価プラン
+
+    計算式の結果科目が他の計算式の構成科目になっている場合、その計算式を先に評価する。
+    依存関係の無い計算式同士は従来どおり priority の高い順（同じ場合はid順）に並べる。
+
+    使用例:
+        plan = FormulaPlan.compile("bs")
+        results = plan.evaluate(balances)
+    """
+
+    def __init__(self, financial_statement, formulas):
+        """
+        Args:
+            financial_statement: 財務諸表のタイプ (bs, pl, cf)
+            formulas: 評価順に並んだ (AccountFormula, 構成科目コードのタプル) のリスト
+        """
+        self.financial_statement = financial_statement
+        self._steps = formulas
+
+    def __len__(self):
+        return len(self._steps)
+
+    @property
+    def target_codes(self):
+        """評価順の結果科目コード"""
+        return [formula.target_code for formula, _ in self._steps]
+
+    @property
+    def formulas(self):
+        """評価順の計算式"""
+        return [formula for formula, _ in self._steps]
+
+    @classmethod
+    def compile(cls, financial_statement, formulas=None):
+        """
+        計算式を依存関係順に並べた評価プランを作成する
+
+        Args:
+            financial_statement: 財務諸表のタイプ (bs, pl, cf)
+            formulas: AccountFormulaのリスト（Noneの場合はデータベースから取得）
+
+        Returns:
+            FormulaPlan: 評価プラン
+
+        Raises:
+            FormulaCycleError: 計算式の依存関係に循環がある場合
+        """
+        if formulas is None:
+            formulas = AccountFormula.query.filter_by(
+                financial_statement=financial_statement
+            ).all()
+
+        # 従来の評価順（優先度の高い順、同じ場合はid順）
+        ordered = sorted(formulas, key=lambda f: (-(f.priority or 0), f.id or 0))
+
+        # 同じ結果科目の計算式が複数ある場合は、従来どおり最後に評価される計算式を使用する
+        nodes = {}
+        for rank, formula in enumerate(ordered):
+            if formula.formula_type not in SUPPORTED_FORMULA_TYPES:
+                logger.warning(f"Unsupported formula type: {formula.formula_type} ({formula.target_code})")
+                continue
+            if formula.target_code in nodes:
+                logger.warning(f"計算式が重複しています: {formula.target_code}（後の計算式を使用）")
+            nodes[formula.target_code] = (rank, formula, tuple(formula.component_codes))
+
+        # 構成科目 → それを使用する計算式の結果科目
+        dependents = {code: [] for code in nodes}
+        indegree = dict.fromkeys(nodes, 0)
+        for target_code, (_, _, component_codes) in nodes.items():
+            for code in set(component_codes):
+                if code in nodes:
+                    dependents[code].append(target_code)
+                    indegree[target_code] += 1
+
+        # Kahnのアルゴリズム（実行可能な計算式のうち従来の順序が先のものから評価する）
+        ready = [(nodes[code][0], code) for code, count in indegree.items() if count == 0]
+        heapq.heapify(ready)
+        steps = []
+        while ready:
+            _, code = heapq.heappop(ready)
+            _, formula, component_codes = nodes[code]
+            steps.append((formula, component_codes))
+            for dependent in dependents[code]:
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    heapq.heappush(ready, (nodes[dependent][0], dependent))
+
+        if len(steps) < len(nodes):
+            cyclic = sorted(code for code, count in indegree.items() if count > 0)
+            raise FormulaCycleError(financial_statement, cyclic)
+
+        logger.debug(f"計算式プランを作成しました: {financial_statement}, 計算式={len(steps)}件")
+        return cls(financial_statement, steps)
+
+    def downstream(self, account_codes):
+        """
+        指定した科目の変更によって結果が変わる計算式だけを含むプランを返す
+
+        Args:
+            account_codes: 値が変更された科目コードのリスト
+
+        Returns:
+            FormulaPlan: 影響を受ける計算式のみの評価プラン（評価順は維持）
+        """
+        dirty = set(account_codes)
+        steps = []
+        # 評価順に並んでいるため、1回の走査で推移的な影響範囲が求まる
+        for formula, component_codes in self._steps:
+            if dirty.intersection(component_codes):
+                steps.append((formula, component_codes))
+                dirty.add(formula.target_code)
+        return FormulaPlan(self.financial_statement, steps)
+
+    def evaluate(self, balances):
+        """
+        残高マップ上で計算式を順に評価する（結果はマップにも反映され、後続の計算式から参照される）
+
+        Args:
+            balances: {科目コード: [[current_value, previous_value], ...]} の辞書（レコード順）
+
+        Returns:
+            list: 評価順の (AccountFormula, current_value, previous_value) のリスト
+        """
+        results = []
+        for formula, component_codes in self._steps:
+            if formula.formula_type == "sum":
+                total_value, total_prev_value = self._evaluate_sum(formula, component_codes, balances)
+            else:
+                total_value, total_prev_value = self._evaluate_diff(formula, component_codes, balances)
+
+            # 結果科目の最初のレコードを更新する（レコードが無い場合は追加する）
+            records = balances.setdefault(formula.target_code, [])
+            if records:
+                records[0][0] = total_value
+                records[0][1] = total_prev_value
+            else:
+                records.append([total_value, total_prev_value])
+            results.append((formula, total_value, total_prev_value))
+        return results
+
+    @staticmethod
+    def _evaluate_sum(formula, component_codes, balances):
+        """科目の合計を計算"""
+        if not component_codes:
+            logger.warning(f"No component codes found for formula: {formula.target_code}")
+            return 0, 0
+
+        total_value = 0
+        total_prev_value = 0
+        for code in dict.fromkeys(component_codes):
+            for current_value, previous_value in balances.get(code, ()):
+                if current_value is not None:
+                    total_value += current_value
+                if previous_value is not None:
+                    total_prev_value += previous_value
+
+        logger.debug(f"Sum calculation result: {formula.target_code} = {total_value} (prev: {total_prev_value})")
+        return total_value, total_prev_value
+
+    @staticmethod
+    def _evaluate_diff(formula, component_codes, balances):
+        """科目の差分を計算（最初の科目から残りを引く）"""
+        if len(component_codes) < 2:
+            logger.warning(f"Insufficient component codes for diff formula: {formula.target_code}")
+            return 0, 0
+
+        first_records = balances.get(component_codes[0])
+        if not first_records:
+            return 0, 0
+
+        current_value, previous_value = first_records[0]
+        total_value = current_value if current_value is not None else 0
+        total_prev_value = previous_value if previous_value is not None else 0
+
+        # 最初の要素以外の要素を引く（各科目の最初のレコードを使用）
+        for code in component_codes[1:]:
+            records = balances.get(code)
+            if records:
+                current_value, previous_value = records[0]
+                if current_value is not None:
+                    total_value -= current_value
+                if previous_value is not None:
+                    total_prev_value -= previous_value
+
+        logger.debug(f"Diff calculation result: {formula.target_code} = {total_value} (prev: {total_prev_value})")
+        return total_value, total_prev_value
@@ -0,0 +1,132 @@
+"""
+勘定科目名のあいまい検索（参照マッピング用）
+difflib.SequenceMatcher の ratio() がしきい値以上になり得る候補のみを転置インデックスで絞り込み、
+候補に対してだけ ratio() を計算する。結果は全件に ratio() を計算した場合と同じになる。
+
+ratio() = 2 * 一致文字数 / (2つの長さの和) であり、一致文字数は共通する文字数（重複を含む）以下のため、
+- 長さによる上限: 2 * min(長さ) / (長さの和)
+- 共通する文字数による上限（SequenceMatcher.quick_ratio と同じ値）
+がしきい値未満の候補は除外できる。共通する文字数の下限からプレフィックスフィルタも適用する。
+"""
+
+import math
+import logging
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 浮動小数点の誤差で候補を除外しないための許容値
+EPSILON = 1e-9
+
+
+def char_tokens(text):
+    """
+    文字のトークン集合（同じ文字の2回目以降は別のトークン）を返す
+    2つの集合の共通部分の大きさが、重複を含めた共通する文字数になる
+
+    Args:
+        text: 文字列
+
+    Returns:
+        frozenset: (文字, 出現回数) のタプルの集合
+    """
+    seen = Counter()
+    tokens = []
+    for char in text:
+        seen[char] += 1
+        tokens.append((char, seen[char]))
+    return frozenset(tokens)
+
+
+class FuzzyNameMatcher:
+    """
+    名前のリストに対して SequenceMatcher の ratio() が最も高い名前を検索するクラス
+
+    使用例:
+        matcher = FuzzyNameMatcher(reference_names)
+        name, similarity = matcher.best_match(account_name, threshold=0.9)
+    """
+
+    def __init__(self, names):
+        """
+        Args:
+            names: 検索対象の名前のリスト（同点の場合はリストの先の名前を優先する）
+        """
+        self.names = list(names)
+        self._tokens = [char_tokens(name) for name in self.names]
+        self._lengths = np.array([len(name) for name in self.names], dtype=np.int64)
+        postings = defaultdict(list)
+        for position, tokens in enumerate(self._tokens):
+            for token in tokens:
+                postings[token].append(position)
+        self._postings = {token: np.array(positions, dtype=np.int64) for token, positions in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, query, threshold):
+        """
+        ratio() がしきい値以上になり得る名前の位置を返す
+
+        Args:
+            query: 検索する名前
+            threshold: 類似度のしきい値
+
+        Returns:
+            numpy.ndarray: 名前の位置（昇順）
+        """
+        empty = np.empty(0, dtype=np.int64)
+        if threshold > 1:
+            return empty
+        tokens = char_tokens(query)
+        query_length = len(query)
+
+        # しきい値を満たすには共通する文字数が min_overlap 以上必要なため、
+        # 出現の少ない順に並べた先頭 query_length - min_overlap + 1 個のいずれかを含む名前のみが候補になる
+        if threshold > 0:
+            min_overlap = math.ceil(query_length * threshold / (2 - threshold) - EPSILON)
+        else:
+            min_overlap = 1
+        prefix_size = query_length - min_overlap + 1
+        if prefix_size <= 0:
+            return empty
+        prefix = sorted(tokens, key=lambda token: (len(self._postings.get(token, ())), token))[:prefix_size]
+        postings = [self._postings[token] for token in prefix if token in self._postings]
+        if not postings:
+            return empty
+        positions = np.unique(np.concatenate(postings))
+
+        # 長さによる上限
+        lengths = self._lengths[positions]
+        keep = 2 * np.minimum(query_length, lengths) / (query_length + lengths) >= threshold - EPSILON
+        positions = positions[keep]
+        lengths = lengths[keep]
+
+        # 共通する文字数による上限
+        overlaps = np.fromiter((len(tokens & self._tokens[position]) for position in positions),
+                               dtype=np.int64, count=len(positions))
+        keep = 2 * overlaps / (query_length + lengths) >= threshold - EPSILON
+        return positions[keep]
+
+    def best_match(self, query, threshold):
+        """
+        ratio() が最も高く、しきい値以上の名前を返す
+
+        Args:
+            query: 検索する名前
+            threshold: 類似度のしきい値
+
+        Returns:
+            tuple: (名前, 類似度)（見つからない場合は (None, 0.0)）
+        """
+        best_match = None
+        best_similarity = 0.0
+        for position in self.candidates(query, threshold):
+            name = self.names[position]
+            similarity = SequenceMatcher(None, query, name).ratio()
+            if similarity > best_similarity and similarity >= threshold:
+                best_similarity = similarity
+                best_match = name
+        return best_match, best_similarity
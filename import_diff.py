@@ -0,0 +1,72 @@
+"""
+財務諸表の再取込時の差分計算
+既存のCSVデータと解析済みの行を勘定科目名と行位置で突き合わせ、追加・更新・削除する行を求める
+"""
+
+from collections import defaultdict
+from utils import normalize_string
+
+# 差分の判定に使用する列（account_name は突き合わせのキー）
+COMPARED_COLUMNS = ('row_number', 'category', 'current_value', 'previous_value')
+
+# 勘定科目の内容（残高に影響する列）
+VALUE_COLUMNS = ('category', 'current_value', 'previous_value')
+
+
+def _rows_by_name(rows, normalize):
+    """勘定科目名ごとに行を行番号順に並べる"""
+    by_name = defaultdict(list)
+    for row in sorted(rows, key=lambda row: row['row_number']):
+        name = normalize_string(row['account_name'], for_db=True) if normalize else row['account_name']
+        by_name[name].append(row)
+    return by_name
+
+
+def diff_rows(existing, parsed):
+    """
+    既存の行と解析済みの行の差分を求める
+
+    同じ勘定科目名の行が複数ある場合（「その他」など）は、行番号順に n 番目同士を突き合わせる。
+    行番号だけが変わった行は更新するが、変更された勘定科目には含めない。
+
+    Args:
+        existing: 既存の行の辞書（id, row_number, account_name, category, current_value, previous_value）のリスト
+        parsed: statement_parser.parse_statement が返す行のリスト（勘定科目名は正規化済み）
+
+    Returns:
+        dict: inserted（追加する行）, updated（{'id': ..., 変更する列: 値}）, deleted（削除するid）,
+              unchanged（変更の無い行数）, changed_accounts（内容が変わった勘定科目名のリスト）
+    """
+    # 既存の行は過去の取込処理で登録されたものもあるため、キーとして比較する前に正規化する
+    existing_by_name = _rows_by_name(existing, normalize=True)
+    parsed_by_name = _rows_by_name(parsed, normalize=False)
+
+    inserted, updated, deleted = [], [], []
+    unchanged = 0
+    changed_accounts = set()
+    for name in existing_by_name.keys() | parsed_by_name.keys():
+        old_rows = existing_by_name.get(name, [])
+        new_rows = parsed_by_name.get(name, [])
+        for old, new in zip(old_rows, new_rows):
+            changes = {column: new[column] for column in COMPARED_COLUMNS if old[column] != new[column]}
+            if not changes:
+                unchanged += 1
+                continue
+            updated.append(dict(changes, id=old['id']))
+            if any(column in changes for column in VALUE_COLUMNS):
+                changed_accounts.add(old['account_name'])
+        for old in old_rows[len(new_rows):]:
+            deleted.append(old['id'])
+            changed_accounts.add(old['account_name'])
+        for new in new_rows[len(old_rows):]:
+            inserted.append(new)
+            changed_accounts.add(new['account_name'])
+
+    inserted.sort(key=lambda row: row['row_number'])
+    return {
+        'inserted': inserted,
+        'updated': updated,
+        'deleted': sorted(deleted),
+        'unchanged': unchanged,
+        'changed_accounts': sorted(changed_accounts),
+    }
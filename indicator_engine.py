@@ -0,0 +1,642 @@
+"""
+複数JA・年度の財務指標を一括計算するベクトル化エンジン
+standard_account_balanceを (JA・年度 × 勘定科目) の行列に展開し、
+FinancialIndicatorsと同じ計算式・リスク評価をNumPyの配列演算で行う
+"""
+
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+from app import db
+from models import StandardAccountBalance
+from account_hierarchy import get_account_hierarchy
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_TYPES = ['liquidity', 'profitability', 'safety', 'efficiency', 'cash_flow']
+
+# リスク評価の区分（閾値を上から順に判定し、該当しない場合は最後のスコア・レベル）
+RISK_BUCKETS = {
+    'current_ratio': ([200, 150, 100], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'quick_ratio': ([150, 100, 75], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'roa': ([1, 0.5, 0.1], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'roe': ([5, 1, 0.5], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'operating_profit_margin': ([25, 15, 5], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'equity_ratio': ([30, 20, 10], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'debt_ratio': ([300, 200, 150], [4, 3, 2, 1], ['高い', '中程度', '低い', '極めて低い']),
+    'debt_to_equity': ([300, 250, 200], [4, 3, 2, 1], ['高い', '中程度', '低い', '極めて低い']),
+    'asset_turnover': ([0.7, 0.5, 0.3, 0.1], [5, 4, 3, 2, 1], ['極めて低い', '低い', '中程度', '高い', '極めて高い']),
+    'receivables_turnover': ([10, 8, 5, 3], [5, 4, 3, 2, 1], ['極めて低い', '低い', '中程度', '高い', '極めて高い']),
+    'free_cash_flow': ([100000, 50000, 0], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+    'ocf_ratio': ([0.3, 0.2, 0.1], [1, 2, 3, 4], ['極めて低い', '低い', '中程度', '高い']),
+}
+
+
+def safe_divide(numerator, denominator):
+    """分母が0の要素は0を返す配列の割り算"""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+
+def risk_bucket(indicator_name, values):
+    """
+    指標値の配列からリスクスコアとリスクレベルの配列を求める
+
+    Returns:
+        tuple: (ndarray[int]: risk_score, ndarray[object]: risk_level)
+    """
+    thresholds, scores, levels = RISK_BUCKETS[indicator_name]
+    conditions = [values > threshold for threshold in thresholds]
+    risk_scores = np.select(conditions, scores[:-1], default=scores[-1])
+    risk_levels = np.select(conditions, np.array(levels[:-1], dtype=object), default=levels[-1])
+    return risk_scores, risk_levels
+
+
+class BalanceMatrix:
+    """
+    複数JA・年度の残高を (entity × (statement_type, account_code)) の密行列として保持するクラス
+    entity は (ja_code, year) の組
+    """
+
+    def __init__(self, entities, keys, values, counts, first_values, first_names, hierarchy):
+        """
+        Args:
+            entities: [(ja_code, year), ...]
+            keys: [(statement_type, account_code), ...]
+            values: 科目ごとの残高合計 (entity × key)
+            counts: 科目ごとのレコード数 (entity × key)
+            first_values: 科目ごとの最初のレコードの値（レコードが無い・値がNoneの場合はNaN）
+            first_names: {(entity_index, key_index): 最初のレコードの科目名}
+            hierarchy: 標準勘定科目の親子関係インデックス
+        """
+        self.entities = entities
+        self.keys = keys
+        self.key_index = {key: i for i, key in enumerate(keys)}
+        self.values = values
+        self.counts = counts
+        self.first_values = first_values
+        self.first_names = first_names
+        self.hierarchy = hierarchy
+        self._resolved = {}
+
+    @property
+    def size(self):
+        return len(self.entities)
+
+    @classmethod
+    def load(cls, ja_codes=None, years=None):
+        """
+        standard_account_balanceを1回のクエリで読み込み、行列に展開する
+
+        Args:
+            ja_codes: 対象JAコードのリスト（Noneの場合は全JA）
+            years: 対象年度のリスト（Noneの場合は全年度）
+
+        Returns:
+            BalanceMatrix: 読み込んだ行列
+        """
+        query = db.session.query(
+            StandardAccountBalance.ja_code,
+            StandardAccountBalance.year,
+            StandardAccountBalance.statement_type,
+            StandardAccountBalance.standard_account_code,
+            StandardAccountBalance.standard_account_name,
+            StandardAccountBalance.current_value
+        )
+        if ja_codes is not None:
+            query = query.filter(StandardAccountBalance.ja_code.in_(list(ja_codes)))
+        if years is not None:
+            query = query.filter(StandardAccountBalance.year.in_([int(y) for y in years]))
+        rows = query.order_by(StandardAccountBalance.id).all()
+
+        # JAと年度が両方指定された場合は、残高が無い組み合わせも（全科目0として）含める
+        entities = None
+        if ja_codes is not None and years is not None:
+            entities = [(ja_code, int(year)) for ja_code in ja_codes for year in years]
+        return cls.from_rows(rows, entities=entities)
+
+    @classmethod
+    def from_rows(cls, rows, entities=None, hierarchy=None):
+        """
+        (ja_code, year, statement_type, code, name, current_value) の行（id順）から行列を作成する
+
+        Args:
+            rows: 残高の行
+            entities: 行列に含める (ja_code, year) のリスト（省略時は行に現れる組み合わせ）
+            hierarchy: 標準勘定科目の親子関係インデックス（省略時は共有インデックス）
+        """
+        if hierarchy is None:
+            hierarchy = get_account_hierarchy()
+
+        df = pd.DataFrame(rows, columns=['ja_code', 'year', 'statement_type', 'code', 'name', 'current_value'])
+        if entities is None:
+            entities = list(dict.fromkeys((ja_code, int(year)) for ja_code, year in zip(df['ja_code'], df['year'])))
+        if df.empty:
+            shape = (len(entities), 0)
+            return cls(entities, [], np.zeros(shape), np.zeros(shape, dtype=np.int64),
+                       np.zeros(shape), {}, hierarchy)
+
+        entity_index = {entity: i for i, entity in enumerate(entities)}
+        entity_codes = np.array([entity_index[(ja_code, int(year))]
+                                 for ja_code, year in zip(df['ja_code'], df['year'])], dtype=np.int64)
+        key_codes, key_uniques = pd.MultiIndex.from_frame(df[['statement_type', 'code']]).factorize()
+        keys = list(key_uniques)
+
+        current_values = pd.to_numeric(df['current_value'], errors='coerce').to_numpy(dtype=float)
+        shape = (len(entities), len(keys))
+
+        # レコード順に加算し、スカラー版と同じ順序で合計する
+        values = np.zeros(shape)
+        np.add.at(values, (entity_codes, key_codes), np.nan_to_num(current_values, nan=0.0))
+        counts = np.zeros(shape, dtype=np.int64)
+        np.add.at(counts, (entity_codes, key_codes), 1)
+
+        first = pd.DataFrame({'e': entity_codes, 'k': key_codes, 'v': current_values, 'n': df['name']})
+        first = first.drop_duplicates(subset=['e', 'k'], keep='first')
+        first_values = np.full(shape, np.nan)
+        first_values[first['e'].to_numpy(), first['k'].to_numpy()] = first['v'].to_numpy(dtype=float)
+        first_names = dict(zip(zip(first['e'].tolist(), first['k'].tolist()), first['n'].tolist()))
+
+        logger.info(f"残高行列を作成しました: {len(entities)}エンティティ × {len(keys)}科目 ({len(df)}レコード)")
+        return cls(entities, keys, values, counts, first_values, first_names, hierarchy)
+
+    def _column(self, statement_type, code):
+        """科目の (合計値, レコード数) の列を返す（存在しない場合はゼロ列）"""
+        k = self.key_index.get((statement_type, code))
+        if k is None:
+            return np.zeros(self.size), np.zeros(self.size, dtype=np.int64)
+        return self.values[:, k], self.counts[:, k]
+
+    def _sum_codes(self, statement_type, codes):
+        """指定コード群の合計とレコード数（コード順に加算）"""
+        total = np.zeros(self.size)
+        record_count = np.zeros(self.size, dtype=np.int64)
+        for code in codes:
+            k = self.key_index.get((statement_type, code))
+            if k is None:
+                continue
+            present = self.counts[:, k] > 0
+            total = np.where(present, total + self.values[:, k], total)
+            record_count += self.counts[:, k]
+        return total, record_count
+
+    def account(self, statement_type, account_code):
+        """
+        BalanceSnapshot.get_account_value と同じ規則で勘定科目の値と名前を全エンティティ分求める
+
+        Returns:
+            tuple: (ndarray[float]: 値, ndarray[object]: 科目名)
+        """
+        account_code = str(account_code)
+        cache_key = (statement_type, account_code)
+        if cache_key in self._resolved:
+            return self._resolved[cache_key]
+
+        n = self.size
+        if account_code == "3200":  # 債券
+            result = (np.zeros(n), np.full(n, "債券", dtype=object))
+            self._resolved[cache_key] = result
+            return result
+
+        direct_values, direct_counts = self._column(statement_type, account_code)
+        direct = direct_counts > 0
+        parent_name = self.hierarchy.name(account_code) or f"{account_code}の科目"
+
+        values = np.zeros(n)
+        names = np.full(n, f"{account_code}の科目", dtype=object)
+
+        default_child_codes = self.hierarchy.default_children(account_code)
+        if default_child_codes:
+            default_values, _ = self._sum_codes(statement_type, default_child_codes)
+            values = default_values
+            names[:] = parent_name
+
+        child_codes = self.hierarchy.children(account_code)
+        if child_codes:
+            child_values, child_counts = self._sum_codes(statement_type, child_codes)
+            has_children = child_counts > 0
+            values = np.where(has_children, child_values, values)
+            names[has_children] = parent_name
+
+        values = np.where(direct, direct_values, values)
+        k = self.key_index.get((statement_type, account_code))
+        if k is not None:
+            for e in np.flatnonzero(direct):
+                names[e] = self.first_names.get((e, k)) or f"科目{account_code}"
+
+        self._resolved[cache_key] = (values, names)
+        return values, names
+
+    def first_record(self, statement_type, account_code):
+        """最初のレコードの値（無い場合はNaN）と科目名の列を返す"""
+        k = self.key_index.get((statement_type, account_code))
+        if k is None:
+            return np.full(self.size, np.nan), np.full(self.size, None, dtype=object)
+        names = np.array([self.first_names.get((e, k)) for e in range(self.size)], dtype=object)
+        return self.first_values[:, k], names
+
+
+class IndicatorEngine:
+    """
+    BalanceMatrixから全カテゴリの財務指標を配列演算で計算するクラス
+
+    使用例:
+        engine = IndicatorEngine(BalanceMatrix.load(years=[2023, 2024]))
+        values = engine.compute()          # {analysis_type: {indicator_name: ndarray}}
+        rows = engine.analysis_rows()      # AnalysisResultに保存する行（dict）のリスト
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self._computed = {}
+
+    def compute(self, analysis_types=None):
+        """指定カテゴリ（省略時は全カテゴリ）の指標値を計算する"""
+        results = {}
+        for analysis_type in analysis_types or ANALYSIS_TYPES:
+            results[analysis_type] = {
+                name: value for name, value in self._category(analysis_type).items()
+                if not name.startswith('_')
+            }
+        return results
+
+    def _category(self, analysis_type):
+        if analysis_type not in self._computed:
+            self._computed[analysis_type] = getattr(self, f"_compute_{analysis_type}")()
+        return self._computed[analysis_type]
+
+    def _compute_liquidity(self):
+        m = self.matrix
+        total_assets, total_assets_name = m.account("bs", "10000")  # 資産の部
+
+        cash, _ = m.account("bs", "11110")  # 現金
+        deposits_asset1, _ = m.account("bs", "11160")  # 系統預金
+        deposits_asset2, _ = m.account("bs", "11170")  # 定期預金
+        cash_deposits = cash + deposits_asset1 + deposits_asset2
+        cash_deposits_alt, _ = m.account("bs", "11000")  # 現金預金
+        cash_deposits = np.where(cash_deposits == 0, cash_deposits_alt, cash_deposits)
+
+        securities, _ = m.account("bs", "11200")  # 有価証券等
+        loans, _ = m.account("bs", "11300")  # 貸出金
+
+        use_total = total_assets > 0
+        current_assets = np.where(use_total, total_assets, cash_deposits + securities + loans)
+        current_assets_name = np.where(use_total, total_assets_name, "流動資産（合計）")
+
+        # 流動負債（21000）、最初のレコードに値があればそれを優先
+        current_liabilities, current_liabilities_name = m.account("bs", "21000")
+        cl_first, cl_first_name = m.first_record("bs", "21000")
+        use_first = ~np.isnan(cl_first) & (cl_first != 0)
+        current_liabilities = np.where(use_first, cl_first, current_liabilities)
+        current_liabilities_name = np.where(
+            use_first,
+            np.array([name or "流動負債" for name in cl_first_name], dtype=object),
+            current_liabilities_name
+        )
+
+        # 流動負債が0の場合は個別の負債科目を合計
+        liability_sum = np.zeros(m.size)
+        for code in ["3000", "3100", "3200", "3300", "3400", "3500", "3600", "3605"]:
+            liability_sum = liability_sum + m.account("bs", code)[0]
+        use_sum = (current_liabilities == 0) & (liability_sum > 0)
+        current_liabilities = np.where(use_sum, liability_sum, current_liabilities)
+        current_liabilities_name = np.where(use_sum, "流動負債（合計）", current_liabilities_name)
+
+        # それでも0の場合は負債の部合計（20000）
+        alt, alt_name = m.account("bs", "20000")
+        use_alt = (current_liabilities == 0) & (alt > 0)
+        current_liabilities = np.where(use_alt, alt, current_liabilities)
+        current_liabilities_name = np.where(use_alt, alt_name, current_liabilities_name)
+
+        accounts_receivable, _ = m.account("bs", "1110")  # コールローン
+        quick_assets = cash_deposits + accounts_receivable
+
+        return {
+            'current_ratio': safe_divide(current_assets, current_liabilities) * 100,
+            'quick_ratio': safe_divide(quick_assets, current_liabilities) * 100,
+            'cash_ratio': safe_divide(cash_deposits, current_liabilities) * 100,
+            'working_capital': current_assets - current_liabilities,
+            '_current_assets': (current_assets, current_assets_name),
+            '_current_liabilities': (current_liabilities, current_liabilities_name),
+            '_quick_assets': quick_assets,
+        }
+
+    def _compute_profitability(self):
+        m = self.matrix
+        net_income, net_income_name = m.account("pl", "80000")  # 税引前当期利益
+        for code in ["90000", "99000", "93000"]:
+            alt, alt_name = m.account("pl", code)
+            use_alt = (net_income == 0) & (alt != 0)
+            net_income = np.where(use_alt, alt, net_income)
+            net_income_name = np.where(use_alt, alt_name, net_income_name)
+
+        operating_income, operating_income_name = m.account("pl", "60000")  # 経常利益
+
+        total_assets, total_assets_name = m.account("bs", "10000")
+        alt_assets, alt_assets_name = m.account("bs", "5950")  # 負債純資産合計
+        no_assets = total_assets == 0
+        total_assets = np.where(no_assets, alt_assets, total_assets)
+        total_assets_name = np.where(no_assets, alt_assets_name, total_assets_name)
+
+        total_equity, total_equity_name = m.account("bs", "30000")
+        capital, _ = m.account("bs", "31000")
+        retained_earnings, _ = m.account("bs", "32000")
+        total_equity = np.where(total_equity == 0, capital + retained_earnings, total_equity)
+
+        operating_revenue, operating_revenue_name = m.account("pl", "40000")  # 経常収益
+
+        return {
+            'roa': safe_divide(net_income, total_assets) * 100,
+            'roe': safe_divide(net_income, total_equity) * 100,
+            'operating_profit_margin': safe_divide(operating_income, operating_revenue) * 100,
+            '_net_income': (net_income, net_income_name),
+            '_total_assets': (total_assets, total_assets_name),
+            '_total_equity': (total_equity, total_equity_name),
+            '_operating_income': (operating_income, operating_income_name),
+            '_operating_revenue': (operating_revenue, operating_revenue_name),
+        }
+
+    def _compute_safety(self):
+        m = self.matrix
+        total_assets, total_assets_name = m.account("bs", "10000")
+        total_liabilities, total_liabilities_name = m.account("bs", "20000")
+        equity_direct, equity_direct_name = m.account("bs", "30000")
+        equity_alt, equity_alt_name = m.account("bs", "5900")
+        capital, _ = m.account("bs", "31000")
+        retained_earnings, _ = m.account("bs", "32000")
+        equity_sum = capital + retained_earnings + 0
+
+        no_direct = equity_direct == 0
+        use_alt = no_direct & (equity_alt > 0)
+        use_sum = no_direct & ~use_alt & (equity_sum > 0)
+        use_diff = no_direct & ~use_alt & ~use_sum
+        total_equity = np.select(
+            [use_alt, use_sum, use_diff],
+            [equity_alt, equity_sum, total_assets - total_liabilities],
+            default=equity_direct
+        )
+        total_equity_name = np.select(
+            [use_alt, use_sum, use_diff],
+            [equity_alt_name,
+             np.full(m.size, "純資産合計（資本金・利益剰余金等の合計）", dtype=object),
+             np.full(m.size, "純資産（資産 - 負債の計算値）", dtype=object)],
+            default=equity_direct_name
+        )
+
+        debt_ratio = safe_divide(total_liabilities, total_equity) * 100
+        return {
+            'equity_ratio': safe_divide(total_equity, total_assets) * 100,
+            'debt_ratio': debt_ratio,
+            'debt_to_equity': debt_ratio.copy(),
+            '_total_assets': (total_assets, total_assets_name),
+            '_total_liabilities': (total_liabilities, total_liabilities_name),
+            '_total_equity': (total_equity, total_equity_name),
+        }
+
+    def _compute_efficiency(self):
+        m = self.matrix
+        total_revenue, total_revenue_name = m.account("pl", "40000")  # 経常収益
+        total_assets, total_assets_name = m.account("bs", "10000")
+        accounts_receivable, accounts_receivable_name = m.account("bs", "1130")
+        inventory, _ = m.account("bs", "1140")
+        accounts_payable, _ = m.account("bs", "3110")
+        cost_of_goods_sold, _ = m.account("pl", "7100")
+
+        receivables_turnover = safe_divide(total_revenue, accounts_receivable)
+        inventory_turnover = safe_divide(cost_of_goods_sold, inventory)
+        payables_turnover = safe_divide(cost_of_goods_sold, accounts_payable)
+        days_sales_outstanding = safe_divide(365, receivables_turnover)
+        days_inventory_outstanding = safe_divide(365, inventory_turnover)
+        days_payables_outstanding = safe_divide(365, payables_turnover)
+
+        return {
+            'asset_turnover': safe_divide(total_revenue, total_assets),
+            'receivables_turnover': receivables_turnover,
+            'days_sales_outstanding': days_sales_outstanding,
+            'inventory_turnover': inventory_turnover,
+            'days_inventory_outstanding': days_inventory_outstanding,
+            'payables_turnover': payables_turnover,
+            'days_payables_outstanding': days_payables_outstanding,
+            'cash_conversion_cycle': days_inventory_outstanding + days_sales_outstanding - days_payables_outstanding,
+            '_total_revenue': (total_revenue, total_revenue_name),
+            '_total_assets': (total_assets, total_assets_name),
+            '_accounts_receivable': (accounts_receivable, accounts_receivable_name),
+        }
+
+    def _compute_cash_flow(self):
+        m = self.matrix
+        operating_cash_flow, operating_cash_flow_name = m.account("cf", "110000")
+        investing_cash_flow, investing_cash_flow_name = m.account("cf", "12000")
+        total_debt, total_debt_name = m.account("bs", "4900")
+        total_revenue, _ = m.account("pl", "6000")
+        net_income, _ = m.account("pl", "9900")
+
+        return {
+            'free_cash_flow': operating_cash_flow - np.abs(investing_cash_flow),
+            'ocf_ratio': safe_divide(operating_cash_flow, total_debt),
+            'cash_flow_margin': safe_divide(operating_cash_flow, total_revenue) * 100,
+            'cf_to_income': safe_divide(operating_cash_flow, net_income),
+            '_operating_cash_flow': (operating_cash_flow, operating_cash_flow_name),
+            '_investing_cash_flow': (investing_cash_flow, investing_cash_flow_name),
+            '_total_debt': (total_debt, total_debt_name),
+        }
+
+    def analysis_rows(self, analysis_types=None):
+        """
+        FinancialIndicators.calculate_*_indicators がAnalysisResultに保存するのと同じ内容の行を作成する
+
+        Returns:
+            list: AnalysisResultのカラム名をキーとするdictのリスト
+        """
+        rows = []
+        for analysis_type in analysis_types or ANALYSIS_TYPES:
+            rows.extend(getattr(self, f"_{analysis_type}_rows")(self._category(analysis_type)))
+        return rows
+
+    def _rows(self, analysis_type, indicator_name, values, decimals, benchmark, describe, mask=None):
+        """
+        1指標分の行を全エンティティについて作成する
+
+        Args:
+            describe: (entity_index, value) -> (analysis_result, formula, calculation, accounts_used)
+            mask: 行を作成するエンティティのマスク（省略時は全エンティティ）
+        """
+        risk_scores, risk_levels = risk_bucket(indicator_name, values)
+        rows = []
+        for i, (ja_code, year) in enumerate(self.matrix.entities):
+            if mask is not None and not mask[i]:
+                continue
+            value = float(values[i])
+            analysis_result, formula, calculation, accounts_used = describe(i, value)
+            rows.append({
+                'ja_code': ja_code,
+                'year': year,
+                'analysis_type': analysis_type,
+                'indicator_name': indicator_name,
+                'indicator_value': round(value, decimals),
+                'benchmark': benchmark,
+                'risk_score': int(risk_scores[i]),
+                'risk_level': risk_levels[i],
+                'analysis_result': analysis_result,
+                'formula': formula,
+                'calculation': calculation,
+                'accounts_used': json.dumps(accounts_used, ensure_ascii=False),
+            })
+        return rows
+
+    @staticmethod
+    def _item(pair, i, code=None):
+        """(値配列, 名前配列) からaccounts_used用のdictを作る"""
+        values, names = pair
+        item = {'name': names[i], 'value': float(values[i])}
+        if code is not None:
+            item = {'code': code, **item}
+        return item
+
+    def _liquidity_rows(self, c):
+        ca, cl = c['_current_assets'], c['_current_liabilities']
+        qa = c['_quick_assets']
+
+        def current_ratio(i, v):
+            return (f"流動比率は{v:.2f}%です。" +
+                    ("健全な水準です。" if v > 150 else "業界平均を下回っており、短期債務支払能力の向上が必要です。"),
+                    '(流動資産 ÷ 流動負債) × 100',
+                    f"({ca[0][i]:,.0f} ÷ {cl[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'流動資産': self._item(ca, i), '流動負債': self._item(cl, i)})
+
+        def quick_ratio(i, v):
+            return (f"当座比率は{v:.2f}%です。" +
+                    ("健全な水準です。" if v > 100 else "業界平均を下回っており、即時支払能力の向上が必要です。"),
+                    '(当座資産 ÷ 流動負債) × 100',
+                    f"({qa[i]:,.0f} ÷ {cl[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'当座資産': {'value': float(qa[i])}, '流動負債': self._item(cl, i)})
+
+        return (self._rows('liquidity', 'current_ratio', c['current_ratio'], 2, 150.0, current_ratio) +
+                self._rows('liquidity', 'quick_ratio', c['quick_ratio'], 2, 100.0, quick_ratio))
+
+    def _profitability_rows(self, c):
+        ni, ta, te = c['_net_income'], c['_total_assets'], c['_total_equity']
+        oi, orev = c['_operating_income'], c['_operating_revenue']
+
+        def roa(i, v):
+            return (f"総資産利益率(ROA)は{v:.4f}%です。" +
+                    ("健全な水準です。" if v > 0.5 else "業界平均を下回っており、資産運用の効率性向上が必要です。"),
+                    '(税引前当期利益 ÷ 総資産) × 100',
+                    f"({ni[0][i]:,.0f} ÷ {ta[0][i]:,.0f}) × 100 = {v:.4f}%",
+                    {'税引前当期利益': self._item(ni, i, '80000'), '総資産': self._item(ta, i, '10000')})
+
+        def roe(i, v):
+            return (f"自己資本利益率(ROE)は{v:.4f}%です。" +
+                    ("健全な水準です。" if v > 1 else "業界平均を下回っており、株主資本の収益性向上が必要です。"),
+                    '(税引前当期利益 ÷ 純資産) × 100',
+                    f"({ni[0][i]:,.0f} ÷ {te[0][i]:,.0f}) × 100 = {v:.4f}%",
+                    {'税引前当期利益': self._item(ni, i, '80000'), '純資産': self._item(te, i, '30000')})
+
+        def operating_profit_margin(i, v):
+            return (f"営業利益率は{v:.2f}%です。" +
+                    ("健全な水準です。" if v > 15 else "業界平均を下回っており、収益性向上が必要です。"),
+                    '(経常利益 ÷ 経常収益) × 100',
+                    f"({oi[0][i]:,.0f} ÷ {orev[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'経常利益': self._item(oi, i, '60000'), '経常収益': self._item(orev, i, '40000')})
+
+        return (self._rows('profitability', 'roa', c['roa'], 4, 0.5, roa) +
+                self._rows('profitability', 'roe', c['roe'], 4, 1.0, roe) +
+                self._rows('profitability', 'operating_profit_margin', c['operating_profit_margin'], 2, 15.0,
+                           operating_profit_margin))
+
+    def _safety_rows(self, c):
+        ta, tl, te = c['_total_assets'], c['_total_liabilities'], c['_total_equity']
+
+        def equity_ratio(i, v):
+            return (f"自己資本比率は{v:.2f}%です。" +
+                    ("健全な水準です。" if v > 20 else "業界平均を下回っており、自己資本の増強が必要です。"),
+                    '(純資産 ÷ 総資産) × 100',
+                    f"({te[0][i]:,.0f} ÷ {ta[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'総資産': self._item(ta, i, '10000'), '純資産': self._item(te, i)})
+
+        def debt_ratio(i, v):
+            return (f"負債比率は{v:.2f}%です。" +
+                    ("業界平均を上回っており、負債の削減が必要です。" if v > 200 else "健全な水準です。") +
+                    "（注：純資産に対する負債の割合で、200%以下が理想的です）",
+                    '(負債合計 ÷ 純資産) × 100',
+                    f"({tl[0][i]:,.0f} ÷ {te[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'負債合計': self._item(tl, i, '20000'), '純資産': self._item(te, i, '30000')})
+
+        def debt_to_equity(i, v):
+            return (f"負債資本比率は{v:.2f}%です。" +
+                    ("業界平均を上回っており、財務レバレッジが高いです。" if v > 200 else "健全な水準です。") +
+                    "（注：負債比率と同様の計算式ですが、国際的にはDebt-to-Equity Ratioとして知られています）",
+                    '(負債合計 ÷ 純資産) × 100',
+                    f"({tl[0][i]:,.0f} ÷ {te[0][i]:,.0f}) × 100 = {v:.2f}%",
+                    {'負債合計': self._item(tl, i, '20000'), '純資産': self._item(te, i)})
+
+        return (self._rows('safety', 'equity_ratio', c['equity_ratio'], 2, 20.0, equity_ratio) +
+                self._rows('safety', 'debt_ratio', c['debt_ratio'], 2, 200.0, debt_ratio) +
+                self._rows('safety', 'debt_to_equity', c['debt_to_equity'], 2, 200.0, debt_to_equity))
+
+    def _efficiency_rows(self, c):
+        rev, ta, ar = c['_total_revenue'], c['_total_assets'], c['_accounts_receivable']
+
+        def asset_turnover(i, v):
+            return (f"総資産回転率は{v:.2f}回です。" +
+                    ("健全な水準です。" if v > 0.5 else "業界平均を下回っており、資産の効率的活用が必要です。"),
+                    '経常収益 ÷ 総資産',
+                    f"{rev[0][i]:,.0f} ÷ {ta[0][i]:,.0f} = {v:.2f}回",
+                    {'経常収益': self._item(rev, i, '40000'), '総資産': self._item(ta, i, '10000')})
+
+        def receivables_turnover(i, v):
+            return (f"売掛金回転率は{v:.2f}回です。" +
+                    ("健全な水準です。" if v > 8 else "業界平均を下回っており、売掛金回収の改善が必要です。"),
+                    '経常収益 ÷ 売掛金',
+                    f"{rev[0][i]:,.0f} ÷ {ar[0][i]:,.0f} = {v:.2f}回",
+                    {'経常収益': self._item(rev, i, '40000'), '売掛金': self._item(ar, i, '1130')})
+
+        # 売掛金回転率はデータが存在する場合のみ保存する
+        return (self._rows('efficiency', 'asset_turnover', c['asset_turnover'], 2, 0.5, asset_turnover) +
+                self._rows('efficiency', 'receivables_turnover', c['receivables_turnover'], 2, 8.0,
+                           receivables_turnover, mask=ar[0] > 0))
+
+    def _cash_flow_rows(self, c):
+        ocf, icf, td = c['_operating_cash_flow'], c['_investing_cash_flow'], c['_total_debt']
+
+        def free_cash_flow(i, v):
+            return (f"フリーキャッシュフローは{v:,.0f}円です。" +
+                    ("健全な水準です。" if v > 50000 else "業界平均を下回っており、キャッシュフロー改善が必要です。"),
+                    '営業キャッシュフロー - 投資活動によるキャッシュフロー',
+                    f"{ocf[0][i]:,.0f} - {abs(icf[0][i]):,.0f} = {v:,.0f}",
+                    {'営業キャッシュフロー': self._item(ocf, i, '110000'),
+                     '投資活動によるキャッシュフロー': self._item(icf, i, '12000')})
+
+        def ocf_ratio(i, v):
+            return (f"営業キャッシュフロー比率は{v:.2f}です。" +
+                    ("健全な水準です。" if v > 0.2 else "業界平均を下回っており、負債に対するキャッシュフロー創出力の改善が必要です。"),
+                    '営業キャッシュフロー ÷ 総負債',
+                    f"{ocf[0][i]:,.0f} ÷ {td[0][i]:,.0f} = {v:.2f}",
+                    {'営業キャッシュフロー': self._item(ocf, i, '110000'), '総負債': self._item(td, i, '4900')})
+
+        return (self._rows('cash_flow', 'free_cash_flow', c['free_cash_flow'], 2, 50000.0, free_cash_flow) +
+                self._rows('cash_flow', 'ocf_ratio', c['ocf_ratio'], 2, 0.2, ocf_ratio))
+
+
+def calculate_indicators_batch(ja_codes=None, years=None, analysis_types=None):
+    """
+    複数JA・年度の財務指標を一括計算する
+
+    Args:
+        ja_codes: 対象JAコードのリスト（Noneの場合は全JA）
+        years: 対象年度のリスト（Noneの場合は全年度）
+        analysis_types: 対象カテゴリのリスト（Noneの場合は全カテゴリ）
+
+    Returns:
+        list: AnalysisResultに保存する行（dict）のリスト
+    """
+    start_time = time.time()
+    engine = IndicatorEngine(BalanceMatrix.load(ja_codes, years))
+    rows = engine.analysis_rows(analysis_types)
+    logger.info(f"一括指標計算: {engine.matrix.size}エンティティ, {len(rows)}行, {time.time() - start_time:.3f}秒")
+    return rows
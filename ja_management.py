@@ -6,7 +6,7 @@ JAの登録、編集、削除などの機能を提供
 import logging
 from flask import flash, redirect, render_template, request, url_for
 from app import db
-from models import JA
+from models import JA, AccountMapping, mapping_knowledge_keys, refresh_mapping_knowledge
 from performance_enhancer import performance_monitor
 
 # ロガー設定
@@ -250,11 +250,13 @@ def register_ja_routes(app):
             )
             logger.info(f'標準勘定科目残高データ {result2.rowcount}件を削除')
             
-            # 3. アカウントマッピングデータの削除
+            # 3. アカウントマッピングデータの削除（削除した勘定科目名のナレッジベースを再集計）
+            knowledge_keys = mapping_knowledge_keys(db.session.connection(), AccountMapping.__table__.c.ja_code == ja_code)
             result3 = db.session.execute(
                 db.text("DELETE FROM account_mapping WHERE ja_code = :ja_code"),
                 {"ja_code": ja_code}
             )
+            refresh_mapping_knowledge(db.session.connection(), knowledge_keys)
             logger.info(f'アカウントマッピングデータ {result3.rowcount}件を削除')
             
             # 4. CSVデータの削除
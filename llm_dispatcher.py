@@ -0,0 +1,191 @@
+"""
+LLM（OpenAI・Azure OpenAI）へのリクエストの並列実行
+スレッドプールで複数のリクエストを同時に送信し、トークンバケットで送信レートを制限する。
+一時的なエラー（レート制限・タイムアウト・サーバーエラー）はジッター付きの指数バックオフでリトライする。
+
+ワーカースレッドではAPIの呼び出しのみを行い、データベースの読み書きは呼び出し元のスレッドで行うこと。
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from openai import APITimeoutError
+    TIMEOUT_ERRORS = (TimeoutError, APITimeoutError)
+except ImportError:
+    TIMEOUT_ERRORS = (TimeoutError,)
+
+logger = logging.getLogger(__name__)
+
+# 同時に送信するリクエスト数
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '8'))
+
+# 1分あたりの最大リクエスト数（プロセス全体）
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get('LLM_REQUESTS_PER_MINUTE', '300'))
+
+# 1リクエストあたりの最大リトライ回数
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '4'))
+
+# バックオフの初期値・上限（秒）
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# リトライするHTTPステータス（それ以外の4xxは要求自体の誤りのためリトライしない）
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    トークンバケットによる送信レートの制限（スレッドセーフ）
+
+    capacity 件までは連続して送信でき、その後は rate 件/秒の間隔で送信する。
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate: 1秒あたりに補充するトークン数
+            capacity: バケットの容量（Noneの場合は rate と同じ。最低1）
+        """
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity if capacity is not None else rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """トークンを取得する（不足している場合は補充されるまで待つ）"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _retry_after(error):
+    """エラーの応答に Retry-After ヘッダーがあれば待ち時間（秒）を返す"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    リトライまでの待ち時間（指数バックオフ・フルジッター）
+
+    Args:
+        attempt: 失敗した回数 - 1（0から）
+        error: 発生したエラー（Retry-After が指定されていればそれ以上待つ）
+
+    Returns:
+        float: 待ち時間（秒）
+    """
+    delay = random.uniform(0, min(maximum, base * (2 ** attempt)))
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after is not None:
+        delay = max(delay, min(maximum, retry_after))
+    return delay
+
+
+def is_retryable(error):
+    """
+    リトライで解消する可能性のあるエラーか（レート制限・サーバーエラーのHTTPステータスと、タイムアウトのみ）
+    不正な応答やプログラムの誤りなどステータスの無いエラーはリトライしない
+    """
+    if isinstance(error, TIMEOUT_ERRORS):
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS_CODES
+
+
+class LLMDispatcher:
+    """
+    LLMへのリクエストを並列に実行するクラス
+
+    使用例:
+        dispatcher = get_dispatcher()
+        for chunk, response, error in dispatcher.map(request, chunks):
+            ...
+    """
+
+    def __init__(self, concurrency=None, requests_per_minute=None, max_retries=None):
+        """
+        Args:
+            concurrency: 同時に送信するリクエスト数（Noneの場合は LLM_CONCURRENCY）
+            requests_per_minute: 1分あたりの最大リクエスト数（Noneの場合は LLM_REQUESTS_PER_MINUTE）
+            max_retries: 最大リトライ回数（Noneの場合は LLM_MAX_RETRIES）
+        """
+        self.concurrency = max(1, concurrency or LLM_CONCURRENCY)
+        requests_per_minute = requests_per_minute or LLM_REQUESTS_PER_MINUTE
+        # 同時実行数までは待たずに送信できるようにする
+        self.limiter = TokenBucket(requests_per_minute / 60.0, capacity=self.concurrency)
+        self.max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+
+    def call(self, func, *args, **kwargs):
+        """
+        送信レートを守ってリクエストを実行し、一時的なエラーはリトライする
+
+        Raises:
+            Exception: リトライできないエラー、または最大リトライ回数を超えた場合の最後のエラー
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt, e)
+                logger.warning(f"LLMリクエストに失敗しました（{attempt + 1}回目）。{delay:.1f}秒後に再試行します: {str(e)}")
+                time.sleep(delay)
+                attempt += 1
+
+    def map(self, func, items):
+        """
+        各要素について func を並列に実行し、完了した順に結果を返す
+
+        Args:
+            func: 要素を1つ受け取ってリクエストを実行する関数
+            items: 要素のリスト
+
+        Yields:
+            tuple: (要素, 結果, エラー)（成功した場合はエラーがNone、失敗した場合は結果がNone）
+        """
+        items = list(items)
+        if not items:
+            return
+        workers = min(self.concurrency, len(items))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm-request') as executor:
+            futures = {executor.submit(self.call, func, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+
+
+def get_dispatcher():
+    """プロセス全体で共有するディスパッチャーを取得する（送信レートはAPIキー単位で制限されるため）"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = LLMDispatcher()
+        return _dispatcher
@@ -0,0 +1,253 @@
+"""
+AIマッピング（OpenAI API）の結果のキャッシュ
+(財務諸表タイプ, 正規化した勘定科目名, 標準勘定科目一覧のハッシュ, モデル) → マッピング結果 を
+llm_mapping_cache テーブルに保存し、APIを呼び出す前に参照する。
+プロセス内のメモリにも保持するため、同じ勘定科目名の2回目以降はデータベースにも問い合わせない。
+
+標準勘定科目の一覧（またはプロンプト）が変わるとハッシュが変わるため、以前の結果は参照されなくなる。
+古い結果は有効期限（LLM_CACHE_TTL_DAYS）を過ぎるか、purge で削除される。
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from app import db
+from models import LLMMappingCache, upsert_rows
+from performance_enhancer import QueryCache
+from utils import normalize_string
+
+logger = logging.getLogger(__name__)
+
+# キャッシュの有効期限（日）
+LLM_CACHE_TTL_DAYS = int(os.environ.get('LLM_CACHE_TTL_DAYS', '90'))
+
+# プロセス内のメモリに保持する件数と期間（秒）
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES', '4096'))
+MEMORY_TTL = 3600
+
+# IN句に渡す勘定科目名の最大数
+LOOKUP_CHUNK = 500
+
+_memory = QueryCache(
+    max_entries=LLM_CACHE_MEMORY_ENTRIES,
+    invalidation_dir=os.environ.get('QUERY_CACHE_DIR')
+)
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def cache_name(account_name):
+    """キャッシュのキーに使用する勘定科目名（NFKC正規化して空白を除く）"""
+    name = normalize_string(account_name, for_db=True) or ''
+    return re.sub(r'\s+', '', name)[:200]
+
+
+def catalog_hash(standard_accounts, salt=''):
+    """
+    標準勘定科目の一覧のハッシュ（コード・名前・種別が変わると変わる）
+
+    Args:
+        standard_accounts: 標準勘定科目のリスト
+        salt: ハッシュに含める文字列（プロンプトの内容など）
+    """
+    catalog = sorted((account.code or '', account.name or '', account.account_type or '')
+                     for account in standard_accounts)
+    encoded = json.dumps([salt, catalog], ensure_ascii=False)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _memory_key(financial_statement, name, catalog, model):
+    return ('llm_mapping', financial_statement, name, catalog, model)
+
+
+def _memory_tags(financial_statement):
+    return (f"llm_mapping:{financial_statement}",)
+
+
+def _result(row):
+    return {
+        "standard_account_code": row.standard_account_code,
+        "standard_account_name": row.standard_account_name or "Unknown",
+        "confidence": row.confidence if row.confidence is not None else 0.0,
+        "rationale": row.rationale or "",
+    }
+
+
+def lookup(financial_statement, account_names, catalog, model):
+    """
+    キャッシュされたマッピング結果を取得する
+
+    Args:
+        financial_statement: 財務諸表タイプ（bs, pl, cf）
+        account_names: 勘定科目名のリスト
+        catalog: catalog_hash の値
+        model: モデル名
+
+    Returns:
+        dict: 勘定科目名 → マッピング結果（キャッシュに無い勘定科目は含まない）
+    """
+    results = {}
+    pending = {}
+    for account_name in dict.fromkeys(account_names):
+        name = cache_name(account_name)
+        found, value = _memory.get(_memory_key(financial_statement, name, catalog, model))
+        if found:
+            results[account_name] = dict(value)
+        elif name:
+            pending.setdefault(name, []).append(account_name)
+    memory_hits = len(results)
+    _count('memory_hits', memory_hits)
+    if not pending:
+        return results
+
+    table = LLMMappingCache.__table__
+    expires_before = datetime.utcnow() - timedelta(days=LLM_CACHE_TTL_DAYS)
+    hit_ids = []
+    try:
+        names = list(pending)
+        for start in range(0, len(names), LOOKUP_CHUNK):
+            rows = db.session.execute(
+                db.select(table).where(
+                    table.c.financial_statement == financial_statement,
+                    table.c.catalog_hash == catalog,
+                    table.c.model == model,
+                    table.c.created_at >= expires_before,
+                    table.c.normalized_name.in_(names[start:start + LOOKUP_CHUNK])
+                )
+            ).all()
+            for row in rows:
+                value = _result(row)
+                _memory.set(_memory_key(financial_statement, row.normalized_name, catalog, model),
+                            value, MEMORY_TTL, _memory_tags(financial_statement))
+                for account_name in pending.pop(row.normalized_name, []):
+                    results[account_name] = dict(value)
+                hit_ids.append(row.id)
+    except Exception as e:
+        logger.warning(f"AIマッピングのキャッシュを参照できませんでした: {str(e)}")
+    _count('db_hits', len(results) - memory_hits)
+    _count('misses', sum(len(account_names) for account_names in pending.values()))
+
+    if hit_ids:
+        # 参照回数の記録は呼び出し元のトランザクションと分ける（失敗してもマッピングには影響しない）
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    table.update().where(table.c.id.in_(hit_ids))
+                    .values(hit_count=table.c.hit_count + 1, last_hit_at=datetime.utcnow())
+                )
+        except Exception as e:
+            logger.warning(f"AIマッピングのキャッシュの参照回数を記録できませんでした: {str(e)}")
+    return results
+
+
+def store(financial_statement, results, catalog, model):
+    """
+    APIで得たマッピング結果をキャッシュに保存する（文字列類似度などAPI以外の結果は保存しないこと）
+
+    Args:
+        financial_statement: 財務諸表タイプ（bs, pl, cf）
+        results: 勘定科目名 → マッピング結果
+        catalog: catalog_hash の値
+        model: モデル名
+    """
+    rows = {}
+    now = datetime.utcnow()
+    for account_name, result in results.items():
+        name = cache_name(account_name)
+        if not name or not result.get("standard_account_code"):
+            continue
+        value = {
+            "standard_account_code": result["standard_account_code"],
+            "standard_account_name": result.get("standard_account_name") or "Unknown",
+            "confidence": float(result.get("confidence") or 0.0),
+            "rationale": result.get("rationale") or "",
+        }
+        _memory.set(_memory_key(financial_statement, name, catalog, model),
+                    value, MEMORY_TTL, _memory_tags(financial_statement))
+        rows[name] = dict(
+            value,
+            financial_statement=financial_statement,
+            normalized_name=name,
+            catalog_hash=catalog,
+            model=model,
+            hit_count=0,
+            created_at=now,
+        )
+    if not rows:
+        return
+    try:
+        with db.engine.begin() as connection:
+            upsert_rows(
+                connection, LLMMappingCache.__table__, list(rows.values()),
+                ['financial_statement', 'normalized_name', 'catalog_hash', 'model']
+            )
+        _count('stores', len(rows))
+    except Exception as e:
+        logger.warning(f"AIマッピングの結果をキャッシュに保存できませんでした: {str(e)}")
+
+
+def _delete(condition, financial_statement=None):
+    with db.engine.begin() as connection:
+        deleted = connection.execute(LLMMappingCache.__table__.delete().where(condition)).rowcount
+    if financial_statement is None:
+        _memory.clear()
+    else:
+        _memory.invalidate_tags(_memory_tags(financial_statement))
+    if deleted:
+        logger.info(f"AIマッピングのキャッシュを{deleted}件削除しました")
+    return deleted
+
+
+def purge(financial_statement=None, keep_catalog=None):
+    """
+    有効期限を過ぎた結果と、標準勘定科目の一覧が変わる前の結果を削除する
+
+    Args:
+        financial_statement: 財務諸表タイプ（Noneの場合は期限切れの結果のみ削除）
+        keep_catalog: 残すハッシュ（financial_statement の他のハッシュの結果を削除する）
+
+    Returns:
+        int: 削除した件数
+    """
+    table = LLMMappingCache.__table__
+    condition = table.c.created_at < datetime.utcnow() - timedelta(days=LLM_CACHE_TTL_DAYS)
+    if financial_statement is not None and keep_catalog is not None:
+        condition = condition | ((table.c.financial_statement == financial_statement) &
+                                 (table.c.catalog_hash != keep_catalog))
+    return _delete(condition)
+
+
+def invalidate(financial_statement):
+    """
+    財務諸表タイプのキャッシュを全て削除する（標準勘定科目の一覧を入れ替えた場合）
+
+    Returns:
+        int: 削除した件数
+    """
+    table = LLMMappingCache.__table__
+    return _delete(table.c.financial_statement == financial_statement, financial_statement)
+
+
+def cache_stats():
+    """キャッシュの統計情報（このプロセスの参照回数とテーブルの件数）"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 4) if lookups else None
+    stats['memory'] = _memory.stats()
+    try:
+        table = LLMMappingCache.__table__
+        stats['entries'] = db.session.execute(db.select(db.func.count()).select_from(table)).scalar()
+        stats['total_hits'] = db.session.execute(db.select(db.func.coalesce(db.func.sum(table.c.hit_count), 0))).scalar()
+    except Exception as e:
+        logger.warning(f"AIマッピングのキャッシュの件数を取得できませんでした: {str(e)}")
+    return stats
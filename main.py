@@ -48,6 +48,14 @@ logger.info("Registering API endpoints...")
 register_api_endpoints(app)
 logger.info("API endpoints registered successfully")
 
+# 未完了のバックグラウンドジョブを再開
+try:
+    from background_jobs import recover_jobs
+    with app.app_context():
+        recover_jobs()
+except Exception as e:
+    logger.error(f"Failed to recover background jobs: {str(e)}")
+
 # Register JA management routes
 logger.info("Registering JA management routes...")
 register_ja_routes(app)
@@ -1,12 +1,31 @@
 from datetime import datetime
 import logging
 import json
+from sqlalchemy import event
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
 from app import db
-from utils import normalize_string
+from utils import normalize_string, normalize_account_name
+from performance_enhancer import mark_cache_dirty, flush_cache_invalidations, discard_cache_invalidations
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
+
+def normalized_name_default(name_column, type_column):
+    """
+    normalized_name 列のデフォルト値（INSERT時に勘定科目名から計算する。ORMを使わない一括INSERTでも計算される）
+    
+    Args:
+        name_column: 勘定科目名の列名
+        type_column: 財務諸表タイプの列名
+    """
+    def default(context):
+        parameters = context.get_current_parameters()
+        return normalize_account_name(parameters.get(name_column), parameters.get(type_column))
+    return default
+
+
 class JA(db.Model):
     """JA (Agricultural Cooperative) basic information table"""
     __tablename__ = 'ja'
@@ -27,6 +46,10 @@ class JA(db.Model):
 class CSVData(db.Model):
     """Imported CSV data table"""
     __tablename__ = 'csv_data'
+    __table_args__ = (
+        db.Index('ix_csv_data_scope', 'ja_code', 'year', 'file_type', 'is_mapped'),
+        db.Index('ix_csv_data_normalized_name', 'file_type', 'normalized_name'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     ja_code = db.Column(db.String(10), db.ForeignKey('ja.ja_code'), nullable=False)
@@ -34,6 +57,8 @@ class CSVData(db.Model):
     file_type = db.Column(db.String(2), nullable=False)  # bs, pl, cf
     row_number = db.Column(db.Integer, nullable=False)
     account_name = db.Column(db.String(100), nullable=False)
+    # 完全一致・参照マッピング用に正規化した勘定科目名（utils.normalize_account_name）
+    normalized_name = db.Column(db.String(100), default=normalized_name_default('account_name', 'file_type'))
     category = db.Column(db.String(50))
     current_value = db.Column(db.Float)
     previous_value = db.Column(db.Float)
@@ -56,14 +81,21 @@ class CSVData(db.Model):
                 super().__setattr__(name, value)
         else:
             super().__setattr__(name, value)
+        if name in ('account_name', 'file_type'):
+            super().__setattr__('normalized_name', normalize_account_name(self.account_name, self.file_type))
 
 class StandardAccount(db.Model):
     """Standard account code master table"""
     __tablename__ = 'standard_account'
+    __table_args__ = (
+        db.Index('ix_standard_account_normalized_name', 'financial_statement', 'normalized_name'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(10), unique=True, nullable=False)
     name = db.Column(db.String(100), nullable=False)
+    # 完全一致マッピング用に正規化した科目名（utils.normalize_account_name）
+    normalized_name = db.Column(db.String(100), default=normalized_name_default('name', 'financial_statement'))
     category = db.Column(db.String(50), nullable=False)
     financial_statement = db.Column(db.String(2), nullable=False)  # bs, pl, cf
     account_type = db.Column(db.String(20), nullable=False)
@@ -87,10 +119,15 @@ class StandardAccount(db.Model):
                 super().__setattr__(name, value)
         else:
             super().__setattr__(name, value)
+        if name in ('name', 'financial_statement'):
+            super().__setattr__('normalized_name', normalize_account_name(self.name, self.financial_statement))
 
 class StandardAccountBalance(db.Model):
     """Mapped account balance table"""
     __tablename__ = 'standard_account_balance'
+    __table_args__ = (
+        db.Index('ix_standard_account_balance_scope', 'ja_code', 'year', 'statement_type', 'standard_account_code'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     ja_code = db.Column(db.String(10), db.ForeignKey('ja.ja_code'), nullable=False)
@@ -123,10 +160,17 @@ class StandardAccountBalance(db.Model):
 class AccountMapping(db.Model):
     """Account mapping information table"""
     __tablename__ = 'account_mapping'
+    __table_args__ = (
+        # 同じJA・財務諸表の勘定科目名に対するマッピングは1件のみ
+        db.Index('uq_account_mapping_name', 'ja_code', 'financial_statement', 'original_account_name', unique=True),
+        db.Index('ix_account_mapping_normalized_name', 'financial_statement', 'normalized_name'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     ja_code = db.Column(db.String(10), nullable=False)
     original_account_name = db.Column(db.String(100), nullable=False)
+    # 完全一致・参照マッピング用に正規化した勘定科目名（utils.normalize_account_name）
+    normalized_name = db.Column(db.String(100), default=normalized_name_default('original_account_name', 'financial_statement'))
     standard_account_code = db.Column(db.String(10), nullable=False)
     standard_account_name = db.Column(db.String(100), nullable=False)
     financial_statement = db.Column(db.String(2), nullable=False)  # bs, pl, cf
@@ -150,10 +194,16 @@ class AccountMapping(db.Model):
                 super().__setattr__(name, value)
         else:
             super().__setattr__(name, value)
+        if name in ('original_account_name', 'financial_statement'):
+            super().__setattr__('normalized_name', normalize_account_name(self.original_account_name, self.financial_statement))
 
 class AnalysisResult(db.Model):
     """Financial analysis and risk assessment results table"""
     __tablename__ = 'analysis_result'
+    __table_args__ = (
+        # 同じJA・年度の指標は1件のみ（ja_code, year, analysis_type での検索にも使用）
+        db.Index('uq_analysis_result_indicator', 'ja_code', 'year', 'analysis_type', 'indicator_name', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     ja_code = db.Column(db.String(10), db.ForeignKey('ja.ja_code'), nullable=False)
@@ -216,6 +266,132 @@ class AccountFormula(db.Model):
         else:
             super().__setattr__(name, value)
 
+class BalanceGeneration(db.Model):
+    """
+    標準勘定科目残高の世代管理テーブル
+    元データ（CSVData・AccountMapping）が変更されるたびに source_generation を進め、
+    残高を再作成した時点の世代を built_generation に記録する
+    """
+    __tablename__ = 'balance_generation'
+    __table_args__ = (
+        db.UniqueConstraint('ja_code', 'year', 'statement_type', name='uq_balance_generation_scope'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    ja_code = db.Column(db.String(10), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    statement_type = db.Column(db.String(2), nullable=False)  # bs, pl, cf
+    source_generation = db.Column(db.Integer, nullable=False, default=0)  # 元データの世代
+    built_generation = db.Column(db.Integer, nullable=False, default=-1)  # 残高作成時の元データの世代
+    built_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f"<BalanceGeneration {self.ja_code} {self.year} {self.statement_type} {self.built_generation}/{self.source_generation}>"
+
+class BackgroundJob(db.Model):
+    """
+    バックグラウンドジョブのテーブル
+    長時間かかる処理（AIマッピング・残高再作成など）の状態・進捗・結果を記録する（background_jobs.py）
+    """
+    __tablename__ = 'background_job'
+    __table_args__ = (
+        # 同じ内容のジョブの重複投入の検出、未完了ジョブの検索に使用
+        db.Index('ix_background_job_key_status', 'job_key', 'status'),
+    )
+
+    id = db.Column(db.String(32), primary_key=True)  # uuid4().hex
+    job_type = db.Column(db.String(50), nullable=False)
+    job_key = db.Column(db.String(255), nullable=False)  # ジョブタイプとパラメータから作成するキー
+    params = db.Column(db.Text)  # パラメータのJSON文字列
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    progress_done = db.Column(db.Integer, nullable=False, default=0)
+    progress_total = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    result = db.Column(db.Text)  # 結果のJSON文字列
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # 実行中のジョブが最後に進捗を記録した日時
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        """APIのレスポンス用の辞書"""
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'params': json.loads(self.params) if self.params else {},
+            'status': self.status,
+            'progress': {
+                'done': self.progress_done,
+                'total': self.progress_total,
+                'percent': round(100 * self.progress_done / self.progress_total, 1) if self.progress_total else None,
+            },
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f"<BackgroundJob {self.id} {self.job_type} {self.status}>"
+
+class LLMMappingCache(db.Model):
+    """
+    AIマッピング（OpenAI API）の結果のキャッシュ
+    同じ勘定科目名は複数のJA・年度で繰り返し現れるため、APIを呼び出す前に参照する（llm_mapping_cache.py）。
+    標準勘定科目の一覧が変わるとハッシュが変わり、以前の結果は参照されなくなる。
+    """
+    __tablename__ = 'llm_mapping_cache'
+    __table_args__ = (
+        db.Index('uq_llm_mapping_cache_key', 'financial_statement', 'normalized_name', 'catalog_hash', 'model', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    financial_statement = db.Column(db.String(2), nullable=False)  # bs, pl, cf
+    normalized_name = db.Column(db.String(200), nullable=False)  # 正規化した勘定科目名
+    catalog_hash = db.Column(db.String(40), nullable=False)  # 標準勘定科目の一覧とプロンプトのハッシュ
+    model = db.Column(db.String(100), nullable=False)
+    standard_account_code = db.Column(db.String(10), nullable=False)  # 該当なしの場合は UNKNOWN
+    standard_account_name = db.Column(db.String(100))
+    confidence = db.Column(db.Float)
+    rationale = db.Column(db.Text)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_hit_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<LLMMappingCache {self.financial_statement} {self.normalized_name} -> {self.standard_account_code}>"
+
+class MappingKnowledge(db.Model):
+    """
+    全JAのマッピングを集計したナレッジベース
+    (財務諸表タイプ, 正規化した勘定科目名, 標準勘定科目コード) ごとに、その対応でマッピングしたJAの数（票数）と信頼度の合計を保持する。
+    account_mapping の追加・変更・削除時に、該当する正規化名のみ再集計する（refresh_mapping_knowledge）。
+    """
+    __tablename__ = 'mapping_knowledge'
+    __table_args__ = (
+        db.Index('uq_mapping_knowledge_key', 'financial_statement', 'normalized_name', 'standard_account_code', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    financial_statement = db.Column(db.String(2), nullable=False)  # bs, pl, cf
+    normalized_name = db.Column(db.String(100), nullable=False)  # utils.normalize_account_name
+    standard_account_code = db.Column(db.String(10), nullable=False)
+    vote_count = db.Column(db.Integer, nullable=False, default=0)  # この対応でマッピングした件数（JAごとに1件）
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def mean_confidence(self):
+        return self.confidence_sum / self.vote_count if self.vote_count else 0.0
+
+    def __repr__(self):
+        return f"<MappingKnowledge {self.financial_statement} {self.normalized_name} -> {self.standard_account_code} ({self.vote_count})>"
+
 class User(db.Model):
     """User information table for authentication"""
     __tablename__ = 'user'
@@ -228,3 +404,413 @@ class User(db.Model):
     
     def __repr__(self):
         return f"<User {self.username}>"
+
+
+# upsert_rows で一度に追加する行数
+UPSERT_CHUNK = 500
+
+# 一意インデックスの存在を確認済みの (データベース, テーブル名, 列名) （作成済みのインデックスは削除されない前提）
+_unique_keys = set()
+
+
+def has_unique_key(connection, table, index_elements):
+    """
+    指定した列の一意インデックス（主キー・一意制約を含む）がデータベースに存在するかを返す
+    起動時に重複行があると一意インデックスの作成が見送られるため、ON CONFLICT を使う前に確認する
+    
+    Args:
+        connection: SQLAlchemyのコネクション
+        table: 対象のテーブル
+        index_elements: 一意インデックスの列名のリスト
+    """
+    columns = frozenset(index_elements)
+    cache_key = (str(connection.engine.url), table.name, columns)
+    if cache_key in _unique_keys:
+        return True
+    inspector = db.inspect(connection)
+    keys = [inspector.get_pk_constraint(table.name).get('constrained_columns') or []]
+    keys.extend(constraint['column_names'] for constraint in inspector.get_unique_constraints(table.name))
+    keys.extend(index['column_names'] for index in inspector.get_indexes(table.name) if index.get('unique'))
+    if any(frozenset(key) == columns for key in keys):
+        _unique_keys.add(cache_key)
+        return True
+    return False
+
+
+def upsert_rows(connection, table, rows, index_elements, update_values=None):
+    """
+    一意インデックスをキーに行を追加または更新する（PostgreSQL・SQLiteは INSERT ... ON CONFLICT を使用）
+    
+    一意インデックスが無い場合（起動時に重複行があり作成を見送った場合など）は、UPDATEして該当が無ければINSERTする。
+    
+    Args:
+        connection: SQLAlchemyのコネクション（db.session.connection() など）
+        table: 対象のテーブル
+        rows: 追加する行の辞書のリスト
+        index_elements: 一意インデックスの列名のリスト
+        update_values: 競合時に更新する値（Noneの場合はキー以外の列を追加する値で更新する）
+    """
+    if not rows:
+        return
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        dialect_insert = None
+    
+    if dialect_insert is None or not has_unique_key(connection, table, index_elements):
+        if dialect_insert is not None:
+            logger.warning(f"{table.name}: 一意インデックス（{', '.join(index_elements)}）が無いため、行ごとに更新します")
+        for row in rows:
+            key = [table.c[column] == row[column] for column in index_elements]
+            values = update_values or {k: v for k, v in row.items() if k not in index_elements}
+            if connection.execute(table.update().where(*key).values(**values)).rowcount == 0:
+                connection.execute(table.insert().values(**row))
+        return
+    
+    # 列の組み合わせごとに複数行のINSERT文にまとめる
+    # （1つの文に同じキーが複数あると競合時の更新が失敗するため、同じキーは最後の行のみ使用する）
+    batches = {}
+    for row in rows:
+        batch = batches.setdefault(tuple(row), {})
+        batch[tuple(row[column] for column in index_elements)] = row
+    for columns, batch in batches.items():
+        batch_rows = list(batch.values())
+        for start in range(0, len(batch_rows), UPSERT_CHUNK):
+            statement = dialect_insert(table).values(batch_rows[start:start + UPSERT_CHUNK])
+            values = update_values or {
+                column: statement.excluded[column] for column in columns if column not in index_elements
+            }
+            connection.execute(statement.on_conflict_do_update(index_elements=index_elements, set_=values))
+
+
+def bump_balance_generation(connection, ja_code, statement_type, year=None, exclude_years=()):
+    """
+    元データの世代を進める（次回の残高表示時に再作成される）
+    
+    Args:
+        connection: SQLAlchemyのコネクション（db.session.connection() など）
+        ja_code: JA code
+        statement_type: 財務諸表のタイプ (bs, pl, cf)
+        year: 年度（Noneの場合は全年度。AccountMappingは年度を持たないため）
+        exclude_years: 全年度の場合に世代を進めない年度（同じトランザクションで残高を差分更新した年度）
+    """
+    table = BalanceGeneration.__table__
+    if year is None:
+        statement = (
+            table.update()
+            .where(table.c.ja_code == ja_code, table.c.statement_type == statement_type)
+            .values(source_generation=table.c.source_generation + 1)
+        )
+        if exclude_years:
+            statement = statement.where(table.c.year.notin_(list(exclude_years)))
+        connection.execute(statement)
+        return
+    
+    result = connection.execute(
+        table.update()
+        .where(table.c.ja_code == ja_code, table.c.year == year, table.c.statement_type == statement_type)
+        .values(source_generation=table.c.source_generation + 1)
+    )
+    if result.rowcount == 0:
+        # 世代レコードが無い場合は作成する（同時作成時は世代を進める）
+        upsert_rows(
+            connection, table,
+            [dict(ja_code=ja_code, year=year, statement_type=statement_type,
+                  source_generation=1, built_generation=-1)],
+            index_elements=['ja_code', 'year', 'statement_type'],
+            update_values={'source_generation': table.c.source_generation + 1}
+        )
+
+
+# ナレッジベースから作成したマッピングの根拠（集計の対象外とし、自身の票で票数が増えないようにする）
+KNOWLEDGE_RATIONALE_PREFIX = "ナレッジベース"
+
+# 再集計で一度に IN 句に渡す正規化名の数
+KNOWLEDGE_REFRESH_CHUNK = 500
+
+
+def mapping_knowledge_keys(connection, condition):
+    """
+    条件に該当する account_mapping の (財務諸表タイプ, 正規化名) を返す（一括削除・更新の前に再集計の対象を求める）
+    
+    Args:
+        connection: SQLAlchemyのコネクション
+        condition: account_mapping テーブルに対するWHERE句（Noneの場合は全件）
+    """
+    table = AccountMapping.__table__
+    query = db.select(table.c.financial_statement, table.c.normalized_name).distinct()
+    if condition is not None:
+        query = query.where(condition)
+    return {(fs, name) for fs, name in connection.execute(query) if fs and name}
+
+
+def refresh_mapping_knowledge(connection, keys=None):
+    """
+    account_mapping からナレッジベース（mapping_knowledge）を再集計する
+    
+    Args:
+        connection: SQLAlchemyのコネクション（db.session.connection() など）
+        keys: 再集計する (財務諸表タイプ, 正規化名) の集合（Noneの場合は全件を作り直す）
+    """
+    knowledge = MappingKnowledge.__table__
+    mapping = AccountMapping.__table__
+    aggregate = db.select(
+        mapping.c.financial_statement,
+        mapping.c.normalized_name,
+        mapping.c.standard_account_code,
+        db.func.count().label('vote_count'),
+        db.func.coalesce(db.func.sum(mapping.c.confidence), 0.0).label('confidence_sum'),
+    ).where(
+        mapping.c.normalized_name.isnot(None),
+        mapping.c.normalized_name != '',
+        db.or_(mapping.c.rationale.is_(None), ~mapping.c.rationale.startswith(KNOWLEDGE_RATIONALE_PREFIX))
+    ).group_by(mapping.c.financial_statement, mapping.c.normalized_name, mapping.c.standard_account_code)
+    now = datetime.utcnow()
+
+    if keys is None:
+        connection.execute(knowledge.delete())
+        connection.execute(knowledge.insert().from_select(
+            ['financial_statement', 'normalized_name', 'standard_account_code', 'vote_count', 'confidence_sum', 'updated_at'],
+            aggregate.add_columns(db.literal(now))
+        ))
+        return
+
+    names_by_type = {}
+    for financial_statement, normalized_name in keys:
+        if financial_statement and normalized_name:
+            names_by_type.setdefault(financial_statement, set()).add(normalized_name)
+    for financial_statement, names in names_by_type.items():
+        names = sorted(names)
+        for start in range(0, len(names), KNOWLEDGE_REFRESH_CHUNK):
+            chunk = names[start:start + KNOWLEDGE_REFRESH_CHUNK]
+            rows = connection.execute(aggregate.where(
+                mapping.c.financial_statement == financial_statement,
+                mapping.c.normalized_name.in_(chunk)
+            )).all()
+            # 票が無くなった対応を削除し、残りは同時に再集計した場合も一意制約に違反しないよう追加または更新する
+            connection.execute(knowledge.delete().where(
+                knowledge.c.financial_statement == financial_statement,
+                knowledge.c.normalized_name.in_(chunk)
+            ))
+            upsert_rows(
+                connection, knowledge,
+                [dict(financial_statement=row.financial_statement, normalized_name=row.normalized_name,
+                      standard_account_code=row.standard_account_code, vote_count=row.vote_count,
+                      confidence_sum=row.confidence_sum, updated_at=now) for row in rows],
+                ['financial_statement', 'normalized_name', 'standard_account_code']
+            )
+
+
+def _balance_generation_scopes(session):
+    """フラッシュ対象のCSVData・AccountMappingから、世代を進める (ja_code, statement_type, year) を集める"""
+    scopes = set()
+    for instance in session.new.union(session.dirty).union(session.deleted):
+        if isinstance(instance, CSVData):
+            if instance in session.dirty and not session.is_modified(instance):
+                continue
+            scopes.add((instance.ja_code, instance.file_type, instance.year))
+        elif isinstance(instance, AccountMapping):
+            if instance in session.dirty and not session.is_modified(instance):
+                continue
+            scopes.add((instance.ja_code, instance.financial_statement, None))
+    return scopes
+
+
+def mark_balances_refreshed(session, ja_code, statement_type, year):
+    """
+    残高をこのトランザクション内で差分更新することを記録する（コミットまで、その年度の世代を進めない）
+    
+    マッピング変更時に全年度の世代を進めると、差分更新した年度も次回の表示時に全体が再作成され、
+    差分で再計算した合計科目・指標が破棄されるため。
+    
+    Args:
+        session: SQLAlchemyのセッション
+        ja_code: JA code
+        statement_type: 財務諸表のタイプ (bs, pl, cf)
+        year: 差分更新する年度
+    """
+    session.info.setdefault('balances_refreshed', set()).add((ja_code, statement_type, int(year)))
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_balance_generation(session, flush_context):
+    """CSVData・AccountMappingの追加・変更・削除時に残高の世代を進める（差分更新を記録した年度は除く）"""
+    scopes = _balance_generation_scopes(session)
+    if not scopes:
+        return
+    refreshed = session.info.get('balances_refreshed', set())
+    connection = session.connection()
+    for ja_code, statement_type, year in scopes:
+        if not (ja_code and statement_type):
+            continue
+        if year is None:
+            exclude_years = {
+                refreshed_year for refreshed_ja, refreshed_type, refreshed_year in refreshed
+                if refreshed_ja == ja_code and refreshed_type == statement_type
+            }
+            bump_balance_generation(connection, ja_code, statement_type, exclude_years=exclude_years)
+        elif (ja_code, statement_type, int(year)) not in refreshed:
+            bump_balance_generation(connection, ja_code, statement_type, year)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def clear_balances_refreshed(session):
+    """トランザクションの終了時に差分更新の記録を破棄する"""
+    session.info.pop('balances_refreshed', None)
+
+
+# 一括変更の対象モデル → WHERE句から世代の範囲を取り出す列（JAコード, 年度, 財務諸表タイプ）
+_BALANCE_SCOPE_COLUMNS = {
+    CSVData: ('ja_code', 'year', 'file_type'),
+    AccountMapping: ('ja_code', None, 'financial_statement'),
+}
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_balance_generation(orm_execute_state):
+    """
+    Query.delete()/update() による一括変更では、WHERE句の等価条件（JAコード・年度・財務諸表タイプ）の範囲の世代を進める
+    JAコードを特定できない場合は全ての世代を進める
+    """
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in _BALANCE_SCOPE_COLUMNS:
+        return
+    ja_column, year_column, type_column = _BALANCE_SCOPE_COLUMNS[mapper.class_]
+    values = _where_values(orm_execute_state.statement, [column for column in (ja_column, year_column, type_column) if column])
+    table = BalanceGeneration.__table__
+    statement = table.update().values(source_generation=table.c.source_generation + 1)
+    if ja_column in values:
+        statement = statement.where(table.c.ja_code == values[ja_column])
+        if year_column in values:
+            statement = statement.where(table.c.year == values[year_column])
+        if type_column in values:
+            statement = statement.where(table.c.statement_type == values[type_column])
+    orm_execute_state.session.connection().execute(statement)
+
+
+# クエリキャッシュの無効化対象（モデル → 変更時に無効化する範囲を返す関数）
+# 範囲は (ja_code, year) で、year が None の場合はJAの全年度、ja_code が None の場合は全てのキャッシュ
+_CACHE_SCOPES = {
+    CSVData: lambda instance: (instance.ja_code, instance.year),
+    StandardAccountBalance: lambda instance: (instance.ja_code, instance.year),
+    AnalysisResult: lambda instance: (instance.ja_code, instance.year),
+    AccountMapping: lambda instance: (instance.ja_code, None),
+    JA: lambda instance: (instance.ja_code, None),
+    StandardAccount: lambda instance: (None, None),
+}
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_query_cache(session, flush_context):
+    """残高・マッピング・分析結果などの変更時に、コミット後に無効化するキャッシュを記録する"""
+    for instance in session.new.union(session.dirty).union(session.deleted):
+        scope = _CACHE_SCOPES.get(type(instance))
+        if scope is None:
+            continue
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        mark_cache_dirty(session, *scope(instance))
+
+
+def _where_values(statement, columns):
+    """
+    一括更新・削除のWHERE句から、指定した列の等価条件の値を取り出す
+
+    Returns:
+        dict: 列名 → 値（値が1つに決まる列のみ）
+    """
+    values = {column: set() for column in columns}
+    whereclause = getattr(statement, 'whereclause', None)
+    if whereclause is not None:
+        for element in visitors.iterate(whereclause):
+            if not isinstance(element, BinaryExpression) or element.operator is not operators.eq:
+                continue
+            column, value = element.left, element.right
+            if getattr(column, 'key', None) in values and isinstance(value, BindParameter):
+                values[column.key].add(value.value)
+    return {column: found.pop() for column, found in values.items() if len(found) == 1}
+
+
+def _where_scope(statement):
+    """一括更新・削除のWHERE句から ja_code と year の等価条件を取り出す（特定できない場合は None）"""
+    values = _where_values(statement, ('ja_code', 'year'))
+    ja_code = values.get('ja_code')
+    year = values.get('year') if ja_code is not None else None
+    return ja_code, year
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_query_cache(orm_execute_state):
+    """Query.delete()/update() による一括変更では、WHERE句の ja_code・year の範囲のキャッシュを無効化する"""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ not in _CACHE_SCOPES:
+        return
+    if mapper.class_ is StandardAccount:
+        mark_cache_dirty(orm_execute_state.session)
+        return
+    mark_cache_dirty(orm_execute_state.session, *_where_scope(orm_execute_state.statement))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_query_cache(session):
+    """コミットした変更に関するキャッシュを無効化する"""
+    flush_cache_invalidations(session)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_query_cache(session):
+    """ロールバックした変更のキャッシュ無効化は行わない"""
+    discard_cache_invalidations(session)
+
+
+def _mapping_knowledge_keys(session):
+    """フラッシュ対象のAccountMappingの (財務諸表タイプ, 正規化名) を変更前の値も含めて集める"""
+    keys = set()
+    for instance in session.new.union(session.dirty).union(session.deleted):
+        if not isinstance(instance, AccountMapping):
+            continue
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        keys.add((instance.financial_statement, instance.normalized_name))
+        state = db.inspect(instance)
+        old_types = state.attrs.financial_statement.history.deleted or [instance.financial_statement]
+        old_names = state.attrs.normalized_name.history.deleted or [instance.normalized_name]
+        keys.update((old_type, old_name) for old_type in old_types for old_name in old_names)
+    return keys
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_mapping_knowledge(session, flush_context):
+    """AccountMappingの追加・変更・削除時に、該当する正規化名のナレッジベースを再集計する"""
+    keys = _mapping_knowledge_keys(session)
+    if keys:
+        refresh_mapping_knowledge(session.connection(), keys)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_bulk_mapping_knowledge(orm_execute_state):
+    """
+    Query.delete()/update() による一括変更では、実行前後に対象の正規化名を求めて再集計する
+    （文を実行して結果を返すため、他の do_orm_execute のイベントより後に登録すること）
+    """
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return None
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not AccountMapping:
+        return None
+    connection = orm_execute_state.session.connection()
+    condition = getattr(orm_execute_state.statement, 'whereclause', None)
+    keys = mapping_knowledge_keys(connection, condition)
+    result = orm_execute_state.invoke_statement()
+    if orm_execute_state.is_update:
+        keys |= mapping_knowledge_keys(connection, condition)
+    refresh_mapping_knowledge(connection, keys)
+    return result
@@ -3,10 +3,14 @@
 画面遷移とデータベースクエリの性能を改善する
 """
 
+import os
 import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from functools import wraps
-from flask import g
+from flask import Response, current_app, has_request_context, request, session
 
 logger = logging.getLogger(__name__)
 
@@ -28,40 +32,314 @@ def performance_monitor(func):
 # Alias for backward compatibility
 timed_function = performance_monitor
 
-def cache_query_result(cache_key=None, cache_duration=300, timeout=None):
+# 結果をキャッシュしない（ブラウザのキャッシュ回避用の）リクエストパラメータ
+CACHE_IGNORED_ARGS = ('t', '_')
+
+
+class QueryCache:
+    """
+    プロセス内で共有するクエリ結果キャッシュ
+    
+    - 最大件数を超えた場合は最も古く使われたエントリから削除する（LRU）
+    - エントリごとに有効期限（TTL）を持つ
+    - エントリにタグ（JAコード・年度）を付け、タグ単位で無効化できる
+    - invalidation_dir を指定すると、無効化をファイルに記録して他のプロセスのキャッシュにも反映する
+    """
+    
+    def __init__(self, max_entries=512, invalidation_dir=None):
+        self.max_entries = max_entries
+        self.invalidation_dir = invalidation_dir
+        self._entries = OrderedDict()  # key -> (value, expires_at, stored_at, tags)
+        self._tags = {}  # tag -> set(key)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        if invalidation_dir:
+            os.makedirs(invalidation_dir, exist_ok=True)
+    
+    def get(self, key):
+        """
+        キャッシュされた値を取得する
+        
+        Returns:
+            tuple: (見つかったか, 値)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, stored_at, tags = entry
+                if expires_at > now and not self._invalidated_elsewhere(tags, stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._remove(key)
+            self.misses += 1
+            return False, None
+    
+    def set(self, key, value, ttl, tags=()):
+        """値をキャッシュに保存する"""
+        now = time.time()
+        tags = tuple(tags)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, now + ttl, now, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+    
+    def invalidate_tags(self, tags):
+        """
+        指定したタグのエントリを削除する
+        
+        Returns:
+            int: 削除したエントリ数
+        """
+        removed = 0
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    removed += 1
+                self._touch_marker(tag)
+        return removed
+    
+    def clear(self):
+        """全てのエントリを削除する"""
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._touch_marker('*')
+    
+    def notify(self, tag):
+        """タグの無効化を他のプロセスに通知する（キャッシュの外で保持するインデックスなどの無効化用）"""
+        self._touch_marker(tag)
+    
+    def notified_since(self, tag, since):
+        """
+        タグの無効化が since 以降に通知されたかを返す（invalidation_dir が無い場合は常にFalse）
+        
+        Args:
+            tag: notify() に指定したタグ
+            since: 時刻（time.time()）
+        """
+        if not self.invalidation_dir:
+            return False
+        try:
+            return os.path.getmtime(self._marker_path(tag)) >= since
+        except OSError:
+            return False
+    
+    def stats(self):
+        """キャッシュの統計情報を返す"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[3]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+    
+    def _marker_path(self, tag):
+        return os.path.join(self.invalidation_dir, hashlib.sha1(tag.encode('utf-8')).hexdigest())
+    
+    def _touch_marker(self, tag):
+        if not self.invalidation_dir:
+            return
+        try:
+            with open(self._marker_path(tag), 'w', encoding='utf-8') as marker:
+                marker.write(tag)
+        except OSError as e:
+            logger.warning(f"キャッシュ無効化の記録に失敗しました: {tag}: {str(e)}")
+    
+    def _invalidated_elsewhere(self, tags, stored_at):
+        """他のプロセスで保存後に無効化されたかを確認する"""
+        if not self.invalidation_dir:
+            return False
+        for tag in ('*',) + tags:
+            try:
+                if os.path.getmtime(self._marker_path(tag)) >= stored_at:
+                    return True
+            except OSError:
+                continue
+        return False
+
+
+query_cache = QueryCache(
+    max_entries=int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', 512)),
+    invalidation_dir=os.environ.get('QUERY_CACHE_DIR')
+)
+
+
+def ja_cache_tags(ja_code, year=None):
+    """
+    JAコード・年度のキャッシュタグを返す
+    
+    Args:
+        ja_code: JAコード
+        year: 年度（Noneの場合はJAの全年度）
+    
+    Returns:
+        list: タグのリスト
+    """
+    if year is None:
+        return [f"ja:{ja_code}"]
+    return [f"ja:{ja_code}", f"ja:{ja_code}:{year}"]
+
+
+def invalidate_ja_cache(ja_code=None, year=None):
+    """
+    JAコード・年度に関するキャッシュを無効化する
+    
+    Args:
+        ja_code: JAコード（Noneの場合は全てのキャッシュ）
+        year: 年度（Noneの場合はJAの全年度）
+    """
+    if ja_code is None:
+        query_cache.clear()
+        return
+    tag = f"ja:{ja_code}" if year is None else f"ja:{ja_code}:{year}"
+    removed = query_cache.invalidate_tags([tag])
+    if removed:
+        logger.debug(f"キャッシュを無効化: {tag} ({removed}件)")
+
+
+def clear_cache():
+    """全てのキャッシュを削除する"""
+    query_cache.clear()
+    logger.info("クエリキャッシュをクリアしました")
+
+
+def mark_cache_dirty(session, ja_code=None, year=None):
+    """
+    セッションのコミット時に無効化するキャッシュを記録する
+    （コミット前に無効化すると、コミットまでの間に古いデータが再びキャッシュされるため）
+    
+    Args:
+        session: SQLAlchemyのセッション
+        ja_code: 変更したJAコード（Noneの場合は全てのキャッシュ）
+        year: 変更した年度（Noneの場合はJAの全年度）
+    """
+    session.info.setdefault('query_cache_dirty', set()).add(
+        (ja_code, int(year) if year is not None else None)
+    )
+
+
+def flush_cache_invalidations(session):
+    """コミットしたセッションに記録されたキャッシュを無効化する"""
+    scopes = session.info.pop('query_cache_dirty', None)
+    if not scopes:
+        return
+    if (None, None) in scopes:
+        invalidate_ja_cache()
+        return
+    for ja_code, year in scopes:
+        invalidate_ja_cache(ja_code, year)
+
+
+def discard_cache_invalidations(session):
+    """ロールバックしたセッションに記録されたキャッシュ無効化を破棄する"""
+    session.info.pop('query_cache_dirty', None)
+
+
+def _request_scope():
+    """リクエストパラメータ（無ければセッション）から対象のJAコードと年度を取得する"""
+    ja_code = request.args.get('ja_code') or session.get('selected_ja_code')
+    year = request.args.get('year') or session.get('selected_year')
+    try:
+        year = int(year) if year is not None else None
+    except (TypeError, ValueError):
+        year = None
+    return ja_code, year
+
+
+def cache_query_result(cache_key=None, cache_duration=300, timeout=None, tags=None, unless=None):
     """
     クエリ結果をキャッシュするデコレータ
+    
+    リクエスト中に呼ばれた場合は、パス・リクエストパラメータ・対象のJAコードと年度をキーに含め、
+    JAコード・年度のタグを付けて保存する（データ変更時に invalidate_ja_cache で無効化される）。
+    Flaskのレスポンスは正常（200）の場合のみキャッシュする。
+    
+    Args:
+        cache_key: キャッシュキーの接頭辞（Noneの場合は関数名）
+        cache_duration: 有効期限（秒）
+        timeout: cache_duration の別名
+        tags: (ja_code, year) からタグのリストを返す関数（Noneの場合は ja_cache_tags）
+        unless: 結果を受け取り、Trueを返した場合はキャッシュしない関数
     """
     # Handle both timeout and cache_duration parameters for backward compatibility
     if timeout is not None:
         cache_duration = timeout
     
     def decorator(func):
+        prefix = cache_key or f"{func.__module__}.{func.__qualname__}"
+        
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # 簡単なメモリキャッシュの実装
-            if not hasattr(g, 'query_cache'):
-                g.query_cache = {}
+            key = (prefix, repr(args), repr(sorted(kwargs.items())))
+            entry_tags = ()
+            if has_request_context():
+                ja_code, year = _request_scope()
+                request_args = tuple(sorted(
+                    (name, value) for name, value in request.args.items(multi=True)
+                    if name not in CACHE_IGNORED_ARGS
+                ))
+                key += (request.path, request_args, ja_code, year)
+                if ja_code:
+                    entry_tags = (tags or ja_cache_tags)(ja_code, year)
             
-            key = f"{cache_key}_{hash(str(args) + str(kwargs))}"
-            current_time = time.time()
+            found, cached = query_cache.get(key)
+            if found:
+                logger.debug(f"キャッシュからデータを取得: {prefix}")
+                if isinstance(cached, _CachedResponse):
+                    return cached.to_response()
+                return cached
             
-            # キャッシュされた結果が有効かチェック
-            if key in g.query_cache:
-                cached_data, cached_time = g.query_cache[key]
-                if current_time - cached_time < cache_duration:
-                    logger.debug(f"キャッシュからデータを取得: {key}")
-                    return cached_data
-            
-            # キャッシュにない場合は関数を実行
             result = func(*args, **kwargs)
-            g.query_cache[key] = (result, current_time)
-            logger.debug(f"データをキャッシュに保存: {key}")
+            if unless is not None and unless(result):
+                return result
+            
+            value = result
+            if isinstance(result, Response):
+                if result.status_code != 200 or result.direct_passthrough:
+                    return result
+                value = _CachedResponse(result)
+            elif isinstance(result, tuple):
+                # (レスポンス, ステータス) の形式はエラー応答のためキャッシュしない
+                return result
+            query_cache.set(key, value, cache_duration, entry_tags)
+            logger.debug(f"データをキャッシュに保存: {prefix}")
             
             return result
         return wrapper
     return decorator
 
+
+class _CachedResponse:
+    """Flaskのレスポンスをスレッド間で共有できる形で保持する"""
+    
+    def __init__(self, response):
+        self.data = response.get_data()
+        self.status = response.status_code
+        self.mimetype = response.mimetype
+    
+    def to_response(self):
+        return current_app.response_class(self.data, status=self.status, mimetype=self.mimetype)
+
 # Alias for backward compatibility
 cached_query = cache_query_result
 
@@ -1,7 +1,8 @@
 import logging
 from app import app, db
 from models import JA, AnalysisResult
-from financial_indicators import FinancialIndicators
+from indicator_engine import calculate_indicators_batch
+from analysis_result_writer import AnalysisResultWriter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -11,29 +12,20 @@ def recalculate_all_ja_efficiency(year=2025):
     with app.app_context():
         # すべてのJAコードを取得
         ja_list = JA.query.all()
+        ja_codes = [ja.ja_code for ja in ja_list]
         
-        for ja in ja_list:
-            ja_code = ja.ja_code
-            
-            # 既存の効率性指標データを削除
-            deleted_count = AnalysisResult.query.filter_by(
-                ja_code=ja_code,
-                year=year,
-                analysis_type='efficiency'
-            ).delete()
-            
-            logger.info(f"JA {ja_code}: {deleted_count}件の効率性指標データを削除しました。")
-            
-            # 再計算を実行
-            try:
-                result = FinancialIndicators.calculate_efficiency_indicators(ja_code, year)
-                logger.info(f"JA {ja_code}: 効率性指標の再計算が完了しました。")
-            except Exception as e:
-                logger.error(f"JA {ja_code}: 効率性指標の再計算中にエラーが発生しました: {str(e)}")
-                continue
+        # 全JAの効率性指標を一括で再計算し、既存データと1トランザクションで置き換える
+        try:
+            writer = AnalysisResultWriter(analysis_types=['efficiency'])
+            for ja_code in ja_codes:
+                writer.add_scope(ja_code, year)
+            writer.extend(calculate_indicators_batch(ja_codes, [year], ['efficiency']))
+            stats = writer.write()
+            logger.info(f"{stats['deleted']}件の効率性指標データを削除し、{stats['inserted']}件を作成しました。")
+        except Exception as e:
+            logger.error(f"効率性指標の再計算中にエラーが発生しました: {str(e)}")
+            return
         
-        # 変更をコミット
-        db.session.commit()
         logger.info(f"すべてのJAの効率性指標の再計算が完了しました。")
         
         # 各JAの効率性スコアを確認
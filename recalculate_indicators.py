@@ -4,6 +4,7 @@
 from app import app, db
 from models import AnalysisResult
 from financial_indicators import FinancialIndicators
+from analysis_result_writer import AnalysisResultWriter
 import logging
 
 # ロギングを設定
@@ -20,28 +21,20 @@ def recalculate_indicators(ja_code, year, analysis_type='profitability'):
         analysis_type: 指標タイプ（profitability, liquidity, safety, efficiency, cash_flow）
     """
     with app.app_context():
-        # 既存の指標を削除
-        deleted = db.session.query(AnalysisResult).filter_by(
-            ja_code=ja_code,
-            year=year,
-            analysis_type=analysis_type
-        ).delete()
-        
-        db.session.commit()
-        logger.info(f"削除した{analysis_type}指標の数: {deleted}")
-        
-        # 新しい基準で指定された指標を再計算
+        # 新しい基準で指定された指標を再計算し、既存の指標と一括で置き換える
+        writer = AnalysisResultWriter(ja_code, year, analysis_types=[analysis_type])
         result = None
         if analysis_type == 'profitability':
-            result = FinancialIndicators.calculate_profitability_indicators(ja_code, year)
+            result = FinancialIndicators.calculate_profitability_indicators(ja_code, year, writer=writer)
         elif analysis_type == 'liquidity':
-            result = FinancialIndicators.calculate_liquidity_indicators(ja_code, year)
+            result = FinancialIndicators.calculate_liquidity_indicators(ja_code, year, writer=writer)
         elif analysis_type == 'safety':
-            result = FinancialIndicators.calculate_safety_indicators(ja_code, year)
+            result = FinancialIndicators.calculate_safety_indicators(ja_code, year, writer=writer)
         elif analysis_type == 'efficiency':
-            result = FinancialIndicators.calculate_efficiency_indicators(ja_code, year)
+            result = FinancialIndicators.calculate_efficiency_indicators(ja_code, year, writer=writer)
         
-        db.session.commit()
+        stats = writer.write()
+        logger.info(f"削除した{analysis_type}指標の数: {stats['deleted']}")
         
         logger.info(f"{analysis_type}指標の再計算結果: {result}")
         
@@ -0,0 +1,388 @@
+"""
+複数JA・年度の一括再計算（夜間の全件再計算用）
+(JA, 年度) ごとに 残高の再作成 → 合計科目の計算 → 財務指標の計算 → 総合リスク評価 の順に処理する。
+対象をシャード（同じ年度の数JA分）に分けてプロセスプールで並列に実行し、
+各ワーカープロセスはそれぞれ1つのデータベース接続を使用する。
+
+処理の済んだ (JA, 年度) は状態ファイルに1行ずつ記録するため、途中で失敗した場合は --resume で続きから再実行できる。
+
+使用例:
+    python recompute_all.py --year 2023 --workers 8
+    python recompute_all.py --ja-code JA001 --ja-code JA002 --stages balances,totals
+    python recompute_all.py --resume
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# アプリケーション（データベース）はワーカープロセスの初期化時に読み込む
+# spawn で起動したワーカーはこのモジュールを読み込み直すため、ここではデータベースに接続しない
+
+logger = logging.getLogger(__name__)
+
+# 処理段階（この順に実行する）
+STAGES = ('balances', 'totals', 'indicators', 'risk')
+
+STATEMENT_TYPES = ('bs', 'pl', 'cf')
+
+# 1つのシャードに含める (JA, 年度) の数（指標の計算はシャード単位で一括して行う）
+SHARD_SIZE = 8
+
+# 処理済みの (JA, 年度) を記録する状態ファイル
+STATE_FILE = 'recompute_state.jsonl'
+
+# ワーカープロセスごとにコンパイルした計算式（財務諸表タイプ → FormulaPlan）
+_plans = {}
+
+
+def list_units(ja_codes=None, years=None):
+    """
+    再計算の対象となる (JA, 年度) の一覧を取得する
+
+    CSVデータまたは標準勘定科目残高のある組み合わせを対象とする。
+
+    Args:
+        ja_codes: 対象JAコードのリスト（Noneの場合は全JA）
+        years: 対象年度のリスト（Noneの場合は全年度）
+
+    Returns:
+        list: (ja_code, year) のリスト（年度・JAコード順）
+    """
+    from app import db
+    from models import CSVData, StandardAccountBalance
+
+    units = set()
+    for model in (CSVData, StandardAccountBalance):
+        query = db.session.query(model.ja_code, model.year).distinct()
+        if ja_codes:
+            query = query.filter(model.ja_code.in_(ja_codes))
+        if years:
+            query = query.filter(model.year.in_(years))
+        units.update((ja_code, int(year)) for ja_code, year in query.all())
+    return sorted(units, key=lambda unit: (unit[1], unit[0]))
+
+
+def make_shards(units, shard_size=SHARD_SIZE):
+    """(JA, 年度) を同じ年度ごとに shard_size 件ずつのシャードに分ける"""
+    shards = []
+    by_year = {}
+    for ja_code, year in units:
+        by_year.setdefault(year, []).append(ja_code)
+    for year, ja_codes in sorted(by_year.items()):
+        for i in range(0, len(ja_codes), shard_size):
+            shards.append((year, ja_codes[i:i + shard_size]))
+    return shards
+
+
+def _init_worker():
+    """ワーカープロセスの初期化（アプリケーションコンテキストを開き、親プロセスの接続を使わないようにする）"""
+    from app import app, db
+
+    app.app_context().push()
+    # fork した場合は親プロセスの接続プールを引き継ぐため、閉じずに破棄して新しい接続を使用する
+    db.engine.dispose(close=False)
+
+
+def _statement_types(model, column, ja_code, year):
+    from app import db
+
+    return {row[0] for row in db.session.query(column).filter(
+        model.ja_code == ja_code, model.year == year
+    ).distinct().all()}
+
+
+def _recompute_totals(ja_code, year):
+    from app import db
+    from models import StandardAccountBalance
+    from account_calculator import AccountCalculator
+    from formula_plan import FormulaPlan
+
+    processed = 0
+    for statement_type in sorted(_statement_types(
+            StandardAccountBalance, StandardAccountBalance.statement_type, ja_code, year)):
+        if statement_type not in STATEMENT_TYPES:
+            continue
+        if statement_type not in _plans:
+            _plans[statement_type] = FormulaPlan.compile(statement_type)
+        # 失敗したシャードを再開時に再実行できるよう、エラーを握りつぶさずに送出させる
+        processed += AccountCalculator.calculate_account_totals(
+            ja_code, year, statement_type, plan=_plans[statement_type], raise_errors=True
+        )
+    db.session.expire_all()
+    return processed
+
+
+def _recompute_balances(ja_code, year, only_stale):
+    from models import CSVData
+    from balance_generation import rebuild_balances
+
+    # CSVデータの無い財務諸表タイプは、残高を（直接登録されたものを含めて）そのまま残す
+    created = 0
+    for statement_type in sorted(_statement_types(CSVData, CSVData.file_type, ja_code, year)):
+        if statement_type not in STATEMENT_TYPES:
+            continue
+        rebuilt = rebuild_balances(ja_code, year, statement_type, force=not only_stale)
+        if rebuilt is not None:
+            created += rebuilt['created']
+    return created
+
+
+def process_shard(year, ja_codes, stages=STAGES, only_stale=False):
+    """
+    1つのシャード（同じ年度の複数JA）を再計算する
+
+    Args:
+        year: 年度
+        ja_codes: JAコードのリスト
+        stages: 実行する処理段階
+        only_stale: Trueの場合、元データが変更された財務諸表タイプのみ残高を再作成する
+
+    Returns:
+        list: (JA, 年度) ごとの結果（ja_code, year, status, message, seconds: {段階: 秒}, counts: {段階: 件数}, risk）
+    """
+    from app import db
+
+    results = {ja_code: {'ja_code': ja_code, 'year': year, 'status': 'ok', 'message': '',
+                         'seconds': {}, 'counts': {}, 'risk': None} for ja_code in ja_codes}
+
+    def run(stage, ja_code, func):
+        result = results[ja_code]
+        if result['status'] != 'ok':
+            return
+        start_time = time.perf_counter()
+        try:
+            result['counts'][stage] = func()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"再計算エラー（{stage}）: JA={ja_code}, 年度={year}: {str(e)}")
+            result['status'] = 'error'
+            result['message'] = f"{stage}: {str(e)}"
+        result['seconds'][stage] = time.perf_counter() - start_time
+
+    for ja_code in ja_codes:
+        if 'balances' in stages:
+            run('balances', ja_code, lambda: _recompute_balances(ja_code, year, only_stale))
+        if 'totals' in stages:
+            run('totals', ja_code, lambda: _recompute_totals(ja_code, year))
+
+    if 'indicators' in stages:
+        # 指標はシャード内のJAをまとめてベクトル化エンジンで計算し、変更のあった指標のみ書き換える
+        from indicator_engine import calculate_indicators_batch
+        from analysis_result_writer import AnalysisResultWriter
+
+        targets = [ja_code for ja_code in ja_codes if results[ja_code]['status'] == 'ok']
+        if targets:
+            start_time = time.perf_counter()
+            try:
+                writer = AnalysisResultWriter(diff=True)
+                for ja_code in targets:
+                    writer.add_scope(ja_code, year)
+                rows = calculate_indicators_batch(targets, [year])
+                writer.extend(rows)
+                writer.write()
+                counts = {}
+                for row in rows:
+                    counts[row['ja_code']] = counts.get(row['ja_code'], 0) + 1
+                for ja_code in targets:
+                    results[ja_code]['counts']['indicators'] = counts.get(ja_code, 0)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"再計算エラー（indicators）: 年度={year}, JA={targets}: {str(e)}")
+                for ja_code in targets:
+                    results[ja_code]['status'] = 'error'
+                    results[ja_code]['message'] = f"indicators: {str(e)}"
+            elapsed = (time.perf_counter() - start_time) / len(targets)
+            for ja_code in targets:
+                results[ja_code]['seconds']['indicators'] = elapsed
+
+    if 'risk' in stages:
+        # リスクスコアは指標ごとに計算済みのため、ここでは総合評価を求めて結果に記録する
+        from risk_analyzer import RiskAnalyzer
+
+        for ja_code in ja_codes:
+            def overall_risk():
+                risk = RiskAnalyzer.get_overall_risk_score(ja_code, year)
+                if risk.get('status') == 'error':
+                    raise RuntimeError(risk.get('message'))
+                results[ja_code]['risk'] = {
+                    'overall_score': risk.get('overall_score'),
+                    'overall_risk_level': risk.get('overall_risk_level'),
+                }
+                return 1
+            run('risk', ja_code, overall_risk)
+
+    db.session.remove()
+    return [results[ja_code] for ja_code in ja_codes]
+
+
+def load_completed(state_file):
+    """状態ファイルから処理済みの (JA, 年度) を読み込む"""
+    completed = set()
+    if not os.path.exists(state_file):
+        return completed
+    with open(state_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で停止した行は無視する
+                continue
+            unit = (record['ja_code'], int(record['year']))
+            if record.get('status') == 'ok':
+                completed.add(unit)
+            else:
+                completed.discard(unit)
+    return completed
+
+
+def _summarize(results, skipped, elapsed, workers):
+    summary = {
+        'units': len(results) + skipped,
+        'ok': sum(1 for result in results if result['status'] == 'ok'),
+        'error': sum(1 for result in results if result['status'] != 'ok'),
+        'skipped': skipped,
+        'workers': workers,
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed > 0 else 0.0,
+        'stages': {},
+    }
+    for stage in STAGES:
+        seconds = [result['seconds'][stage] for result in results if stage in result['seconds']]
+        if not seconds:
+            continue
+        summary['stages'][stage] = {
+            'units': len(seconds),
+            'seconds': sum(seconds),
+            'average': sum(seconds) / len(seconds),
+            'count': sum(result['counts'].get(stage) or 0 for result in results),
+        }
+    return summary
+
+
+def recompute_all(ja_codes=None, years=None, stages=STAGES, max_workers=None, shard_size=SHARD_SIZE,
+                  only_stale=False, state_file=STATE_FILE, resume=False):
+    """
+    複数JA・年度を一括で再計算する
+
+    Args:
+        ja_codes: 対象JAコードのリスト（Noneの場合は全JA）
+        years: 対象年度のリスト（Noneの場合は全年度）
+        stages: 実行する処理段階（STAGES の部分集合）
+        max_workers: ワーカープロセス数（Noneの場合はCPU数、1の場合はこのプロセスで実行）
+        shard_size: 1つのシャードに含める (JA, 年度) の数
+        only_stale: Trueの場合、元データが変更された財務諸表タイプのみ残高を再作成する
+        state_file: 処理済みの (JA, 年度) を記録するファイル
+        resume: Trueの場合は状態ファイルに記録済みの (JA, 年度) を処理しない
+
+    Returns:
+        dict: results（(JA, 年度) ごとの結果）, summary（件数・経過時間・スループット・段階ごとの時間）
+    """
+    from app import db
+
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"不明な処理段階です: {', '.join(unknown)}")
+    stages = tuple(stage for stage in STAGES if stage in stages)
+
+    units = list_units(ja_codes, years)
+    completed = load_completed(state_file) if resume else set()
+    pending = [unit for unit in units if unit not in completed]
+    skipped = len(units) - len(pending)
+    shards = make_shards(pending, shard_size)
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(shards) or 1))
+    logger.info(f"一括再計算を開始します: 対象={len(units)}件, 処理済み={skipped}件, "
+                f"シャード={len(shards)}件, ワーカー={workers}, 段階={','.join(stages)}")
+
+    results = []
+    start_time = time.perf_counter()
+    with open(state_file, 'a' if resume else 'w', encoding='utf-8') as state:
+        if state.tell() > 0:
+            # 前回の書き込み途中の行と連結しないよう改行する
+            state.write('\n')
+        def record(shard_results):
+            for result in shard_results:
+                results.append(result)
+                state.write(json.dumps(result, ensure_ascii=False) + '\n')
+            state.flush()
+            elapsed = time.perf_counter() - start_time
+            logger.info(f"進捗: {len(results)}/{len(pending)}件 ({len(results) / elapsed:.2f}件/秒)")
+
+        if workers == 1:
+            for year, shard_ja_codes in shards:
+                record(process_shard(year, shard_ja_codes, stages, only_stale))
+        else:
+            # 子プロセスに接続を引き継がないよう、起動前に接続を閉じる
+            db.session.remove()
+            db.engine.dispose()
+            # Webアプリ（複数スレッド）から fork するとロックの状態などを引き継ぐため、その場合は新しいプロセスを起動する
+            if threading.active_count() == 1 and 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+                futures = {
+                    executor.submit(process_shard, year, shard_ja_codes, stages, only_stale): (year, shard_ja_codes)
+                    for year, shard_ja_codes in shards
+                }
+                for future in as_completed(futures):
+                    year, shard_ja_codes = futures[future]
+                    try:
+                        record(future.result())
+                    except Exception as e:
+                        logger.error(f"シャードの処理エラー: 年度={year}, JA={shard_ja_codes}: {str(e)}")
+                        record([{'ja_code': ja_code, 'year': year, 'status': 'error', 'message': str(e),
+                                 'seconds': {}, 'counts': {}, 'risk': None} for ja_code in shard_ja_codes])
+
+    summary = _summarize(results, skipped, time.perf_counter() - start_time, workers)
+    logger.info(f"一括再計算が完了しました: 成功={summary['ok']}件, エラー={summary['error']}件, "
+                f"{summary['elapsed']:.1f}秒 ({summary['throughput']:.2f}件/秒)")
+    return {'results': results, 'summary': summary}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="複数JA・年度の残高・合計科目・財務指標・リスク評価を一括で再計算する")
+    parser.add_argument('--ja-code', action='append', help="対象のJAコード（複数指定可、既定: 全JA）")
+    parser.add_argument('--year', type=int, action='append', help="対象の年度（複数指定可、既定: 全年度）")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f"実行する処理段階（カンマ区切り、既定: {','.join(STAGES)}）")
+    parser.add_argument('--workers', type=int, help="ワーカープロセス数（既定: CPU数）")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help=f"1つのシャードに含めるJA数（既定: {SHARD_SIZE}）")
+    parser.add_argument('--only-stale', action='store_true',
+                        help="元データが変更された財務諸表タイプのみ残高を再作成する")
+    parser.add_argument('--state', default=STATE_FILE, help=f"状態ファイル（既定: {STATE_FILE}）")
+    parser.add_argument('--resume', action='store_true', help="状態ファイルに記録済みの (JA, 年度) を処理せずに再開する")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+    from app import app
+    with app.app_context():
+        report = recompute_all(
+            ja_codes=args.ja_code, years=args.year,
+            stages=[stage.strip() for stage in args.stages.split(',') if stage.strip()],
+            max_workers=args.workers, shard_size=args.shard_size, only_stale=args.only_stale,
+            state_file=args.state, resume=args.resume
+        )
+
+    for result in report['results']:
+        if result['status'] != 'ok':
+            print(f"エラー {result['ja_code']} {result['year']}: {result['message']}")
+    summary = report['summary']
+    print(f"対象: {summary['units']}件 (成功 {summary['ok']}, エラー {summary['error']}, 処理済み {summary['skipped']})")
+    print(f"経過時間: {summary['elapsed']:.1f}秒, ワーカー: {summary['workers']}, "
+          f"スループット: {summary['throughput']:.2f}件/秒")
+    for stage, stats in summary['stages'].items():
+        print(f"  {stage:<10} {stats['units']:>6}件  合計 {stats['seconds']:8.1f}秒  "
+              f"平均 {stats['average'] * 1000:8.1f}ミリ秒  件数 {stats['count']}")
+    return 0 if not summary['error'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@ import sys
 import logging
 from app import app, db
 from models import JA, CSVData, AccountMapping, StandardAccountBalance
-from create_account_balances import create_standard_account_balances
+from balance_generation import rebuild_balances
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,32 +30,20 @@ def recreate_all_balances(ja_code, year, file_type=None):
     for ft in file_types:
         logger.info(f"Processing {ja_code}, {year}, {ft}")
         
-        # 既存の残高データを削除
-        deleted = StandardAccountBalance.query.filter_by(
-            ja_code=ja_code,
-            year=int(year),
-            statement_type=ft
-        ).delete()
-        
-        logger.info(f"Deleted {deleted} existing balance records for {ja_code}, {year}, {ft}")
-        
-        # コミット
-        db.session.commit()
-        
-        # 残高データを再作成
+        # 既存の残高データを削除し、マッピング済みCSVデータから一括で作成し直す（1トランザクション）
+        # 作成した世代を記録し、次回の表示時に同じ残高を再作成しないようにする
         try:
-            # create_standard_account_balancesにはapp_contextが含まれている
-            created = create_standard_account_balances(ja_code, year, ft)
-            logger.info(f"Created {created} balance records for {ja_code}, {year}, {ft}")
+            built = rebuild_balances(ja_code, year, ft, force=True) or {'deleted': 0, 'created': 0}
+            logger.info(f"Deleted {built['deleted']} and created {built['created']} balance records for {ja_code}, {year}, {ft}")
             result[ft] = {
-                "deleted": deleted,
-                "created": created,
+                "deleted": built['deleted'],
+                "created": built['created'],
                 "status": "success"
             }
         except Exception as e:
             logger.error(f"Error creating balance records for {ja_code}, {year}, {ft}: {str(e)}")
             result[ft] = {
-                "deleted": deleted,
+                "deleted": 0,
                 "created": 0,
                 "status": "error",
                 "error": str(e)
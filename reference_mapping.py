@@ -8,92 +8,18 @@
 
 import logging
 import re
-from difflib import SequenceMatcher
+from datetime import datetime
 from sqlalchemy import func, desc, and_
 from app import db
-from models import JA, AccountMapping, CSVData, StandardAccount
+from models import (JA, AccountMapping, CSVData, StandardAccount, MappingKnowledge,
+                    KNOWLEDGE_RATIONALE_PREFIX, bump_balance_generation)
+from utils import normalize_account_name
+from performance_enhancer import mark_cache_dirty
+from fuzzy_matcher import FuzzyNameMatcher
 
 # ロガー設定
 logger = logging.getLogger(__name__)
 
-def normalize_account_name(name, file_type='bs'):
-    """
-    勘定科目名を正規化する（空白、全角/半角、カッコなどを処理）
-    
-    Args:
-        name: 勘定科目名
-        file_type: ファイルタイプ (bs, pl, cf)
-        
-    Returns:
-        str: 正規化された勘定科目名
-    """
-    if name is None:
-        return ""
-    
-    # 「うち」で始まる括弧付き科目は特別処理（括弧内の内容を抽出）
-    is_uchi_item = False
-    uchi_content = ""
-    if name.startswith('(うち') or name.startswith('（うち'):
-        uchi_match = re.match(r'[\(（]うち(.*?)[\)）]', name)
-        if uchi_match:
-            uchi_content = uchi_match.group(1)
-            is_uchi_item = True
-    
-    # 全角→半角変換（数字、アルファベット、スペース、記号）
-    name = name.translate(str.maketrans({
-        '０': '0', '１': '1', '２': '2', '３': '3', '４': '4',
-        '５': '5', '６': '6', '７': '7', '８': '8', '９': '9',
-        'ａ': 'a', 'ｂ': 'b', 'ｃ': 'c', 'ｄ': 'd', 'ｅ': 'e',
-        'ｆ': 'f', 'ｇ': 'g', 'ｈ': 'h', 'ｉ': 'i', 'ｊ': 'j',
-        'ｋ': 'k', 'ｌ': 'l', 'ｍ': 'm', 'ｎ': 'n', 'ｏ': 'o',
-        'ｐ': 'p', 'ｑ': 'q', 'ｒ': 'r', 'ｓ': 's', 'ｔ': 't',
-        'ｕ': 'u', 'ｖ': 'v', 'ｗ': 'w', 'ｘ': 'x', 'ｙ': 'y',
-        'ｚ': 'z',
-        'Ａ': 'A', 'Ｂ': 'B', 'Ｃ': 'C', 'Ｄ': 'D', 'Ｅ': 'E',
-        'Ｆ': 'F', 'Ｇ': 'G', 'Ｈ': 'H', 'Ｉ': 'I', 'Ｊ': 'J',
-        'Ｋ': 'K', 'Ｌ': 'L', 'Ｍ': 'M', 'Ｎ': 'N', 'Ｏ': 'O',
-        'Ｐ': 'P', 'Ｑ': 'Q', 'Ｒ': 'R', 'Ｓ': 'S', 'Ｔ': 'T',
-        'Ｕ': 'U', 'Ｖ': 'V', 'Ｗ': 'W', 'Ｘ': 'X', 'Ｙ': 'Y',
-        'Ｚ': 'Z',
-        '　': ' ', '（': '(', '）': ')', '＜': '<', '＞': '>',
-        '【': '[', '】': ']', '％': '%', '＆': '&', '＊': '*',
-        '＋': '+', '－': '-', '／': '/', '＝': '=', '：': ':',
-        '；': ';', '，': ',', '．': '.', '＠': '@', '＿': '_',
-        '｜': '|', '～': '~', '＄': '$', '＃': '#', '！': '!'
-    }))
-    
-    # 空白文字の正規化（全ての種類の空白を半角スペースに変換し、連続する空白を1つにまとめる）
-    name = re.sub(r'\s+', ' ', name)
-    
-    # 括弧付き「うち」項目の場合、括弧を削除せずに内容を使用
-    if is_uchi_item and uchi_content:
-        name = uchi_content
-    else:
-        # 括弧と括弧内の内容を削除
-        name = re.sub(r'[\(（].*?[\)）]', '', name)
-    
-    # 先頭と末尾の空白を削除
-    name = name.strip()
-    
-    # 財務諸表タイプ別の特殊処理
-    if file_type == 'bs':
-        # BSの場合「預金」→「貯金」変換
-        name = name.replace('預金', '貯金')
-        name = name.replace('普通預金', '普通貯金')
-    elif file_type == 'pl':
-        # PLの場合の特殊処理
-        # 「収益」と「収入」の統一
-        if '収入' in name and not '収益' in name:
-            name = name.replace('収入', '収益')
-        # 「費用」と「経費」の統一
-        if '経費' in name and not '費用' in name:
-            name = name.replace('経費', '費用')
-        # 「当期首繰越利益剰余金」→「当期首繰越剰余金」に統一
-        if '当期首繰越利益剰余金' in name:
-            name = name.replace('当期首繰越利益剰余金', '当期首繰越剰余金')
-    
-    return name
-
 def get_reference_ja_list():
     """
     マッピングが充実しているJAのリストを取得する（参照用）
@@ -262,6 +188,7 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
         # 参照するJAのマッピングデータを取得
         reference_mappings_query = db.session.query(
             AccountMapping.original_account_name,
+            AccountMapping.normalized_name,
             AccountMapping.standard_account_code,
             AccountMapping.confidence,
             AccountMapping.financial_statement
@@ -283,8 +210,10 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
         
         # 参照マッピングデータの辞書を作成（高速検索用）
         reference_dict = {}
-        for original_account_name, standard_code, confidence, ref_financial_statement in reference_mappings:
-            norm_name = normalize_account_name(original_account_name, file_type)
+        for original_account_name, norm_name, standard_code, confidence, ref_financial_statement in reference_mappings:
+            # 保存済みの正規化名が無い（移行前の）行のみ、ここで正規化する
+            if norm_name is None:
+                norm_name = normalize_account_name(original_account_name, file_type)
             if norm_name and standard_code:
                 # 同じ勘定科目名に複数のマッピングがある場合は信頼度が高い方を採用
                 if norm_name not in reference_dict or confidence > reference_dict[norm_name][1]:
@@ -296,9 +225,14 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
         ).all()
         standard_dict = {account.code: account for account in standard_accounts}
         
+        # 類似度検索用のインデックス（類似度がしきい値以上になり得る参照科目のみ比較する）
+        matcher = FuzzyNameMatcher(reference_dict)
+        
         # 未マッピング科目に対して参照マッピングを適用
         for csv_data in unmapped_accounts:
-            norm_name = normalize_account_name(csv_data.account_name, file_type)
+            norm_name = csv_data.normalized_name
+            if norm_name is None:
+                norm_name = normalize_account_name(csv_data.account_name, file_type)
             
             # 完全一致で参照
             if norm_name in reference_dict:
@@ -310,12 +244,7 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
                     skipped_count += 1
                     continue
                 
-                # 標準勘定科目の名前を取得
-                standard_account = StandardAccount.query.filter_by(code=standard_code).first()
-                if not standard_account:
-                    logger.warning(f"標準勘定科目が見つかりません: {standard_code}")
-                    skipped_count += 1
-                    continue
+                standard_account = standard_dict[standard_code]
                 
                 # マッピングを作成（属性ごとに設定）
                 new_mapping = AccountMapping()
@@ -335,14 +264,7 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
                 mapped_count += 1
             else:
                 # 完全一致しない場合は類似度で検索
-                best_match = None
-                best_similarity = 0.0
-                
-                for ref_name in reference_dict:
-                    similarity = SequenceMatcher(None, norm_name, ref_name).ratio()
-                    if similarity > best_similarity and similarity >= confidence_threshold:
-                        best_similarity = similarity
-                        best_match = ref_name
+                best_match, best_similarity = matcher.best_match(norm_name, confidence_threshold)
                 
                 if best_match:
                     standard_code, confidence = reference_dict[best_match]
@@ -414,4 +336,134 @@ def apply_reference_mapping(target_ja_code, target_year, file_type, confidence_t
             "message": str(e),
             "mapped": 0,
             "skipped": 0
-        }
\ No newline at end of file
+        }
+def apply_knowledge_mapping(ja_codes, years=None, file_types=('bs', 'pl', 'cf'), min_votes=1, min_confidence=0.8):
+    """
+    全JAのマッピングを集計したナレッジベース（mapping_knowledge）を参照し、
+    指定したJA・年度の未マッピング勘定科目を1回のSQL（INSERT ... SELECT）でまとめてマッピングする
+    
+    正規化した勘定科目名ごとに票数の最も多い標準勘定科目を採用する。
+    信頼度は「採用した標準勘定科目の信頼度の合計 / 全ての票数」（票が割れている場合は低くなる）。
+    
+    Args:
+        ja_codes: 対象のJAコードのリスト
+        years: 対象の年度のリスト（Noneの場合は全年度）
+        file_types: 対象のファイルタイプ（bs, pl, cf）
+        min_votes: 採用する標準勘定科目に必要な票数
+        min_confidence: 信頼度のしきい値
+        
+    Returns:
+        dict: 処理結果
+    """
+    try:
+        ja_codes = list(ja_codes)
+        file_types = list(file_types)
+        if not ja_codes or not file_types:
+            return {"status": "success", "message": "対象がありません", "mapped": 0, "updated_rows": 0}
+        logger.info(f"ナレッジベースによるマッピング開始: JA={len(ja_codes)}件, 年度={years}, タイプ={file_types}")
+        
+        csv = CSVData.__table__
+        knowledge = MappingKnowledge.__table__
+        mapping = AccountMapping.__table__
+        standard = StandardAccount.__table__
+        
+        scope = [csv.c.ja_code.in_(ja_codes), csv.c.file_type.in_(file_types), csv.c.is_mapped == False]
+        if years is not None:
+            scope.append(csv.c.year.in_([int(year) for year in years]))
+        
+        # 対象の未マッピング勘定科目（年度が違っても同じJA・勘定科目名のマッピングは1件）
+        targets = db.select(
+            csv.c.ja_code, csv.c.account_name, csv.c.normalized_name, csv.c.file_type
+        ).where(*scope, csv.c.normalized_name != '').distinct().subquery('t')
+        
+        # 対象の正規化名について、票数の多い順に順位を付けた標準勘定科目
+        key = (knowledge.c.financial_statement, knowledge.c.normalized_name)
+        ranked = db.select(
+            knowledge.c.financial_statement,
+            knowledge.c.normalized_name,
+            knowledge.c.standard_account_code,
+            knowledge.c.vote_count,
+            knowledge.c.confidence_sum,
+            db.func.row_number().over(
+                partition_by=key,
+                order_by=(knowledge.c.vote_count.desc(), knowledge.c.confidence_sum.desc(), knowledge.c.id)
+            ).label('rank'),
+            db.func.sum(knowledge.c.vote_count).over(partition_by=key).label('total_votes'),
+        ).where(
+            knowledge.c.financial_statement.in_(file_types),
+            knowledge.c.normalized_name.in_(db.select(targets.c.normalized_name))
+        ).subquery('r')
+        
+        confidence = (ranked.c.confidence_sum / ranked.c.total_votes).label('confidence')
+        rationale = (
+            db.literal(f"{KNOWLEDGE_RATIONALE_PREFIX}: 他JAの既存マッピング（")
+            + db.cast(ranked.c.vote_count, db.String) + db.literal("/")
+            + db.cast(ranked.c.total_votes, db.String) + db.literal("票）")
+        )
+        query = db.select(
+            targets.c.ja_code,
+            targets.c.account_name,
+            targets.c.normalized_name,
+            ranked.c.standard_account_code,
+            standard.c.name,
+            targets.c.file_type,
+            confidence,
+            rationale,
+            db.literal(datetime.utcnow()),
+        ).select_from(
+            targets.join(ranked, db.and_(
+                ranked.c.financial_statement == targets.c.file_type,
+                ranked.c.normalized_name == targets.c.normalized_name,
+                ranked.c.rank == 1
+            )).join(standard, db.and_(
+                standard.c.code == ranked.c.standard_account_code,
+                standard.c.financial_statement == targets.c.file_type
+            ))
+        ).where(
+            ranked.c.vote_count >= min_votes,
+            ranked.c.confidence_sum >= min_confidence * ranked.c.total_votes,
+            ~db.exists().where(
+                mapping.c.ja_code == targets.c.ja_code,
+                mapping.c.financial_statement == targets.c.file_type,
+                mapping.c.original_account_name == targets.c.account_name
+            )
+        )
+        
+        connection = db.session.connection()
+        mapped = connection.execute(mapping.insert().from_select(
+            ['ja_code', 'original_account_name', 'normalized_name', 'standard_account_code',
+             'standard_account_name', 'financial_statement', 'confidence', 'rationale', 'created_at'],
+            query
+        )).rowcount
+        
+        updated_rows = 0
+        if mapped:
+            updated_rows = connection.execute(csv.update().where(*scope, db.exists().where(
+                mapping.c.ja_code == csv.c.ja_code,
+                mapping.c.financial_statement == csv.c.file_type,
+                mapping.c.original_account_name == csv.c.account_name
+            )).values(is_mapped=True)).rowcount
+            # Coreの変更はORMのイベントで検知されないため、残高の世代とキャッシュを明示的に更新する
+            for ja_code in ja_codes:
+                for file_type in file_types:
+                    bump_balance_generation(connection, ja_code, file_type)
+                mark_cache_dirty(db.session, ja_code)
+        db.session.commit()
+        
+        logger.info(f"ナレッジベースによるマッピング完了: {mapped}件マッピング, 勘定科目データ{updated_rows}行")
+        return {
+            "status": "success",
+            "message": "ナレッジベースによるマッピングが完了しました",
+            "mapped": mapped,
+            "updated_rows": updated_rows
+        }
+        
+    except Exception as e:
+        logger.error(f"ナレッジベースによるマッピングでエラー: {e}")
+        db.session.rollback()
+        return {
+            "status": "error",
+            "message": str(e),
+            "mapped": 0,
+            "updated_rows": 0
+        }
@@ -12,6 +12,7 @@ from create_account_balances import create_standard_account_balances
 from recreate_all_balances import recreate_all_balances
 from recreate_deposit_balances import recreate_deposit_balances
 from financial_indicators import FinancialIndicators
+from account_hierarchy import invalidate_account_hierarchy
 from recalculate_indicators import recalculate_indicators
 
 # ロガーの設定
@@ -55,6 +56,8 @@ def register_additional_routes(app):
             cf_count = import_cf_standard_accounts("attached_assets/キャッシュフロー計算書標準科目テーブル.csv")
             logger.info(f"{cf_count}件のCF勘定科目をインポートしました")
             
+            invalidate_account_hierarchy()
+            
             # 合計
             total_count = bs_pl_count + cf_count
             flash(f'標準勘定科目の一括インポートが完了しました。合計: {total_count}件（BS/PL: {bs_pl_count}件、CF: {cf_count}件）', 'success')
@@ -18,7 +18,16 @@ logger = logging.getLogger(__name__)
 from data_processor import DataProcessor
 from ai_account_mapper import AIAccountMapper
 from financial_indicators import FinancialIndicators
+from balance_snapshot import BalanceSnapshot
+from analysis_result_writer import AnalysisResultWriter
+from account_hierarchy import invalidate_account_hierarchy
+from balance_changes import BalanceChangeSet
+from balance_generation import rebuild_balances
+from balance_builder import build_balances
 from risk_analyzer import RiskAnalyzer
+from performance_enhancer import cached_query
+from encoding_detector import read_csv_bytes, EncodingDetectionError
+from background_jobs import submit_job, new_upload_path, batch_upload_suffix
 
 # ロガーの設定
 logging.basicConfig(level=logging.DEBUG)
@@ -36,6 +45,27 @@ def register_routes(app):
     
     # メインページのルートは既存のindex関数で処理されるため削除
     
+    # 標準勘定科目残高の強制再作成
+    @app.route('/account_balances/rebuild', methods=['POST'])
+    def rebuild_account_balances():
+        """世代に関わらず標準勘定科目残高を再作成して一覧画面に戻る"""
+        ja_code = request.form.get('ja_code') or session.get('selected_ja_code')
+        year = request.form.get('year') or session.get('selected_year')
+        financial_statement = request.form.get('financial_statement', 'bs')
+        
+        if not ja_code or not year:
+            flash('JAと年度を選択してください。', 'warning')
+            return redirect(url_for('account_balances', financial_statement=financial_statement))
+        
+        try:
+            rebuilt = rebuild_balances(ja_code, int(year), financial_statement, force=True)
+            flash(f'残高データを再作成しました: {rebuilt["created"] if rebuilt else 0}件', 'success')
+        except Exception as e:
+            logger.error(f"残高データの再作成中にエラー: {str(e)}")
+            flash(f'残高データの再作成中にエラーが発生しました: {str(e)}', 'danger')
+        
+        return redirect(url_for('account_balances', ja_code=ja_code, year=year, financial_statement=financial_statement))
+    
     # 標準勘定科目残高一覧表示
     @app.route('/account_balances')
     def account_balances():
@@ -62,119 +92,17 @@ def register_routes(app):
         refresh = request.args.get('refresh', 'false').lower() == 'true'
         # 合計計算フラグを確認
         calculate_totals = request.args.get('calculate_totals', 'false').lower() == 'true'
-        # 残高再作成フラグを確認
-        recreate_balances = request.args.get('recreate_balances', 'true').lower() == 'true'
         
         if refresh:
             db.session.expire_all()
             
-        # 残高データを再作成するか（デフォルトで再作成するように変更）
-        if recreate_balances and ja_code and year:
+        # 元データ（CSVデータ・マッピング）が前回の作成時から変更されている場合のみ残高を再作成
+        # （強制的な再作成は POST /account_balances/rebuild から行う）
+        if ja_code and year:
             try:
-                # 年度を整数に確実に変換
-                year_int = int(year)
-                logger.info(f"残高データ再作成処理開始: JA={ja_code}, 年度={year_int}, タイプ={financial_statement}")
-                
-                # 代替方法：直接クエリで残高データを削除してから作成し直す
-                # これにより、モジュールの循環参照やコンテキスト問題を回避
-                # まず既存の残高データを削除
-                deleted = StandardAccountBalance.query.filter_by(
-                    ja_code=ja_code,
-                    year=year_int,
-                    statement_type=financial_statement
-                ).delete()
-                
-                # コミット
-                db.session.commit()
-                
-                # 残高データを再作成
-                logger.info(f"標準勘定科目残高を再作成: JA={ja_code}, 年度={year}, タイプ={financial_statement}")
-                
-                # 標準勘定科目コードとマッピングを取得
-                mappings = {}
-                for mapping in AccountMapping.query.filter_by(
-                    ja_code=ja_code,
-                    financial_statement=financial_statement
-                ).all():
-                    mappings[mapping.original_account_name] = mapping
-                    
-                logger.info(f"マッピング取得完了: {len(mappings)}件")
-                
-                # CSVデータからマッピングに基づいて残高を作成
-                created = 0
-                # 既にyear_intとして整数変換済み
-                # is_mappedの条件を修正：Trueの代わりに文字列't'またはbooleanを使用
-                csv_data = CSVData.query.filter(
-                    CSVData.ja_code == ja_code,
-                    CSVData.year == year_int,
-                    CSVData.file_type == financial_statement,
-                    CSVData.is_mapped == True
-                ).all()
-                logger.info(f"マッピング済みCSVデータ取得: {len(csv_data)}件")
-                
-                for data in csv_data:
-                    mapping = mappings.get(data.account_name)
-                    if not mapping:
-                        continue
-                    
-                    # 数値を変換
-                    try:
-                        current_value = float(data.current_value) if data.current_value is not None else 0
-                    except (ValueError, TypeError):
-                        current_value = 0
-                        
-                    try:
-                        previous_value = float(data.previous_value) if data.previous_value is not None else 0
-                    except (ValueError, TypeError):
-                        previous_value = 0
-                    
-                    # カテゴリから statement_subtype を決定
-                    statement_subtype = "その他"
-                    category = data.category or ""
-                    
-                    if financial_statement == "bs":
-                        if "資産" in category:
-                            statement_subtype = "BS資産"
-                        elif "負債" in category:
-                            statement_subtype = "BS負債"
-                        elif "純資産" in category:
-                            statement_subtype = "BS純資産"
-                    elif financial_statement == "pl":
-                        if "収益" in category:
-                            statement_subtype = "PL収益"
-                        elif "費用" in category:
-                            statement_subtype = "PL費用"
-                    elif financial_statement == "cf":
-                        if "営業活動" in category:
-                            statement_subtype = "CF営業活動"
-                        elif "投資活動" in category:
-                            statement_subtype = "CF投資活動"
-                        elif "財務活動" in category:
-                            statement_subtype = "CF財務活動"
-                        elif "現金" in category or "現金同等物" in category:
-                            statement_subtype = "CF現金同等物"
-                        else:
-                            statement_subtype = "CF"
-                    
-                    # 新しい残高レコードを作成
-                    new_balance = StandardAccountBalance()
-                    new_balance.ja_code = ja_code
-                    new_balance.year = int(year)
-                    new_balance.statement_type = financial_statement
-                    new_balance.statement_subtype = statement_subtype
-                    new_balance.standard_account_code = mapping.standard_account_code
-                    new_balance.standard_account_name = mapping.standard_account_name
-                    new_balance.current_value = current_value
-                    new_balance.previous_value = previous_value
-                    db.session.add(new_balance)
-                    created += 1
-                
-                # 変更をコミット
-                db.session.commit()
-                
-                # 成功メッセージを表示
-                flash(f'残高データを再作成しました: {created}件', 'success')
-                
+                rebuilt = rebuild_balances(ja_code, int(year), financial_statement)
+                if rebuilt is not None:
+                    flash(f'残高データを再作成しました: {rebuilt["created"]}件', 'success')
             except Exception as e:
                 logger.error(f"残高データの再作成中にエラー: {str(e)}")
                 flash(f'残高データの再作成中にエラーが発生しました: {str(e)}', 'danger')
@@ -258,47 +186,6 @@ def register_routes(app):
                     financial_statement=financial_statement
                 ).limit(5).all()
                 logger.info(f"標準勘定科目の最初の5件: {', '.join([a.code for a in standard_accounts])}")
-                
-                # マッピングデータも確認
-                mappings = AccountMapping.query.filter_by(
-                    ja_code=ja_code,
-                    financial_statement=financial_statement
-                ).limit(5).all()
-                logger.info(f"マッピングデータの最初の5件: {len(mappings)}")
-                
-                # CSVデータも確認
-                csv_data = CSVData.query.filter_by(
-                    ja_code=ja_code,
-                    year=year_int,
-                    file_type=financial_statement
-                ).limit(5).all()
-                logger.info(f"CSVデータの最初の5件: {len(csv_data)}")
-                
-                # もしマッピングとCSVデータがあれば、残高を自動的に再作成
-                if len(mappings) > 0 and len(csv_data) > 0:
-                    logger.info(f"データはあるが残高がないので自動的に再作成: JA={ja_code}, 年度={year_int}")
-                    # 自動的に残高再作成を行うフラグをセット
-                    recreate_balances = True
-                    
-                    # ここで残高を再作成（既存のコードを再利用）
-                    try:
-                        # 既存の残高データを削除
-                        deleted = StandardAccountBalance.query.filter_by(
-                            ja_code=ja_code,
-                            year=year_int,
-                            statement_type=financial_statement
-                        ).delete()
-                        
-                        # コミット
-                        db.session.commit()
-                        
-                        # 残高データを再作成
-                        logger.info(f"データ検出時に自動的に残高再作成: JA={ja_code}, 年度={year_int}, タイプ={financial_statement}")
-                        
-                        # 処理をこのまま続行（自動再作成したので）
-                        # 後続の残高データアクセスで正しいデータが取得できるようになる
-                    except Exception as e:
-                        logger.error(f"自動残高再作成中にエラー: {str(e)}")
             
             logger.info(f"標準勘定科目残高クエリ実行: JA={ja_code}, 年度={year_int}, タイプ={financial_statement}")
             
@@ -588,6 +475,7 @@ def register_routes(app):
                     # デバッグインポートモジュールを使用
                     from debug_import import debug_import_standard_accounts
                     debug_import_standard_accounts(filepath, financial_statement)
+                    invalidate_account_hierarchy()
                     
                     flash(f'デバッグモードで標準勘定科目をインポートしました。処理ログを確認してください。', 'success')
                     return redirect(url_for('standard_accounts'))
@@ -611,42 +499,38 @@ def register_routes(app):
             
             # ファイルを保存
             if file.filename:
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                if request.args.get('format') == 'job':
+                    # バックグラウンドジョブが読み込むまで残るため、アップロードIDの名前で保存する（ジョブにはIDのみ渡す）
+                    upload_id, filepath = new_upload_path()
+                else:
+                    filename = secure_filename(file.filename)
+                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                 file.save(filepath)
             else:
                 flash('ファイル名が不正です', 'danger')
                 return redirect(url_for('standard_accounts'))
             
+            # バックグラウンドジョブとして実行する（画面は /api/jobs/<id> で進捗を表示する）
+            if request.args.get('format') == 'job':
+                job, created = submit_job('import_standard_accounts', {
+                    'upload_id': upload_id,
+                    'financial_statement': financial_statement,
+                    'replace_existing': replace_existing,
+                })
+                return jsonify(dict(job.to_dict(), created=created)), 202
+            
             # CSVファイルを読み込む（エンコーディング問題に対処）
             try:
-                # ファイルの内容を一度読み込んでUTF-8に変換してから保存し直す
+                # ファイルの内容を一度だけ読み込み、文字コードを判定してから解析する
                 with open(filepath, 'rb') as f:
                     content = f.read()
 
-                # 様々なエンコーディングを試す
-                encodings_to_try = ['utf-8-sig', 'utf-8', 'shift-jis', 'euc-jp', 'cp932']
-                decoded_content = None
-                
-                for enc in encodings_to_try:
-                    try:
-                        decoded_content = content.decode(enc)
-                        logger.info(f"ファイルは {enc} エンコーディングで正常に読み込まれました")
-                        break
-                    except UnicodeDecodeError:
-                        continue
-                
-                if decoded_content is None:
+                try:
+                    df, encoding = read_csv_bytes(content)
+                except EncodingDetectionError:
                     flash('CSVファイルのエンコーディングを識別できませんでした。UTF-8形式で保存し直してください。', 'danger')
                     return redirect(url_for('standard_accounts'))
-                
-                # UTF-8で保存し直す
-                fixed_filepath = filepath + '.fixed.csv'
-                with open(fixed_filepath, 'w', encoding='utf-8') as f:
-                    f.write(decoded_content)
-                
-                # 修正済みのファイルを読み込む
-                df = pd.read_csv(fixed_filepath)
+                logger.info(f"ファイルは {encoding} エンコーディングで正常に読み込まれました")
                 
             except Exception as e:
                 import traceback
@@ -667,76 +551,8 @@ def register_routes(app):
                 flash(f'CSVファイルに必要なカラムがありません: {", ".join(missing_columns)}', 'danger')
                 return redirect(url_for('standard_accounts'))
             
-            # 既存のデータを削除（指定された場合）
-            if replace_existing:
-                # 関連するマッピング情報をクリア
-                # 関連するマッピング情報を取得
-                mappings_to_clear = AccountMapping.query.filter_by(financial_statement=financial_statement).all()
-                
-                if mappings_to_clear:
-                    # マッピング情報に関連するCSVデータのis_mappedフラグをリセット
-                    for mapping in mappings_to_clear:
-                        csv_data = CSVData.query.filter(
-                            CSVData.account_name == mapping.original_account_name,
-                            CSVData.file_type == financial_statement
-                        ).all()
-                        
-                        for data in csv_data:
-                            data.is_mapped = False
-                    
-                    # マッピング情報を削除
-                    mapping_count = AccountMapping.query.filter_by(financial_statement=financial_statement).delete()
-                    logger.info(f'{mapping_count}件のマッピング情報を削除しました')
-                
-                # 標準勘定科目を削除
-                deleted_count = StandardAccount.query.filter_by(financial_statement=financial_statement).delete()
-                logger.info(f'{deleted_count}件の標準勘定科目を削除しました')
-            
-            # 標準勘定科目を登録
-            imported_count = 0
-            for _, row in df.iterrows():
-                # 必須項目を取得
-                code = str(row['code'])
-                name = row['name']
-                category = row['category']
-                
-                # オプション項目を取得
-                parent_code = str(row['parent_code']) if 'parent_code' in df.columns and pd.notna(row['parent_code']) else None
-                display_order = int(row['display_order']) if 'display_order' in df.columns and pd.notna(row['display_order']) else int(code)
-                account_type = row['account_type'] if 'account_type' in df.columns and pd.notna(row['account_type']) else category
-                description = row['description'] if 'description' in df.columns and pd.notna(row['description']) else None
-                
-                # 既存のレコードを検索
-                existing = StandardAccount.query.filter_by(
-                    code=code, financial_statement=financial_statement
-                ).first()
-                
-                if existing:
-                    # 既存のレコードを更新
-                    existing.name = name
-                    existing.category = category
-                    existing.account_type = account_type
-                    existing.display_order = display_order
-                    existing.parent_code = parent_code
-                    if description:
-                        existing.description = description
-                else:
-                    # 新規レコードを作成（属性ごとに設定）
-                    new_account = StandardAccount()
-                    new_account.code = code
-                    new_account.name = name
-                    new_account.category = category
-                    new_account.financial_statement = financial_statement
-                    new_account.account_type = account_type
-                    new_account.display_order = display_order
-                    new_account.parent_code = parent_code
-                    new_account.description = description
-                    db.session.add(new_account)
-                
-                imported_count += 1
-            
-            # 変更をコミット
-            db.session.commit()
+            # 標準勘定科目を登録（既存のデータの削除・コミットを含む）
+            imported_count = DataProcessor.import_standard_accounts(df, financial_statement, replace_existing)
             
             # 一時ファイルを削除
             os.remove(filepath)
@@ -795,6 +611,7 @@ def register_routes(app):
             
             db.session.add(new_account)
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'標準勘定科目「{name}」を追加しました', 'success')
             
@@ -846,6 +663,7 @@ def register_routes(app):
             account.parent_code = parent_code
             
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'標準勘定科目「{name}」を更新しました', 'success')
             
@@ -886,6 +704,7 @@ def register_routes(app):
             
             db.session.delete(account)
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'標準勘定科目「{name}」を削除しました', 'success')
             
@@ -958,6 +777,7 @@ def register_routes(app):
             deleted_count = StandardAccount.query.filter_by(financial_statement=financial_statement).delete()
             
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'{fs_name}の標準勘定科目を{deleted_count}件一括削除しました', 'success')
             
@@ -1511,7 +1331,9 @@ def register_routes(app):
                 return redirect(url_for('data_import'))
             
             # Process file
-            success, message, row_count = DataProcessor.process_csv(file, ja_code, int(year), file_type)
+            success, message, row_count = DataProcessor.process_csv(
+                file, ja_code, int(year), file_type, diff=request.form.get('diff_import') == 'on'
+            )
             
             if success:
                 flash(f'データ取込成功: {message}', 'success')
@@ -1528,6 +1350,58 @@ def register_routes(app):
             flash(f'エラーが発生しました: {str(e)}', 'danger')
             return redirect(url_for('data_import'))
     
+    @app.route('/batch_import', methods=['POST'])
+    def batch_import():
+        """
+        複数ファイル・ZIPファイルの一括取込（ファイル名から取込先を判定）
+        ファイル数が多いとリクエストの時間内に終わらないため、バックグラウンドジョブとして実行する
+        （ファイルごとの取込結果はジョブの結果に含まれる）
+        """
+        try:
+            uploads = []
+            for upload in request.files.getlist('files'):
+                if not upload or not upload.filename:
+                    continue
+                try:
+                    suffix = batch_upload_suffix(upload.filename)
+                except ValueError as e:
+                    flash(str(e), 'warning')
+                    continue
+                # バックグラウンドジョブが読み込むまで残るため、アップロードIDの名前で保存する
+                upload_id, filepath = new_upload_path(suffix)
+                upload.save(filepath)
+                uploads.append({'upload_id': upload_id, 'filename': upload.filename})
+            
+            if not uploads:
+                if request.args.get('format') == 'job':
+                    return jsonify({'status': 'error', 'message': '取込対象のファイルがありません。'}), 400
+                flash('取込対象のファイルがありません。', 'danger')
+                return redirect(url_for('data_import'))
+            
+            ja_code = request.form.get('ja_code')
+            if ja_code in ('None', 'new', ''):
+                ja_code = None
+            job, created = submit_job('batch_import', {
+                'uploads': uploads,
+                'ja_code': ja_code,
+                'year': request.form.get('year') or None,
+                'diff': request.form.get('diff_import') == 'on',
+            })
+            
+            if request.args.get('format') in ('job', 'json'):
+                return jsonify(dict(job.to_dict(), created=created)), 202
+            
+            flash(f"一括取込を開始しました（{len(uploads)}ファイル、ジョブID: {job.id}）。"
+                  f"結果は /api/jobs/{job.id} で確認できます。", 'info')
+            return redirect(url_for('data_import'))
+            
+        except Exception as e:
+            logger.error(f"Error in batch import: {str(e)}")
+            if request.args.get('format') in ('job', 'json'):
+                return jsonify({'status': 'error', 'message': str(e)}), 500
+            flash(f'エラーが発生しました: {str(e)}', 'danger')
+            return redirect(url_for('data_import'))
+    
     @app.route('/data_management')
     def data_management():
         """Data management page"""
@@ -2336,12 +2210,18 @@ def register_routes(app):
                 
                 if mapping:
                     # Update existing mapping
+                    previous_code = mapping.standard_account_code
                     mapping.standard_account_code = standard_account_code
                     mapping.standard_account_name = standard_account.name
                     mapping.confidence = 1.0  # Manual mapping has full confidence
                     mapping.rationale = "手動マッピング（更新）"
                     
+                    # 変更前後の科目の残高と、それに依存する合計科目・指標のみ再計算
+                    changes = BalanceChangeSet()
+                    changes.remap(ja_code, year, file_type, [previous_code, standard_account_code])
                     db.session.commit()
+                    changes.propagate()
+                    
                     flash(f'アカウント "{original_account_name}" のマッピングを "{standard_account.name}" に更新しました。', 'success')
                 else:
                     flash(f'マッピングレコードが見つかりませんでした: {original_account_name}', 'danger')
@@ -2369,8 +2249,10 @@ def register_routes(app):
                     financial_statement=file_type
                 ).first()
                 
+                previous_code = None
                 if mapping:
                     # Update existing mapping
+                    previous_code = mapping.standard_account_code
                     mapping.standard_account_code = standard_account_code
                     mapping.standard_account_name = standard_account.name
                     mapping.confidence = 1.0  # Manual mapping has full confidence
@@ -2390,7 +2272,12 @@ def register_routes(app):
                 # Update account status
                 account.is_mapped = True
                 
+                # 変更前後の科目の残高と、それに依存する合計科目・指標のみ再計算
+                changes = BalanceChangeSet()
+                changes.remap(ja_code, year, file_type, [previous_code, standard_account_code])
                 db.session.commit()
+                changes.propagate()
+                
                 flash(f'アカウント "{account.account_name}" を "{standard_account.name}" にマッピングしました。', 'success')
             
             return redirect(url_for('mapping', file_type=file_type))
@@ -2437,8 +2324,14 @@ def register_routes(app):
                 data.is_mapped = False
             
             # マッピングを削除
+            previous_code = mapping.standard_account_code
             db.session.delete(mapping)
+            
+            # 削除したマッピングの科目の残高と、それに依存する合計科目・指標のみ再計算
+            changes = BalanceChangeSet()
+            changes.remap(ja_code, year, file_type, [previous_code])
             db.session.commit()
+            changes.propagate()
             
             flash(f'「{original_account_name}」のマッピングを削除しました。', 'success')
             return redirect(url_for('mapping', file_type=file_type))
@@ -2519,96 +2412,26 @@ def register_routes(app):
                 return redirect(url_for('mapping', file_type=file_type))
             
             # Get all mapped CSV data
-            mapped_data = CSVData.query.filter_by(
+            mapped_count = CSVData.query.filter_by(
                 ja_code=ja_code,
                 year=int(year),
                 file_type=file_type,
                 is_mapped=True
-            ).all()
+            ).count()
             
-            if not mapped_data:
+            if not mapped_count:
                 flash('マッピングされたデータがありません。', 'warning')
                 return redirect(url_for('mapping', file_type=file_type))
             
-            # Get account mappings
-            mappings = {}
-            for mapping in AccountMapping.query.filter_by(
-                ja_code=ja_code,
-                financial_statement=file_type
-            ).all():
-                mappings[mapping.original_account_name] = mapping
-            
-            # Process each mapped account
-            processed_count = 0
-            
-            for data in mapped_data:
-                mapping = mappings.get(data.account_name)
-                if not mapping:
-                    continue
-                
-                # Determine statement subtype based on file type and category
-                statement_subtype = "その他"
-                if file_type == "bs":
-                    category = data.category or ""  # Noneの場合は空文字列を使用
-                    if "資産" in category and "純資産" not in category:
-                        statement_subtype = "BS資産"
-                    elif "負債" in category:
-                        statement_subtype = "BS負債"
-                    elif "純資産" in category:
-                        statement_subtype = "BS純資産"
-                elif file_type == "pl":
-                    category = data.category or ""  # Noneの場合は空文字列を使用
-                    # PLの場合はカテゴリーの部分一致で判定
-                    if "収益" in category or "収入" in category or "売上" in category:
-                        statement_subtype = "PL収益"
-                    elif "費用" in category or "支出" in category or "原価" in category or "損失" in category:
-                        statement_subtype = "PL費用"
-                    else:
-                        # カテゴリーがなくてもPLならデフォルトでPL費用に分類（収益は上部、費用は下部に表示されることが多い）
-                        statement_subtype = "PL費用"
-                elif file_type == "cf":
-                    category = data.category or ""  # Noneの場合は空文字列を使用
-                    # CFの場合も詳細なカテゴリ分けを行う
-                    if category == "営業活動":
-                        statement_subtype = "CF営業活動"
-                    elif category == "投資活動":
-                        statement_subtype = "CF投資活動"
-                    elif category == "財務活動":
-                        statement_subtype = "CF財務活動"
-                    elif category == "現金及び現金同等物":
-                        statement_subtype = "CF現金同等物"
-                    else:
-                        # カテゴリーがわからない場合はCFのままとする
-                        statement_subtype = "CF"
-                
-                # Check if standard account balance record already exists
-                balance = StandardAccountBalance.query.filter_by(
-                    ja_code=ja_code,
-                    year=int(year),
-                    statement_type=file_type,
-                    standard_account_code=mapping.standard_account_code
-                ).first()
-                
-                if balance:
-                    # Update existing record
-                    balance.current_value = data.current_value
-                    balance.previous_value = data.previous_value
-                else:
-                    # Create new record - 引数渡しではなく属性設定で作成
-                    new_balance = StandardAccountBalance()
-                    new_balance.ja_code = ja_code
-                    new_balance.year = int(year)
-                    new_balance.statement_type = file_type
-                    new_balance.statement_subtype = statement_subtype
-                    new_balance.standard_account_code = mapping.standard_account_code
-                    new_balance.standard_account_name = mapping.standard_account_name
-                    new_balance.current_value = data.current_value
-                    new_balance.previous_value = data.previous_value
-                    db.session.add(new_balance)
-                
-                processed_count += 1
+            # マッピング済みデータを結合して一括で残高を作成（作成する科目の既存残高は置き換える）
+            built = build_balances(ja_code, int(year), file_type)
+            processed_count = built['created']
             
-            db.session.commit()
+            # 値が変わった科目に依存する合計科目・指標のみ再計算
+            changes = BalanceChangeSet()
+            for code in built['changed_codes']:
+                changes.add(ja_code, year, file_type, code)
+            changes.propagate()
             flash(f'{processed_count}件のデータが標準勘定科目に変換されました。', 'success')
             
             return redirect(url_for('data_management', file_type=file_type))
@@ -2709,6 +2532,7 @@ def register_routes(app):
             
             # データベースに保存
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'標準勘定科目「{name}（コード:{code}）」を更新しました。', 'success')
             
@@ -2800,6 +2624,7 @@ def register_routes(app):
             # データベースに保存
             db.session.add(new_standard_account)
             db.session.commit()
+            invalidate_account_hierarchy()
             
             flash(f'標準勘定科目「{name}（コード:{code}）」を追加しました。', 'success')
             
@@ -3011,45 +2836,46 @@ def register_routes(app):
                 session['selected_ja_code'] = ja_code
                 session['selected_year'] = int(year)
                 
-                # すでに存在する分析結果を削除
-                from models import AnalysisResult
-                deleted = AnalysisResult.query.filter_by(ja_code=ja_code, year=int(year)).delete()
-                db.session.commit()
-                logger.debug(f"既存の分析結果を削除: {deleted}件")
+                # 分析結果は一括で書き込み、既存の結果は書き込み時に同じトランザクションで置き換える
+                writer = AnalysisResultWriter(ja_code, int(year))
+                
+                # 残高を一度だけ読み込み、各カテゴリの計算で共有する
+                snapshot = BalanceSnapshot.load(ja_code, int(year))
                 
                 # 各カテゴリを個別に計算して例外を処理
                 try:
-                    FinancialIndicators.calculate_liquidity_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_liquidity_indicators(ja_code, int(year), snapshot, writer)
                     logger.debug("流動性指標計算完了")
                 except Exception as e:
                     logger.warning(f"流動性指標計算エラー: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_profitability_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_profitability_indicators(ja_code, int(year), snapshot, writer)
                     logger.debug("収益性指標計算完了")
                 except Exception as e:
                     logger.warning(f"収益性指標計算エラー: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_safety_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_safety_indicators(ja_code, int(year), snapshot, writer)
                     logger.debug("安全性指標計算完了")
                 except Exception as e:
                     logger.warning(f"安全性指標計算エラー: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_efficiency_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_efficiency_indicators(ja_code, int(year), snapshot, writer)
                     logger.debug("効率性指標計算完了")
                 except Exception as e:
                     logger.warning(f"効率性指標計算エラー: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_cash_flow_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_cash_flow_indicators(ja_code, int(year), snapshot, writer)
                     logger.debug("キャッシュフロー指標計算完了")
                 except Exception as e:
                     logger.warning(f"キャッシュフロー指標計算エラー: {str(e)}")
                 
-                # コミット
-                db.session.commit()
+                # 一括書き込み（コミットを含む）
+                stats = writer.write()
+                logger.debug(f"分析結果の書き込み: {stats}")
                 
                 flash('財務指標の計算が完了しました。', 'success')
                 return redirect(url_for('analysis', type='profitability'))
@@ -3082,51 +2908,53 @@ def register_routes(app):
             logger.info(f"財務指標再計算API: JA={ja_code}, year={year}")
             
             try:
-                # 既存の分析結果を削除
-                deleted = AnalysisResult.query.filter_by(ja_code=ja_code, year=int(year)).delete()
-                logger.info(f"既存の分析結果を削除: {deleted}件")
-                db.session.commit()
+                # 分析結果は一括で書き込み、変更のあった指標のみ既存の結果を置き換える
+                writer = AnalysisResultWriter(ja_code, int(year), diff=True)
+                
+                # 残高を一度だけ読み込み、各カテゴリの計算で共有する
+                snapshot = BalanceSnapshot.load(ja_code, int(year))
                 
                 # 各カテゴリの指標を個別に計算（エラーがあっても処理を続行）
                 errors = []
                 
                 try:
-                    FinancialIndicators.calculate_liquidity_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_liquidity_indicators(ja_code, int(year), snapshot, writer)
                     logger.info("流動性指標計算完了")
                 except Exception as e:
                     logger.warning(f"流動性指標計算エラー: {str(e)}")
                     errors.append(f"流動性指標: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_profitability_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_profitability_indicators(ja_code, int(year), snapshot, writer)
                     logger.info("収益性指標計算完了")
                 except Exception as e:
                     logger.warning(f"収益性指標計算エラー: {str(e)}")
                     errors.append(f"収益性指標: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_safety_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_safety_indicators(ja_code, int(year), snapshot, writer)
                     logger.info("安全性指標計算完了")
                 except Exception as e:
                     logger.warning(f"安全性指標計算エラー: {str(e)}")
                     errors.append(f"安全性指標: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_efficiency_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_efficiency_indicators(ja_code, int(year), snapshot, writer)
                     logger.info("効率性指標計算完了")
                 except Exception as e:
                     logger.warning(f"効率性指標計算エラー: {str(e)}")
                     errors.append(f"効率性指標: {str(e)}")
                 
                 try:
-                    FinancialIndicators.calculate_cash_flow_indicators(ja_code, int(year))
+                    FinancialIndicators.calculate_cash_flow_indicators(ja_code, int(year), snapshot, writer)
                     logger.info("キャッシュフロー指標計算完了")
                 except Exception as e:
                     logger.warning(f"キャッシュフロー指標計算エラー: {str(e)}")
                     errors.append(f"キャッシュフロー指標: {str(e)}")
                 
-                # 変更をコミット
-                db.session.commit()
+                # 一括書き込み（コミットを含む）
+                stats = writer.write()
+                logger.info(f"分析結果の書き込み: {stats}")
                 
                 # エラーが発生した場合も、一部の指標の計算は成功した可能性がある
                 if errors:
@@ -3241,6 +3069,7 @@ def register_routes(app):
         )
     
     @app.route('/api/indicator_data')
+    @cached_query(timeout=300, unless=lambda response: response.get_json().get('status') != 'success')  # 5分間キャッシュ
     def indicator_data():
         """API endpoint for indicator data (for charts)"""
         try:
@@ -0,0 +1,485 @@
+"""
+財務諸表ファイル（CSV/Excel）の解析
+データベースに依存しないため、一括取込ではプロセスプールのワーカーからも使用する
+"""
+
+import io
+import os
+import logging
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from encoding_detector import read_csv_bytes, EncodingDetectionError
+from utils import normalize_string_series
+
+logger = logging.getLogger(__name__)
+
+# 取込対象外とする勘定科目名（合計行・見出し行）
+SKIPPED_ACCOUNT_NAMES = ["合計", "total", "小計", "subtotal"]
+
+# Excelを読み込む際に一度に処理する行数
+EXCEL_CHUNK_ROWS = 5000
+
+# シート名 → 財務諸表タイプ（BS・PL・CFを1つのブックにまとめたファイル用）
+SHEET_KEYWORDS = (
+    ('bs', ('bs', '貸借対照表', 'balance')),
+    ('pl', ('pl', '損益計算書', 'profit')),
+    ('cf', ('cf', 'キャッシュ', 'cash')),
+)
+
+
+class StatementParseError(ValueError):
+    """ファイルを財務諸表として解析できない場合のエラー"""
+
+
+def detect_columns(columns):
+    """
+    見出しから勘定科目名・当期・前期の列を判定する
+
+    Args:
+        columns: 列名のリスト
+
+    Returns:
+        tuple: (account_col, current_col, previous_col)
+
+    Raises:
+        StatementParseError: 勘定科目名の列を判定できない場合
+    """
+    # Identify potential account name column
+    account_col = None
+    category_col = None
+
+    # First, identify category column if it exists
+    for col in columns:
+        if "区分" in col or "category" in col.lower():
+            category_col = col
+            break
+
+    # Then identify account name column, avoiding category column
+    for col in columns:
+        if col == category_col:
+            continue  # Skip category column
+        if "科目名" in col or "account_name" in col.lower() or "勘定科目" in col:
+            account_col = col
+            break
+        elif "科目" in col or "account" in col.lower() or "item" in col.lower():
+            account_col = col
+            break
+
+    if account_col is None and len(columns) > 0:
+        # If no specific account column found, use first non-category column
+        for col in columns:
+            if col != category_col:
+                account_col = col
+                break
+
+    if account_col is None:
+        raise StatementParseError("Could not identify account name column")
+
+    # Identify value columns
+    current_col = None
+    previous_col = None
+
+    for col in columns:
+        if "当年" in col or "current" in col.lower() or "this" in col.lower() or "令和5年度" in col:
+            current_col = col
+        elif "前年" in col or "previous" in col.lower() or "last" in col.lower() or "令和4年度" in col:
+            previous_col = col
+
+    # If specific columns weren't found, try to use position
+    if current_col is None:
+        if len(columns) > 3:  # 4列以上ある場合（BS・PLデータタイプ）
+            current_col = columns[3]  # 北海道BSのフォーマットに合わせて修正（4列目）
+        elif len(columns) > 1:  # 2列以上ある場合（CFデータタイプ）
+            current_col = columns[1]  # CFフォーマットでは2列目が当期の値
+
+    if previous_col is None:
+        if len(columns) > 2:  # 3列以上ある場合
+            previous_col = columns[2]  # 北海道BSのフォーマットに合わせて修正（3列目）
+        elif len(columns) > 1:  # 2列以上ある場合
+            # CFでは前期データがない場合もあるため、とりあえず同じ列を使用
+            previous_col = current_col
+
+    logger.info(f"Selected columns - Account: {account_col}, Current: {current_col}, Previous: {previous_col}")
+    return account_col, current_col, previous_col
+
+
+def rows_from_frame(df, columns, file_type):
+    """
+    DataFrame（ファイル全体またはExcelの一部の行）からCSVDataの行を作成する
+
+    Args:
+        df: 読み込んだデータ（欠損値は0で埋めたもの）
+        columns: detect_columns の戻り値
+        file_type: Type of financial statement (bs, pl, cf)
+
+    Returns:
+        list: 行の辞書（row_number, account_name, category, current_value, previous_value）のリスト
+    """
+    account_col, current_col, previous_col = columns
+
+    # 勘定科目名（空の行・合計行は除外）
+    account_names = df[account_col].astype(str).str.strip()
+    keep = (account_names != '') & ~account_names.str.lower().isin(SKIPPED_ACCOUNT_NAMES)
+    df = df[keep]
+    account_names = account_names[keep]
+
+    # 北海道BSのフォーマットでは区分が別の列にある場合がある
+    category_values = df["区分"].astype(str).str.strip() if "区分" in df.columns else None
+    categories = infer_categories(account_names, category_values, file_type)
+
+    # 金額（カンマ・△記号を処理して数値に変換）
+    if current_col is not None:
+        current_values = clean_numeric(df[current_col], current_col)
+    else:
+        current_values = pd.Series(0.0, index=df.index)
+    if previous_col is not None:
+        previous_values = clean_numeric(df[previous_col], previous_col)
+    else:
+        previous_values = pd.Series(0.0, index=df.index)
+
+    return [
+        {
+            'row_number': row_number,
+            'account_name': account_name,
+            'category': category,
+            'current_value': current_value,
+            'previous_value': previous_value,
+        }
+        for row_number, account_name, category, current_value, previous_value in zip(
+            df.index.tolist(),
+            normalize_string_series(account_names).tolist(),
+            categories.tolist(),
+            current_values.tolist(),
+            previous_values.tolist()
+        )
+    ]
+
+
+def _clean_frame(df):
+    # Basic data cleaning
+    df = df.replace([np.inf, -np.inf], np.nan)
+    return df.fillna(0)
+
+
+def _excel_header(values):
+    """Excelの見出し行を pd.read_excel と同じ列名にする（空欄は Unnamed: n、重複は .n を付ける）"""
+    header = []
+    seen = {}
+    for position, value in enumerate(values):
+        name = f"Unnamed: {position}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        header.append(name)
+    return header
+
+
+def iter_excel_frames(worksheet, chunk_rows=EXCEL_CHUNK_ROWS):
+    """
+    読み取り専用のワークシートから行を順に読み込み、chunk_rows 行ずつのDataFrameを返す
+
+    1行目を見出しとし、行番号（index）は pd.read_excel と同じく見出しの次の行を0とする。
+    末尾の空行は読み込まない。
+
+    Args:
+        worksheet: openpyxl の読み取り専用ワークシート
+        chunk_rows: 1つのDataFrameの行数
+
+    Yields:
+        tuple: (列名のリスト, DataFrame)
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    first = next(rows, None)
+    if first is None:
+        return
+    header = _excel_header(first)
+    width = len(header)
+
+    chunk = []
+    pending_blank = []
+    start = 0
+    for values in rows:
+        values = (tuple(values) + (None,) * width)[:width]
+        if all(value is None for value in values):
+            # 後に値のある行が続く場合のみ空行として扱う（末尾の空行は除外）
+            pending_blank.append(values)
+            continue
+        if pending_blank:
+            chunk.extend(pending_blank)
+            pending_blank = []
+        chunk.append(values)
+        if len(chunk) >= chunk_rows:
+            yield header, pd.DataFrame(chunk, columns=header, index=range(start, start + len(chunk)))
+            start += len(chunk)
+            chunk = []
+    if chunk or start == 0:
+        yield header, pd.DataFrame(chunk, columns=header, index=range(start, start + len(chunk)))
+
+
+def sheet_file_type(sheet_name):
+    """シート名から財務諸表タイプを判定する（判定できない場合はNone）"""
+    name = sheet_name.lower()
+    for file_type, keywords in SHEET_KEYWORDS:
+        if any(keyword in name for keyword in keywords):
+            return file_type
+    return None
+
+
+def _iter_worksheet_rows(worksheet, file_type, chunk_rows):
+    """ワークシートを chunk_rows 行ずつ解析し、行のリストを順に返す"""
+    columns = None
+    for header, frame in iter_excel_frames(worksheet, chunk_rows):
+        if columns is None:
+            columns = detect_columns(header)
+        yield rows_from_frame(_clean_frame(frame), columns, file_type)
+    if columns is None:
+        raise StatementParseError("Could not identify account name column")
+
+
+def _parse_worksheet(worksheet, file_type, chunk_rows):
+    parsed = []
+    for rows in _iter_worksheet_rows(worksheet, file_type, chunk_rows):
+        parsed.extend(rows)
+    return parsed
+
+
+def _open_workbook(source):
+    """bytes またはファイルオブジェクト（アップロードされたファイル）からブックを読み取り専用で開く"""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    return load_workbook(source, read_only=True, data_only=True)
+
+
+def _select_worksheet(workbook, file_type):
+    """file_type に一致する名前のシート、無ければ最初のシート"""
+    for worksheet in workbook.worksheets:
+        if sheet_file_type(worksheet.title) == file_type:
+            return worksheet
+    return workbook.worksheets[0]
+
+
+def parse_workbook(data, file_type=None, chunk_rows=EXCEL_CHUNK_ROWS):
+    """
+    Excelブック（.xlsx）を読み取り専用モードで1行ずつ読み込んで解析する
+
+    ブック全体をメモリに展開せず、chunk_rows 行ずつ数値変換・区分判定を行う。
+    BS・PL・CFを1つのブックにまとめたファイルは、シート名から財務諸表タイプを判定する。
+
+    Args:
+        data: ファイルの内容（bytes またはファイルオブジェクト）
+        file_type: 財務諸表タイプ（指定した場合は一致するシート、無ければ最初のシートを読み込む）
+        chunk_rows: 一度に処理する行数
+
+    Returns:
+        dict: {file_type: 行のリスト}
+
+    Raises:
+        StatementParseError: 解析できない場合
+    """
+    workbook = _open_workbook(data)
+    try:
+        if file_type is not None:
+            worksheet = _select_worksheet(workbook, file_type)
+            return {file_type: _parse_worksheet(worksheet, file_type, chunk_rows)}
+
+        typed = {}
+        for worksheet in workbook.worksheets:
+            sheet_type = sheet_file_type(worksheet.title)
+            if sheet_type:
+                typed.setdefault(sheet_type, worksheet)
+        if not typed:
+            raise StatementParseError("シート名から財務諸表タイプを判定できません")
+        return {
+            sheet_type: _parse_worksheet(worksheet, sheet_type, chunk_rows)
+            for sheet_type, worksheet in typed.items()
+        }
+    finally:
+        workbook.close()
+
+
+def iter_statement_rows(source, filename, file_type, chunk_rows=EXCEL_CHUNK_ROWS):
+    """
+    財務諸表ファイルを解析し、CSVDataの行を chunk_rows 行程度ずつ返す
+
+    .xlsx はアップロードされたファイルから直接読み取り専用で読み込むため、
+    ファイル全体や解析済みの全行をメモリに保持しない。CSV・.xls は一度に解析する。
+
+    Args:
+        source: ファイルの内容（bytes またはファイルオブジェクト）
+        filename: ファイル名（拡張子で形式を判定）
+        file_type: Type of financial statement (bs, pl, cf)
+        chunk_rows: 一度に処理する行数（.xlsx のみ）
+
+    Yields:
+        list: 行の辞書のリスト
+
+    Raises:
+        StatementParseError: 解析できない場合
+    """
+    if filename.lower().endswith('.xlsx'):
+        workbook = _open_workbook(source)
+        try:
+            worksheet = _select_worksheet(workbook, file_type)
+            yield from _iter_worksheet_rows(worksheet, file_type, chunk_rows)
+        finally:
+            workbook.close()
+        return
+
+    data = source if isinstance(source, (bytes, bytearray)) else source.read()
+    df = _clean_frame(read_statement_frame(data, filename))
+    yield rows_from_frame(df, detect_columns(list(df.columns)), file_type)
+
+
+def read_statement_frame(data, filename):
+    """
+    CSV・Excel（.xls）ファイルの内容をDataFrameとして読み込む
+
+    Args:
+        data: ファイルの内容（bytes）
+        filename: ファイル名（拡張子で形式を判定）
+
+    Returns:
+        DataFrame: 読み込んだデータ
+    """
+    _, ext = os.path.splitext(filename.lower())
+    if ext == '.csv':
+        # ファイルを1回だけ読み込み、文字コードを判定してから解析する
+        try:
+            df, encoding = read_csv_bytes(data)
+        except EncodingDetectionError as e:
+            logger.warning(f"Failed to detect CSV encoding: {str(e)}")
+            raise StatementParseError(
+                "Could not read CSV file with any supported encoding. Please ensure the file is properly encoded."
+            )
+        logger.info(f"Successfully read CSV with encoding: {encoding}")
+        return df
+    # Excel files (.xls)
+    return pd.read_excel(io.BytesIO(data))
+
+
+def parse_statement(data, filename, file_type):
+    """
+    財務諸表ファイルを解析してCSVDataの行を作成する
+
+    Args:
+        data: ファイルの内容（bytes）
+        filename: ファイル名
+        file_type: Type of financial statement (bs, pl, cf)
+
+    Returns:
+        list: 行の辞書（row_number, account_name, category, current_value, previous_value）のリスト
+
+    Raises:
+        StatementParseError: 解析できない場合
+    """
+    parsed = []
+    for rows in iter_statement_rows(data, filename, file_type):
+        parsed.extend(rows)
+    return parsed
+
+
+def parse_statement_file(data, filename, file_type=None):
+    """
+    財務諸表ファイルを解析する（一括取込用）
+
+    file_type を指定しない場合は、Excelブックのシート名から財務諸表タイプを判定する。
+
+    Returns:
+        dict: {file_type: 行のリスト}
+    """
+    if file_type is None:
+        if not filename.lower().endswith('.xlsx'):
+            raise StatementParseError("ファイル名から財務諸表タイプを判定できません")
+        return parse_workbook(data)
+    return {file_type: parse_statement(data, filename, file_type)}
+
+
+def infer_categories(account_names, category_values, file_type):
+    """
+    区分列（無い場合は勘定科目名）から区分を推測する
+
+    Args:
+        account_names: 勘定科目名のSeries
+        category_values: 区分列の値のSeries（区分列が無い場合はNone）
+        file_type: Type of financial statement (bs, pl, cf)
+
+    Returns:
+        numpy.ndarray: 区分の配列（推測できない場合はNone）
+    """
+    def contains(series, *keywords):
+        matched = np.zeros(len(series), dtype=bool)
+        for keyword in keywords:
+            matched |= series.str.contains(keyword, regex=False).to_numpy()
+        return matched
+
+    categories = np.full(len(account_names), None, dtype=object)
+    if category_values is not None:
+        categories = np.select(
+            [
+                contains(category_values, "資産"),
+                contains(category_values, "負債"),
+                contains(category_values, "純資産", "資本"),
+                contains(category_values, "収益", "収入"),
+                contains(category_values, "費用", "支出"),
+            ],
+            ["資産の部", "負債の部", "純資産の部", "収益の部", "費用の部"],
+            default=None
+        )
+
+    # 区分列から検出できなかった場合は勘定科目名から推測
+    by_name = np.select(
+        [
+            contains(account_names, "資産"),
+            contains(account_names, "負債"),
+            contains(account_names, "純資産", "資本"),
+            contains(account_names, "収益", "収入"),
+            contains(account_names, "費用", "支出"),
+            contains(account_names, "営業活動", "営業キャッシュ"),
+            contains(account_names, "投資活動"),
+            contains(account_names, "財務活動"),
+        ],
+        ["資産の部", "負債の部", "純資産の部", "収益の部", "費用の部", "営業活動CF", "投資活動CF", "財務活動CF"],
+        default=None
+    )
+    categories = np.where(pd.isna(categories), by_name, categories)
+
+    # file_typeがcfの場合、デフォルトでCF区分を設定
+    if file_type == "cf":
+        by_cf_name = np.select(
+            [
+                contains(account_names, "営業"),
+                contains(account_names, "投資"),
+                contains(account_names, "財務"),
+            ],
+            ["営業活動CF", "投資活動CF", "財務活動CF"],
+            default="営業活動CF"
+        )
+        categories = np.where(pd.isna(categories), by_cf_name, categories)
+    return categories
+
+def clean_numeric(values, column_name):
+    """
+    金額の列を数値に変換する（カンマ・空白を除去し、△をマイナスとして扱う）
+    変換できない値は0とし、まとめて警告を出力する
+
+    Args:
+        values: 金額のSeries
+        column_name: 列名（ログ用）
+
+    Returns:
+        Series: float型のSeries
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float).fillna(0.0)
+
+    # 全角数字はNFKCで半角にしてから変換する
+    text = values.astype(str).str.normalize('NFKC').str.replace(',', '', regex=False).str.strip().str.replace('△', '-', regex=False)
+    numbers = pd.to_numeric(text, errors='coerce')
+    invalid = numbers.isna() & (text != '') & (text.str.lower() != 'nan')
+    if invalid.any():
+        samples = ', '.join(text[invalid].head(5))
+        logger.warning(f"Could not convert {int(invalid.sum())} values in column {column_name} (e.g. {samples}); using 0")
+    return numbers.fillna(0.0)
@@ -0,0 +1,168 @@
+/**
+ * バックグラウンドジョブの投入と進捗表示
+ *
+ * - data-job-type 属性を持つフォームは、送信時にフォームの値をパラメータとして /api/jobs にジョブを投入する
+ * - data-job-upload 属性を持つフォーム（ファイルのアップロード）は、送信先に format=job を付けて送信する
+ * いずれもページを遷移せずに /api/jobs/<id> をポーリングして進捗を表示し、完了後にページを再読み込みする。
+ */
+const BackgroundJobs = (function() {
+    'use strict';
+
+    // 進捗を確認する間隔（ミリ秒）
+    const POLL_INTERVAL = 1500;
+
+    const STATUS_LABELS = {
+        queued: '待機中',
+        running: '実行中',
+        succeeded: '完了',
+        failed: '失敗',
+        cancelled: '取消'
+    };
+
+    function parseJob(response) {
+        return response.json().then(function(data) {
+            if (!response.ok && response.status !== 202) {
+                throw new Error(data.message || 'ジョブの処理に失敗しました');
+            }
+            return data;
+        });
+    }
+
+    function submit(jobType, params) {
+        return fetch('/api/jobs', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({job_type: jobType, params: params || {}})
+        }).then(parseJob);
+    }
+
+    function get(jobId) {
+        return fetch('/api/jobs/' + jobId, {cache: 'no-store'}).then(parseJob);
+    }
+
+    function cancel(jobId) {
+        return fetch('/api/jobs/' + jobId + '/cancel', {method: 'POST'}).then(parseJob);
+    }
+
+    // ジョブが終了するまでポーリングし、終了時のジョブを返す
+    function poll(jobId, onProgress) {
+        return new Promise(function(resolve, reject) {
+            function check() {
+                get(jobId).then(function(job) {
+                    if (onProgress) {
+                        onProgress(job);
+                    }
+                    if (job.status === 'queued' || job.status === 'running') {
+                        setTimeout(check, POLL_INTERVAL);
+                    } else {
+                        resolve(job);
+                    }
+                }).catch(reject);
+            }
+            check();
+        });
+    }
+
+    function run(jobType, params, onProgress) {
+        return submit(jobType, params).then(function(job) {
+            return poll(job.id, onProgress);
+        });
+    }
+
+    // フォームの下に進捗バーと取消ボタンを表示する
+    function createProgressPanel(form) {
+        let panel = form.querySelector('.background-job-progress');
+        if (!panel) {
+            panel = document.createElement('div');
+            panel.className = 'background-job-progress mt-2';
+            panel.innerHTML =
+                '<div class="progress" style="height: 20px;">' +
+                '  <div class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" style="width: 100%;"></div>' +
+                '</div>' +
+                '<div class="d-flex justify-content-between align-items-center mt-1">' +
+                '  <small class="background-job-message text-muted"></small>' +
+                '  <button type="button" class="btn btn-sm btn-outline-secondary background-job-cancel">取消</button>' +
+                '</div>';
+            form.appendChild(panel);
+        }
+        panel.style.display = '';
+        return {
+            panel: panel,
+            bar: panel.querySelector('.progress-bar'),
+            message: panel.querySelector('.background-job-message'),
+            cancelButton: panel.querySelector('.background-job-cancel')
+        };
+    }
+
+    function showProgress(view, job) {
+        const percent = job.progress ? job.progress.percent : null;
+        view.bar.style.width = (percent === null ? 100 : percent) + '%';
+        view.bar.textContent = percent === null ? '' : percent + '%';
+        const label = STATUS_LABELS[job.status] || job.status;
+        view.message.textContent = label + (job.message ? '：' + job.message : '');
+    }
+
+    function showResult(view, job) {
+        view.bar.classList.remove('progress-bar-animated', 'progress-bar-striped');
+        view.cancelButton.style.display = 'none';
+        if (job.status === 'succeeded') {
+            view.bar.classList.add('bg-success');
+            view.message.textContent = '完了しました。画面を更新します…';
+            setTimeout(function() { window.location.reload(); }, 1000);
+        } else if (job.status === 'cancelled') {
+            view.bar.classList.add('bg-secondary');
+            view.message.textContent = '取り消しました';
+        } else {
+            view.bar.classList.add('bg-danger');
+            view.message.textContent = 'エラー：' + (job.error || job.message || '処理に失敗しました');
+        }
+    }
+
+    function startJob(form) {
+        if (form.dataset.jobUpload !== undefined) {
+            const action = form.getAttribute('action');
+            const url = action + (action.indexOf('?') >= 0 ? '&' : '?') + 'format=job';
+            return fetch(url, {method: 'POST', body: new FormData(form)}).then(parseJob);
+        }
+        const params = {};
+        new FormData(form).forEach(function(value, key) {
+            params[key] = value;
+        });
+        return submit(form.dataset.jobType, params);
+    }
+
+    function bindForm(form) {
+        form.addEventListener('submit', function(event) {
+            event.preventDefault();
+            const buttons = form.querySelectorAll('button[type="submit"]');
+            buttons.forEach(function(button) { button.disabled = true; });
+            const view = createProgressPanel(form);
+            view.bar.className = 'progress-bar progress-bar-striped progress-bar-animated';
+            view.cancelButton.style.display = '';
+            view.message.textContent = 'ジョブを投入しています…';
+
+            startJob(form).then(function(job) {
+                view.cancelButton.onclick = function() {
+                    view.cancelButton.disabled = true;
+                    cancel(job.id).catch(function(error) { console.error('ジョブの取消エラー:', error); });
+                };
+                return poll(job.id, function(current) { showProgress(view, current); });
+            }).then(function(job) {
+                showResult(view, job);
+                if (job.status !== 'succeeded') {
+                    buttons.forEach(function(button) { button.disabled = false; });
+                }
+            }).catch(function(error) {
+                console.error('バックグラウンドジョブのエラー:', error);
+                showResult(view, {status: 'failed', error: error.message});
+                buttons.forEach(function(button) { button.disabled = false; });
+            });
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function() {
+        document.querySelectorAll('form[data-job-type], form[data-job-upload]').forEach(bindForm);
+    });
+
+    return {submit: submit, get: get, cancel: cancel, poll: poll, run: run};
+})();
@@ -0,0 +1,188 @@
+"""
+一括AIマッピング（AIAccountMapper._map_accounts_with_llm）のテスト
+OpenAIクライアントの代わりに応答を固定したクライアントを使用し、リクエスト回数・個別の再問い合わせ・
+文字列類似度へのフォールバック・キャッシュの利用を確認する
+"""
+
+import re
+import json
+import threading
+from types import SimpleNamespace
+import pytest
+import llm_dispatcher
+import llm_mapping_cache
+from ai_account_mapper import AIAccountMapper
+from llm_dispatcher import LLMDispatcher
+from models import StandardAccount, CSVData, AccountMapping, LLMMappingCache
+
+STANDARD_ACCOUNTS = [("11110", "現金"), ("11200", "預金"), ("11300", "有価証券")]
+
+# 一括リクエストの応答（勘定科目名 → 応答の1件。None の場合は応答に含めない）
+BATCH_ANSWERS = {
+    "手許現金": {"standard_account_code": "11110", "confidence": 0.95, "rationale": "現金"},
+    "当座預金": {"standard_account_code": "11200", "confidence": 0.9, "rationale": "預金"},
+    # 一覧に無いコードは不正な応答として個別に問い合わせる
+    "国債": {"standard_account_code": "99999", "confidence": 0.9, "rationale": "不正"},
+    "謎の科目": None,
+}
+
+# 個別リクエストの応答（None の場合は不正な応答）
+SINGLE_ANSWERS = {
+    "国債": {"standard_account_code": "11300", "confidence": 0.85, "rationale": "有価証券"},
+    "謎の科目": None,
+}
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class FakeClient:
+    """chat.completions.create の応答を固定したOpenAIクライアント"""
+
+    def __init__(self, rate_limited=0):
+        self.batch_calls = []
+        self.single_calls = []
+        self.rate_limited = rate_limited
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @property
+    def calls(self):
+        return len(self.batch_calls) + len(self.single_calls)
+
+    def create(self, model, messages, **kwargs):
+        user_prompt = messages[1]["content"]
+        match = re.search(r"Original account name: (.*)", user_prompt)
+        with self._lock:
+            if match:
+                name = match.group(1).strip()
+                self.single_calls.append(name)
+                answer = SINGLE_ANSWERS[name]
+                return self._response(answer if answer is not None else {"confidence": "高い"})
+
+            items = json.loads(user_prompt)
+            self.batch_calls.append([item["account_name"] for item in items])
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise RateLimited("rate limited")
+        mappings = [
+            dict(BATCH_ANSWERS[item["account_name"]], index=item["index"])
+            for item in items if BATCH_ANSWERS[item["account_name"]] is not None
+        ]
+        return self._response({"mappings": mappings})
+
+    @staticmethod
+    def _response(content):
+        message = SimpleNamespace(content=json.dumps(content, ensure_ascii=False))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.fixture
+def mapper(database, monkeypatch):
+    monkeypatch.setattr(llm_dispatcher, "backoff_delay", lambda attempt, error=None: 0)
+    llm_mapping_cache._memory.clear()
+    for position, (code, name) in enumerate(STANDARD_ACCOUNTS):
+        database.session.add(StandardAccount(
+            code=code, name=name, category="資産", financial_statement="bs",
+            account_type="資産", display_order=position
+        ))
+    database.session.commit()
+
+    mapper = AIAccountMapper()
+    mapper.client = FakeClient(rate_limited=1)
+    mapper.model = "fake-model"
+    mapper.dispatcher = LLMDispatcher(concurrency=2, requests_per_minute=60000, max_retries=2)
+
+    # 文字列類似度の結果は固定し、呼び出された勘定科目名を記録する
+    mapper.similarity_calls = []
+
+    def similarity(account_name, financial_statement):
+        mapper.similarity_calls.append(account_name)
+        return {"standard_account_code": "UNKNOWN", "standard_account_name": "Unknown",
+                "confidence": 0.0, "rationale": "一致なし"}
+
+    monkeypatch.setattr(mapper, "string_similarity_mapping", similarity)
+    yield mapper
+    llm_mapping_cache._memory.clear()
+
+
+def _add_accounts(db, ja_code, names):
+    accounts = [
+        CSVData(ja_code=ja_code, year=2023, file_type="bs", row_number=row_number, account_name=name,
+                category="資産", current_value=100.0, previous_value=0.0, is_mapped=False)
+        for row_number, name in enumerate(names, start=1)
+    ]
+    db.session.add_all(accounts)
+    db.session.commit()
+    return accounts
+
+
+def _mappings(ja_code):
+    return {
+        mapping.original_account_name: mapping.standard_account_code
+        for mapping in AccountMapping.query.filter_by(ja_code=ja_code, financial_statement="bs")
+    }
+
+
+def test_batch_mapping_with_retries_and_fallback(database, mapper):
+    accounts = _add_accounts(database, "JA001", list(BATCH_ANSWERS))
+
+    handled = mapper._map_accounts_with_llm("JA001", "bs", accounts, confidence_threshold=0.7, batch_size=2)
+
+    client = mapper.client
+    # 2件ずつ2回（レート制限による1回のリトライを含めて3回）と、不正・欠落した2件の個別問い合わせ
+    assert len(client.batch_calls) == 3
+    assert sorted(client.single_calls) == sorted(["国債", "謎の科目"])
+    # 個別問い合わせでも得られなかった勘定科目のみ文字列類似度でマッピングする
+    assert mapper.similarity_calls == ["謎の科目"]
+
+    by_name = {account.account_name: handled[account.id] for account in accounts}
+    assert by_name == {"手許現金": True, "当座預金": True, "国債": True, "謎の科目": False}
+    assert _mappings("JA001") == {"手許現金": "11110", "当座預金": "11200", "国債": "11300"}
+    mapped = {account.account_name for account in CSVData.query.filter_by(ja_code="JA001", is_mapped=True)}
+    assert mapped == {"手許現金", "当座預金", "国債"}
+
+    # APIで得た結果のみキャッシュに保存する（文字列類似度の結果は保存しない）
+    cached = {row.normalized_name for row in LLMMappingCache.query.all()}
+    assert cached == {"手許現金", "当座預金", "国債"}
+
+
+def test_batch_mapping_uses_cache_on_second_run(database, mapper):
+    names = ["手許現金", "当座預金", "国債"]
+    mapper.client.rate_limited = 0
+    first = _add_accounts(database, "JA001", names)
+    mapper._map_accounts_with_llm("JA001", "bs", first, confidence_threshold=0.7, batch_size=2)
+    calls = mapper.client.calls
+    assert calls == 3
+
+    # 別のJAの同じ勘定科目名は問い合わせずにキャッシュの結果でマッピングする（メモリを破棄してテーブルから参照する）
+    llm_mapping_cache._memory.clear()
+    second = _add_accounts(database, "JA002", names)
+    handled = mapper._map_accounts_with_llm("JA002", "bs", second, confidence_threshold=0.7, batch_size=2)
+
+    assert mapper.client.calls == calls
+    assert all(handled[account.id] for account in second)
+    assert _mappings("JA002") == {"手許現金": "11110", "当座預金": "11200", "国債": "11300"}
+    assert sum(row.hit_count for row in LLMMappingCache.query.all()) == 3
+
+    # 3回目はプロセス内のメモリから参照する
+    memory_hits = llm_mapping_cache.cache_stats()["memory_hits"]
+    assert mapper.map_accounts(names, "bs") == mapper.map_accounts(names, "bs")
+    assert mapper.client.calls == calls
+    assert llm_mapping_cache.cache_stats()["memory_hits"] == memory_hits + 6
+
+
+def test_batch_mapping_skips_names_with_existing_mapping(database, mapper):
+    database.session.add(AccountMapping(
+        ja_code="JA001", original_account_name="手許現金", standard_account_code="11110",
+        standard_account_name="現金", financial_statement="bs", confidence=1.0
+    ))
+    database.session.commit()
+    accounts = _add_accounts(database, "JA001", ["手許現金", "当座預金"])
+    mapper.client.rate_limited = 0
+
+    handled = mapper._map_accounts_with_llm("JA001", "bs", accounts, confidence_threshold=0.7)
+
+    assert mapper.client.batch_calls == [["当座預金"]]
+    assert list(handled) == [accounts[1].id]
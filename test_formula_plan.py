@@ -0,0 +1,192 @@
+"""
+計算式の評価プラン（formula_plan.FormulaPlan）のテスト
+依存関係順の並び替え・循環参照の検出と、従来の優先度順の評価との結果の一致を確認する
+"""
+
+import copy
+import json
+import pytest
+from models import AccountFormula
+from formula_plan import FormulaPlan, FormulaCycleError
+
+
+def _formula(formula_id, target_code, components, formula_type="sum", priority=0):
+    return AccountFormula(
+        id=formula_id, target_code=target_code, target_name=f"科目{target_code}", financial_statement="bs",
+        formula_type=formula_type, components=json.dumps(components), operator="+", priority=priority
+    )
+
+
+def _evaluate_by_priority(formulas, balances):
+    """
+    従来の AccountCalculator.calculate_account_totals と同じ評価（優先度の高い順に1回ずつ評価する）
+    合計は構成科目の全レコード、差分は各構成科目の最初のレコードを使用し、結果は結果科目の最初のレコードに書き込む
+    """
+    for formula in sorted(formulas, key=lambda f: (-(f.priority or 0), f.id)):
+        codes = formula.component_codes
+        if formula.formula_type == "sum":
+            records = [record for code in codes for record in balances.get(code, ())]
+            values = [
+                sum(record[0] for record in records if record[0] is not None),
+                sum(record[1] for record in records if record[1] is not None),
+            ]
+        elif formula.formula_type == "diff":
+            first = balances.get(codes[0]) if len(codes) >= 2 else None
+            values = [0, 0]
+            if first:
+                values = [first[0][0] or 0, first[0][1] or 0]
+                for code in codes[1:]:
+                    if balances.get(code):
+                        for position in (0, 1):
+                            if balances[code][0][position] is not None:
+                                values[position] -= balances[code][0][position]
+        else:
+            continue
+        records = balances.setdefault(formula.target_code, [])
+        if records:
+            records[0][:] = values
+        else:
+            records.append(values)
+    return balances
+
+
+# 構成科目の残高（同じ科目のレコードが複数ある場合や、値が無い場合を含む）
+BALANCES = {
+    "1000": [[100.0, 90.0]],
+    "1100": [[50.0, None], [25.0, 5.0]],
+    "2000": [[300.0, 280.0]],
+    "3000": [[400.0, 350.0]],
+    "3100": [[None, 20.0]],
+    "5000": [[60.0, 60.0]],
+    "5200": [[45.0, 30.0]],
+}
+
+# 優先度が依存関係と矛盾しない計算式（従来の評価でも正しい結果になる）
+CONSISTENT_FORMULAS = [
+    _formula(1, "2900", ["1000", "1100", "2000"], priority=30),
+    _formula(2, "4900", ["3000", "3100"], priority=30),
+    _formula(3, "5900", ["5000", "5200"], priority=30),
+    _formula(4, "5950", ["4900", "5900"], priority=20),
+    _formula(5, "5990", ["2900", "5950"], formula_type="diff", priority=10),
+    _formula(6, "9000", ["1000", "9999"], formula_type="diff", priority=10),
+    _formula(7, "9100", [], priority=10),
+]
+
+
+def test_plan_orders_components_before_totals():
+    # initialize_account_formulas と同じく、合計の合計（5950, 5951）の優先度が構成する合計より高い
+    formulas = [
+        _formula(1, "2900", ["1000", "1100", "2000"], priority=10),
+        _formula(2, "4900", ["3000", "3100"], priority=10),
+        _formula(3, "5900", ["5000", "5200"], priority=10),
+        _formula(4, "5950", ["4900", "5900"], priority=20),
+        _formula(5, "5951", ["2900"], priority=30),
+    ]
+
+    plan = FormulaPlan.compile("bs", formulas)
+
+    order = plan.target_codes
+    assert len(order) == 5
+    for target_code, component_codes in (("5950", ["4900", "5900"]), ("5951", ["2900"])):
+        for code in component_codes:
+            assert order.index(code) < order.index(target_code)
+    # 依存関係の無い計算式同士は優先度の高い順・id順のまま
+    assert order == ["2900", "5951", "4900", "5900", "5950"]
+
+
+def test_plan_keeps_priority_order_without_dependencies():
+    formulas = [
+        _formula(3, "A", ["x"], priority=0),
+        _formula(1, "B", ["y"], priority=5),
+        _formula(2, "C", ["z"], priority=5),
+    ]
+
+    assert FormulaPlan.compile("bs", formulas).target_codes == ["B", "C", "A"]
+
+
+def test_plan_matches_priority_order_evaluation():
+    expected = _evaluate_by_priority(CONSISTENT_FORMULAS, copy.deepcopy(BALANCES))
+
+    balances = copy.deepcopy(BALANCES)
+    results = FormulaPlan.compile("bs", CONSISTENT_FORMULAS).evaluate(balances)
+
+    assert balances == expected
+    assert {formula.target_code: (current, previous) for formula, current, previous in results} == {
+        code: tuple(expected[code][0]) for code in ("2900", "4900", "5900", "5950", "5990", "9000", "9100")
+    }
+    assert expected["5950"] == [[505.0, 460.0]]
+    assert expected["5990"] == [[-30.0, -85.0]]
+
+
+def test_plan_matches_repeated_priority_order_evaluation_when_priorities_are_inverted():
+    # 合計の合計を先に評価する優先度の場合、従来の評価は1回目は古い値を使い、繰り返すと正しい値に収束する
+    formulas = [
+        _formula(1, "4900", ["3000", "3100"], priority=10),
+        _formula(2, "5900", ["5000", "5200"], priority=10),
+        _formula(3, "5950", ["4900", "5900"], priority=20),
+    ]
+    stale = _evaluate_by_priority(formulas, copy.deepcopy(BALANCES))
+    converged = _evaluate_by_priority(formulas, copy.deepcopy(stale))
+    assert stale["5950"] != converged["5950"]
+
+    balances = copy.deepcopy(BALANCES)
+    FormulaPlan.compile("bs", formulas).evaluate(balances)
+
+    assert balances == converged
+    assert balances["5950"] == [[505.0, 460.0]]
+
+
+def test_plan_uses_last_formula_for_duplicate_targets():
+    formulas = [
+        _formula(1, "2900", ["1000"], priority=10),
+        _formula(2, "2900", ["1000", "2000"], priority=10),
+        _formula(3, "2950", ["2900"], priority=0),
+    ]
+    expected = _evaluate_by_priority(formulas, copy.deepcopy(BALANCES))
+
+    plan = FormulaPlan.compile("bs", formulas)
+    balances = copy.deepcopy(BALANCES)
+    plan.evaluate(balances)
+
+    assert [formula.id for formula in plan.formulas] == [2, 3]
+    assert balances == expected
+
+
+def test_plan_skips_unsupported_formula_types():
+    formulas = [
+        _formula(1, "2900", ["1000", "2000"]),
+        _formula(2, "2910", ["1000", "2000"], formula_type="ratio"),
+    ]
+
+    assert FormulaPlan.compile("bs", formulas).target_codes == ["2900"]
+
+
+def test_plan_rejects_cycles():
+    formulas = [
+        _formula(1, "A", ["B", "x"]),
+        _formula(2, "B", ["A"]),
+        _formula(3, "C", ["A"]),
+        _formula(4, "D", ["x"]),
+    ]
+
+    with pytest.raises(FormulaCycleError) as error:
+        FormulaPlan.compile("bs", formulas)
+
+    assert error.value.financial_statement == "bs"
+    # 循環する計算式と、その結果を使用する計算式が評価できない
+    assert error.value.codes == ["A", "B", "C"]
+
+
+def test_plan_rejects_self_reference():
+    with pytest.raises(FormulaCycleError) as error:
+        FormulaPlan.compile("bs", [_formula(1, "A", ["A", "x"])])
+
+    assert error.value.codes == ["A"]
+
+
+def test_downstream_keeps_only_affected_formulas_in_order():
+    plan = FormulaPlan.compile("bs", CONSISTENT_FORMULAS)
+
+    assert plan.downstream(["3100"]).target_codes == ["4900", "5950", "5990"]
+    assert plan.downstream(["1000"]).target_codes == ["2900", "5990", "9000"]
+    assert not plan.downstream(["7777"])
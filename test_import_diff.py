@@ -0,0 +1,182 @@
+"""
+再取込時の差分計算（import_diff.diff_rows）と差分の反映（DataProcessor.merge_rows）のテスト
+"""
+
+import json
+from models import CSVData, AccountMapping, AccountFormula, StandardAccountBalance
+from import_diff import diff_rows
+from data_processor import DataProcessor
+from balance_generation import rebuild_balances
+from account_calculator import AccountCalculator
+
+JA_CODE = "JA001"
+YEAR = 2023
+
+
+def _row(row_number, account_name, current_value, previous_value=0.0, category="資産", row_id=None):
+    row = {
+        'row_number': row_number,
+        'account_name': account_name,
+        'category': category,
+        'current_value': current_value,
+        'previous_value': previous_value,
+    }
+    if row_id is not None:
+        row['id'] = row_id
+    return row
+
+
+def test_diff_rows_unchanged():
+    existing = [_row(1, "現金", 100.0, row_id=1), _row(2, "預金", 200.0, row_id=2)]
+    parsed = [_row(1, "現金", 100.0), _row(2, "預金", 200.0)]
+
+    diff = diff_rows(existing, parsed)
+
+    assert diff == {'inserted': [], 'updated': [], 'deleted': [], 'unchanged': 2, 'changed_accounts': []}
+
+
+def test_diff_rows_changed_added_removed():
+    existing = [_row(1, "現金", 100.0, row_id=1), _row(2, "預金", 200.0, row_id=2), _row(3, "貸付金", 300.0, row_id=3)]
+    parsed = [_row(1, "現金", 150.0), _row(2, "預金", 200.0), _row(3, "有価証券", 50.0)]
+
+    diff = diff_rows(existing, parsed)
+
+    assert diff['updated'] == [{'id': 1, 'current_value': 150.0}]
+    assert diff['inserted'] == [_row(3, "有価証券", 50.0)]
+    assert diff['deleted'] == [3]
+    assert diff['unchanged'] == 1
+    assert diff['changed_accounts'] == sorted(["現金", "貸付金", "有価証券"])
+
+
+def test_diff_rows_row_number_only_is_not_a_changed_account():
+    # 先頭に行が挿入され、後続の行の行番号だけがずれた場合
+    existing = [_row(1, "現金", 100.0, row_id=1), _row(2, "預金", 200.0, row_id=2)]
+    parsed = [_row(1, "小口現金", 5.0), _row(2, "現金", 100.0), _row(3, "預金", 200.0)]
+
+    diff = diff_rows(existing, parsed)
+
+    assert sorted(diff['updated'], key=lambda row: row['id']) == [
+        {'id': 1, 'row_number': 2},
+        {'id': 2, 'row_number': 3},
+    ]
+    assert diff['inserted'] == [_row(1, "小口現金", 5.0)]
+    assert diff['changed_accounts'] == ["小口現金"]
+
+
+def test_diff_rows_duplicate_names_match_by_occurrence():
+    # 同じ勘定科目名の行は行番号順に n 番目同士を突き合わせる
+    existing = [
+        _row(1, "その他", 10.0, row_id=1),
+        _row(2, "現金", 100.0, row_id=2),
+        _row(3, "その他", 20.0, row_id=3),
+        _row(4, "その他", 30.0, row_id=4),
+    ]
+    parsed = [
+        _row(1, "その他", 10.0),
+        _row(2, "現金", 100.0),
+        _row(3, "その他", 25.0),
+    ]
+
+    diff = diff_rows(existing, parsed)
+
+    # 2番目の「その他」は値が変わり、3番目の「その他」は削除される
+    assert diff['updated'] == [{'id': 3, 'current_value': 25.0}]
+    assert diff['deleted'] == [4]
+    assert diff['inserted'] == []
+    assert diff['unchanged'] == 2
+    assert diff['changed_accounts'] == ["その他"]
+
+
+def test_diff_rows_duplicate_names_added_occurrence():
+    existing = [_row(1, "その他", 10.0, row_id=1)]
+    parsed = [_row(1, "その他", 10.0), _row(2, "その他", 15.0)]
+
+    diff = diff_rows(existing, parsed)
+
+    assert diff['inserted'] == [_row(2, "その他", 15.0)]
+    assert diff['updated'] == []
+    assert diff['unchanged'] == 1
+
+
+def test_diff_rows_normalizes_existing_names():
+    # 過去の取込で登録された全角英数字の勘定科目名も、正規化済みの解析結果と突き合わせる
+    existing = [_row(1, "ＡＢＣ預金", 100.0, row_id=1)]
+    parsed = [_row(1, "ABC預金", 100.0)]
+
+    diff = diff_rows(existing, parsed)
+
+    assert diff['unchanged'] == 1
+    assert diff['inserted'] == [] and diff['deleted'] == []
+
+
+def _seed_mapped_statement(db):
+    """CSVデータを取り込み、マッピング・残高・合計科目を作成する"""
+    DataProcessor.merge_rows(JA_CODE, YEAR, "bs", [
+        _row(1, "現金", 100.0, 90.0),
+        _row(2, "預金", 200.0, 180.0),
+        _row(3, "その他", 10.0),
+        _row(4, "その他", 20.0),
+    ])
+    for name, code in (("現金", "11110"), ("預金", "11200"), ("その他", "11300")):
+        db.session.add(AccountMapping(
+            ja_code=JA_CODE, original_account_name=name, standard_account_code=code,
+            standard_account_name=f"科目{code}", financial_statement="bs", confidence=1.0
+        ))
+    CSVData.query.update({CSVData.is_mapped: True})
+    db.session.add(AccountFormula(
+        target_code="11000", target_name="現金預金", financial_statement="bs", formula_type="sum",
+        components=json.dumps(["11110", "11200"]), operator="+"
+    ))
+    db.session.commit()
+
+    rebuild_balances(JA_CODE, YEAR, "bs", force=True)
+    AccountCalculator.calculate_account_totals(JA_CODE, YEAR, "bs", raise_errors=True)
+
+
+def _balances():
+    return {
+        balance.standard_account_code: balance.current_value
+        for balance in StandardAccountBalance.query.filter_by(ja_code=JA_CODE, year=YEAR, statement_type="bs")
+    }
+
+
+def test_merge_rows_updates_balances_and_totals(database):
+    _seed_mapped_statement(database)
+    assert _balances() == {"11110": 100.0, "11200": 200.0, "11300": 30.0, "11000": 300.0}
+    cash_id = CSVData.query.filter_by(account_name="現金").one().id
+
+    result = DataProcessor.merge_rows(JA_CODE, YEAR, "bs", [
+        _row(1, "現金", 150.0, 90.0),
+        _row(2, "預金", 200.0, 180.0),
+        _row(3, "その他", 10.0),
+        _row(4, "その他", 25.0),
+    ])
+
+    assert result == {
+        'inserted': 0, 'updated': 2, 'deleted': 0, 'unchanged': 2,
+        'changed_accounts': sorted(["現金", "その他"]),
+    }
+    # 変更された行はマッピング状態を維持したまま更新される
+    cash = CSVData.query.filter_by(account_name="現金").one()
+    assert cash.id == cash_id
+    assert cash.is_mapped
+    assert cash.current_value == 150.0
+    # 残高と、それに依存する合計科目がコミット後に再計算される
+    assert _balances() == {"11110": 150.0, "11200": 200.0, "11300": 35.0, "11000": 350.0}
+
+
+def test_merge_rows_removed_row_updates_balances(database):
+    _seed_mapped_statement(database)
+
+    result = DataProcessor.merge_rows(JA_CODE, YEAR, "bs", [
+        _row(1, "現金", 100.0, 90.0),
+        _row(2, "その他", 10.0),
+    ])
+
+    assert result['deleted'] == 2
+    assert result['updated'] == 1
+    assert result['changed_accounts'] == sorted(["預金", "その他"])
+    balances = _balances()
+    assert "11200" not in balances
+    assert balances["11300"] == 10.0
+    assert balances["11000"] == 100.0
@@ -0,0 +1,106 @@
+"""
+一括指標計算エンジン（indicator_engine）と FinancialIndicators（JA・年度ごとの計算）の結果が一致することのテスト
+"""
+
+import json
+from models import StandardAccount, StandardAccountBalance, AnalysisResult
+from analysis_result_writer import AnalysisResultWriter
+from financial_indicators import FinancialIndicators
+from indicator_engine import calculate_indicators_batch
+
+JA_CODES = ["JA001", "JA002"]
+YEARS = [2023, 2024]
+
+# (財務諸表タイプ, コード, 親コード)
+ACCOUNTS = [
+    ("bs", "10000", None), ("bs", "11000", "10000"), ("bs", "11110", "11000"), ("bs", "11200", "11000"),
+    ("bs", "11300", "10000"), ("bs", "1130", "10000"), ("bs", "20000", None), ("bs", "21000", "20000"),
+    ("bs", "3000", "21000"), ("bs", "3100", "21000"), ("bs", "30000", None), ("bs", "31000", "30000"),
+    ("bs", "5900", None), ("pl", "40000", None), ("pl", "60000", None), ("pl", "80000", None),
+    ("pl", "90000", None), ("cf", "110000", None), ("cf", "12000", None),
+]
+
+# JAごとの残高（コード → 値）。JA002は一部の科目が無く、親科目は子科目の合計になる
+BALANCES = {
+    "JA001": {
+        "bs": {"10000": 5000.0, "11000": 1200.0, "11110": 300.0, "11200": 900.0, "11300": 250.0, "1130": 80.0,
+               "20000": 4500.0, "21000": 800.0, "30000": 500.0, "31000": 420.0, "5900": 500.0},
+        "pl": {"40000": 320.0, "60000": 40.0, "80000": 25.0, "90000": 18.0},
+        "cf": {"110000": 60.0, "12000": -35.0},
+    },
+    "JA002": {
+        "bs": {"11110": 150.0, "11200": 350.0, "3000": 400.0, "3100": 120.0, "31000": 90.0},
+        "pl": {"40000": 75.0},
+        "cf": {},
+    },
+}
+
+
+def _seed(db):
+    for position, (statement_type, code, parent_code) in enumerate(ACCOUNTS):
+        db.session.add(StandardAccount(
+            code=code, name=f"科目{code}", category="テスト", financial_statement=statement_type,
+            account_type="テスト", display_order=position, parent_code=parent_code
+        ))
+    for ja_code in JA_CODES:
+        for year in YEARS:
+            for statement_type, values in BALANCES[ja_code].items():
+                for code, value in values.items():
+                    db.session.add(StandardAccountBalance(
+                        ja_code=ja_code, year=year, statement_type=statement_type, statement_subtype="テスト",
+                        standard_account_code=code, standard_account_name=f"科目{code}",
+                        current_value=value * (1 + (year - 2023) / 10), previous_value=0
+                    ))
+    db.session.commit()
+
+
+def _stored_rows():
+    """保存された分析結果を {キー: 行} として読み込む（accounts_used は解析したJSON）"""
+    rows = {}
+    for result in AnalysisResult.query.all():
+        row = {column: getattr(result, column) for column in AnalysisResultWriter.COLUMNS}
+        row['accounts_used'] = json.loads(row['accounts_used'])
+        rows[tuple(row[column] for column in AnalysisResultWriter.COLUMNS[:AnalysisResultWriter.KEY_SIZE])] = row
+    return rows
+
+
+def _write_scalar():
+    for ja_code in JA_CODES:
+        for year in YEARS:
+            writer = AnalysisResultWriter(ja_code, year, diff=True)
+            FinancialIndicators.calculate_all_indicators(ja_code, year, writer)
+            writer.write()
+
+
+def _write_engine():
+    writer = AnalysisResultWriter(diff=True)
+    for ja_code in JA_CODES:
+        for year in YEARS:
+            writer.add_scope(ja_code, year)
+    writer.extend(calculate_indicators_batch(JA_CODES, YEARS))
+    return writer.write()
+
+
+def test_engine_rows_match_scalar_rows(database):
+    _seed(database)
+
+    _write_scalar()
+    scalar = _stored_rows()
+    assert scalar
+
+    # 同じ残高から一括計算した行は全て既存の行と同じ内容になり、書き換えられない
+    stats = _write_engine()
+    assert stats == {'inserted': 0, 'deleted': 0, 'unchanged': len(scalar)}
+    assert _stored_rows() == scalar
+
+
+def test_alternating_paths_do_not_rewrite_rows(database):
+    _seed(database)
+
+    stats = _write_engine()
+    assert stats['inserted'] > 0
+    engine_rows = _stored_rows()
+
+    _write_scalar()
+    assert _stored_rows() == engine_rows
+    assert _write_engine() == {'inserted': 0, 'deleted': 0, 'unchanged': len(engine_rows)}
@@ -0,0 +1,142 @@
+"""
+LLMへのリクエストの送信レート制限（TokenBucket）とリトライ（backoff_delay, is_retryable, LLMDispatcher.call）のテスト
+"""
+
+import random
+from types import SimpleNamespace
+import pytest
+from openai import APITimeoutError
+import llm_dispatcher
+from llm_dispatcher import TokenBucket, LLMDispatcher, backoff_delay, is_retryable
+
+
+class FakeClock:
+    """time.monotonic と time.sleep の代わり（sleep した分だけ時刻を進める）"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StatusError(Exception):
+    """HTTPステータス付きのAPIエラー（openai.APIStatusError の代わり）"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_dispatcher, "time", clock)
+    return clock
+
+
+def test_token_bucket_allows_burst_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        bucket.acquire()
+
+    assert clock.sleeps == []
+
+
+def test_token_bucket_waits_for_refill(clock):
+    bucket = TokenBucket(rate=2, capacity=1)
+
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    # 待っている間に補充されたトークンは容量を超えない
+    clock.now += 10
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5), pytest.approx(0.5)]
+
+
+def test_token_bucket_capacity_defaults_to_rate_and_at_least_one():
+    assert TokenBucket(rate=5).capacity == 5
+    assert TokenBucket(rate=0.1).capacity == 1
+
+
+def test_backoff_delay_is_bounded_by_exponential_cap():
+    random.seed(0)
+    for attempt in range(8):
+        for _ in range(20):
+            delay = backoff_delay(attempt, base=1.0, maximum=30.0)
+            assert 0 <= delay <= min(30.0, 2 ** attempt)
+
+
+def test_backoff_delay_uses_full_jitter(monkeypatch):
+    monkeypatch.setattr(llm_dispatcher.random, "uniform", lambda low, high: high)
+
+    assert [backoff_delay(attempt, base=1.0, maximum=30.0) for attempt in range(6)] == [1, 2, 4, 8, 16, 30]
+
+
+def test_backoff_delay_respects_retry_after(monkeypatch):
+    monkeypatch.setattr(llm_dispatcher.random, "uniform", lambda low, high: low)
+
+    assert backoff_delay(0, StatusError(429, {"retry-after": "7"})) == 7
+    # Retry-After も上限を超えない
+    assert backoff_delay(0, StatusError(429, {"retry-after": "600"})) == llm_dispatcher.BACKOFF_MAX
+    # 解析できない Retry-After は無視する
+    assert backoff_delay(0, StatusError(429, {"retry-after": "soon"})) == 0
+
+
+def test_is_retryable():
+    assert is_retryable(TimeoutError())
+    assert is_retryable(APITimeoutError(request=None))
+    for status_code in (408, 409, 429, 500, 502, 503, 504):
+        assert is_retryable(StatusError(status_code))
+    for status_code in (400, 401, 403, 404, 422):
+        assert not is_retryable(StatusError(status_code))
+    assert not is_retryable(ValueError("不正な応答"))
+
+
+def test_dispatcher_call_retries_transient_errors(clock, monkeypatch):
+    monkeypatch.setattr(llm_dispatcher, "backoff_delay", lambda attempt, error=None: 0.25)
+    dispatcher = LLMDispatcher(concurrency=1, requests_per_minute=6000, max_retries=3)
+    errors = [StatusError(429), StatusError(503)]
+
+    def request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert dispatcher.call(request) == "ok"
+    assert clock.sleeps.count(0.25) == 2
+
+
+def test_dispatcher_call_gives_up(clock, monkeypatch):
+    monkeypatch.setattr(llm_dispatcher, "backoff_delay", lambda attempt, error=None: 0)
+    dispatcher = LLMDispatcher(concurrency=1, requests_per_minute=6000, max_retries=2)
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise StatusError(429)
+
+    with pytest.raises(StatusError):
+        dispatcher.call(rate_limited)
+    assert len(calls) == 3
+
+    # リトライで解消しないエラーはすぐに送出する
+    calls.clear()
+
+    def bad_request():
+        calls.append(1)
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        dispatcher.call(bad_request)
+    assert len(calls) == 1
@@ -0,0 +1,213 @@
+"""
+既存のデータベースに追加された列と、検索用の複合インデックス・一意インデックスを追加するスクリプト
+db.create_all() は既存のテーブルに列やインデックスを追加しないため、起動時とこのスクリプトから実行する
+"""
+import logging
+from sqlalchemy import func, text, bindparam
+from app import app, db
+from models import (CSVData, StandardAccount, StandardAccountBalance, AccountMapping, AnalysisResult,
+                    MappingKnowledge, refresh_mapping_knowledge)
+from utils import normalize_account_name
+
+logger = logging.getLogger(__name__)
+
+# インデックスを管理するモデル
+INDEXED_MODELS = (CSVData, StandardAccount, StandardAccountBalance, AccountMapping, AnalysisResult)
+
+# 他のテーブルから再計算できるため、起動時にも重複行（最新以外）を削除して一意インデックスを作成するモデル
+DERIVED_MODELS = (AnalysisResult,)
+
+# normalized_name 列のもとになる列（モデル → (勘定科目名の列, 財務諸表タイプの列)）
+NORMALIZED_NAME_SOURCES = {
+    CSVData: ('account_name', 'file_type'),
+    StandardAccount: ('name', 'financial_statement'),
+    AccountMapping: ('original_account_name', 'financial_statement'),
+}
+
+# normalized_name を一度に更新する勘定科目名の数
+BACKFILL_BATCH_SIZE = 1000
+
+
+def count_duplicates(table, columns):
+    """
+    キーが重複している行のうち、最新（idが最大）以外の行数を返す（一意インデックスを作成できない原因）
+
+    Returns:
+        int: 重複している行数
+    """
+    latest_ids = db.select(func.max(table.c.id)).group_by(*[table.c[column] for column in columns])
+    return db.session.execute(
+        db.select(func.count()).select_from(table).where(table.c.id.not_in(latest_ids))
+    ).scalar()
+
+
+def remove_duplicates(table, columns):
+    """
+    一意インデックスを作成できるよう、キーが重複する行のうち最新（idが最大）以外を削除する
+
+    Returns:
+        int: 削除した行数
+    """
+    latest_ids = db.select(func.max(table.c.id)).group_by(*[table.c[column] for column in columns])
+    deleted = db.session.execute(table.delete().where(table.c.id.not_in(latest_ids))).rowcount
+    db.session.commit()
+    return deleted
+
+
+def ensure_table_columns():
+    """
+    モデルに定義された列のうち、データベースに存在しないものを追加する（何度実行しても安全）
+    追加できるのはNULLを許可する列のみ（既存の行の値は backfill_normalized_names などで設定する）
+
+    Returns:
+        list: 追加した列名（テーブル名.列名）のリスト
+    """
+    added = []
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for model in INDEXED_MODELS:
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning(f"NOT NULLの列は追加できません: {table.name}.{column.name}")
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            logger.info(f"列を追加しています: {table.name}.{column.name}")
+            with db.engine.begin() as connection:
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}"
+                ))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def backfill_normalized_names():
+    """
+    normalized_name が未設定の行に正規化した勘定科目名を設定する（列の追加後や、SQLを直接実行して追加された行）
+
+    Returns:
+        int: 正規化した勘定科目名の数（テーブルごとの勘定科目名と財務諸表タイプの組み合わせ）
+    """
+    backfilled = 0
+    for model, (name_column, type_column) in NORMALIZED_NAME_SOURCES.items():
+        table = model.__table__
+        names = table.c[name_column]
+        types = table.c[type_column]
+        with db.engine.begin() as connection:
+            pairs = connection.execute(
+                db.select(names, types).where(table.c.normalized_name.is_(None)).distinct()
+            ).all()
+            if not pairs:
+                continue
+            statement = table.update().where(
+                names == bindparam('source_name'),
+                types == bindparam('source_type'),
+                table.c.normalized_name.is_(None)
+            ).values(normalized_name=bindparam('new_normalized_name'))
+            params = [
+                {'source_name': name, 'source_type': file_type,
+                 'new_normalized_name': normalize_account_name(name, file_type)}
+                for name, file_type in pairs
+            ]
+            for start in range(0, len(params), BACKFILL_BATCH_SIZE):
+                connection.execute(statement, params[start:start + BACKFILL_BATCH_SIZE])
+            if model is AccountMapping:
+                refresh_mapping_knowledge(
+                    connection, {(param['source_type'], param['new_normalized_name']) for param in params}
+                )
+        logger.info(f"{table.name}: 正規化した勘定科目名を{len(pairs)}件設定しました")
+        backfilled += len(pairs)
+    return backfilled
+
+
+def ensure_mapping_knowledge():
+    """
+    ナレッジベース（mapping_knowledge）が空で、マッピングがある場合に全件を集計する（テーブルの追加後）
+
+    Returns:
+        int: 集計した (正規化名, 標準勘定科目) の数
+    """
+    with db.engine.begin() as connection:
+        if connection.execute(db.select(MappingKnowledge.__table__.c.id).limit(1)).first() is not None:
+            return 0
+        if connection.execute(db.select(AccountMapping.__table__.c.id).limit(1)).first() is None:
+            return 0
+        refresh_mapping_knowledge(connection)
+        built = connection.execute(db.select(func.count()).select_from(MappingKnowledge.__table__)).scalar()
+    logger.info(f"ナレッジベースを集計しました: {built}件")
+    return built
+
+
+def ensure_table_indexes(remove_duplicate_rows=False):
+    """
+    モデルに定義されたインデックスのうち、データベースに存在しないものを作成する（何度実行しても安全）
+    一意インデックスのキーが重複している場合、remove_duplicate_rows=False（起動時）では行を削除せず、
+    インデックスの作成を見送ってログに記録する。重複行の削除はこのスクリプトを実行した場合と、
+    再計算できる派生テーブル（DERIVED_MODELS）の場合のみ行う。
+
+    Args:
+        remove_duplicate_rows: 一意インデックスの作成前に重複行（最新以外）を削除するか
+
+    Returns:
+        list: 作成したインデックス名のリスト
+    """
+    created = []
+    inspector = db.inspect(db.engine)
+    for model in INDEXED_MODELS:
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                columns = [column.name for column in index.columns]
+                if remove_duplicate_rows or model in DERIVED_MODELS:
+                    deleted = remove_duplicates(table, columns)
+                    if deleted:
+                        logger.warning(f"{table.name}: 重複行を{deleted}件削除しました（キー: {', '.join(columns)}）")
+                else:
+                    duplicates = count_duplicates(table, columns)
+                    if duplicates:
+                        logger.error(
+                            f"{table.name}: キー（{', '.join(columns)}）が重複する行が{duplicates}件あるため、"
+                            f"インデックス {index.name} を作成しませんでした。"
+                            f"重複を確認のうえ python update_table_indexes.py を実行してください"
+                        )
+                        continue
+            logger.info(f"インデックスを作成しています: {index.name}")
+            try:
+                index.create(bind=db.engine)
+            except Exception:
+                # 複数のプロセスが同時に起動した場合、他のプロセスが先に作成していることがある
+                if index.name in {existing_index['name'] for existing_index in db.inspect(db.engine).get_indexes(table.name)}:
+                    continue
+                raise
+            created.append(index.name)
+    return created
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with app.app_context():
+        try:
+            added_columns = ensure_table_columns()
+            if added_columns:
+                logger.info(f"{len(added_columns)}件の列を追加しました: {', '.join(added_columns)}")
+            backfill_normalized_names()
+            ensure_mapping_knowledge()
+            created_indexes = ensure_table_indexes(remove_duplicate_rows=True)
+            if created_indexes:
+                logger.info(f"{len(created_indexes)}件のインデックスを作成しました: {', '.join(created_indexes)}")
+            else:
+                logger.info("インデックスはすべて作成済みです")
+        except Exception as e:
+            logger.error(f"インデックス作成エラー: {str(e)}")
+            db.session.rollback()
+            raise
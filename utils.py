@@ -44,4 +44,98 @@ def normalize_string(text, for_db=True):
         # 非常に問題のある文字列の場合は、安全なASCII文字列に置き換え
         if for_db:
             return text.encode('ascii', errors='ignore').decode('ascii', errors='ignore')
-        return text
\ No newline at end of file
+        return text
+
+def normalize_string_series(series, for_db=True):
+    """
+    pandasのSeriesの文字列をまとめて正規化する（normalize_string の列単位版）
+    
+    Args:
+        series: 正規化する文字列のSeries
+        for_db: データベース用かどうか（Trueなら制御文字を除去する）
+        
+    Returns:
+        Series: 正規化された文字列のSeries
+    """
+    normalized = series.astype(str).str.normalize('NFKC')
+    if for_db:
+        normalized = normalized.str.replace(r'[\x00-\x1F\x7F-\x9F]', '', regex=True)
+    return normalized
+
+def normalize_account_name(name, file_type='bs'):
+    """
+    勘定科目名を正規化する（空白、全角/半角、カッコなどを処理）
+    
+    Args:
+        name: 勘定科目名
+        file_type: ファイルタイプ (bs, pl, cf)
+        
+    Returns:
+        str: 正規化された勘定科目名
+    """
+    if name is None:
+        return ""
+    
+    # 「うち」で始まる括弧付き科目は特別処理（括弧内の内容を抽出）
+    is_uchi_item = False
+    uchi_content = ""
+    if name.startswith('(うち') or name.startswith('（うち'):
+        uchi_match = re.match(r'[\(（]うち(.*?)[\)）]', name)
+        if uchi_match:
+            uchi_content = uchi_match.group(1)
+            is_uchi_item = True
+    
+    # 全角→半角変換（数字、アルファベット、スペース、記号）
+    name = name.translate(str.maketrans({
+        '０': '0', '１': '1', '２': '2', '３': '3', '４': '4',
+        '５': '5', '６': '6', '７': '7', '８': '8', '９': '9',
+        'ａ': 'a', 'ｂ': 'b', 'ｃ': 'c', 'ｄ': 'd', 'ｅ': 'e',
+        'ｆ': 'f', 'ｇ': 'g', 'ｈ': 'h', 'ｉ': 'i', 'ｊ': 'j',
+        'ｋ': 'k', 'ｌ': 'l', 'ｍ': 'm', 'ｎ': 'n', 'ｏ': 'o',
+        'ｐ': 'p', 'ｑ': 'q', 'ｒ': 'r', 'ｓ': 's', 'ｔ': 't',
+        'ｕ': 'u', 'ｖ': 'v', 'ｗ': 'w', 'ｘ': 'x', 'ｙ': 'y',
+        'ｚ': 'z',
+        'Ａ': 'A', 'Ｂ': 'B', 'Ｃ': 'C', 'Ｄ': 'D', 'Ｅ': 'E',
+        'Ｆ': 'F', 'Ｇ': 'G', 'Ｈ': 'H', 'Ｉ': 'I', 'Ｊ': 'J',
+        'Ｋ': 'K', 'Ｌ': 'L', 'Ｍ': 'M', 'Ｎ': 'N', 'Ｏ': 'O',
+        'Ｐ': 'P', 'Ｑ': 'Q', 'Ｒ': 'R', 'Ｓ': 'S', 'Ｔ': 'T',
+        'Ｕ': 'U', 'Ｖ': 'V', 'Ｗ': 'W', 'Ｘ': 'X', 'Ｙ': 'Y',
+        'Ｚ': 'Z',
+        '　': ' ', '（': '(', '）': ')', '＜': '<', '＞': '>',
+        '【': '[', '】': ']', '％': '%', '＆': '&', '＊': '*',
+        '＋': '+', '－': '-', '／': '/', '＝': '=', '：': ':',
+        '；': ';', '，': ',', '．': '.', '＠': '@', '＿': '_',
+        '｜': '|', '～': '~', '＄': '$', '＃': '#', '！': '!'
+    }))
+    
+    # 空白文字の正規化（全ての種類の空白を半角スペースに変換し、連続する空白を1つにまとめる）
+    name = re.sub(r'\s+', ' ', name)
+    
+    # 括弧付き「うち」項目の場合、括弧を削除せずに内容を使用
+    if is_uchi_item and uchi_content:
+        name = uchi_content
+    else:
+        # 括弧と括弧内の内容を削除
+        name = re.sub(r'[\(（].*?[\)）]', '', name)
+    
+    # 先頭と末尾の空白を削除
+    name = name.strip()
+    
+    # 財務諸表タイプ別の特殊処理
+    if file_type == 'bs':
+        # BSの場合「預金」→「貯金」変換
+        name = name.replace('預金', '貯金')
+        name = name.replace('普通預金', '普通貯金')
+    elif file_type == 'pl':
+        # PLの場合の特殊処理
+        # 「収益」と「収入」の統一
+        if '収入' in name and not '収益' in name:
+            name = name.replace('収入', '収益')
+        # 「費用」と「経費」の統一
+        if '経費' in name and not '費用' in name:
+            name = name.replace('経費', '費用')
+        # 「当期首繰越利益剰余金」→「当期首繰越剰余金」に統一
+        if '当期首繰越利益剰余金' in name:
+            name = name.replace('当期首繰越利益剰余金', '当期首繰越剰余金')
+    
+    return name